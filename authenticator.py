@@ -1,18 +1,53 @@
 from crypto import encrypt, decrypt, hmac, generate_key
-from utils import write_file_bytes, read_file_bytes, xor, bytes_list_to_bytes
+from utils import write_file_bytes, write_file_atomic, read_file_bytes, xor, bytes_list_to_bytes
 from challenge import Challenge
 from message import Message
+from metrics import registry, CounterFamily
+from rng import Randomness, get_default
+from persistence import PersistencePolicy, VaultJournal, MaskHistory, GENERATION
+from struct import Struct
+from time import monotonic
+from hmac import compare_digest
+import instrument
 
 PATH_DV_VAULTS = 'dvVaults/'
 PATH_SV_VAULTS = 'svVaults/'
 PATH_DV_KEYS = 'dvKeys/'
 
+# The suffix of the rotation journal of a device vault, and of the rotation history of a server vault
+
+JOURNAL_SUFFIX = '.journal'
+HISTORY_SUFFIX = '.history'
+
 KEY_LENGTH = 32 # In bytes
 TIME_TO_LIVE = 9 # In messages
 
+# The prefix of the data tagged with a session key, so the tags aren't mistaken for other uses of the key
+
+TAG_LABEL = b'tag/'
+
+# The vault writes of the process (the rotations of every authenticator)
+
+VAULT_WRITES = registry.counter('iot_vault_writes_total', 'Vault and rotation history files written.')
+JOURNAL_APPENDS = registry.counter('iot_vault_journal_appends_total', 'Rotations appended to a device vault journal.')
+
+# The versioned header of an exported state (magic, version, flags, device, session and generation)
+
+STATE_MAGIC = b'AUS'
+STATE_VERSION = 1
+STATE_HEADER = Struct('<3sBBIIQ')
+
+# The flags of an exported state
+
+STATE_DEVICE = 1
+STATE_VAULT = 2
+
 class InvalidCommParameters(Exception):
     pass
 
+class VaultOutOfSync(InvalidCommParameters):
+    pass
+
 class Authenticator:
     '''
     A class representing the authenticator, which is responsible of ensuring the authentication of message exchange.
@@ -24,9 +59,17 @@ class Authenticator:
         __sessionId (int): The identifier that identifies the session is being monitored.
         __sessionKey (bytes): The generated session key.
         __sessionData (list): The list of data exchanged during the session.
+        __rng (Randomness): The source of the keys, challenges and nonces.
+        __generation (int): The rotations of the vault since it was provisioned (device only).
+        __persistence (PersistencePolicy): How often the rotated vault is persisted (device only).
+        __journal (VaultJournal): The rotations since the vault was persisted (device only).
+        __unpersisted (int): The rotations since the vault was persisted (device only).
+        __persistedAt (float): The monotonic time the vault was persisted (device only).
+        __history (MaskHistory): The recent rotations of the vault (server only).
+        __writes (CounterFamily): The counter of the vault and history files written.
     '''
 
-    def __init__(self, device_id: int, device: bool, session_id: int = 0):
+    def __init__(self, device_id: int, device: bool, session_id: int = 0, rng: Randomness = None, persistence: PersistencePolicy = None, writes: CounterFamily = None):
         '''
         Initializes the Authenticator Object.
 
@@ -34,23 +77,156 @@ class Authenticator:
             device_id (int): The identifier of the device the authenticator keeps track of.
             device (bool): Checks if the authenticator is from a device or a server.
             session_id (int): The identifier of the session the authenticator keeps track of.
+            rng (Randomness) = None: The source of the keys, challenges and nonces (the default one if not given).
+            persistence (PersistencePolicy) = None: How often a device persists its rotated vault (every 32 rotations or 5 minutes if not given).
+            writes (CounterFamily) = None: The counter of the vault and history files written (the one of the process if not given).
+        '''
+
+        self.__setup(device_id, device, rng, persistence, writes, True)
+
+        # Session attributes
+        self.__sessionId = session_id
+        self.__sessionKey = generate_key(KEY_LENGTH, self.__rng)
+        self.__sessionData = list()
+
+    def __setup(self, device_id: int, device: bool, rng: Randomness, persistence: PersistencePolicy, writes: CounterFamily, read_vault: bool) -> None:
+        '''
+        Sets up the attributes of the vault.
+
+        Args:
+            device_id (int): The identifier of the device the authenticator keeps track of.
+            device (bool): Checks if the authenticator is from a device or a server.
+            rng (Randomness): The source of the keys, challenges and nonces (the default one if None).
+            persistence (PersistencePolicy): How often a device persists its rotated vault (the default one if None).
+            writes (CounterFamily): The counter of the vault and history files written (the one of the process if None).
+            read_vault (bool): If the vault is read from its file.
+
+        Returns:
+            None: The vault attributes are set.
         '''
 
         # Attributes to be kept in memory
 
+        self.__rng = get_default() if rng is None else rng
         self.__deviceId = device_id
         self.__vault = list()
         self.__vaultKey = None
+        self.__generation = 0
+        self.__persistence = None
+        self.__journal = None
+        self.__unpersisted = 0
+        self.__persistedAt = monotonic()
+        self.__history = None
+        self.__writes = VAULT_WRITES if writes is None else writes
 
         if (device):
             self.__vaultKey = read_file_bytes(PATH_DV_KEYS + str(self.__deviceId))
+            self.__persistence = PersistencePolicy() if persistence is None else persistence
+            self.__journal = VaultJournal(PATH_DV_VAULTS + str(self.__deviceId) + JOURNAL_SUFFIX, self.__vaultKey, self.__rng, self.__persistence.is_sync())
 
-        self.__read_vault()
+        else:
+            self.__history = MaskHistory(PATH_SV_VAULTS + str(self.__deviceId) + HISTORY_SUFFIX)
 
-        # Session attributes
-        self.__sessionId = session_id
-        self.__sessionKey = generate_key(KEY_LENGTH)
-        self.__sessionData = list()
+        if read_vault:
+            self.__read_vault()
+
+    def export_state(self, seal_key: bytes, with_vault: bool = True) -> bytes:
+        '''
+        Exports the state of the session, so another process can continue it without a new handshake.
+
+        The identifiers and the generation are in the clear, the session key, the transcript and the vault are
+        sealed under a local key. The authenticator must not be used once its state is imported elsewhere.
+
+        Args:
+            seal_key (bytes): The local key that seals the secrets (KEY_LENGTH bytes).
+            with_vault (bool) = True: If the vault is included (otherwise it is read from its file on import).
+
+        Returns:
+            bytes: The state.
+        '''
+
+        flags = (STATE_DEVICE if self.__vaultKey is not None else 0) | (STATE_VAULT if with_vault else 0)
+
+        header = STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, flags, self.__deviceId, self.__sessionId, self.__generation)
+
+        # The sealed part repeats the header, so the clear one can't be swapped
+
+        secrets = [header, self.__sessionKey, len(self.__sessionData).to_bytes(2, 'little')]
+
+        for data in self.__sessionData:
+
+            secrets.append(len(data).to_bytes(4, 'little') + data)
+
+        if with_vault:
+
+            secrets.append(bytes_list_to_bytes(self.__vault))
+
+        return header + encrypt(b''.join(secrets), seal_key, self.__rng)
+
+    @classmethod
+    def import_state(cls, state: bytes, seal_key: bytes, rng: Randomness = None, persistence: PersistencePolicy = None, writes: CounterFamily = None) -> 'Authenticator':
+        '''
+        Rebuilds an authenticator from an exported state.
+
+        Args:
+            state (bytes): The state.
+            seal_key (bytes): The local key the secrets were sealed under.
+            rng (Randomness) = None: The source of the keys, challenges and nonces (the default one if not given).
+            persistence (PersistencePolicy) = None: How often a device persists its rotated vault (the default one if not given).
+            writes (CounterFamily) = None: The counter of the vault and history files written (the one of the process if not given).
+
+        Returns:
+            Authenticator: The authenticator, in the middle of the same session.
+
+        Raises:
+            ValueError: If the state has an unknown format or version, or its vault file has another generation.
+            InvalidTag: If the state wasn't sealed under the key or was altered.
+        '''
+
+        magic, version, flags, device_id, session_id, generation = STATE_HEADER.unpack_from(state)
+
+        if magic != STATE_MAGIC or version != STATE_VERSION:
+            raise ValueError(f'unsupported authenticator state {magic!r} version {version}')
+
+        secrets = decrypt(state[STATE_HEADER.size:], seal_key)
+
+        if secrets[0:STATE_HEADER.size] != state[0:STATE_HEADER.size]:
+            raise ValueError('the authenticator state header was altered')
+
+        # Build the authenticator without reading the vault unless it wasn't exported
+
+        authenticator = cls.__new__(cls)
+
+        authenticator.__setup(device_id, bool(flags & STATE_DEVICE), rng, persistence, writes, flags & STATE_VAULT == 0)
+
+        authenticator.__sessionId = session_id
+        authenticator.__sessionData = list()
+
+        if authenticator.__generation != generation and flags & STATE_VAULT == 0:
+            raise ValueError(f'the vault of {device_id} is at generation {authenticator.__generation}, not {generation}')
+
+        offset = STATE_HEADER.size
+
+        authenticator.__sessionKey = secrets[offset:offset + KEY_LENGTH]
+        offset += KEY_LENGTH
+
+        count = int.from_bytes(secrets[offset:offset + 2], 'little')
+        offset += 2
+
+        for _ in range(count):
+
+            length = int.from_bytes(secrets[offset:offset + 4], 'little')
+            offset += 4
+
+            authenticator.__sessionData.append(secrets[offset:offset + length])
+            offset += length
+
+        if flags & STATE_VAULT:
+
+            authenticator.__vault = [secrets[i:i + KEY_LENGTH] for i in range(offset, len(secrets), KEY_LENGTH)]
+            authenticator.__generation = generation
+
+        return authenticator
 
     def __read_vault(self) -> None:
         '''
@@ -60,6 +236,8 @@ class Authenticator:
             None -> The values are stored inside the attributes.
         '''
 
+        timer = instrument.timer('auth.vault_read')
+
         # Fetch the keys from the vault file
         
         if self.__vaultKey is None:
@@ -68,22 +246,49 @@ class Authenticator:
 
             vault = read_file_bytes(path)
 
+            timer.lap('file')
+
         else:
 
             path = PATH_DV_VAULTS + str(self.__deviceId)
 
             encrypted = read_file_bytes(path)
 
+            timer.lap('file')
+
             # Decrypt the read vault
 
             vault = decrypt(encrypted, self.__vaultKey)
 
-        # Read the keys from the vault
+            timer.lap('decrypt')
+
+        # Read the keys from the vault, a device vault persisted after rotations ends with its generation
 
         n_keys = len(vault) // KEY_LENGTH
 
+        if len(vault) % KEY_LENGTH == GENERATION.size:
+
+            self.__generation = GENERATION.unpack_from(vault, n_keys * KEY_LENGTH)[0]
+
         self.__vault = [vault[i * KEY_LENGTH: (i + 1) * KEY_LENGTH] for i in range(n_keys)]
 
+        # Replay the rotations journaled after the vault was persisted
+
+        if self.__journal is not None:
+
+            for generation, previous, digest in self.__journal.entries():
+
+                if previous == self.__generation and generation > self.__generation:
+
+                    self.__rotate(digest)
+
+                    self.__generation = generation
+                    self.__unpersisted += 1
+
+            timer.lap('journal')
+
+        timer.stop()
+
     def __write_vault(self) -> None:
         '''
         Writes and stores the current keys in the vault.
@@ -104,6 +309,8 @@ class Authenticator:
 
                 vault += key
 
+            vault += GENERATION.pack(self.__generation)
+
         else:
 
             path = PATH_DV_VAULTS + str(self.__deviceId)
@@ -114,13 +321,34 @@ class Authenticator:
 
                 tmp += key
 
-            # Encrypt the information
+            # Encrypt the information, with the generation it reached
+
+            vault = encrypt(tmp + GENERATION.pack(self.__generation), self.__vaultKey, self.__rng)
+
+        # Write the vault into the desired file, a device replaces it at once as it may crash at any time
+
+        timer = instrument.timer('auth.vault_write')
 
-            vault = encrypt(tmp, self.__vaultKey)
+        if self.__vaultKey is None:
+
+            write_file_bytes(vault, path)
+
+        else:
 
-        # Write the vault into the desired file
+            write_file_atomic(vault, path, self.__persistence.is_sync())
 
-        write_file_bytes(vault, path)
+            # The journaled rotations are in the vault now, the last ones are kept to roll back
+
+            self.__journal.trim(self.__generation)
+
+            self.__unpersisted = 0
+            self.__persistedAt = monotonic()
+
+        timer.stop()
+
+        instrument.count('auth.vault_writes')
+
+        self.__writes.inc()
 
     def __check_device_id(self, device_id: int) -> bool:
         '''
@@ -160,9 +388,13 @@ class Authenticator:
             tuple[bytes, Challenge]: The challenge to be sent and the respective solution.
         '''
         
+        timer = instrument.timer('auth.challenge_generate')
+
         # Generates a challenge
 
-        challenge = Challenge(len(self.__vault), restriction)
+        challenge = Challenge(len(self.__vault), restriction, self.__rng)
+
+        timer.lap('create')
 
         # Solve the challenge and append the t_key (if appliable)
 
@@ -172,6 +404,9 @@ class Authenticator:
 
             solution = xor(solution, self.__sessionKey)
 
+        timer.lap('solve')
+        timer.stop()
+
         # Return the challenge and solution
 
         return (solution, challenge)
@@ -188,6 +423,8 @@ class Authenticator:
             bytes: The solution to the given challenge.
         '''
 
+        timer = instrument.timer('auth.challenge_solve')
+
         # Solve the challenge with the given parameters
         
         solution = challenge.solve(self.__vault)
@@ -196,9 +433,11 @@ class Authenticator:
 
             solution = xor(solution, t_key)
 
+        timer.stop()
+
         return solution
 
-    def handshake(self, t_key: bool, key: bytes = None, answer: bytes = None, challenge: Challenge = None) -> Message:
+    def handshake(self, t_key: bool, key: bytes = None, answer: bytes = None, challenge: Challenge = None, sync: bytes = None) -> Message:
         '''
         Creates an handshake message with the given parameters and current session attributes.
 
@@ -207,6 +446,7 @@ class Authenticator:
             key (bytes) = None: Encryption key.
             answer (bytes) = None: The answer to a challenge.
             challenge (Challenge) = None: A challenge to be solved.
+            sync (bytes) = None: The generation data, after the challenge (see sync_request and sync_response).
 
         Returns:
             Message: The created handshake message.
@@ -234,11 +474,17 @@ class Authenticator:
 
             data += challenge.to_bytes()
 
+        # Append the generation data (if appliable)
+
+        if sync is not None:
+
+            data += sync
+
         # Encrypt the information (if appliable)
 
         if key is not None:
 
-            data = encrypt(data, key)
+            data = encrypt(data, key, self.__rng)
 
         # Check if device is server
 
@@ -280,12 +526,13 @@ class Authenticator:
 
         self.__sessionKey = xor(self.__sessionKey, t_key)
 
-    def encrypt(self, data: bytes) -> Message:
+    def encrypt(self, data: bytes, type: bytes = b'1') -> Message:
         '''
         Encrypts and authenticates a message to be sent.
 
         Args:
             data (bytes): The content of the message to be sent.
+            type (bytes) = b'1': The type of the message (b'1' for a reading, b'2' for a batch of a gateway).
 
         Returns:
             Message: The structured message, ready to be sent.
@@ -297,16 +544,17 @@ class Authenticator:
 
         # Encrypt the data and create the message
 
-        enc = encrypt(data, self.__sessionKey)
+        enc = encrypt(data, self.__sessionKey, self.__rng)
 
-        return Message(self.__deviceId, self.__sessionId, b'1', enc)
+        return Message(self.__deviceId, self.__sessionId, type, enc)
 
-    def decrypt(self, msg: Message) -> bytes:
+    def decrypt(self, msg: Message, type: bytes = b'1') -> bytes:
         '''
         Decrypts and checks the authenticy of a message received.
 
         Args:
             msg (Message): The message received.
+            type (bytes) = b'1': The type the message must have.
 
         Returns:
             bytes: The plain data contained in the message.
@@ -318,7 +566,7 @@ class Authenticator:
 
         # Check message values
 
-        if not (self.__check_device_id(msg.get_deviceId()) and self.__check_session_id(msg.get_sessionId()) and msg.get_type() == b'1'):
+        if not (self.__check_device_id(msg.get_deviceId()) and self.__check_session_id(msg.get_sessionId()) and msg.get_type() == type):
             raise InvalidCommParameters()
 
         # Decrypt the data received from the message
@@ -331,6 +579,33 @@ class Authenticator:
 
         return data
     
+    def sign(self, data: bytes) -> bytes:
+        '''
+        Tags data with the session key, without counting it as a message of the session.
+
+        Args:
+            data (bytes): The data to be tagged.
+
+        Returns:
+            bytes: The tag.
+        '''
+
+        return hmac(TAG_LABEL + data, self.__sessionKey)
+
+    def verify(self, data: bytes, tag: bytes) -> bool:
+        '''
+        Checks if data was tagged with the session key.
+
+        Args:
+            data (bytes): The data.
+            tag (bytes): The tag received with the data.
+
+        Returns:
+            bool: If the tag is the one of the data.
+        '''
+
+        return compare_digest(self.sign(data), tag)
+
     def time_lived(self) -> int:
         '''
         Calculates the time this session has been alive in terms of messages exchanged.
@@ -341,6 +616,207 @@ class Authenticator:
 
         return len(self.__sessionData)
     
+    def __rotate(self, digest: bytes) -> None:
+        '''
+        XORs every key of the vault with a rotation hash.
+
+        Args:
+            digest (bytes): The hash.
+
+        Returns:
+            None: The vault is rotated.
+        '''
+
+        for i, key in enumerate(self.__vault):
+
+            self.__vault[i] = xor(key, digest)
+
+    def get_generation(self) -> int:
+        '''
+        Returns the rotations of the vault since it was provisioned (since it was loaded on the server).
+
+        Returns:
+            int: The generation.
+        '''
+
+        return self.__generation
+
+    def get_session_id(self) -> int:
+        '''
+        Returns the identifier of the current session.
+
+        Returns:
+            int: The session identifier.
+        '''
+
+        return self.__sessionId
+
+    def __resync_key(self, generation: int) -> bytes:
+        '''
+        Derives the key of a resynchronization from the current vault, so only its holder can read it.
+
+        Args:
+            generation (int): The generation the vault is rolled forward to.
+
+        Returns:
+            bytes: The key.
+        '''
+
+        return hmac(b'resync' + GENERATION.pack(generation), bytes_list_to_bytes(self.__vault))
+
+    def sync_request(self) -> bytes:
+        '''
+        Returns the generation data of a device, sent in the first handshake message.
+
+        Returns:
+            bytes: The generation of the vault.
+        '''
+
+        return GENERATION.pack(self.__generation)
+
+    def sync_response(self, request: bytes) -> bytes:
+        '''
+        Answers the generation data of a device, rolling it forward if its vault is behind the one of the server.
+
+        Args:
+            request (bytes): The generation data of the device (empty if the device doesn't send it).
+
+        Returns:
+            bytes: The generation of the server vault, followed by the mask that rolls the device forward encrypted with the device vault (empty if the device is in sync, ahead or didn't ask).
+
+        Raises:
+            VaultOutOfSync: If the device is behind the rotations the server remembers.
+        '''
+
+        if len(request) < GENERATION.size:
+            return bytes()
+
+        generation = GENERATION.unpack_from(request)[0]
+
+        # A device ahead of the server (the server missed the end of a session) rolls itself back from its journal
+
+        if generation >= self.__generation:
+            return GENERATION.pack(self.__generation)
+
+        mask = self.__history.mask(generation, self.__generation)
+
+        if mask is None:
+            raise VaultOutOfSync()
+
+        # Encrypt the mask with the vault the device holds, the server one rolled back
+
+        current = self.__vault
+
+        self.__vault = [xor(key, mask) for key in current]
+
+        key = self.__resync_key(self.__generation)
+
+        self.__vault = current
+
+        instrument.count('auth.resyncs')
+
+        return GENERATION.pack(self.__generation) + encrypt(mask, key, self.__rng)
+
+    def apply_sync(self, response: bytes) -> None:
+        '''
+        Rolls the device vault forward or back to the generation of the server, if they differ.
+
+        Args:
+            response (bytes): The generation data of the server (empty if the server doesn't send it).
+
+        Returns:
+            None: The vault has the generation of the server.
+
+        Raises:
+            VaultOutOfSync: If the device is ahead of the server by rotations its journal no longer holds.
+            InvalidTag: If the mask wasn't encrypted with the vault of the device.
+        '''
+
+        if len(response) < GENERATION.size:
+            return
+
+        generation = GENERATION.unpack_from(response)[0]
+
+        if generation == self.__generation:
+            return
+
+        if generation < self.__generation:
+
+            self.__roll_back(generation)
+
+            return
+
+        mask = decrypt(response[GENERATION.size:], self.__resync_key(generation))
+
+        # The jump is journaled as one rotation
+
+        self.__rotate(mask)
+
+        previous, self.__generation = self.__generation, generation
+        self.__unpersisted += 1
+
+        self.__journal.append(generation, previous, mask)
+
+        JOURNAL_APPENDS.inc()
+
+        instrument.count('auth.resyncs')
+
+    def __roll_back(self, generation: int) -> None:
+        '''
+        Undoes the last rotations of a device vault, the ones a server that missed the end of a session didn't do.
+
+        Args:
+            generation (int): The generation of the server.
+
+        Returns:
+            None: The vault has the generation of the server, and is persisted.
+
+        Raises:
+            VaultOutOfSync: If the journal doesn't hold the rotations down to the generation.
+        '''
+
+        if self.__journal is None:
+            raise VaultOutOfSync()
+
+        vault, current = list(self.__vault), self.__generation
+
+        # Undo the rotations from the last one, following the generations they started from
+
+        for reached, previous, digest in reversed(self.__journal.entries()):
+
+            if current <= generation:
+                break
+
+            if reached == current:
+
+                vault = [xor(key, digest) for key in vault]
+
+                current = previous
+
+        if current != generation:
+            raise VaultOutOfSync()
+
+        self.__vault = vault
+        self.__generation = generation
+
+        # Persisting drops the undone rotations from the journal, so they aren't replayed
+
+        self.__write_vault()
+
+        instrument.count('auth.rollbacks')
+
+    def persist(self) -> None:
+        '''
+        Persists the vault of a device if it has rotations that are only in the journal, before a shutdown.
+
+        Returns:
+            None: The vault file is up to date.
+        '''
+
+        if self.__journal is not None and self.__unpersisted > 0:
+
+            self.__write_vault()
+
     def reset(self) -> None:
         '''
         Resets the authenticator for a new session.
@@ -349,6 +825,8 @@ class Authenticator:
             None: The authenticator gets reset.
         '''
 
+        timer = instrument.timer('auth.rotate')
+
         # Convert the data into a 32 bytes stream
 
         stream = bytes_list_to_bytes(self.__sessionData)
@@ -368,16 +846,44 @@ class Authenticator:
 
         hash = hmac(vault, key)
 
+        timer.lap('hash')
+
         # Update the vault
 
-        for i, key in enumerate(self.__vault):
+        self.__rotate(hash)
 
-            self.__vault[i] = xor(key, hash)
+        self.__generation += 1
 
-        self.__write_vault()
+        timer.lap('update')
+
+        # A device journals the rotation and persists the vault on the cadence of its policy
+
+        if self.__journal is not None:
+
+            self.__journal.append(self.__generation, self.__generation - 1, hash)
+
+            self.__unpersisted += 1
+
+            JOURNAL_APPENDS.inc()
+
+            timer.lap('journal')
+
+        else:
+
+            self.__history.append(self.__generation, hash)
+
+            self.__writes.inc()
+
+        if self.__journal is None or self.__persistence.due(self.__unpersisted, self.__persistedAt):
+
+            self.__write_vault()
+
+            timer.lap('write')
+
+        timer.stop()
 
         # Reset the session
 
         self.__sessionId += 1
-        self.__sessionKey = generate_key(KEY_LENGTH)
+        self.__sessionKey = generate_key(KEY_LENGTH, self.__rng)
         self.__sessionData = list()
\ No newline at end of file
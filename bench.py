@@ -0,0 +1,281 @@
+from setup import provision, PATH_DV_VAULTS, PATH_SV_VAULTS, PATH_DV_KEYS
+from authenticator import Authenticator, KEY_LENGTH
+from handshake import DeviceHandshake
+from challenge import Challenge, CHALLENGE_SIZE
+from config_dv import thermo, assist
+from controller import Controller
+from crypto import encrypt, decrypt, hmac, generate_key, generate_keys
+from utils import xor, bytes_list_to_bytes
+from rng import Randomness
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import argparse, copy, json, os, statistics, sys
+
+# Microbenchmarks of the crypto and protocol hot paths, with a comparison against a saved baseline
+
+# The device of the handshakes, and the one whose vault is rotated on its own
+
+DEVICE_ID = 1
+RESET_DEVICE_ID = 2
+
+# The seed of the inputs, so every run measures the same challenge sizes and payloads
+
+SEED = 0
+
+def handshake() -> None:
+    '''
+    Runs the full handshake between a device and the server in memory, as in authtest.py, drawing the same
+    challenges every time.
+
+    Returns:
+        None: Both sides agree on the session key.
+
+    Raises:
+        AssertionError: If the challenge of the server isn't verified.
+        InvalidCommParameters: If the challenge of the device isn't verified.
+    '''
+
+    rng = Randomness(SEED)
+
+    dv = DeviceHandshake(Authenticator(DEVICE_ID, True, rng = rng))
+
+    m1 = dv.start()
+
+    sv = Authenticator(m1.get_deviceId(), False, m1.get_sessionId(), rng)
+
+    sync = sv.sync_response(m1.get_data())
+
+    key, csv = sv.generate_challenge(False)
+
+    m3 = dv.respond(sv.handshake(False, challenge = csv, sync = sync))
+
+    data = decrypt(m3.get_data(), key)
+
+    solving = Challenge.from_bytes(data[CHALLENGE_SIZE + KEY_LENGTH:])
+
+    assert csv.verify(data[0:CHALLENGE_SIZE])
+
+    t1 = data[CHALLENGE_SIZE:CHALLENGE_SIZE + KEY_LENGTH]
+
+    m4 = sv.handshake(True, sv.solve_challenge(solving, t1), solving.get_chal())
+
+    sv.feed_key(t1)
+
+    dv.finish(m4)
+
+def cases() -> dict:
+    '''
+    Builds the benchmarked calls, with their inputs prepared beforehand.
+
+    Returns:
+        dict: The callable of each benchmark name.
+    '''
+
+    # Fixed inputs, so every run measures the same work (the calls themselves draw from the CSPRNG, as in production)
+
+    rng = Randomness(SEED)
+
+    a, b = generate_key(KEY_LENGTH, rng), generate_key(KEY_LENGTH, rng)
+    vault = generate_keys(128, KEY_LENGTH, rng)
+    vault_bytes = bytes_list_to_bytes(vault)
+    challenge = Challenge(len(vault), rng = rng)
+    challenge_bytes = challenge.to_bytes()
+    payload = rng.bytes(64)
+    ciphertext = encrypt(payload, a)
+    authenticator = Authenticator(RESET_DEVICE_ID, False)
+
+    benchmarks = {
+        'utils.xor': lambda: xor(a, b),
+        'Challenge.solve': lambda: challenge.solve(vault),
+        'Challenge.to_bytes': challenge.to_bytes,
+        'Challenge.from_bytes': lambda: Challenge.from_bytes(challenge_bytes),
+        'crypto.encrypt': lambda: encrypt(payload, a),
+        'crypto.decrypt': lambda: decrypt(ciphertext, a),
+        'crypto.hmac': lambda: hmac(vault_bytes, a),
+        'Authenticator.reset': authenticator.reset,
+        'handshake': handshake
+    }
+
+    # Encoding and decoding of every kind of reading
+
+    compact = Controller(compact=True)
+    compact.create_int_sensor(-120, 120)
+    compact.create_float_sensor(0, 100, 0.01)
+
+    # The shared controllers are copied, so seeding them doesn't change the readings of the rest of the process
+
+    for name, controller in [('thermo', copy.deepcopy(thermo)), ('assist', copy.deepcopy(assist)), ('thermo_compact', compact)]:
+
+        controller.set_rng(rng)
+
+        state, sensors = 0, controller.read_sensors(None)
+        data = controller.read_device_bytes(None)
+
+        if controller.is_compact():
+
+            benchmarks[f'Controller.encode[{name}]'] = lambda controller=controller, state=state, sensors=sensors: controller.information_to_compact(state, sensors)
+
+        else:
+
+            benchmarks[f'Controller.encode[{name}]'] = lambda controller=controller, state=state, sensors=sensors: controller.information_to_bytes(state, sensors)
+
+        benchmarks[f'Controller.decode[{name}]'] = lambda controller=controller, data=data: controller.bytes_to_information(data)
+
+    return benchmarks
+
+def measure(function, repeat: int, target: float) -> dict:
+    '''
+    Times a call, calibrating the number of loops so each repetition takes the target time.
+
+    Args:
+        function (callable): The call.
+        repeat (int): The number of repetitions.
+        target (float): The seconds of each repetition.
+
+    Returns:
+        dict: The 'loops' per repetition and the 'min', 'median' and 'stdev' microseconds per call.
+    '''
+
+    # Warm up and calibrate
+
+    loops = 1
+
+    while True:
+
+        start = perf_counter()
+
+        for _ in range(loops):
+            function()
+
+        elapsed = perf_counter() - start
+
+        if elapsed >= target / 10:
+            break
+
+        loops *= 2
+
+    loops = max(1, int(loops * target / elapsed))
+
+    # Time the repetitions
+
+    samples = []
+
+    for _ in range(repeat):
+
+        start = perf_counter()
+
+        for _ in range(loops):
+            function()
+
+        samples.append((perf_counter() - start) / loops * 1e6)
+
+    return {'loops': loops, 'min': min(samples), 'median': statistics.median(samples), 'stdev': statistics.stdev(samples) if repeat > 1 else 0.0}
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    '''
+    Prints the change of each benchmark against a baseline.
+
+    Args:
+        results (dict): The results of this run.
+        baseline (dict): The results of the baseline.
+        threshold (float): The relative slowdown counted as a regression.
+
+    Returns:
+        bool: If there was any regression.
+    '''
+
+    regressed = False
+
+    for name, result in results.items():
+
+        if name not in baseline:
+
+            print(f'{name:<32} {result["min"]:>12.2f} us   (new)')
+            continue
+
+        # The fastest repetition is the least disturbed by the rest of the machine
+
+        ratio = result['min'] / baseline[name]['min']
+
+        flag = ''
+
+        if ratio > 1 + threshold:
+
+            flag = 'REGRESSION'
+            regressed = True
+
+        elif ratio < 1 - threshold:
+
+            flag = 'improved'
+
+        print(f'{name:<32} {baseline[name]["min"]:>12.2f} us -> {result["min"]:>10.2f} us {ratio:>7.2f}x {flag}')
+
+    return regressed
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Times the crypto and protocol hot paths.')
+    parser.add_argument('--repeat', type=int, default=7, help='the number of repetitions of each benchmark')
+    parser.add_argument('--target', type=float, default=0.2, help='the seconds of each repetition')
+    parser.add_argument('--filter', default='', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='compare the results against this saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='the relative slowdown counted as a regression')
+    args = parser.parse_args()
+
+    baseline = None
+
+    if args.compare is not None:
+
+        with open(args.compare) as file:
+
+            baseline = json.load(file)['results']
+
+    output = None if args.json is None else os.path.abspath(args.json)
+
+    # The authenticators read and rotate the vaults of a scratch device
+
+    with TemporaryDirectory() as path:
+
+        cwd = os.getcwd()
+        os.chdir(path)
+
+        for directory in (PATH_DV_VAULTS, PATH_SV_VAULTS, PATH_DV_KEYS):
+
+            os.makedirs(directory)
+
+        provision(DEVICE_ID, Randomness(SEED))
+        provision(RESET_DEVICE_ID, Randomness(SEED + 1))
+
+        results = dict()
+
+        try:
+
+            for name, function in cases().items():
+
+                if args.filter not in name:
+                    continue
+
+                results[name] = measure(function, args.repeat, args.target)
+
+                if baseline is None:
+
+                    print(f'{name:<32} {results[name]["min"]:>12.2f} us (median {results[name]["median"]:.2f}, stdev {results[name]["stdev"]:.2f}, {results[name]["loops"]} loops)')
+
+        finally:
+
+            os.chdir(cwd)
+
+    if output is not None:
+
+        with open(output, 'w') as file:
+
+            json.dump({'python': sys.version.split()[0], 'repeat': args.repeat, 'results': results}, file, indent=2)
+
+    if baseline is not None and compare(results, baseline, args.threshold):
+
+        sys.exit(1)
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,126 @@
+from config_dv import thermo
+from database import Database
+from authenticator import TIME_TO_LIVE
+from multiprocessing import Process, Queue
+from time import perf_counter
+import resource, random, sys
+
+# Benchmark of the memory and query latency of the columnar database against the list of entries
+
+READINGS = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+DEVICES = 100
+QUERIES = 20
+
+def generate(n_readings: int):
+    '''
+    Generates the readings of the benchmark, with the devices taking turns and sessions of TIME_TO_LIVE readings.
+
+    Args:
+        n_readings (int): The number of readings.
+
+    Returns:
+        generator: The (device_id, session_id, state, sensors, time) of each reading.
+    '''
+
+    # Use a pool of readings, generating them is not what is being measured
+
+    pool = [thermo.bytes_to_information(thermo.read_device_bytes()) for _ in range(1000)]
+
+    for i in range(n_readings):
+
+        state, sensors = pool[i % len(pool)]
+
+        yield (i % DEVICES, (i // DEVICES) // TIME_TO_LIVE, state, sensors, float(i))
+
+def list_store(n_readings: int):
+    '''
+    Builds the store used before the columnar database.
+
+    Returns:
+        tuple: The store and the filtering function.
+    '''
+
+    database = []
+
+    for device_id, session_id, state, sensors, timestamp in generate(n_readings):
+
+        database.append({'device_id': device_id, 'session_id': session_id, 'state': state, 'sensors': list(sensors), 'time': timestamp})
+
+    def select(device_id: int, session_id: int) -> list:
+
+        return [entry for entry in database if (device_id is None or entry['device_id'] == device_id) and (session_id is None or entry['session_id'] == session_id)]
+
+    return database, select
+
+def columnar_store(n_readings: int):
+    '''
+    Builds the columnar database.
+
+    Returns:
+        tuple: The store and the filtering function.
+    '''
+
+    database = Database()
+
+    for device_id in range(DEVICES):
+
+        database.register_device(device_id, thermo)
+
+    for device_id, session_id, state, sensors, timestamp in generate(n_readings):
+
+        database.add(device_id, session_id, state, sensors, timestamp)
+
+    return database, database.select
+
+def run(name: str, build, results: Queue) -> None:
+    '''
+    Measures a store in its own process, so the memory of each store is isolated.
+
+    Returns:
+        None: The results are put in the queue.
+    '''
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = perf_counter()
+
+    store, select = build(READINGS)
+
+    ingest = perf_counter() - start
+
+    memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+
+    # Query random devices and sessions
+
+    last_session = (READINGS // DEVICES) // TIME_TO_LIVE
+
+    latencies = {}
+
+    for label, filters in [('device', lambda: (random.randrange(DEVICES), None)), ('device+session', lambda: (random.randrange(DEVICES), random.randint(0, last_session))), ('session', lambda: (None, random.randint(0, last_session)))]:
+
+        start = perf_counter()
+
+        for _ in range(QUERIES):
+
+            select(*filters())
+
+        latencies[label] = (perf_counter() - start) / QUERIES
+
+    results.put((name, ingest, memory, latencies))
+
+if __name__ == '__main__':
+
+    print(f'{READINGS} readings from {DEVICES} devices')
+
+    results = Queue()
+
+    for name, build in [('list', list_store), ('columnar', columnar_store)]:
+
+        process = Process(target=run, args=(name, build, results))
+        process.start()
+
+        name, ingest, memory, latencies = results.get()
+
+        process.join()
+
+        print(f'{name:<9} ingest {ingest:8.2f} s | memory {memory / READINGS:7.1f} B/reading | ' + ' | '.join(f'{label} {latency * 1e3:9.3f} ms' for label, latency in latencies.items()))
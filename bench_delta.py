@@ -0,0 +1,82 @@
+from config_dv import thermo, assist
+from controller import Controller
+from delta import DeltaCodec
+from crypto import encrypt, generate_key
+from authenticator import KEY_LENGTH, TIME_TO_LIVE
+from time import perf_counter
+import sys
+
+# Benchmark of the bandwidth and CPU of the delta mode against full snapshots
+
+HEADER_SIZE = 13 # Device id, session id, type and length
+
+SESSIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+# The compact version of the thermometer profile
+
+compact = Controller(compact=True)
+compact.create_int_sensor(-120, 120)
+compact.create_float_sensor(0, 100, 0.01)
+
+profiles = {'thermo': thermo, 'assist': assist, 'thermo (compact)': compact}
+
+key = generate_key(KEY_LENGTH)
+
+print(f'{SESSIONS} sessions of {TIME_TO_LIVE} readings per profile')
+print(f'{"profile":<18} {"mode":<6} {"bytes/reading":>14} {"wire/reading":>13} {"codec us/reading":>17}')
+
+for name, controller in profiles.items():
+
+    # Generate the readings of every session beforehand
+
+    sessions = []
+
+    for _ in range(SESSIONS):
+
+        readings = []
+
+        for _ in range(TIME_TO_LIVE):
+
+            controller.change_state()
+            readings.append(controller.read_device_bytes())
+
+        sessions.append(readings)
+
+    n_readings = SESSIONS * TIME_TO_LIVE
+
+    # Full snapshots are sent as they are
+
+    payload = sum(len(reading) for readings in sessions for reading in readings)
+    wire = sum(HEADER_SIZE + len(encrypt(reading, key)) for readings in sessions for reading in readings)
+
+    print(f'{name:<18} {"full":<6} {payload / n_readings:>14.2f} {wire / n_readings:>13.2f} {0:>17.2f}')
+
+    # Delta frames are encoded and decoded, starting each session with a keyframe
+
+    encoder = DeltaCodec()
+    decoder = DeltaCodec()
+
+    frames = []
+
+    start = perf_counter()
+
+    for readings in sessions:
+
+        encoder.reset()
+        decoder.reset()
+
+        for reading in readings:
+
+            frame = encoder.encode(reading)
+
+            if decoder.decode(frame) != reading:
+                raise AssertionError('delta frame did not reconstruct the reading')
+
+            frames.append(frame)
+
+    elapsed = perf_counter() - start
+
+    payload = sum(len(frame) for frame in frames)
+    wire = sum(HEADER_SIZE + len(encrypt(frame, key)) for frame in frames)
+
+    print(f'{name:<18} {"delta":<6} {payload / n_readings:>14.2f} {wire / n_readings:>13.2f} {elapsed / n_readings * 1e6:>17.2f}')
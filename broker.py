@@ -0,0 +1,274 @@
+from threading import Lock, Condition
+from collections import deque
+from types import MappingProxyType
+
+class Subscription:
+    '''
+    A class representing a subscriber to the readings, with a bounded buffer of the readings not yet consumed.
+
+    When the buffer is full the oldest reading is dropped, so a slow subscriber never blocks the publisher.
+
+    Attributes:
+        __filters (tuple): The device identifier, session identifier and state to filter (None matches all).
+        __buffer (deque): The readings not yet consumed.
+        __condition (Condition): The condition that signals new readings.
+        __dropped (int): The number of readings dropped because the buffer was full.
+        __closed (bool): If the subscription was closed.
+    '''
+
+    def __init__(self, device_id: int = None, session_id: int = None, state: int = None, capacity: int = 1024):
+        '''
+        Initializes a Subscription object.
+
+        Args:
+            device_id (int) = None: The identifier of device to filter.
+            session_id (int) = None: The identifier of session to filter.
+            state (int) = None: The device state to filter.
+            capacity (int) = 1024: The number of readings kept for the subscriber.
+        '''
+
+        self.__filters = (device_id, session_id, state)
+        self.__buffer = deque(maxlen=capacity)
+        self.__condition = Condition(Lock())
+        self.__dropped = 0
+        self.__closed = False
+
+    def get_filters(self) -> tuple:
+        '''
+        Returns the filters of the subscription.
+
+        Returns:
+            tuple: The device identifier, session identifier and state to filter.
+        '''
+
+        return self.__filters
+
+    def get_dropped(self) -> int:
+        '''
+        Returns the number of readings dropped because the subscriber was too slow.
+
+        Returns:
+            int: The number of readings dropped.
+        '''
+
+        return self.__dropped
+
+    def put(self, entry) -> None:
+        '''
+        Adds a reading to the buffer, dropping the oldest one if it is full.
+
+        Args:
+            entry (Mapping): The reading.
+
+        Returns:
+            None: The reading is buffered.
+        '''
+
+        with self.__condition:
+
+            if len(self.__buffer) == self.__buffer.maxlen:
+
+                self.__dropped += 1
+
+            self.__buffer.append(entry)
+
+            self.__condition.notify()
+
+    def get(self, timeout: float = None):
+        '''
+        Takes the oldest reading of the buffer, waiting for one if it is empty.
+
+        Args:
+            timeout (float) = None: The number of seconds to wait (forever if not given).
+
+        Returns:
+            Mapping: The reading, with the device, session, state, sensors and time (None on timeout or if closed).
+        '''
+
+        with self.__condition:
+
+            if not self.__condition.wait_for(lambda: self.__buffer or self.__closed, timeout):
+                return None
+
+            if not self.__buffer:
+                return None
+
+            return self.__buffer.popleft()
+
+    def __iter__(self):
+        '''
+        Yields the readings as they arrive, until the subscription is closed.
+
+        Returns:
+            generator: The readings.
+        '''
+
+        while True:
+
+            entry = self.get()
+
+            if entry is None:
+                return
+
+            yield entry
+
+    def close(self) -> None:
+        '''
+        Closes the subscription, waking up the consumer.
+
+        Returns:
+            None: The subscription is closed.
+        '''
+
+        with self.__condition:
+
+            self.__closed = True
+
+            self.__condition.notify_all()
+
+class Broker:
+    '''
+    A class that fans out the readings to the subscribers whose filters match them.
+
+    Subscribers with the same filters form a group, which is matched once per reading, and each reading is
+    built once as a read-only entry shared by every subscriber. The groups are replaced (never changed) when
+    subscribers come and go, so publishing doesn't take any lock but the ones of the buffers.
+
+    Attributes:
+        __groups (dict): The subscriptions of each filter.
+        __lock (Lock): The lock that serializes the changes to the groups.
+    '''
+
+    def __init__(self):
+        '''
+        Initializes a Broker object.
+        '''
+
+        self.__groups = dict()
+        self.__lock = Lock()
+
+    def subscribe(self, device_id: int = None, session_id: int = None, state: int = None, capacity: int = 1024) -> Subscription:
+        '''
+        Creates a subscription to the readings that match the filters.
+
+        Args:
+            device_id (int) = None: The identifier of device to filter.
+            session_id (int) = None: The identifier of session to filter.
+            state (int) = None: The device state to filter.
+            capacity (int) = 1024: The number of readings kept for the subscriber.
+
+        Returns:
+            Subscription: The subscription.
+        '''
+
+        subscription = Subscription(device_id, session_id, state, capacity)
+
+        with self.__lock:
+
+            groups = dict(self.__groups)
+            groups[subscription.get_filters()] = groups.get(subscription.get_filters(), ()) + (subscription,)
+
+            self.__groups = groups
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        '''
+        Removes a subscription, closing it.
+
+        Args:
+            subscription (Subscription): The subscription.
+
+        Returns:
+            None: The subscription stops receiving readings.
+        '''
+
+        with self.__lock:
+
+            groups = dict(self.__groups)
+            group = tuple(other for other in groups.get(subscription.get_filters(), ()) if other is not subscription)
+
+            if group:
+
+                groups[subscription.get_filters()] = group
+
+            else:
+
+                groups.pop(subscription.get_filters(), None)
+
+            self.__groups = groups
+
+        subscription.close()
+
+    def has_subscribers(self) -> bool:
+        '''
+        Checks if there is any subscriber.
+
+        Returns:
+            bool: If there are subscribers.
+        '''
+
+        return bool(self.__groups)
+
+    def publish(self, device_id: int, session_id: int, state: int, sensors: list, timestamp: float) -> int:
+        '''
+        Delivers a reading to the subscribers whose filters match it.
+
+        Args:
+            device_id (int): The identifier of the device.
+            session_id (int): The identifier of the session.
+            state (int): The state of the device.
+            sensors (list): The list of information from the sensors.
+            timestamp (float): The time of the reading.
+
+        Returns:
+            int: The number of subscribers that received the reading.
+        '''
+
+        groups = self.__groups
+        entry = None
+        delivered = 0
+
+        for (dev_id, sess_id, st), subscriptions in groups.items():
+
+            if (dev_id is not None and dev_id != device_id) or (sess_id is not None and sess_id != session_id) or (st is not None and st != state):
+                continue
+
+            # Build the entry once, only if someone wants it
+
+            if entry is None:
+
+                entry = MappingProxyType({
+                    'device_id': device_id,
+                    'session_id': session_id,
+                    'state': state,
+                    'sensors': tuple(sensors),
+                    'time': timestamp
+                })
+
+            for subscription in subscriptions:
+
+                subscription.put(entry)
+
+            delivered += len(subscriptions)
+
+        return delivered
+
+    def close(self) -> None:
+        '''
+        Closes every subscription.
+
+        Returns:
+            None: The subscribers are woken up and stop receiving readings.
+        '''
+
+        with self.__lock:
+
+            groups = self.__groups
+            self.__groups = dict()
+
+        for subscriptions in groups.values():
+
+            for subscription in subscriptions:
+
+                subscription.close()
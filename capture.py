@@ -0,0 +1,341 @@
+from message import Message, HEADER
+from controller import Controller
+from crypto import encrypt, decrypt, generate_key
+from authenticator import KEY_LENGTH
+from cryptography.exceptions import InvalidTag
+from struct import Struct
+from threading import Lock
+from time import perf_counter
+import json, os
+
+# The magic number at the start of a capture
+
+CAPTURE_MAGIC = b'CAP2'
+
+# The seed of the server randomness (if it was seeded), if the vaults are sealed (omitted otherwise) and the number of devices
+
+SNAPSHOT_HEADER = Struct('<?Q?I')
+
+# The types of sensors a controller spec may declare
+
+SENSOR_TYPES = ('INT', 'FLOAT', 'STRING', 'BOOLEAN')
+
+# The snapshot of each device (identifier, vault length and controller length)
+
+DEVICE_HEADER = Struct('<III')
+
+# The header of each frame (offset in seconds, connection, direction, device, session, type and data length)
+
+FRAME_HEADER = Struct('<dIBII1sI')
+
+# The directions of the frames
+
+INBOUND = 0
+OUTBOUND = 1
+
+def controller_to_bytes(controller: Controller) -> bytes:
+    '''
+    Serializes the sensor specs of a controller, as JSON.
+
+    Args:
+        controller (Controller): The controller (None for a device without one, as a gateway).
+
+    Returns:
+        bytes: The specs of the sensors and the encoding of the readings.
+    '''
+
+    if controller is None:
+        return b'null'
+
+    return json.dumps({'sensors': controller.get_sensors(), 'compact': controller.is_compact(), 'delta': controller.is_delta()}).encode()
+
+def controller_from_bytes(data: bytes) -> Controller:
+    '''
+    Builds a controller from its serialized sensor specs.
+
+    Args:
+        data (bytes): The specs, as written by controller_to_bytes.
+
+    Returns:
+        Controller: The controller (None for a device without one).
+
+    Raises:
+        ValueError: If the specs are malformed.
+    '''
+
+    try:
+
+        spec = json.loads(data)
+
+        if spec is None:
+            return None
+
+        sensors = []
+
+        for sensor in spec['sensors']:
+
+            if sensor['type'] not in SENSOR_TYPES:
+                raise ValueError(f'unknown sensor type {sensor["type"]}')
+
+            # JSON has no tuples, the ranges are restored as the controller declares them
+
+            if 'range' in sensor:
+
+                sensor['range'] = tuple(sensor['range'])
+
+            sensors.append(sensor)
+
+        return Controller(sensors, bool(spec['compact']), bool(spec['delta']))
+
+    except (KeyError, TypeError, UnicodeDecodeError, json.JSONDecodeError) as error:
+
+        raise ValueError(f'malformed controller spec: {error}')
+
+def load_capture_key(path: str, create: bool = True) -> bytes:
+    '''
+    Loads the key that seals the vaults of the captures, creating it (readable only by the owner) if missing.
+
+    Args:
+        path (str): The path of the key.
+        create (bool) = True: If a missing key is created.
+
+    Returns:
+        bytes: The key.
+
+    Raises:
+        ValueError: If the file doesn't hold a key, or it is missing and not created.
+    '''
+
+    if not os.path.exists(path):
+
+        if not create:
+            raise ValueError(f'the capture key {path} is missing')
+
+
+        key = generate_key(KEY_LENGTH)
+
+        with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as file:
+
+            file.write(key)
+
+        return key
+
+    with open(path, 'rb') as file:
+
+        key = file.read()
+
+    if len(key) != KEY_LENGTH:
+        raise ValueError(f'{path} is not a capture key')
+
+    return key
+
+class CaptureWriter:
+    '''
+    A class that records the framed messages exchanged by a server into a compact binary log.
+
+    The log starts with the seed of the server and a snapshot of the server vault and controller of each device,
+    so a replay can start the server from the same state, followed by every frame with its offset since the capture started, the
+    connection it went through and its direction.
+
+    The vaults are the long term secrets of the devices, so they are sealed with a key kept apart from the log,
+    or left out if no key is given (a replay then takes them from the vaults of the server). The controllers
+    are written as the specs of their sensors.
+
+    Attributes:
+        __file (file): The log file.
+        __start (float): The performance counter when the capture started.
+        __lock (Lock): The lock that serializes the frames.
+        __frames (int): The number of frames recorded.
+    '''
+
+    def __init__(self, path: str, devices: dict, seed: int = None, key: bytes = None):
+        '''
+        Initializes a CaptureWriter object, writing the snapshot of the devices.
+
+        Args:
+            path (str): The path of the log.
+            devices (dict): The server vault (bytes) and controller of each device identifier, as (vault, controller).
+            seed (int) = None: The seed of the server randomness (None if it draws from the CSPRNG).
+            key (bytes) = None: The key that seals the vaults (they are left out if not given).
+        '''
+
+        self.__file = open(path, 'wb')
+        self.__lock = Lock()
+        self.__frames = 0
+
+        self.__file.write(CAPTURE_MAGIC + SNAPSHOT_HEADER.pack(seed is not None, seed or 0, key is not None, len(devices)))
+
+        for device_id, (vault, controller) in devices.items():
+
+            # The device identifier authenticates the sealed vault, so vaults can't be swapped between devices
+
+            vault = b'' if key is None else encrypt(device_id.to_bytes(4, 'little') + vault, key)
+            data = controller_to_bytes(controller)
+
+            self.__file.write(DEVICE_HEADER.pack(device_id, len(vault), len(data)) + vault + data)
+
+        self.__start = perf_counter()
+
+    def record(self, connection: int, direction: int, msg: Message) -> None:
+        '''
+        Records a frame.
+
+        Args:
+            connection (int): The number of the connection.
+            direction (int): INBOUND if the frame was received by the server, OUTBOUND if sent.
+            msg (Message): The message.
+
+        Returns:
+            None: The frame is appended to the log.
+        '''
+
+        header = FRAME_HEADER.pack(perf_counter() - self.__start, connection, direction, msg.get_deviceId(), msg.get_sessionId(), msg.get_type(), msg.get_dataLength())
+
+        with self.__lock:
+
+            # Frames that race with the end of the capture are left out
+
+            if self.__file.closed:
+                return
+
+            self.__file.write(header + msg.get_data())
+
+            self.__frames += 1
+
+    def get_frames(self) -> int:
+        '''
+        Returns the number of frames recorded.
+
+        Returns:
+            int: The number of frames.
+        '''
+
+        return self.__frames
+
+    def close(self) -> None:
+        '''
+        Closes the log.
+
+        Returns:
+            None: The log is flushed and closed.
+        '''
+
+        with self.__lock:
+
+            self.__file.close()
+
+def read_capture(path: str, key: bytes = None) -> tuple[dict, list, int]:
+    '''
+    Reads a capture.
+
+    Args:
+        path (str): The path of the log.
+        key (bytes) = None: The key that sealed the vaults.
+
+    Returns:
+        tuple[dict, list, int]: The (vault, controller) of each device identifier (the vault is None if it was left out), the frames, as (offset, connection, direction, message), and the seed of the server (None if it wasn't seeded).
+
+    Raises:
+        ValueError: If the file is not a capture, a controller spec is malformed, or the vaults are sealed and the key is missing or wrong.
+    '''
+
+    with open(path, 'rb') as file:
+
+        data = file.read()
+
+    if data[0:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError(f'{path} is not a capture')
+
+    seeded, seed, sealed, n_devices = SNAPSHOT_HEADER.unpack_from(data, len(CAPTURE_MAGIC))
+    offset = len(CAPTURE_MAGIC) + SNAPSHOT_HEADER.size
+
+    # Read the snapshot of the devices
+
+    devices = dict()
+
+    for _ in range(n_devices):
+
+        device_id, vault_length, controller_length = DEVICE_HEADER.unpack_from(data, offset)
+        offset += DEVICE_HEADER.size
+
+        vault = data[offset:offset + vault_length]
+        offset += vault_length
+
+        controller = controller_from_bytes(data[offset:offset + controller_length])
+        offset += controller_length
+
+        # Unseal the vault, checking it belongs to the device
+
+        if not sealed:
+
+            vault = None
+
+        elif key is None:
+
+            raise ValueError(f'{path} has sealed vaults, the capture key is needed')
+
+        else:
+
+            try:
+
+                vault = decrypt(vault, key)
+
+            except InvalidTag:
+
+                raise ValueError(f'the capture key doesn\'t unseal the vaults of {path}')
+
+            if int.from_bytes(vault[0:4], 'little') != device_id:
+                raise ValueError(f'the vault of device {device_id} was sealed for another device')
+
+            vault = vault[4:]
+
+        devices[device_id] = (vault, controller)
+
+    # Read the frames, a truncated last frame (from a crash) is dropped
+
+    frames = []
+
+    while offset + FRAME_HEADER.size <= len(data):
+
+        at, connection, direction, device_id, session_id, type, length = FRAME_HEADER.unpack_from(data, offset)
+        offset += FRAME_HEADER.size
+
+        if offset + length > len(data):
+            break
+
+        frames.append((at, connection, direction, Message(device_id, session_id, type, data[offset:offset + length])))
+        offset += length
+
+    return devices, frames, seed if seeded else None
+
+def conversations(frames: list) -> dict:
+    '''
+    Splits the frames of a capture by connection.
+
+    Args:
+        frames (list): The frames, as (offset, connection, direction, message).
+
+    Returns:
+        dict: The frames of each connection, as (offset, direction, message), in order.
+    '''
+
+    split = dict()
+
+    for at, connection, direction, msg in frames:
+
+        split.setdefault(connection, []).append((at, direction, msg))
+
+    return split
+
+def frame_bytes(msg: Message) -> int:
+    '''
+    Returns the size of a message on the wire.
+
+    Args:
+        msg (Message): The message.
+
+    Returns:
+        int: The size of the header and the data.
+    '''
+
+    return HEADER.size + msg.get_dataLength()
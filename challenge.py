@@ -1,5 +1,5 @@
 from utils import xor
-import os, random
+from rng import Randomness, get_default
 
 CHALLENGE_SIZE = 12
 
@@ -12,28 +12,33 @@ class Challenge:
         __chal (bytes): The numeric challenge.
     '''
 
-    def __init__(self, n_keys: int, restriction: list = None):
+    def __init__(self, n_keys: int, restriction: list = None, rng: Randomness = None):
         '''
         Initializes the challenge.
 
         Args:
             n_keys (int): Number of keys in the vault associated.
             restriction (list) = None: A set that this challenge can't be equal to.
+            rng (Randomness) = None: The source of randomness (the default one if not given).
         '''
 
+        if rng is None:
+            rng = get_default()
+
         self.__keySet = list()
-        self.__chal = os.urandom(CHALLENGE_SIZE)
+        self.__chal = rng.bytes(CHALLENGE_SIZE)
 
-        self.__generate_set(n_keys, restriction)
+        self.__generate_set(n_keys, restriction, rng)
 
 
-    def __generate_set(self, n_keys: int, restriction: list = None) -> None:
+    def __generate_set(self, n_keys: int, restriction: list, rng: Randomness) -> None:
         '''
         Generates the keyset for the challenge.
 
         Args:
             n_keys (int): Number of keys in the vault associated.
-            restriction (list) = None: A set that this challenge can't be equal to.
+            restriction (list): A set that this challenge can't be equal to (None if there is none).
+            rng (Randomness): The source of randomness.
 
         Returns:
             None: The set is associated with the challenge.
@@ -41,13 +46,13 @@ class Challenge:
         
         # Generate the set size
 
-        set_size = random.randint(1, n_keys)
+        set_size = rng.randint(1, n_keys)
 
         # Generate the key set
 
         for i in range(set_size):
 
-            self.__keySet.append(random.randint(0, n_keys - 1))
+            self.__keySet.append(rng.randint(0, n_keys - 1))
 
         # Check if the set collides with the restriction
         
@@ -55,7 +60,7 @@ class Challenge:
 
             self.__keySet = list()
 
-            self.__generate_set()
+            self.__generate_set(n_keys, restriction, rng)
 
     def get_set(self) -> list:
         '''
@@ -67,6 +72,16 @@ class Challenge:
         
         return self.__keySet
 
+    def get_length(self) -> int:
+        '''
+        Returns the size of the challenge in bytes format.
+
+        Returns:
+            int: The size of the challenge number, the set size and the set.
+        '''
+
+        return CHALLENGE_SIZE + 4 + 4 * len(self.__keySet)
+
     def get_chal(self) -> bytes:
         '''
         Returns the challenge number.
@@ -161,9 +176,9 @@ class Challenge:
             key_set.append(int.from_bytes(data[offset:offset + 4], 'little'))
             offset += 4
 
-        # Create the object
+        # Create the object (without drawing a challenge that would be overwritten)
 
-        challenge = cls(n_keys=1)
+        challenge = cls.__new__(cls)
 
         challenge.__chal = chal
         challenge.__keySet = key_set
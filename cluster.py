@@ -0,0 +1,787 @@
+from handler import Handler
+from authenticator import KEY_LENGTH
+from message import Message
+from storage import SegmentStore
+from config_dv import thermo, assist
+from setup import load_registry, PATH_REGISTRY
+from crypto import generate_key
+from metrics import MetricsRegistry
+from bisect import bisect_right
+from hashlib import sha256
+from multiprocessing import Process, Pipe
+from socket import socket, create_connection, AF_INET, SOCK_STREAM, SOMAXCONN, SOL_SOCKET, SO_REUSEADDR, SHUT_WR
+from struct import Struct
+from threading import Condition, Lock, Thread
+from time import sleep
+import argparse, os
+import metrics
+
+# The points of each node on the ring, more points spread the devices more evenly
+
+REPLICAS = 128
+
+# The key of a device on the ring
+
+DEVICE_KEY = Struct('<I')
+
+# The bytes moved at once between a device and its node
+
+CHUNK_SIZE = 64 * 1024
+
+class HashRing:
+    '''
+    A class that maps device identifiers to nodes by consistent hashing.
+
+    Each node is placed at several points of a 64 bit ring and a device belongs to the first point after its
+    own hash, so adding or removing a node only moves the devices between it and its neighbours, about one
+    in the number of nodes.
+
+    Attributes:
+        __replicas (int): The points of each node.
+        __nodes (set): The names of the nodes.
+        __points (list): The sorted points of the ring.
+        __owners (list): The node of each point.
+    '''
+
+    def __init__(self, nodes: list = (), replicas: int = REPLICAS):
+        '''
+        Initializes a HashRing object.
+
+        Args:
+            nodes (list) = (): The names of the nodes.
+            replicas (int) = REPLICAS: The points of each node.
+        '''
+
+        self.__replicas = replicas
+        self.__nodes = set(nodes)
+        self.__points = []
+        self.__owners = []
+
+        self.__build()
+
+    @staticmethod
+    def __hash(key: bytes) -> int:
+        '''
+        Places a key on the ring.
+
+        Args:
+            key (bytes): The key.
+
+        Returns:
+            int: The point of the key.
+        '''
+
+        return int.from_bytes(sha256(key).digest()[0:8], 'little')
+
+    def __build(self) -> None:
+        '''
+        Places the points of every node, sorted.
+
+        Returns:
+            None: The ring is rebuilt.
+        '''
+
+        points = sorted((self.__hash(f'{node}#{i}'.encode()), node) for node in self.__nodes for i in range(self.__replicas))
+
+        self.__points = [point for point, _ in points]
+        self.__owners = [node for _, node in points]
+
+    def add(self, node: str) -> None:
+        '''
+        Adds a node.
+
+        Args:
+            node (str): The name of the node.
+
+        Returns:
+            None: The node takes its share of the devices.
+        '''
+
+        self.__nodes.add(node)
+
+        self.__build()
+
+    def remove(self, node: str) -> None:
+        '''
+        Removes a node.
+
+        Args:
+            node (str): The name of the node.
+
+        Returns:
+            None: The devices of the node move to its neighbours.
+        '''
+
+        self.__nodes.discard(node)
+
+        self.__build()
+
+    def get_nodes(self) -> list:
+        '''
+        Returns the names of the nodes.
+
+        Returns:
+            list: The names, sorted.
+        '''
+
+        return sorted(self.__nodes)
+
+    def get_node(self, device_id: int) -> str:
+        '''
+        Returns the node of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            str: The name of the node.
+
+        Raises:
+            LookupError: If the ring has no nodes.
+        '''
+
+        if not self.__points:
+            raise LookupError('the ring has no nodes')
+
+        i = bisect_right(self.__points, self.__hash(DEVICE_KEY.pack(device_id)))
+
+        return self.__owners[i % len(self.__owners)]
+
+    def assign(self, device_ids: list) -> dict:
+        '''
+        Splits devices by node.
+
+        Args:
+            device_ids (list): The identifiers of the devices.
+
+        Returns:
+            dict: The identifiers of the devices of each node.
+        '''
+
+        assignment = {node: [] for node in self.__nodes}
+
+        for device_id in device_ids:
+
+            assignment[self.get_node(device_id)].append(device_id)
+
+        return assignment
+
+class Router:
+    '''
+    A class that forwards each device connection to the node that owns the device.
+
+    The router reads the first message of a connection to learn the device, connects to its node and then
+    copies the bytes both ways without decoding them. When a node closes a connection (as it does when it
+    hands the session off), the device sees the end of the stream, reconnects and is forwarded to the new
+    owner. The devices being handed off are held, so they aren't forwarded before the ring has changed.
+
+    Attributes:
+        __ring (HashRing): The ring of the nodes.
+        __addresses (dict): The address and port of each node.
+        __lock (Lock): The lock that protects the ring, the addresses and the held devices.
+        __released (Condition): Signals that the held devices were released.
+        __held (set): The devices whose new connections wait to be forwarded.
+        __host (socket): The listening socket.
+        __running (bool): If the router accepts connections.
+        __metrics (dict): The metrics of the router, by short name.
+    '''
+
+    def __init__(self, addr: str, port: int, ring: HashRing = None, registry: MetricsRegistry = None):
+        '''
+        Initializes a Router object, binding the port.
+
+        Args:
+            addr (str): The address of the router.
+            port (int): The port of the router.
+            ring (HashRing) = None: The ring of the nodes (an empty one if not given).
+            registry (MetricsRegistry) = None: The registry of the metrics (the shared one if not given).
+        '''
+
+        if registry is None:
+            registry = metrics.registry
+
+        self.__ring = HashRing() if ring is None else ring
+        self.__addresses = dict()
+        self.__lock = Lock()
+        self.__released = Condition(self.__lock)
+        self.__held = set()
+        self.__running = False
+
+        self.__host = socket(AF_INET, SOCK_STREAM)
+        self.__host.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.__host.bind((addr, port))
+
+        self.__metrics = {
+            'routed': registry.counter('iot_router_connections_total', 'Connections forwarded, by node.', ('node',)),
+            'failed': registry.counter('iot_router_failures_total', 'Connections that failed to be forwarded, by reason.', ('reason',))
+        }
+
+    def get_port(self) -> int:
+        '''
+        Returns the port the router is bound to.
+
+        Returns:
+            int: The port.
+        '''
+
+        return self.__host.getsockname()[1]
+
+    def set_node(self, node: str, addr: str, port: int) -> None:
+        '''
+        Adds a node, or moves it to another address.
+
+        Args:
+            node (str): The name of the node.
+            addr (str): The address of the node.
+            port (int): The port of the node.
+
+        Returns:
+            None: The new connections of its devices go to the node.
+        '''
+
+        with self.__lock:
+
+            self.__addresses[node] = (addr, port)
+            self.__ring.add(node)
+
+    def remove_node(self, node: str) -> None:
+        '''
+        Removes a node, its open connections are left to be closed by the node.
+
+        Args:
+            node (str): The name of the node.
+
+        Returns:
+            None: The new connections of its devices go to the other nodes.
+        '''
+
+        with self.__lock:
+
+            self.__ring.remove(node)
+            self.__addresses.pop(node, None)
+
+    def hold(self, device_ids: set) -> None:
+        '''
+        Holds the new connections of some devices until they are released.
+
+        Args:
+            device_ids (set): The identifiers of the devices.
+
+        Returns:
+            None: The connections of the devices wait.
+        '''
+
+        with self.__lock:
+
+            self.__held = set(device_ids)
+
+    def release(self) -> None:
+        '''
+        Forwards the held connections, to the nodes the ring gives them now.
+
+        Returns:
+            None: No device is held.
+        '''
+
+        with self.__lock:
+
+            self.__held = set()
+
+            self.__released.notify_all()
+
+    def get_owner(self, device_id: int) -> str:
+        '''
+        Returns the node of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            str: The name of the node.
+
+        Raises:
+            LookupError: If the router has no nodes.
+        '''
+
+        with self.__lock:
+
+            return self.__ring.get_node(device_id)
+
+    def run(self) -> None:
+        '''
+        Accepts connections until the router is closed.
+
+        Returns:
+            None: The router is closed.
+        '''
+
+        self.__host.listen(SOMAXCONN)
+        self.__running = True
+
+        while self.__running:
+
+            try:
+
+                client, _ = self.__host.accept()
+
+            except OSError:
+
+                if not self.__running:
+                    break
+
+                sleep(0.01)
+                continue
+
+            Thread(target=self.__forward, args=(client,), daemon=True).start()
+
+    def __forward(self, client: socket) -> None:
+        '''
+        Connects a device to its node and copies the bytes both ways until either side closes.
+
+        Args:
+            client (socket): The connection of the device.
+
+        Returns:
+            None: Both connections are closed.
+        '''
+
+        upstream = None
+
+        try:
+
+            msg = Message.read_bytes(client)
+
+            with self.__lock:
+
+                self.__released.wait_for(lambda: msg.get_deviceId() not in self.__held)
+
+                node = self.__ring.get_node(msg.get_deviceId())
+                address = self.__addresses[node]
+
+            upstream = create_connection(address)
+            upstream.sendall(msg.to_bytes())
+
+            self.__metrics['routed'].labels(node).add()
+
+            # The replies are copied by another thread
+
+            replies = Thread(target=self.__copy, args=(upstream, client), daemon=True)
+            replies.start()
+
+            self.__copy(client, upstream)
+
+            replies.join()
+
+        except LookupError:
+
+            self.__metrics['failed'].labels('no_node').add()
+
+        except OSError:
+
+            self.__metrics['failed'].labels('connection').add()
+
+        finally:
+
+            client.close()
+
+            if upstream is not None:
+
+                upstream.close()
+
+    @staticmethod
+    def __copy(source: socket, destination: socket) -> None:
+        '''
+        Copies the bytes of a connection to another until it ends, then ends the other one.
+
+        Args:
+            source (socket): The connection read.
+            destination (socket): The connection written.
+
+        Returns:
+            None: The end of the stream is passed on.
+        '''
+
+        try:
+
+            while True:
+
+                data = source.recv(CHUNK_SIZE)
+
+                if not data:
+                    break
+
+                destination.sendall(data)
+
+        except OSError:
+
+            pass
+
+        try:
+
+            destination.shutdown(SHUT_WR)
+
+        except OSError:
+
+            pass
+
+    def close(self) -> None:
+        '''
+        Stops accepting connections, the forwarded ones end with their nodes.
+
+        Returns:
+            None: The port is closed.
+        '''
+
+        self.__running = False
+        self.__host.close()
+
+def node(name: str, port: int, devices: dict, seal_key: bytes, conn, storage: str = None) -> None:
+    '''
+    Runs the Handler of a node, serving the commands of the cluster until it is stopped.
+
+    Every node knows every device and reads the server vaults from the shared files, the router only sends
+    a device to its owner, so a single node rotates the vault of a device at a time.
+
+    Args:
+        name (str): The name of the node.
+        port (int): The port of the node.
+        devices (dict): The controller of each device identifier.
+        seal_key (bytes): The key that seals the sessions handed off between the nodes.
+        conn (Connection): Where the commands are received and answered.
+        storage (str) = None: The directory of the readings of the nodes (kept in memory if not given).
+
+    Returns:
+        None: The node is stopped.
+    '''
+
+    store = None if storage is None else SegmentStore(os.path.join(storage, name) + '/')
+
+    sv = Handler({device_id: {'auth': None, 'controller': controller} for device_id, controller in devices.items()}, 'localhost', port, store)
+
+    Thread(target=sv.run_server, daemon=True).start()
+
+    conn.send(None)
+
+    while True:
+
+        command, argument = conn.recv()
+
+        if command == 'stop':
+            break
+
+        # Errors are sent back, so the cluster raises them
+
+        try:
+
+            if command == 'export':
+
+                conn.send(sv.export_sessions(seal_key, argument))
+
+            elif command == 'import':
+
+                conn.send(sv.import_sessions(argument, seal_key))
+
+            else:
+
+                conn.send(sv.get_ingest_stats())
+
+        except Exception as error:
+
+            conn.send(error)
+
+    sv.flush(10)
+
+    conn.send(sv.get_ingest_stats())
+
+    sv.close()
+
+class Cluster:
+    '''
+    A class that runs Handler nodes as local processes behind a Router.
+
+    When a node joins or leaves, the running sessions of the devices that change owner are exported from
+    the old node and imported into the new one, so the devices carry on without a new handshake. The ring
+    changes once the sessions are imported, and the router holds the devices that move until then.
+
+    Attributes:
+        __devices (dict): The controller of each device identifier.
+        __router (Router): The router.
+        __replicas (int): The points of each node on the ring.
+        __nodes (dict): The process, command connection and port of each node.
+        __sealKey (bytes): The key that seals the sessions handed off between the nodes.
+        __nodePort (int): The port of the next node.
+        __storage (str): The directory of the readings of the nodes (None to keep them in memory).
+        __count (int): The number of nodes started, to name them.
+    '''
+
+    def __init__(self, devices: dict, port: int = 9070, node_port: int = 9080, replicas: int = REPLICAS, storage: str = None):
+        '''
+        Initializes a Cluster object, binding the router port.
+
+        Args:
+            devices (dict): The controller of each device identifier.
+            port (int) = 9070: The port of the router, where the devices connect.
+            node_port (int) = 9080: The port of the first node, the next ones take the following ports.
+            replicas (int) = REPLICAS: The points of each node on the ring.
+            storage (str) = None: The directory of the readings of the nodes (kept in memory if not given).
+        '''
+
+        self.__devices = devices
+        self.__router = Router('localhost', port, HashRing(replicas = replicas))
+        self.__replicas = replicas
+        self.__nodes = dict()
+        self.__sealKey = generate_key(KEY_LENGTH)
+        self.__nodePort = node_port
+        self.__storage = storage
+        self.__count = 0
+
+        Thread(target=self.__router.run, daemon=True).start()
+
+    def get_router(self) -> Router:
+        '''
+        Returns the router.
+
+        Returns:
+            Router: The router.
+        '''
+
+        return self.__router
+
+    def get_nodes(self) -> list:
+        '''
+        Returns the names of the running nodes.
+
+        Returns:
+            list: The names.
+        '''
+
+        return list(self.__nodes)
+
+    def __call(self, name: str, command: str, argument=None):
+        '''
+        Runs a command on a node.
+
+        Args:
+            name (str): The name of the node.
+            command (str): 'export', 'import' or 'stats'.
+            argument = None: The argument of the command.
+
+        Returns:
+            The answer of the node.
+
+        Raises:
+            Exception: The error raised by the node.
+        '''
+
+        _, conn, _ = self.__nodes[name]
+
+        conn.send((command, argument))
+
+        answer = conn.recv()
+
+        if isinstance(answer, Exception):
+            raise answer
+
+        return answer
+
+    def __owners(self, nodes: list) -> dict:
+        '''
+        Returns the node of every device, for a set of nodes.
+
+        Args:
+            nodes (list): The names of the nodes.
+
+        Returns:
+            dict: The name of the node of each device identifier (empty if there are no nodes).
+        '''
+
+        if not nodes:
+            return dict()
+
+        ring = HashRing(nodes, self.__replicas)
+
+        return {device_id: ring.get_node(device_id) for device_id in self.__devices}
+
+    def __hand_off(self, owners: dict, new_owners: dict, change) -> int:
+        '''
+        Moves the sessions of the devices whose node changes, then changes the ring.
+
+        Args:
+            owners (dict): The node of each device identifier before the change.
+            new_owners (dict): The node of each device identifier after the change.
+            change (callable): Changes the ring of the router.
+
+        Returns:
+            int: The number of devices that changed node.
+        '''
+
+        moves = dict()
+
+        for device_id, old in owners.items():
+
+            new = new_owners[device_id]
+
+            if new != old:
+
+                moves.setdefault((old, new), set()).add(device_id)
+
+        # The devices that move reconnect as soon as their sessions are exported, they wait for the new ring
+
+        self.__router.hold(set().union(*moves.values()))
+
+        try:
+
+            for (old, new), device_ids in moves.items():
+
+                self.__call(new, 'import', self.__call(old, 'export', device_ids))
+
+        finally:
+
+            change()
+
+            self.__router.release()
+
+        return sum(len(device_ids) for device_ids in moves.values())
+
+    def add_node(self) -> tuple[str, int]:
+        '''
+        Starts a node and moves its share of the devices to it.
+
+        Returns:
+            tuple[str, int]: The name of the node and the number of devices moved to it.
+        '''
+
+        name = f'node{self.__count}'
+        port = self.__nodePort + self.__count
+        self.__count += 1
+
+        receiver, sender = Pipe()
+
+        process = Process(target=node, args=(name, port, self.__devices, self.__sealKey, sender, self.__storage))
+        process.start()
+
+        receiver.recv()
+
+        owners = self.__owners(list(self.__nodes))
+
+        self.__nodes[name] = (process, receiver, port)
+
+        # The first node has no sessions to take over
+
+        if not owners:
+
+            self.__router.set_node(name, 'localhost', port)
+
+            return name, 0
+
+        return name, self.__hand_off(owners, self.__owners(list(self.__nodes)), lambda: self.__router.set_node(name, 'localhost', port))
+
+    def remove_node(self, name: str) -> tuple[int, dict]:
+        '''
+        Moves the devices of a node to the others and stops it.
+
+        Args:
+            name (str): The name of the node.
+
+        Returns:
+            tuple[int, dict]: The number of devices moved from the node and its ingest statistics.
+        '''
+
+        remaining = [other for other in self.__nodes if other != name]
+
+        if not remaining:
+
+            self.__router.remove_node(name)
+
+            return 0, self.__stop(name)
+
+        moved = self.__hand_off(self.__owners(list(self.__nodes)), self.__owners(remaining), lambda: self.__router.remove_node(name))
+
+        return moved, self.__stop(name)
+
+    def __stop(self, name: str) -> dict:
+        '''
+        Stops a node.
+
+        Args:
+            name (str): The name of the node.
+
+        Returns:
+            dict: The ingest statistics of the node.
+        '''
+
+        process, conn, _ = self.__nodes.pop(name)
+
+        conn.send(('stop', None))
+
+        stats = conn.recv()
+
+        process.join()
+
+        return stats
+
+    def close(self) -> dict:
+        '''
+        Stops the router and every node.
+
+        Returns:
+            dict: The ingest statistics of each node.
+        '''
+
+        self.__router.close()
+
+        return {name: self.__stop(name) for name in list(self.__nodes)}
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Runs a cluster of servers on localhost, each device served by the node its identifier hashes to.')
+    parser.add_argument('--nodes', type=int, default=3, help='the number of nodes to start with')
+    parser.add_argument('--port', type=int, default=9070, help='the port of the router, where the devices connect')
+    parser.add_argument('--node-port', type=int, default=9080, help='the port of the first node')
+    parser.add_argument('--registry', default=PATH_REGISTRY, help='the registry of the devices (python setup.py --count <n>)')
+    parser.add_argument('--storage', help='the directory of the readings of the nodes (kept in memory if not given)')
+    args = parser.parse_args()
+
+    devices = {1058: thermo, 5953: assist}
+
+    if os.path.exists(args.registry):
+
+        devices.update({device_id: device['controller'] for device_id, device in load_registry(args.registry).items()})
+
+    cluster = Cluster(devices, args.port, args.node_port, storage = args.storage)
+
+    for _ in range(args.nodes):
+
+        cluster.add_node()
+
+    # Control terminal
+
+    while True:
+
+        command = input(f'{cluster.get_nodes()} add, remove <node> or exit? ').split()
+
+        if not command:
+            continue
+
+        if command[0] == 'exit':
+            break
+
+        if command[0] == 'add':
+
+            name, moved = cluster.add_node()
+
+            print(f'{name} started, {moved} of {len(devices)} devices moved to it')
+
+        elif command[0] == 'remove' and len(command) == 2 and command[1] in cluster.get_nodes():
+
+            moved, stats = cluster.remove_node(command[1])
+
+            print(f'{command[1]} stopped, {moved} of {len(devices)} devices moved from it, {stats}')
+
+    for name, stats in cluster.close().items():
+
+        print(f'{name}: {stats}')
+
+if __name__ == '__main__':
+
+    main()
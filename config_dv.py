@@ -4,9 +4,13 @@ from controller import Controller
 
 thermo = Controller()
 thermo.create_int_sensor(-120, 120)
-thermo.create_float_sensor(0, 100)
+thermo.create_float_sensor(0, 100, 0.01)
 
 # Controller for a smart assistant (COMMANDS)
 
 assist = Controller()
-assist.create_str_sensor(10)
\ No newline at end of file
+assist.create_str_sensor(10)
+
+# The controllers by name, as written in the device registry
+
+PROFILES = {'thermo': thermo, 'assist': assist}
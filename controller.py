@@ -1,8 +1,62 @@
 from copy import deepcopy
-import random
+from rng import Randomness, get_default
 import struct
 import string
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The struct format of each sensor type (strings have their length prepended)
+
+SENSOR_FORMATS = {
+    'INT': 'i',
+    'FLOAT': 'f',
+    'STRING': 's',
+    'BOOLEAN': '?'
+}
+
+# The number of bits of the state in the compact encoding
+
+STATE_BITS = 2
+
+# The states that signal a failure of the device (MALFUNCTION and SENSOR MALFUNCTION)
+
+ALARM_STATES = (2, 3)
+
+# The numpy type of each sensor type (strings have their length appended)
+
+SENSOR_DTYPES = {
+    'INT': '<i4',
+    'FLOAT': '<f4',
+    'STRING': 'S',
+    'BOOLEAN': '?'
+}
+
+# The value in the place of a failed sensor, which is marked in the failure bitmap of the reading
+
+SENSOR_DEFAULTS = {
+    'INT': 0,
+    'FLOAT': 0.0,
+    'STRING': '',
+    'BOOLEAN': False
+}
+
+def failed_mask(failed, index: int) -> 'np.ndarray':
+    '''
+    Returns which records have a sensor marked as failed in their failure bitmap.
+
+    Args:
+        failed (numpy.ndarray): The 'failed' field of the records.
+        index (int): The index of the sensor.
+
+    Returns:
+        numpy.ndarray: The boolean mask of the records where the sensor failed.
+    '''
+
+    return (failed[:, index // 8] >> (index % 8)) & 1 == 1
+
 class Controller:
     '''
     A class that emulates an IoT device controller generating data for its sensors.
@@ -10,6 +64,12 @@ class Controller:
     Attributes:
         __sensors (list): The list of available sensors in the controller.
         __state (int): The state of the IoT device.
+        __compact (bool): If the readings are bit-packed using the declared ranges of the sensors.
+        __delta (bool): If successive readings are sent as differences to the previous one.
+        __codec (struct.Struct): The compiled codec of the readings (None until needed).
+        __dtype (numpy.dtype): The structured type of the readings (None until needed).
+        __layout (list): The bit layout of the compact readings (None until needed).
+        __rng (Randomness): The source of the simulated readings (None for the default one).
 
     For the state the following dictionary will be followed:
 
@@ -24,24 +84,104 @@ class Controller:
         'type' = 'INT' | 'FLOAT' | 'STRING' | 'BOOLEAN'
         'range' = (lower_bound, upper_bound) (INT | FLOAT)
         'length' = size (STRING)
+        'precision' = step | None (FLOAT)
     }
     '''
 
-    def __init__(self, sensors: list = None):
+    def __init__(self, sensors: list = None, compact: bool = False, delta: bool = False, rng: Randomness = None):
             '''
             Initializes a Controller object.
 
             Args:
                 sensors (list) = None: A preset list of sensors in the correct format.
+                compact (bool) = False: If the readings are bit-packed using the declared ranges of the sensors.
+                delta (bool) = False: If successive readings are sent as differences to the previous one.
+                rng (Randomness) = None: The source of the simulated readings (the default one if not given).
             '''
 
             self.__sensors = list()
             self.__state = 0
+            self.__compact = compact
+            self.__delta = delta
+            self.__codec = None
+            self.__dtype = None
+            self.__layout = None
+            self.__rng = rng
 
             # In case a preset list as been given
             if (sensors is not None):
                 self.__sensors = deepcopy(sensors)
 
+    def get_sensors(self) -> list:
+        '''
+        Returns the sensors of the controller.
+
+        Returns:
+            list: A copy of the list of sensors, in the correct format.
+        '''
+
+        return deepcopy(self.__sensors)
+
+    def is_compact(self) -> bool:
+        '''
+        Checks if the readings are bit-packed using the declared ranges of the sensors.
+
+        Returns:
+            bool: If the compact mode is enabled.
+        '''
+
+        return self.__compact
+
+    def is_delta(self) -> bool:
+        '''
+        Checks if successive readings are sent as differences to the previous one.
+
+        Returns:
+            bool: If the delta mode is enabled.
+        '''
+
+        return self.__delta
+
+    def set_rng(self, rng: Randomness) -> None:
+        '''
+        Replaces the source of the simulated readings.
+
+        Args:
+            rng (Randomness): The source (the default one if None).
+
+        Returns:
+            None: The source is replaced.
+        '''
+
+        self.__rng = rng
+
+    def __get_rng(self) -> Randomness:
+        '''
+        Returns the source of the simulated readings.
+
+        Returns:
+            Randomness: The source of the controller, or the default one.
+        '''
+
+        return get_default() if self.__rng is None else self.__rng
+
+    def __add_sensor(self, sensor: dict) -> None:
+        '''
+        Adds a sensor to the list, discarding the compiled codecs.
+
+        Args:
+            sensor (dict): The sensor in the correct format.
+
+        Returns:
+            None: The sensor is added to the list.
+        '''
+
+        self.__sensors.append(sensor)
+
+        self.__codec = None
+        self.__dtype = None
+        self.__layout = None
+
     def create_int_sensor(self, lower_bound: int, upper_bound: int) -> None:
         '''
         Creates a integer type sensor that generates integers between the lower and upper bound (if applicable).
@@ -54,21 +194,22 @@ class Controller:
             None: The generated sensor will be added to the list.
         '''
 
-        self.__sensors.append({'type': 'INT', 'range': (lower_bound, upper_bound)})
+        self.__add_sensor({'type': 'INT', 'range': (lower_bound, upper_bound)})
 
-    def create_float_sensor(self, lower_bound: float, upper_bound: float) -> None:
+    def create_float_sensor(self, lower_bound: float, upper_bound: float, precision: float = None) -> None:
         '''
         Creates a float type sensor that generates floats between the lower and upper bound (if applicable).
 
         Args:
             lower_bound (float): The lower bound.
             upper_bound (float): The upper bound.
+            precision (float) = None: The precision the readings are quantized to in the compact encoding.
 
         Returns:
             None: The generated sensor will be added to the list.
         '''
 
-        self.__sensors.append({'type': 'FLOAT', 'range': (lower_bound, upper_bound)})
+        self.__add_sensor({'type': 'FLOAT', 'range': (lower_bound, upper_bound), 'precision': precision})
 
     def create_str_sensor(self, length: int) -> None:
         '''
@@ -81,7 +222,7 @@ class Controller:
             None: The generated sensor will be added to the list.
         '''
 
-        self.__sensors.append({'type': 'STRING', 'length': length})
+        self.__add_sensor({'type': 'STRING', 'length': length})
 
     def create_bool_sensor(self) -> None:
         '''
@@ -91,7 +232,7 @@ class Controller:
             None: The generated sensor will be added to the list.
         '''
 
-        self.__sensors.append({'type': 'BOOLEAN'})
+        self.__add_sensor({'type': 'BOOLEAN'})
 
     def read_sensors(self, fail: list = None) -> list:
         '''
@@ -127,19 +268,19 @@ class Controller:
                 
                 if sensor_type == "INT":
 
-                    data.append(random.randint(sensor['range'][0], sensor['range'][1]))
+                    data.append(self.__get_rng().randint(sensor['range'][0], sensor['range'][1]))
 
                 elif sensor_type == "FLOAT":
 
-                    data.append(round(random.uniform(sensor['range'][0], sensor['range'][1]), 2))
+                    data.append(round(self.__get_rng().uniform(sensor['range'][0], sensor['range'][1]), 2))
 
                 elif sensor_type == "STRING":
 
-                    data.append(''.join(random.choices(string.ascii_letters + string.digits, k = sensor['length'])))
+                    data.append(''.join(self.__get_rng().choices(string.ascii_letters + string.digits, k = sensor['length'])))
 
                 elif sensor_type == "BOOLEAN":
 
-                    data.append(random.choice([True, False]))
+                    data.append(self.__get_rng().choice([True, False]))
 
         return data
 
@@ -151,7 +292,7 @@ class Controller:
             None: The state of the device is changed.
         '''
 
-        self.__state = random.choice([0, 1, 2, 3])
+        self.__state = self.__get_rng().choice([0, 1, 2, 3])
 
     def gen_fail_list(self) -> list:
         '''
@@ -165,57 +306,122 @@ class Controller:
         
         # In a range from 0 to num_sensors randomize how many sensors will fail
 
-        num_failures = random.randint(0, num_sensors)
+        num_failures = self.__get_rng().randint(0, num_sensors)
 
         # Randomly select sensor indexes to fail
 
-        fail_list = random.sample(range(num_sensors), num_failures)
+        fail_list = self.__get_rng().sample(range(num_sensors), num_failures)
 
         return fail_list
 
-    def read_device_bytes(self, fail: list = None) -> bytes:
+    def __getstate__(self) -> dict:
         '''
-        Generates simulated data that the device would output from all the sensors and it self.
+        Returns the state to be copied, leaving out the compiled codecs.
+
+        Returns:
+            dict: The attributes of the controller.
+        '''
+
+        # The compiled codecs are not copied, they are rebuilt when needed, and the copy draws from the default source
+
+        state = self.__dict__.copy()
+        state['_Controller__rng'] = None
+        state['_Controller__codec'] = None
+        state['_Controller__dtype'] = None
+        state['_Controller__layout'] = None
+
+        return state
+
+    def __get_codec(self) -> struct.Struct:
+        '''
+        Returns the compiled codec of the readings, compiling it if the sensors changed.
+
+        Returns:
+            struct.Struct: The codec for the state and the readings of all the sensors.
+        '''
+
+        if self.__codec is None:
+
+            # The state is always the first field, followed by the failure bitmap of the sensors
+
+            fmt = f'<i{self.get_failed_size()}s'
+
+            for sensor in self.__sensors:
+
+                if sensor['type'] == 'STRING':
+
+                    fmt += str(sensor['length'])
+
+                fmt += SENSOR_FORMATS[sensor['type']]
+
+            self.__codec = struct.Struct(fmt)
+
+        return self.__codec
+
+    def get_failed_size(self) -> int:
+        '''
+        Returns the size of the failure bitmap of a reading, with a bit per sensor.
+
+        Returns:
+            int: The size of the bitmap in bytes.
+        '''
+
+        return (len(self.__sensors) + 7) // 8
+
+    def get_reading_size(self) -> int:
+        '''
+        Returns the size of a reading (state, failure bitmap and sensors) in bytes.
+
+        Returns:
+            int: The size of the reading.
+        '''
+
+        return self.__get_codec().size
+
+    def information_to_bytes(self, state: int, readings: list) -> bytes:
+        '''
+        Converts the device state and the readings into binary information.
 
         Args:
-            fail (list): The list of sensor indexes that will fail.
+            state (int): The device state.
+            readings (list): The list of readings, in the same order as the sensors (None for a failed sensor).
 
         Returns:
             bytes: The readings in the bytes format.
         '''
 
-        # Generate the data
+        # Failing sensors are marked in the bitmap and sent with the default value of their type
 
-        sensor_data = self.read_sensors(fail)  
-        state_data = self.__state  
-        
-        byte_data = bytes()  
-        
-        # Convert device state to bytes 
+        failed = sum(1 << i for i, reading in enumerate(readings) if reading is None)
 
-        byte_data += state_data.to_bytes(4, 'little')
+        values = [SENSOR_DEFAULTS[sensor['type']] if reading is None else reading for sensor, reading in zip(self.__sensors, readings)]
 
-        # Convert readings to bytes
-        
-        for reading in sensor_data:
+        # Strings are encoded before packing
 
-            if isinstance(reading, int):
-                
-                byte_data += reading.to_bytes(4, 'little', signed=True)
+        for i, sensor in enumerate(self.__sensors):
 
-            elif isinstance(reading, float):
+            if sensor['type'] == 'STRING':
 
-                byte_data += (struct.pack("f", reading)) 
+                values[i] = values[i].encode('utf-8')
 
-            elif isinstance(reading, str):
+        return self.__get_codec().pack(state, failed.to_bytes(self.get_failed_size(), 'little'), *values)
 
-                byte_data += reading.encode("utf-8")  
+    def read_device_bytes(self, fail: list = None) -> bytes:
+        '''
+        Generates simulated data that the device would output from all the sensors and it self.
 
-            elif isinstance(reading, bool):
+        Args:
+            fail (list): The list of sensor indexes that will fail.
 
-                byte_data += (struct.pack("?", reading)) 
-        
-        return byte_data
+        Returns:
+            bytes: The readings in the bytes format.
+        '''
+
+        if self.__compact:
+
+            return self.information_to_compact(self.__state, self.read_sensors(fail))
+
+        return self.information_to_bytes(self.__state, self.read_sensors(fail))
 
     def bytes_to_information(self, data: bytes) -> tuple[int, list]:
         '''
@@ -225,44 +431,295 @@ class Controller:
             data (bytes): The readings in binary mode.
 
         Returns:
-            tuple[int, list]: The device state and the list of readings.
+            tuple[int, list]: The device state and the list of readings (None for a failed sensor).
         '''
 
-        # Get the device state and the starting index
+        if self.__compact:
 
-        state = int.from_bytes(data[0:4], 'little')
-        byte_index = 4
+            return self.compact_to_information(data)
 
-        # Get the readings of the device
+        # Unpack the state, the failure bitmap and the readings at once
 
-        readings = []
+        state, failed, *readings = self.__get_codec().unpack_from(data)
 
-        for sensor in self.__sensors:
+        return state, self.__finish_readings(int.from_bytes(failed, 'little'), readings)
 
-            sensor_type = sensor['type']
-                
-            if sensor_type == "INT":
+    def __finish_readings(self, failed: int, readings: list) -> list:
+        '''
+        Decodes the strings of unpacked readings and replaces the failed sensors by None.
+
+        Args:
+            failed (int): The failure bitmap, with a bit per sensor.
+            readings (list): The unpacked readings, in the same order as the sensors.
+
+        Returns:
+            list: The readings.
+        '''
+
+        for i, sensor in enumerate(self.__sensors):
+
+            if failed >> i & 1:
+
+                readings[i] = None
 
-                readings.append(int.from_bytes(data[byte_index:byte_index+4], 'little', signed=True))
+            elif sensor['type'] == 'STRING':
 
-                byte_index += 4
+                # Remove the padding
 
-            elif sensor_type == "FLOAT":
+                readings[i] = readings[i].rstrip(b'\x00').decode('utf-8')
 
-                readings.append(struct.unpack('f', data[byte_index:byte_index+4]))
+        return readings
 
-                byte_index += 8
+    def __get_layout(self) -> list:
+        '''
+        Returns the bit layout of the compact readings, compiling it if the sensors changed.
+
+        Returns:
+            list: The (type, bits, lower bound, precision) of the state, the failure bitmap and of each sensor.
+        '''
+
+        if self.__layout is None:
+
+            # The state is always the first field, followed by a failure bit per sensor
+
+            layout = [('INT', STATE_BITS, 0, None), ('FAILED', len(self.__sensors), 0, None)]
+
+            for sensor in self.__sensors:
+
+                if sensor['type'] == 'INT':
+
+                    lower, upper = sensor['range']
+
+                    layout.append(('INT', (upper - lower).bit_length(), lower, None))
+
+                elif sensor['type'] == 'FLOAT' and sensor.get('precision') is not None:
+
+                    lower, upper = sensor['range']
+                    steps = round((upper - lower) / sensor['precision'])
+
+                    layout.append(('FLOAT', steps.bit_length(), lower, sensor['precision']))
+
+                elif sensor['type'] == 'FLOAT':
+
+                    layout.append(('FLOAT', 32, None, None))
+
+                elif sensor['type'] == 'STRING':
+
+                    layout.append(('STRING', 8 * sensor['length'], None, None))
+
+                elif sensor['type'] == 'BOOLEAN':
+
+                    layout.append(('BOOLEAN', 1, None, None))
+
+            self.__layout = layout
+
+        return self.__layout
+
+    def get_compact_size(self) -> int:
+        '''
+        Returns the size of a compact reading (state and sensors) in bytes.
+
+        Returns:
+            int: The size of the compact reading.
+        '''
+
+        return (sum(field[1] for field in self.__get_layout()) + 7) // 8
+
+    def information_to_compact(self, state: int, readings: list) -> bytes:
+        '''
+        Converts the device state and the readings into bit-packed binary information.
+
+        Integers are stored as offsets from their lower bound with just enough bits for the declared range,
+        floats with a declared precision are quantized the same way and booleans take a single bit. Each sensor
+        has a failure bit, set when the sensor failed (its field is then zero).
 
-            elif sensor_type == "STRING":
+        Args:
+            state (int): The device state.
+            readings (list): The list of readings, in the same order as the sensors (None for a failed sensor).
+
+        Returns:
+            bytes: The readings in the compact bytes format.
+
+        Raises:
+            ValueError: If a reading is outside the declared range of its sensor.
+        '''
+
+        packed = 0
+        n_bits = 0
+
+        # The failure bits are in the order of the sensors, from the most significant one
+
+        failed = sum(1 << (len(self.__sensors) - 1 - i) for i, reading in enumerate(readings) if reading is None)
+
+        for (sensor_type, bits, lower, precision), reading in zip(self.__get_layout(), [state, failed] + list(readings)):
+
+            # Convert the reading to an unsigned field (failing sensors are marked by their bit)
+
+            if reading is None:
+
+                field = 0
+
+            elif sensor_type in ('INT', 'FAILED'):
+
+                field = reading - lower
+
+            elif sensor_type == 'FLOAT' and precision is not None:
+
+                field = round((reading - lower) / precision)
 
-                readings.append(data[byte_index:byte_index+sensor['length']].decode("utf-8"))
+            elif sensor_type == 'FLOAT':
 
-                byte_index += sensor['length']
+                field = int.from_bytes(struct.pack('<f', reading), 'little')
+
+            elif sensor_type == 'STRING':
+
+                field = int.from_bytes(reading.encode('utf-8').ljust(bits // 8, b'\x00')[0:bits // 8], 'big')
+
+            else:
+
+                field = int(reading)
+
+            if field < 0 or field >= (1 << bits):
+                raise ValueError(f'reading {reading} is out of the declared range')
+
+            # Append the field to the packed readings
+
+            packed = (packed << bits) | field
+            n_bits += bits
+
+        # Align the first field with the first bit of the data
+
+        n_bytes = (n_bits + 7) // 8
+
+        return (packed << (8 * n_bytes - n_bits)).to_bytes(n_bytes, 'big')
+
+    def compact_to_information(self, data: bytes) -> tuple[int, list]:
+        '''
+        Given bit-packed binary information generate the device readings.
+
+        Args:
+            data (bytes): The readings in the compact binary mode.
+
+        Returns:
+            tuple[int, list]: The device state and the list of readings (None for a failed sensor).
+        '''
+
+        layout = self.__get_layout()
+
+        n_bytes = self.get_compact_size()
+        packed = int.from_bytes(data[0:n_bytes], 'big')
+
+        # Read the fields from the first bit of the data
+
+        offset = 8 * n_bytes
+        values = []
+
+        for sensor_type, bits, lower, precision in layout:
+
+            offset -= bits
+            field = (packed >> offset) & ((1 << bits) - 1)
+
+            if sensor_type in ('INT', 'FAILED'):
+
+                values.append(lower + field)
+
+            elif sensor_type == 'FLOAT' and precision is not None:
+
+                # Remove the representation error of the quantization steps
+
+                values.append(round(lower + field * precision, 10))
+
+            elif sensor_type == 'FLOAT':
+
+                values.append(struct.unpack('<f', field.to_bytes(4, 'little'))[0])
+
+            elif sensor_type == 'STRING':
+
+                values.append(field.to_bytes(bits // 8, 'big').rstrip(b'\x00').decode('utf-8'))
+
+            else:
+
+                values.append(bool(field))
+
+        state, failed, readings = values[0], values[1], values[2:]
+
+        return state, [None if failed >> (len(readings) - 1 - i) & 1 else reading for i, reading in enumerate(readings)]
+
+    def get_dtype(self) -> 'np.dtype':
+        '''
+        Returns the numpy structured type of a reading, with the same layout as the fixed width binary format.
+
+        Returns:
+            numpy.dtype: The type with a 'state' field, the 'failed' bitmap bytes and a 'sensor_<i>' field per sensor.
+
+        Raises:
+            ImportError: If numpy is not available.
+        '''
+
+        if np is None:
+            raise ImportError('numpy is required for bulk decoding')
+
+        if self.__dtype is None:
+
+            fields = [('state', '<i4'), ('failed', 'u1', (self.get_failed_size(),))]
+
+            for i, sensor in enumerate(self.__sensors):
+
+                dtype = SENSOR_DTYPES[sensor['type']]
+
+                if sensor['type'] == 'STRING':
+
+                    dtype += str(sensor['length'])
+
+                fields.append((f'sensor_{i}', dtype))
+
+            self.__dtype = np.dtype(fields)
+
+        return self.__dtype
+
+    def bytes_to_records(self, data: bytes) -> 'np.recarray':
+        '''
+        Given binary information of several concatenated readings generate a record array, without copying.
+
+        Compact readings are bit-packed, so they are widened to the fixed width layout one by one first.
+
+        Args:
+            data (bytes): The readings in binary mode.
+
+        Returns:
+            numpy.recarray: One record per reading.
+
+        Raises:
+            ImportError: If numpy is not available.
+            ValueError: If the data is not a whole number of readings.
+        '''
+
+        if self.__compact:
+
+            size = self.get_compact_size()
+
+            if len(data) % size != 0:
+                raise ValueError(f'{len(data)} bytes are not a whole number of {size} byte readings')
+
+            data = b''.join(self.information_to_bytes(*self.compact_to_information(data[i:i + size])) for i in range(0, len(data), size))
+
+        return np.frombuffer(data, dtype=self.get_dtype()).view(np.recarray)
+
+    def records_to_information(self, records: 'np.recarray') -> list:
+        '''
+        Converts a record array into the device readings.
+
+        Args:
+            records (numpy.recarray): The records of the readings.
+
+        Returns:
+            list: The device state and the list of readings of each record, like bytes_to_information.
+        '''
 
-            elif sensor_type == "BOOLEAN":
+        information = []
 
-                readings.append(struct.unpack('?', data[byte_index:byte_index+1]))
+        for state, failed, *readings in records.tolist():
 
-                byte_index += 1
+            information.append((state, self.__finish_readings(int.from_bytes(failed.tobytes(), 'little'), readings)))
 
-        return state, readings
\ No newline at end of file
+        return information
@@ -1,30 +1,35 @@
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.hmac import HMAC
 from cryptography.hazmat.primitives.hashes import SHA256
-import os, secrets
+from rng import Randomness, get_default
 
 NONCE_SIZE = 12
 
-def generate_key(length: int) -> bytes:
+def generate_key(length: int, rng: Randomness = None) -> bytes:
     '''
     Generates a secure cryptographic key.
 
     Args:
         length (int): Length (in bytes) of the generated cryptographic key.
+        rng (Randomness) = None: The source of randomness (the default one if not given).
 
     Returns:
         bytes: The generated random key.
     '''
 
-    return secrets.token_bytes(length)
+    if rng is None:
+        rng = get_default()
 
-def generate_keys(vault_size: int, key_size: int) -> list:
+    return rng.bytes(length)
+
+def generate_keys(vault_size: int, key_size: int, rng: Randomness = None) -> list:
     '''
     Generates a set of keys.
 
     Args:
         vault_size (int): The size of the set of keys.
         key_size (int): The size of the keys.
+        rng (Randomness) = None: The source of randomness (the default one if not given).
 
     Returns:
         list: The set of keys generated.
@@ -34,17 +39,18 @@ def generate_keys(vault_size: int, key_size: int) -> list:
 
     for _ in range(vault_size):
 
-        vault.append(generate_key(key_size))
+        vault.append(generate_key(key_size, rng))
 
     return vault
 
-def encrypt(data: bytes, key: bytes) -> bytes:
+def encrypt(data: bytes, key: bytes, rng: Randomness = None) -> bytes:
     '''
     Encrypts data given a secure cryptographic key.
 
     Args:
         data (bytes): The information desired for encryption.
         key (bytes): The key that will be used for encryption.
+        rng (Randomness) = None: The source of the nonce (the default one if not given).
 
     Returns:
         bytes: The encrypted data with the given key.
@@ -52,7 +58,7 @@ def encrypt(data: bytes, key: bytes) -> bytes:
 
     # Generate the random nonce
 
-    nonce = os.urandom(NONCE_SIZE)
+    nonce = (get_default() if rng is None else rng).bytes(NONCE_SIZE)
 
     # Encrypt the given data
 
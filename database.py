@@ -0,0 +1,693 @@
+from controller import Controller, SENSOR_DEFAULTS, failed_mask
+from threading import Lock
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The array type code of each sensor type (strings are kept in a fixed width byte array)
+
+COLUMN_TYPES = {
+    'INT': 'i',
+    'FLOAT': 'f',
+    'BOOLEAN': 'b'
+}
+
+# The number of sorted runs of timestamps searched one by one, above which the rows are scanned
+
+MAX_RUNS = 16
+
+class DeviceColumns:
+    '''
+    A class representing the append-only columns of the readings of a single device.
+
+    The readings are appended in the order they arrive, which is not always the order of their timestamps
+    (the clocks of the gateways differ), so the rows are split in runs of sorted timestamps, each one being
+    searched on its own.
+
+    Attributes:
+        __sensors (list): The sensors of the device, in the format of the controller.
+        __times (array): The timestamp of each reading.
+        __sessions (array): The session identifier of each reading.
+        __states (array): The device state of each reading.
+        __columns (list): One column per sensor (an array, or a bytearray of fixed width strings).
+        __failed (bytearray): The failure bitmap of each reading, with a bit per sensor.
+        __failed_size (int): The size of each failure bitmap in bytes.
+        __ranges (dict): The (start, stop) row ranges of each session identifier.
+        __runs (list): The first row of each run of sorted timestamps.
+    '''
+
+    def __init__(self, controller: Controller):
+        '''
+        Initializes a DeviceColumns object.
+
+        Args:
+            controller (Controller): The controller that defines the sensors of the device.
+        '''
+
+        self.__sensors = controller.get_sensors()
+        self.__times = array('d')
+        self.__sessions = array('I')
+        self.__states = array('B')
+        self.__columns = [bytearray() if sensor['type'] == 'STRING' else array(COLUMN_TYPES[sensor['type']]) for sensor in self.__sensors]
+        self.__failed = bytearray()
+        self.__failed_size = controller.get_failed_size()
+        self.__ranges = dict()
+        self.__runs = [0]
+
+    def __len__(self) -> int:
+        '''
+        Returns the number of readings stored.
+
+        Returns:
+            int: The number of readings.
+        '''
+
+        return len(self.__times)
+
+    def __index_session(self, session_id: int, start: int, n_rows: int) -> None:
+        '''
+        Extends the row ranges of a session with the rows being appended.
+
+        Args:
+            session_id (int): The identifier of the session.
+            start (int): The first row being appended.
+            n_rows (int): The number of rows being appended.
+
+        Returns:
+            None: The ranges are updated.
+        '''
+
+        ranges = self.__ranges.setdefault(session_id, [])
+
+        # Grow the last range if the rows are contiguous, otherwise open a new one
+
+        if ranges and ranges[-1][1] == start:
+
+            ranges[-1][1] = start + n_rows
+
+        else:
+
+            ranges.append([start, start + n_rows])
+
+    def append(self, session_id: int, state: int, sensors: list, timestamp: float) -> None:
+        '''
+        Appends a reading to the columns.
+
+        Args:
+            session_id (int): The identifier of the session.
+            state (int): The state of the device.
+            sensors (list): The list of information from the sensors (None for a failed sensor).
+            timestamp (float): The time of the reading.
+
+        Returns:
+            None: The reading is appended.
+        '''
+
+        self.__index_session(session_id, len(self.__times), 1)
+
+        # Failed sensors are marked in the bitmap and hold the default value of their type in the columns
+
+        failed = sum(1 << i for i, reading in enumerate(sensors) if reading is None)
+
+        self.__failed += failed.to_bytes(self.__failed_size, 'little')
+
+        for sensor, column, reading in zip(self.__sensors, self.__columns, sensors):
+
+            if reading is None:
+
+                reading = SENSOR_DEFAULTS[sensor['type']]
+
+            if sensor['type'] == 'STRING':
+
+                column += reading.encode('utf-8').ljust(sensor['length'], b'\x00')[0:sensor['length']]
+
+            else:
+
+                column.append(reading)
+
+        # A reading older than the previous one starts a new sorted run
+
+        if self.__times and timestamp < self.__times[-1]:
+
+            self.__runs.append(len(self.__times))
+
+        self.__states.append(state)
+        self.__sessions.append(session_id)
+        self.__times.append(timestamp)
+
+    def extend_records(self, records, session_id: int = None, timestamp: float = None) -> list:
+        '''
+        Appends a record array of readings to the columns, one column at a time.
+
+        Args:
+            records (numpy.recarray): The readings, as given by Controller.bytes_to_records or SegmentStore.read.
+            session_id (int) = None: The identifier of the session (if the records have no 'session' field).
+            timestamp (float) = None: The time of the readings (if the records have no 'time' field).
+
+        Returns:
+            list: The session identifiers of the readings appended.
+        '''
+
+        n_rows = len(records)
+        first = len(self.__times)
+
+        sessions = records['session'] if session_id is None else np.full(n_rows, session_id, dtype='u4')
+        times = records['time'] if timestamp is None else np.full(n_rows, timestamp, dtype='f8')
+
+        # Index each run of readings of the same session
+
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(sessions)) + 1)) if n_rows else []
+        stops = list(starts[1:]) + [n_rows]
+
+        for start, stop in zip(starts, stops):
+
+            self.__index_session(int(sessions[start]), first + int(start), int(stop - start))
+
+        # The record fields have the same layout as the columns
+
+        for i, column in enumerate(self.__columns):
+
+            if isinstance(column, bytearray):
+
+                column += records[f'sensor_{i}'].tobytes()
+
+            else:
+
+                column.frombytes(records[f'sensor_{i}'].astype(column.typecode).tobytes())
+
+        # Every reading older than the previous one starts a new sorted run
+
+        if n_rows:
+
+            previous = np.concatenate(([self.__times[-1] if self.__times else times[0]], times[:-1]))
+
+            self.__runs.extend((first + np.flatnonzero(times < previous)).tolist())
+
+        self.__failed += records['failed'].tobytes()
+        self.__states.frombytes(records['state'].astype('B').tobytes())
+        self.__sessions.frombytes(sessions.astype('I').tobytes())
+        self.__times.frombytes(times.astype('d').tobytes())
+
+        return [int(sessions[start]) for start in starts]
+
+    def __row(self, device_id: int, i: int) -> dict:
+        '''
+        Builds the entry of a row.
+
+        Args:
+            device_id (int): The identifier of the device.
+            i (int): The row.
+
+        Returns:
+            dict: The entry, with the device, session, state, sensors and time.
+        '''
+
+        sensors = []
+
+        failed = int.from_bytes(self.__failed[i * self.__failed_size:(i + 1) * self.__failed_size], 'little')
+
+        for j, (sensor, column) in enumerate(zip(self.__sensors, self.__columns)):
+
+            if failed >> j & 1:
+
+                sensors.append(None)
+
+            elif sensor['type'] == 'STRING':
+
+                length = sensor['length']
+
+                sensors.append(column[i * length:(i + 1) * length].rstrip(b'\x00').decode('utf-8'))
+
+            elif sensor['type'] == 'BOOLEAN':
+
+                sensors.append(bool(column[i]))
+
+            else:
+
+                sensors.append(column[i])
+
+        return {
+            'device_id': device_id,
+            'session_id': self.__sessions[i],
+            'state': self.__states[i],
+            'sensors': sensors,
+            'time': self.__times[i]
+        }
+
+    def __select(self, n_rows: int, start: float = None, end: float = None):
+        '''
+        Finds the rows inside a time range with a binary search on each run of sorted timestamps.
+
+        Args:
+            n_rows (int): The number of rows visible to the search.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+
+        Returns:
+            range | list: The rows, a range if they are contiguous, otherwise a list sorted by time.
+        '''
+
+        runs = self.__runs[0:bisect_left(self.__runs, n_rows)]
+
+        # The common case of readings appended in order
+
+        if len(runs) <= 1:
+
+            lo = 0 if start is None else bisect_left(self.__times, start, 0, n_rows)
+            hi = n_rows if end is None else bisect_left(self.__times, end, 0, n_rows)
+
+            return range(lo, max(lo, hi))
+
+        if len(runs) <= MAX_RUNS:
+
+            selected = []
+
+            for first, stop in zip(runs, runs[1:] + [n_rows]):
+
+                lo = first if start is None else bisect_left(self.__times, start, first, stop)
+                hi = stop if end is None else bisect_left(self.__times, end, first, stop)
+
+                selected.extend(range(lo, hi))
+
+        else:
+
+            # Too many runs to search, scan the timestamps
+
+            selected = [i for i in range(n_rows) if (start is None or self.__times[i] >= start) and (end is None or self.__times[i] < end)]
+
+        # The sort is stable, the readings of the same time stay in insertion order
+
+        return sorted(selected, key=self.__times.__getitem__)
+
+    def rows(self, device_id: int, n_rows: int, start: float = None, end: float = None, session_id: int = None):
+        '''
+        Yields the entries of the device among the first rows, touching only the rows of the time range and session.
+
+        The columns are append-only, so the first rows never change and can be read while others are appended.
+
+        Args:
+            device_id (int): The identifier of the device.
+            n_rows (int): The number of rows visible to the reader.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+            session_id (int) = None: The identifier of session to filter.
+
+        Returns:
+            generator: The entries, in time order (in insertion order for the same time).
+        '''
+
+        selected = self.__select(n_rows, start, end)
+
+        if isinstance(selected, range) and session_id is not None:
+
+            selected = [i for first, last in list(self.__ranges.get(session_id, [])) for i in range(max(selected.start, first), min(selected.stop, last))]
+
+        elif session_id is not None:
+
+            selected = [i for i in selected if self.__sessions[i] == session_id]
+
+        for i in selected:
+
+            yield self.__row(device_id, i)
+
+    def last(self, device_id: int, n_rows: int, n: int) -> list:
+        '''
+        Returns the most recent entries of the device among the first rows.
+
+        Args:
+            device_id (int): The identifier of the device.
+            n_rows (int): The number of rows visible to the reader.
+            n (int): The number of entries.
+
+        Returns:
+            list: The entries, from the oldest to the newest.
+        '''
+
+        return [self.__row(device_id, i) for i in range(max(0, n_rows - n), n_rows)]
+
+    def aggregate(self, n_rows: int, start: float = None, end: float = None, window: float = None) -> list:
+        '''
+        Computes the min, max, mean and last value of each sensor over the windows of a time range, among the first rows.
+
+        The failed readings of a sensor are left out of its statistics, which are None in a window where it always failed.
+
+        Args:
+            n_rows (int): The number of rows visible to the reader.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+            window (float) = None: The length of the windows (a single window if not given).
+
+        Returns:
+            list: A dictionary per window with readings, with its 'start', 'count' and per sensor statistics.
+
+        Raises:
+            ImportError: If numpy is not available.
+            ValueError: If the window is not positive.
+        '''
+
+        if np is None:
+            raise ImportError('numpy is required for aggregate queries')
+
+        if window is not None and window <= 0:
+            raise ValueError(f'the window must be positive, not {window}')
+
+        selected = self.__select(n_rows, start, end)
+
+        if len(selected) == 0:
+            return []
+
+        # Work over copies of the rows, so the columns can keep growing meanwhile
+
+        if isinstance(selected, range):
+
+            lo, hi = selected.start, selected.stop
+            positions = np.arange(hi - lo)
+
+        else:
+
+            lo, hi = min(selected), max(selected) + 1
+            positions = np.array(selected) - lo
+
+        times = np.frombuffer(self.__times[lo:hi], dtype='f8')[positions]
+
+        origin = times[0] if start is None else start
+
+        # Find where each window starts, the selected rows are sorted by time
+
+        if window is None:
+
+            starts = np.array([0])
+            windows = [origin]
+
+        else:
+
+            bins = ((times - origin) // window).astype('i8')
+
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+            windows = (origin + bins[starts] * window).tolist()
+
+        counts = np.diff(np.append(starts, len(times)))
+
+        # Reduce every sensor column at once per window, leaving out the failed readings
+
+        failed = np.frombuffer(self.__failed[lo * self.__failed_size:hi * self.__failed_size], dtype='u1').reshape(hi - lo, self.__failed_size)[positions]
+
+        statistics = []
+
+        for j, (sensor, column) in enumerate(zip(self.__sensors, self.__columns)):
+
+            valid = ~failed_mask(failed, j)
+
+            # The last valid row of each window (-1 if every reading of the window failed)
+
+            lasts = np.maximum.reduceat(np.where(valid, np.arange(len(positions)), -1), starts).tolist()
+
+            if sensor['type'] == 'STRING':
+
+                length = sensor['length']
+
+                rows = [None if i < 0 else lo + int(positions[i]) for i in lasts]
+
+                values = [None if i is None else column[i * length:(i + 1) * length].rstrip(b'\x00').decode('utf-8') for i in rows]
+
+                statistics.append([{'last': value} for value in values])
+
+                continue
+
+            values = np.frombuffer(column[lo:hi], dtype=column.typecode)[positions].astype('f8')
+            cast = float if sensor['type'] == 'FLOAT' else int
+
+            valid_counts = np.add.reduceat(valid.astype('i8'), starts).tolist()
+            mins = np.fmin.reduceat(np.where(valid, values, np.nan), starts).tolist()
+            maxs = np.fmax.reduceat(np.where(valid, values, np.nan), starts).tolist()
+            sums = np.add.reduceat(np.where(valid, values, 0.0), starts).tolist()
+
+            statistics.append([{
+                'min': cast(mins[i]) if valid_counts[i] else None,
+                'max': cast(maxs[i]) if valid_counts[i] else None,
+                'mean': sums[i] / valid_counts[i] if valid_counts[i] else None,
+                'last': cast(values[lasts[i]]) if lasts[i] >= 0 else None,
+                'count': valid_counts[i]
+            } for i in range(len(starts))])
+
+        return [{
+            'start': windows[i],
+            'count': int(counts[i]),
+            'sensors': [sensor[i] for sensor in statistics]
+        } for i in range(len(starts))]
+
+    def memory_usage(self) -> int:
+        '''
+        Returns the number of bytes used by the columns.
+
+        Returns:
+            int: The size of the columns.
+        '''
+
+        columns = [self.__times, self.__sessions, self.__states, self.__failed] + self.__columns
+
+        return sum(len(column) * column.itemsize if isinstance(column, array) else len(column) for column in columns)
+
+class Database:
+    '''
+    A class representing the columnar database of the device readings, indexed by device and session.
+
+    Attributes:
+        __devices (dict): The columns of each device identifier.
+        __sessions (dict): The set of device identifiers with readings of each session identifier.
+        __lock (Lock): The lock that protects the columns and indexes.
+    '''
+
+    def __init__(self):
+        '''
+        Initializes a Database object.
+        '''
+
+        self.__devices = dict()
+        self.__sessions = dict()
+        self.__lock = Lock()
+
+    def register_device(self, device_id: int, controller: Controller) -> None:
+        '''
+        Creates the columns of a device, based on its sensors.
+
+        Args:
+            device_id (int): The identifier of the device.
+            controller (Controller): The controller that defines the sensors of the device.
+
+        Returns:
+            None: The device is registered.
+        '''
+
+        with self.__lock:
+
+            if device_id not in self.__devices:
+
+                self.__devices[device_id] = DeviceColumns(controller)
+
+    def add(self, device_id: int, session_id: int, state: int, sensors: list, timestamp: float) -> None:
+        '''
+        Adds a reading to the database.
+
+        Args:
+            device_id (int): The identifier of the device.
+            session_id (int): The identifier of the session.
+            state (int): The state of the device.
+            sensors (list): The list of information from the sensors.
+            timestamp (float): The time of the reading.
+
+        Returns:
+            None: The reading is added.
+        '''
+
+        with self.__lock:
+
+            self.__devices[device_id].append(session_id, state, sensors, timestamp)
+
+            self.__sessions.setdefault(session_id, set()).add(device_id)
+
+    def add_records(self, device_id: int, records, session_id: int = None, timestamp: float = None) -> None:
+        '''
+        Adds a record array of readings of the same device to the database.
+
+        Args:
+            device_id (int): The identifier of the device.
+            records (numpy.recarray): The readings, as given by Controller.bytes_to_records or SegmentStore.read.
+            session_id (int) = None: The identifier of the session (if the records have no 'session' field).
+            timestamp (float) = None: The time of the readings (if the records have no 'time' field).
+
+        Returns:
+            None: The readings are added.
+        '''
+
+        with self.__lock:
+
+            for session in self.__devices[device_id].extend_records(records, session_id, timestamp):
+
+                self.__sessions.setdefault(session, set()).add(device_id)
+
+    def snapshot(self) -> dict:
+        '''
+        Captures the number of rows of each device, which define a consistent version of the database.
+
+        Returns:
+            dict: The number of rows of each device identifier.
+        '''
+
+        with self.__lock:
+
+            return {device_id: len(columns) for device_id, columns in self.__devices.items()}
+
+    def rows(self, device_id: int = None, session_id: int = None, start: float = None, end: float = None, snapshot: dict = None):
+        '''
+        Yields the entries that match the filters lazily, from a snapshot, so the writers are never blocked.
+
+        The lock is only taken to capture the snapshot (if not given) and the devices to look at, the entries are
+        built while new readings keep being added.
+
+        Args:
+            device_id (int) = None: The identifier of device to filter.
+            session_id (int) = None: The identifier of session to filter.
+            start (float) = None: The start of the time range (inclusive).
+            end (float) = None: The end of the time range (exclusive).
+            snapshot (dict) = None: The snapshot to read (the current one if not given).
+
+        Returns:
+            generator: The entries, with the device, session, state, sensors and time.
+        '''
+
+        with self.__lock:
+
+            if snapshot is None:
+
+                snapshot = {dev_id: len(columns) for dev_id, columns in self.__devices.items()}
+
+            # Choose the devices to look at
+
+            if device_id is not None:
+
+                devices = [device_id] if device_id in snapshot else []
+
+            elif session_id is not None:
+
+                devices = sorted(dev_id for dev_id in self.__sessions.get(session_id, []) if dev_id in snapshot)
+
+            else:
+
+                devices = list(snapshot)
+
+            columns = [(dev_id, self.__devices[dev_id]) for dev_id in devices]
+
+        for dev_id, device in columns:
+
+            yield from device.rows(dev_id, snapshot[dev_id], start, end, session_id)
+
+    def select(self, device_id: int = None, session_id: int = None) -> list:
+        '''
+        Returns the entries that match the filters, using the indexes to skip the other devices and sessions.
+
+        Args:
+            device_id (int) = None: The identifier of device to filter.
+            session_id (int) = None: The identifier of session to filter.
+
+        Returns:
+            list: The entries, with the device, session, state, sensors and time.
+        '''
+
+        return list(self.rows(device_id, session_id))
+
+    def query(self, device_id: int, start: float = None, end: float = None, session_id: int = None) -> list:
+        '''
+        Returns the entries of a device inside a time range.
+
+        Args:
+            device_id (int): The identifier of the device.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+            session_id (int) = None: The identifier of session to filter.
+
+        Returns:
+            list: The entries, with the device, session, state, sensors and time.
+        '''
+
+        return list(self.rows(device_id, session_id, start, end))
+
+    def last(self, device_id: int, n: int) -> list:
+        '''
+        Returns the most recent entries of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+            n (int): The number of entries.
+
+        Returns:
+            list: The entries, from the oldest to the newest.
+        '''
+
+        with self.__lock:
+
+            if device_id not in self.__devices:
+                return []
+
+            device = self.__devices[device_id]
+            n_rows = len(device)
+
+        return device.last(device_id, n_rows, n)
+
+    def aggregate(self, device_id: int, start: float = None, end: float = None, window: float = None) -> list:
+        '''
+        Computes the min, max, mean and last value of each sensor of a device over the windows of a time range.
+
+        Args:
+            device_id (int): The identifier of the device.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+            window (float) = None: The length of the windows (a single window if not given).
+
+        Returns:
+            list: A dictionary per window with readings, with its 'start', 'count' and per sensor statistics.
+
+        Raises:
+            ImportError: If numpy is not available.
+            ValueError: If the window is not positive.
+        '''
+
+        # Only capture the visible rows under the lock
+
+        with self.__lock:
+
+            if device_id not in self.__devices:
+                return []
+
+            device = self.__devices[device_id]
+            n_rows = len(device)
+
+        return device.aggregate(n_rows, start, end, window)
+
+    def __len__(self) -> int:
+        '''
+        Returns the number of readings stored.
+
+        Returns:
+            int: The number of readings.
+        '''
+
+        with self.__lock:
+
+            return sum(len(columns) for columns in self.__devices.values())
+
+    def memory_usage(self) -> int:
+        '''
+        Returns the number of bytes used by the columns of all the devices.
+
+        Returns:
+            int: The size of the columns.
+        '''
+
+        with self.__lock:
+
+            return sum(columns.memory_usage() for columns in self.__devices.values())
@@ -0,0 +1,148 @@
+from utils import xor
+
+KEYFRAME = 0
+DELTA = 1
+
+class DeltaCodec:
+    '''
+    A class that encodes successive readings of a device as differences to the previous one.
+
+    The first reading (and any reading that doesn't benefit from it) is sent whole as a keyframe, the
+    others are XORed with the previous reading and only the bytes that changed are sent, after a bitmap
+    marking their positions.
+
+    Attributes:
+        __previous (bytes): The last reading encoded or decoded (None before the first keyframe).
+    '''
+
+    def __init__(self):
+        '''
+        Initializes a DeltaCodec object.
+        '''
+
+        self.__previous = None
+
+    def get_previous(self) -> bytes:
+        '''
+        Returns the previous reading, the state the next frame depends on.
+
+        Returns:
+            bytes: The last reading encoded or decoded (None before the first keyframe).
+        '''
+
+        return self.__previous
+
+    def set_previous(self, reading: bytes) -> None:
+        '''
+        Restores the previous reading, to continue a stream on another codec.
+
+        Args:
+            reading (bytes): The last reading encoded or decoded (None before the first keyframe).
+
+        Returns:
+            None: The codec continues from the reading.
+        '''
+
+        self.__previous = reading
+
+    def reset(self) -> None:
+        '''
+        Forgets the previous reading, so the next one is sent as a keyframe.
+
+        Returns:
+            None: The codec is reset.
+        '''
+
+        self.__previous = None
+
+    def encode(self, reading: bytes) -> bytes:
+        '''
+        Encodes a reading relative to the previous one.
+
+        Args:
+            reading (bytes): The reading in binary mode.
+
+        Returns:
+            bytes: The keyframe or the delta frame.
+        '''
+
+        previous = self.__previous
+        self.__previous = reading
+
+        # Send a keyframe when there is nothing to compare to
+
+        if previous is None or len(previous) != len(reading):
+
+            return KEYFRAME.to_bytes(1, 'little') + reading
+
+        # Mark the bytes that changed and keep their difference
+
+        diff = xor(previous, reading)
+
+        bitmap = bytearray((len(reading) + 7) // 8)
+        changed = bytearray()
+
+        for i, byte in enumerate(diff):
+
+            if byte != 0:
+
+                bitmap[i // 8] |= 1 << (i % 8)
+                changed.append(byte)
+
+        # Send a keyframe if the delta wouldn't be smaller
+
+        if len(bitmap) + len(changed) >= len(reading):
+
+            return KEYFRAME.to_bytes(1, 'little') + reading
+
+        return DELTA.to_bytes(1, 'little') + bytes(bitmap) + bytes(changed)
+
+    def decode(self, frame: bytes) -> bytes:
+        '''
+        Reconstructs a reading from a keyframe or a delta frame.
+
+        Args:
+            frame (bytes): The keyframe or the delta frame.
+
+        Returns:
+            bytes: The reading in binary mode.
+
+        Raises:
+            ValueError: If a delta frame arrives before any keyframe, or doesn't match the previous reading.
+        '''
+
+        if not frame:
+            raise ValueError('empty frame')
+
+        if frame[0] == KEYFRAME:
+
+            self.__previous = frame[1:]
+
+            return self.__previous
+
+        if self.__previous is None:
+            raise ValueError('delta frame received before a keyframe')
+
+        # Apply the changed bytes over the previous reading
+
+        reading = bytearray(self.__previous)
+
+        n_bitmap = (len(reading) + 7) // 8
+        bitmap = frame[1:1 + n_bitmap]
+        changed = 1 + n_bitmap
+
+        # The frame must have the bitmap of the previous reading and one byte per position it marks
+
+        if len(bitmap) < n_bitmap or len(frame) != changed + sum(bin(byte).count('1') for byte in bitmap):
+            raise ValueError('delta frame does not match the previous reading')
+
+        for i in range(len(reading)):
+
+            if bitmap[i // 8] & (1 << (i % 8)):
+
+                reading[i] ^= frame[changed]
+                changed += 1
+
+        self.__previous = bytes(reading)
+
+        return self.__previous
@@ -1,22 +1,43 @@
-from authenticator import InvalidCommParameters, Authenticator, KEY_LENGTH, TIME_TO_LIVE
+from authenticator import Authenticator, TIME_TO_LIVE
 from controller import Controller
 from copy import deepcopy
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import create_connection, MSG_PEEK
 from message import Message
-from challenge import Challenge, CHALLENGE_SIZE
-from crypto import decrypt
-from time import sleep
+from handshake import DeviceHandshake
+from delta import DeltaCodec
+from rng import Randomness
+from persistence import PersistencePolicy
+from threading import Event, Lock
+import instrument
+
+# The seconds a device waits to reconnect after an error
+
+RECONNECT_DELAY = 5.0
 
 class Device:
     '''
     A class that emulates the functioning IoT device controller.
 
+    When the connection is lost the device reconnects. A live session is resumed on the new connection
+    without a handshake only if the server handed it off (as between the nodes of a cluster), otherwise the
+    server abandoned it and the device authenticates again.
+
     Attributes:
         __controller (controller): The sensors and state controller.
-        __server (communicator): The connection socket to the server.
+        __addr (str): The address of the server.
+        __port (int): The port of the server.
+        __server (communicator): The connection socket to the server (None if not connected).
+        __delta (DeltaCodec): The encoder of successive readings (None if the delta mode is disabled).
+        __rng (Randomness): The source of the keys, challenges and nonces (None for the default one).
+        __persistence (PersistencePolicy): How often the rotated vault is persisted (None for the default one).
+        __interval (float): The seconds between the readings.
+        __reconnectDelay (float): The seconds between the attempts to reconnect.
+        __handedOff (bool): If the server handed the session off before closing the current connection.
+        __stopped (Event): Set when the device is closed.
+        __closeLock (Lock): The lock that serializes the closes, from the running loop and from other threads.
     '''
 
-    def __init__(self, sv_addr: str, sv_port: int, device_id: int, controller: Controller):
+    def __init__(self, sv_addr: str, sv_port: int, device_id: int, controller: Controller, rng: Randomness = None, persistence: PersistencePolicy = None, interval: float = 3.0, reconnect_delay: float = RECONNECT_DELAY):
             '''
             Initializes a Device object.
 
@@ -25,13 +46,33 @@ class Device:
                 sv_port (int): The port of the server.
                 device_it (int): The identifier of the device.
                 controller (controller): The controller of the IoT device state and sensors.
+                rng (Randomness) = None: The source of the keys and the readings (the default one if not given).
+                persistence (PersistencePolicy) = None: How often the rotated vault is persisted (the Authenticator default if not given).
+                interval (float) = 3.0: The seconds between the readings.
+                reconnect_delay (float) = RECONNECT_DELAY: The seconds between the attempts to reconnect.
             '''
 
             self.__deviceId = device_id
-            self.__server = socket(AF_INET, SOCK_STREAM)
-            self.__server.connect((sv_addr, sv_port))
+            self.__addr = sv_addr
+            self.__port = sv_port
+            self.__server = create_connection((sv_addr, sv_port))
             self.__authenticator = None
             self.__controller = deepcopy(controller)
+            self.__delta = DeltaCodec() if controller.is_delta() else None
+            self.__rng = None
+            self.__persistence = persistence
+            self.__interval = interval
+            self.__reconnectDelay = reconnect_delay
+            self.__handedOff = False
+            self.__stopped = Event()
+            self.__closeLock = Lock()
+
+            # The readings and the sessions draw from their own streams, so they don't depend on each other
+
+            if rng is not None:
+
+                self.__rng = rng.derive(device_id, 'auth')
+                self.__controller.set_rng(rng.derive(device_id, 'sensors'))
 
     def __send_sv(self, data: bytes) -> None:
         '''
@@ -74,35 +115,44 @@ class Device:
             BrokenPipeError: In case communication fails.
         '''
 
-        # Reset or initialize the authenticator
-        
-        if self.__authenticator is None:
-             
-            self.__authenticator = Authenticator(self.__deviceId, True)
+        timer = instrument.timer('dv.handshake')
+
+        # Rotate the vault after a finished session, an unfinished one is abandoned (as the server does) by
+        # loading the vault again
+
+        if self.__authenticator is not None and self.__authenticator.time_lived() == TIME_TO_LIVE:
 
-        else:
-             
             self.__authenticator.reset()
 
-        # Create the handshake to send to the server
+            timer.lap('rotate')
 
-        m1 = self.__authenticator.handshake(False)
+        else:
 
-        m1.write_bytes(self.__server)
+            self.__authenticator = Authenticator(self.__deviceId, True, rng = self.__rng, persistence = self.__persistence)
 
-        # Receive and solve challenge from server
+            timer.lap('vault_load')
 
-        m2 = Message.read_bytes(self.__server)
+        # Start the readings of the new session with a keyframe
+
+        if self.__delta is not None:
 
-        ch1 = Challenge.from_bytes(m2.get_data())
+            self.__delta.reset()
 
-        k1 = self.__authenticator.solve_challenge(ch1)
+        # Create the handshake to send to the server
+
+        handshake = DeviceHandshake(self.__authenticator)
 
-        # Create challenge for server
+        handshake.start().write_bytes(self.__server)
 
-        k2, ch2 = self.__authenticator.generate_challenge(True, ch1.get_set())
+        # Receive and solve challenge from server, and challenge it back
 
-        m3 = self.__authenticator.handshake(True, k1, ch1.get_chal(), ch2)
+        m2 = Message.read_bytes(self.__server)
+
+        timer.lap('m1_m2')
+
+        m3 = handshake.respond(m2)
+
+        timer.lap('challenge')
 
         m3.write_bytes(self.__server)
 
@@ -110,52 +160,161 @@ class Device:
 
         m4 = Message.read_bytes(self.__server)
 
-        self.__authenticator.check_handshake(m4)
+        timer.lap('m3_m4')
+
+        handshake.finish(m4)
+
+        timer.lap('decrypt')
+        timer.stop()
+
+        instrument.count('dv.handshakes')
+
+    def __is_connected(self) -> bool:
+        '''
+        Checks if the server kept the connection open, taking the hand-off the server sends before closing it.
+
+        Returns:
+            bool: If the connection is open.
+        '''
+
+        self.__server.setblocking(False)
+
+        try:
+
+            pending = self.__server.recv(1, MSG_PEEK)
+
+        except BlockingIOError:
+
+            return True
+
+        except OSError:
+
+            return False
+
+        finally:
+
+            self.__server.setblocking(True)
+
+        # The server sends nothing between the handshakes but the hand-off of the session, before the end of the stream
+
+        if pending != b'':
+
+            try:
+
+                msg = Message.read_bytes(self.__server)
+
+            except Exception:
 
-        data = decrypt(m4.get_data(), k2)
+                return False
 
-        if not ch2.verify(data[0:CHALLENGE_SIZE]):
-            raise InvalidCommParameters()
+            self.__handedOff = msg.get_type() == b'4' and self.__authenticator is not None and msg.get_deviceId() == self.__deviceId and msg.get_sessionId() == self.__authenticator.get_session_id()
 
-        self.__authenticator.feed_key(data[CHALLENGE_SIZE:CHALLENGE_SIZE + KEY_LENGTH])
+        return False
+
+    def __connect(self) -> None:
+        '''
+        Connects to the server if the connection was lost, resuming the session if the server handed it off.
+
+        Returns:
+            None: The device is connected, with a session unless it needs a handshake.
+        '''
+
+        if self.__server is not None and not self.__is_connected():
+
+            self.__disconnect()
+
+        if self.__server is None:
+
+            self.__server = create_connection((self.__addr, self.__port))
+
+            # A hand-off is resumed once, the next connection that ends without one abandons the session
+
+            self.__handedOff = False
+
+        # Authenticate the device
+
+        if self.__authenticator is None or self.__authenticator.time_lived() == TIME_TO_LIVE:
+
+            # A failed handshake leaves no session to resume
+
+            try:
+
+                self.__authenticate()
+
+            except Exception:
+
+                self.__authenticator = None
+
+                raise
+
+    def __disconnect(self) -> None:
+        '''
+        Drops the connection, keeping the session only if the server handed it off.
+
+        Returns:
+            None: The device is disconnected.
+        '''
+
+        # The server abandons an unfinished session when the connection ends, a finished one is rotated on both sides
+
+        if not self.__handedOff and self.__authenticator is not None and self.__authenticator.time_lived() < TIME_TO_LIVE:
+
+            self.__authenticator = None
+
+        if self.__server is not None:
+
+            self.__server.close()
+
+        self.__server = None
 
     def run(self) -> None:
         '''
-        Runs one single execution of the functioning loop.
+        Runs the functioning loop until the device is closed, reconnecting when the connection is lost.
 
         Returns:
             None: The execution is runned.
         '''
-    
 
         try:
 
-            while True:
+            while not self.__stopped.is_set():
+
+                try:
+
+                    if self.__stopped.wait(self.__interval):
+                        break
 
-                # Authenticate the device
+                    # Check the connection right before sending, so a hand-off or a restart of the server isn't missed
 
-                if self.__authenticator is None or self.__authenticator.time_lived() == TIME_TO_LIVE:
+                    self.__connect()
 
-                    self.__authenticate()
+                    # Generate the sensor data
 
-                # Generate the sensor data
+                    self.__controller.change_state()
 
-                sleep(3)
+                    data = self.__controller.read_device_bytes(None)
 
-                self.__controller.change_state()
+                    if self.__delta is not None:
 
-                data = self.__controller.read_device_bytes(None)
+                        data = self.__delta.encode(data)
 
-                # Send sensor data to the server
+                    # Send sensor data to the server
 
-                self.__send_sv(data)
+                    self.__send_sv(data)
 
-        except Exception:
+                except Exception:
 
-            print('Lost connection to the server!')
+                    if self.__stopped.is_set():
+                        break
+
+                    print('Lost connection to the server, reconnecting')
+
+                    self.__disconnect()
+
+                    self.__stopped.wait(self.__reconnectDelay)
 
         finally:
-            
+
             self.close()
 
     def close(self) -> None:
@@ -166,4 +325,18 @@ class Device:
             None: Finalizes the device functioning.
         '''
 
-        self.__server.close()
\ No newline at end of file
+        self.__stopped.set()
+
+        with self.__closeLock:
+
+            # Persist the rotations that are only journaled
+
+            authenticator, server = self.__authenticator, self.__server
+
+            if authenticator is not None:
+
+                authenticator.persist()
+
+            if server is not None:
+
+                server.close()
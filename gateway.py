@@ -0,0 +1,485 @@
+from handler import Handler
+from authenticator import Authenticator, InvalidCommParameters, TIME_TO_LIVE
+from handshake import run_handshake
+from message import Message, batch_to_bytes, BATCH_ACCEPTED, BATCH_REJECTED
+from crypto import NONCE_SIZE
+from ingest import IngestLanes
+from metrics import MetricsServer
+from config_dv import thermo, assist
+from setup import load_registry, PATH_REGISTRY
+from rng import Randomness, get_default
+from socket import create_connection
+from threading import Condition, Lock, Thread, Event
+import argparse, os
+
+# The seconds the uplink waits for the server to answer
+
+UPLINK_TIMEOUT = 10.0
+
+# The seconds the uplink waits to reconnect after an error
+
+RETRY_DELAY = 1.0
+
+class Uplink:
+    '''
+    A class that forwards the readings of a gateway to the central server in batches, over one authenticated
+    long lived connection.
+
+    The gateway authenticates to the server as a device of its own, registered in the server without a
+    controller. Each batch is a message of the gateway session, so the session is renewed every TIME_TO_LIVE
+    batches on the same connection. The readings are grouped by device session and a batch is sent when it
+    holds enough readings, after the maximum delay, or at once when an alarm comes in.
+
+    The server acknowledges every batch. A batch that isn't acknowledged is queued again ahead of the newer
+    readings and sent after reconnecting (so a batch whose acknowledgement is lost may be stored twice), and
+    the readings push back on the devices when too many are waiting. A batch the server rejects is dropped, once
+    the rejection is authenticated with the session key.
+
+    Attributes:
+        __gatewayId (int): The identifier of the gateway.
+        __addr (str): The address of the server.
+        __port (int): The port of the server.
+        __maxReadings (int): The readings that make a batch full.
+        __maxDelay (float): The seconds a reading waits at most for its batch.
+        __maxPending (int): The readings that can wait before the devices are held back.
+        __rng (Randomness): The source of the keys, challenges and nonces.
+        __server (socket): The connection to the server (None if not connected).
+        __authenticator (Authenticator): The authenticator of the gateway session (None if there is none).
+        __groups (dict): The readings waiting, as (data, timestamps) of each (device_id, session_id).
+        __count (int): The number of readings waiting.
+        __lock (Lock): The lock that protects the readings waiting.
+        __space (Condition): Signals that readings were taken for a batch.
+        __sendLock (Lock): The lock that serializes the batches.
+        __wake (Event): Set when a batch has to be sent before the delay.
+        __running (bool): If the batches are being sent.
+        __stopped (Event): Set when the uplink is closed.
+        __thread (Thread): The thread that sends the batches.
+        __stats (dict): The readings and batches sent, the readings rejected and the errors.
+    '''
+
+    def __init__(self, gateway_id: int, addr: str, port: int, max_readings: int = 256, max_delay: float = 0.05, rng: Randomness = None, max_pending: int = 65536):
+        '''
+        Initializes an Uplink object.
+
+        Args:
+            gateway_id (int): The identifier of the gateway.
+            addr (str): The address of the server.
+            port (int): The port of the server.
+            max_readings (int) = 256: The readings that make a batch full.
+            max_delay (float) = 0.05: The seconds a reading waits at most for its batch.
+            rng (Randomness) = None: The source of the keys and challenges (the default one if not given).
+            max_pending (int) = 65536: The readings that can wait before the devices are held back.
+        '''
+
+        if rng is None:
+            rng = get_default()
+
+        self.__gatewayId = gateway_id
+        self.__addr = addr
+        self.__port = port
+        self.__maxReadings = max_readings
+        self.__maxDelay = max_delay
+        self.__maxPending = max_pending
+        self.__rng = rng.derive(gateway_id, 'auth')
+        self.__server = None
+        self.__authenticator = None
+        self.__groups = dict()
+        self.__count = 0
+        self.__lock = Lock()
+        self.__space = Condition(self.__lock)
+        self.__sendLock = Lock()
+        self.__wake = Event()
+        self.__running = False
+        self.__stopped = Event()
+        self.__thread = None
+        self.__stats = {'readings': 0, 'batches': 0, 'rejected': 0, 'handshakes': 0, 'errors': 0}
+
+    def add(self, device_id: int, session_id: int, state: int, data: bytes, timestamp: float) -> None:
+        '''
+        Queues a reading for the next batch, as the sink of the Handler of the gateway.
+
+        Args:
+            device_id (int): The identifier of the device.
+            session_id (int): The identifier of the session.
+            state (int): The state of the device.
+            data (bytes): The reading in binary mode.
+            timestamp (float): The time of the reading.
+
+        Returns:
+            None: The reading is queued.
+        '''
+
+        with self.__lock:
+
+            # The device waits while the server is behind (or unreachable)
+
+            self.__space.wait_for(lambda: self.__count < self.__maxPending or not self.__running)
+
+            group = self.__groups.get((device_id, session_id))
+
+            if group is None:
+
+                self.__groups[(device_id, session_id)] = [bytearray(data), [timestamp]]
+
+            else:
+
+                group[0] += data
+                group[1].append(timestamp)
+
+            self.__count += 1
+
+            full = self.__count >= self.__maxReadings
+
+        # Alarms don't wait for the batch to fill
+
+        if full or IngestLanes.classify(state) == 'alarm':
+
+            self.__wake.set()
+
+    def __requeue(self, groups: dict, count: int) -> None:
+        '''
+        Queues the readings of a batch that wasn't acknowledged again, ahead of the readings that came in since.
+
+        Args:
+            groups (dict): The readings of the batch, as (data, timestamps) of each (device_id, session_id).
+            count (int): The number of readings of the batch.
+
+        Returns:
+            None: The readings are sent with the next batch.
+        '''
+
+        with self.__lock:
+
+            for key, (data, timestamps) in self.__groups.items():
+
+                if key in groups:
+
+                    groups[key][0] += data
+                    groups[key][1].extend(timestamps)
+
+                else:
+
+                    groups[key] = [data, timestamps]
+
+            self.__groups = groups
+            self.__count += count
+
+    def __prepare(self) -> None:
+        '''
+        Connects to the server and authenticates a new session, if needed.
+
+        Returns:
+            None: The next batch can be encrypted.
+        '''
+
+        if self.__server is None:
+
+            self.__server = create_connection((self.__addr, self.__port), UPLINK_TIMEOUT)
+
+        if self.__authenticator is None or self.__authenticator.time_lived() == TIME_TO_LIVE:
+
+            self.__authenticate()
+
+    def __authenticate(self) -> None:
+        '''
+        Authenticates the server and the gateway, agreeing on a shared key, as the Device does.
+
+        Returns:
+            None: The session key is agreed.
+
+        Raises:
+            InvalidTag: If decryption fails due to authentication failure.
+            InvalidCommParameters: If communication of the handshake has invalid parameters.
+            ConnectionResetError: In case communication fails.
+        '''
+
+        # Reset or initialize the authenticator
+
+        if self.__authenticator is None:
+
+            self.__authenticator = Authenticator(self.__gatewayId, True, rng = self.__rng)
+
+        else:
+
+            self.__authenticator.reset()
+
+        run_handshake(self.__authenticator, lambda msg: msg.write_bytes(self.__server), lambda: Message.read_bytes(self.__server))
+
+        self.__stats['handshakes'] += 1
+
+    def __disconnect(self) -> None:
+        '''
+        Drops the connection after an error, abandoning the session as the server does.
+
+        Returns:
+            None: The next batch reconnects.
+        '''
+
+        # An unfinished session is abandoned, the next handshake rolls the vault forward if the server rotated it
+
+        self.__authenticator = None
+
+        if self.__server is not None:
+
+            self.__server.close()
+
+        self.__server = None
+
+    def flush(self) -> int:
+        '''
+        Sends the readings waiting as one batch and waits for the server to acknowledge it.
+
+        Returns:
+            int: The number of readings sent (0 if the batch is queued again or rejected).
+        '''
+
+        with self.__lock:
+
+            groups, self.__groups = self.__groups, dict()
+            count, self.__count = self.__count, 0
+
+            self.__space.notify_all()
+
+        if not groups:
+            return 0
+
+        batch = batch_to_bytes([(device_id, session_id, timestamps, bytes(data)) for (device_id, session_id), (data, timestamps) in groups.items()])
+
+        with self.__sendLock:
+
+            try:
+
+                # The batch is encrypted under the session it is sent in
+
+                self.__prepare()
+
+                msg = self.__authenticator.encrypt(batch, b'2')
+
+                msg.write_bytes(self.__server)
+
+                # The acknowledgement names the batch by its nonce, and is tagged with the key of the session, so
+                # a forged one is an error that queues the batch again instead of dropping it
+
+                ack = Message.read_bytes(self.__server)
+
+                status, nonce, tag = ack.get_data()[0:1], ack.get_data()[1:1 + NONCE_SIZE], ack.get_data()[1 + NONCE_SIZE:]
+
+                if ack.get_type() != b'3' or nonce != msg.get_data()[0:NONCE_SIZE] or status not in (BATCH_ACCEPTED, BATCH_REJECTED) or not self.__authenticator.verify(status + nonce, tag):
+                    raise InvalidCommParameters()
+
+            except Exception:
+
+                self.__stats['errors'] += 1
+
+                self.__disconnect()
+
+                self.__requeue(groups, count)
+
+                return 0
+
+            if status == BATCH_REJECTED:
+
+                self.__stats['rejected'] += count
+
+                return 0
+
+            self.__stats['readings'] += count
+            self.__stats['batches'] += 1
+
+            return count
+
+    def __run(self) -> None:
+        '''
+        Sends the batches until the uplink is closed.
+
+        Returns:
+            None: The uplink is closed.
+        '''
+
+        while self.__running:
+
+            self.__wake.wait(self.__maxDelay)
+            self.__wake.clear()
+
+            errors = self.__stats['errors']
+
+            self.flush()
+
+            # The readings keep queueing while the uplink waits to reconnect
+
+            if self.__stats['errors'] > errors:
+
+                self.__stopped.wait(RETRY_DELAY)
+
+    def start(self) -> None:
+        '''
+        Starts sending the batches in the background.
+
+        Returns:
+            None: The background thread is started.
+        '''
+
+        self.__running = True
+
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def get_stats(self) -> dict:
+        '''
+        Returns the statistics of the uplink.
+
+        Returns:
+            dict: The 'readings' and 'batches' sent, the readings 'rejected' by the server, the readings still 'pending', the 'handshakes' and the 'errors'.
+        '''
+
+        with self.__lock:
+
+            return dict(self.__stats, pending = self.__count)
+
+    def close(self) -> None:
+        '''
+        Sends the readings left and closes the connection, persisting the rotated vault.
+
+        Returns:
+            None: The uplink is closed, the readings the server didn't acknowledge are left pending.
+        '''
+
+        with self.__lock:
+
+            self.__running = False
+
+            self.__space.notify_all()
+
+        self.__stopped.set()
+        self.__wake.set()
+
+        if self.__thread is not None:
+
+            self.__thread.join()
+            self.__thread = None
+
+        self.flush()
+
+        with self.__sendLock:
+
+            if self.__authenticator is not None:
+
+                self.__authenticator.persist()
+
+            self.__disconnect()
+
+class Gateway:
+    '''
+    A class representing an edge gateway, that terminates the sessions of the devices and forwards their
+    readings to the central server through an Uplink.
+
+    The devices authenticate to the gateway as they would to the server, so the handshakes and the decryption
+    of every reading happen at the edge, and the server only decrypts one batch per uplink message.
+
+    Attributes:
+        __uplink (Uplink): The batches to the server.
+        __handler (Handler): The server of the devices.
+        __thread (Thread): The thread that accepts the devices.
+    '''
+
+    def __init__(self, gateway_id: int, devices: dict, addr: str, port: int, sv_addr: str, sv_port: int, max_readings: int = 256, max_delay: float = 0.05, rng: Randomness = None):
+        '''
+        Initializes a Gateway object, binding the port of the devices.
+
+        Args:
+            gateway_id (int): The identifier of the gateway, provisioned as a device.
+            devices (dict): The dictionary of the devices the gateway serves, as for the Handler.
+            addr (str): The address where the devices connect.
+            port (int): The port where the devices connect.
+            sv_addr (str): The address of the server.
+            sv_port (int): The port of the server.
+            max_readings (int) = 256: The readings that make a batch full.
+            max_delay (float) = 0.05: The seconds a reading waits at most for its batch.
+            rng (Randomness) = None: The source of the keys and challenges (the default one if not given).
+        '''
+
+        self.__uplink = Uplink(gateway_id, sv_addr, sv_port, max_readings, max_delay, rng)
+        self.__handler = Handler(devices, addr, port, rng = rng, sink = self.__uplink.add)
+        self.__thread = None
+
+    def get_handler(self) -> Handler:
+        '''
+        Returns the server of the devices.
+
+        Returns:
+            Handler: The handler.
+        '''
+
+        return self.__handler
+
+    def get_uplink(self) -> Uplink:
+        '''
+        Returns the batches to the server.
+
+        Returns:
+            Uplink: The uplink.
+        '''
+
+        return self.__uplink
+
+    def start(self) -> None:
+        '''
+        Starts accepting the devices and sending the batches in the background.
+
+        Returns:
+            None: The background threads are started.
+        '''
+
+        self.__uplink.start()
+
+        self.__thread = Thread(target=self.__handler.run_server, daemon=True)
+        self.__thread.start()
+
+    def close(self) -> dict:
+        '''
+        Stops accepting the devices, then sends the readings left.
+
+        Returns:
+            dict: The statistics of the uplink.
+        '''
+
+        self.__handler.close()
+
+        self.__uplink.close()
+
+        return self.__uplink.get_stats()
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Runs an edge gateway, that serves the devices and forwards their readings to the server in batches.')
+    parser.add_argument('--id', type=int, required=True, help='the identifier of the gateway (provisioned with python setup.py, and given to terminal_sv.py --gateway)')
+    parser.add_argument('--port', type=int, default=9060, help='the port where the devices connect')
+    parser.add_argument('--server', default='localhost', help='the address of the server')
+    parser.add_argument('--server-port', type=int, default=9070, help='the port of the server')
+    parser.add_argument('--registry', default=PATH_REGISTRY, help='the registry of the devices (python setup.py --count <n>)')
+    parser.add_argument('--max-readings', type=int, default=256, help='the readings that make a batch full')
+    parser.add_argument('--max-delay', type=float, default=0.05, help='the seconds a reading waits at most for its batch')
+    parser.add_argument('--metrics-port', type=int, default=9061, help='the local port of the metrics of the gateway')
+    args = parser.parse_args()
+
+    devices = {1058: {'auth': None, 'controller': thermo}, 5953: {'auth': None, 'controller': assist}}
+
+    if os.path.exists(args.registry):
+
+        devices.update(load_registry(args.registry))
+
+    gateway = Gateway(args.id, devices, 'localhost', args.port, args.server, args.server_port, args.max_readings, args.max_delay)
+    gateway.start()
+
+    metrics_gw = MetricsServer(gateway.get_handler().get_registry(), '127.0.0.1', args.metrics_port)
+    metrics_gw.start()
+
+    input('Press enter to stop the gateway\n')
+
+    metrics_gw.stop()
+
+    print(gateway.close())
+
+if __name__ == '__main__':
+
+    main()
@@ -1,10 +1,39 @@
-from message import Message
-from time import time
+from message import Message, bytes_to_batch, BATCH_ACCEPTED, BATCH_REJECTED
+from time import time, perf_counter, sleep
 from threading import Lock, Thread
-from authenticator import InvalidCommParameters, Authenticator, KEY_LENGTH, TIME_TO_LIVE
-from crypto import decrypt
+from authenticator import InvalidCommParameters, VaultOutOfSync, Authenticator, KEY_LENGTH, TIME_TO_LIVE, PATH_SV_VAULTS, STATE_HEADER
+from crypto import decrypt, NONCE_SIZE
 from challenge import Challenge, CHALLENGE_SIZE
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, AF_INET, SOCK_STREAM, SOMAXCONN, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR
+from struct import Struct
+from delta import DeltaCodec
+from database import Database
+from storage import SegmentStore
+from broker import Broker, Subscription
+from ringbuffer import HotTier
+from ingest import IngestLanes
+from capture import CaptureWriter, INBOUND, OUTBOUND
+from utils import read_file_bytes
+from metrics import MetricsRegistry
+from rng import Randomness, get_default
+from cryptography.exceptions import InvalidTag
+import instrument, metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The header of exported sessions (magic, version and count) and of each session (state and delta lengths)
+
+SESSIONS_MAGIC = b'HSS'
+SESSIONS_VERSION = 1
+SESSIONS_HEADER = Struct('<3sBI')
+SESSION_ENTRY = Struct('<II')
+
+# The delta length of a session without a previous reading
+
+NO_PREVIOUS = 0xFFFFFFFF
 
 class Handler:
     '''
@@ -12,61 +41,463 @@ class Handler:
 
     Attributes:
         __devices (dict): The dictionary of devices the server recognizes.
-        __database (list): The list of information the server stores about the devices.
+        __database (Database): The columnar database of the readings, when they are only kept in memory.
+        __storage (SegmentStore): The persistent storage of the readings, from which they are read (None if the readings are only kept in memory).
+        __broker (Broker): The fan-out of the readings to the subscribers.
+        __hot (HotTier): The ring buffers of the last readings of each device, in front of the database or storage (None if there are none).
+        __ingest (IngestLanes): The alarm and bulk lanes of the readings waiting to be stored.
+        __registry (MetricsRegistry): The registry of the metrics of the server.
+        __metrics (dict): The counters and histograms of the server, by name.
         __host (socket): The hosting socket that accepts incoming connections.
+        __clients (dict): The number of each open connection.
+        __capture (CaptureWriter): The capture of the frames exchanged (None if not capturing).
+        __rng (Randomness): The source of the challenges and keys, split per device and session.
+        __sink (callable): Receives the readings instead of the ingest lanes (None to store them).
     '''
 
-    def __init__(self, devices: dict, sv_addr: str, sv_port: int):
+    def __init__(self, devices: dict, sv_addr: str, sv_port: int, storage: SegmentStore = None, hot: HotTier = None, registry: MetricsRegistry = None, rng: Randomness = None, sink = None):
         '''
         Initializes the Handler object.
 
+        A device without a controller is a gateway: it authenticates like any device and sends batches with the
+        readings of the devices it serves, which are the ones listed in its 'devices' (a set of identifiers).
+
         Args:
             devices (dict): The dictionary of know devices.
             sv_addr (str): The address of the server.
             sv_port (int): The port of the server.
+            storage (SegmentStore) = None: The persistent storage of the readings.
+            hot (HotTier) = None: The ring buffers of the last readings of each device, in front of the database or storage.
+            registry (MetricsRegistry) = None: The registry of the metrics (the shared one if not given).
+            rng (Randomness) = None: The source of the challenges and keys (the default one if not given).
+            sink (callable) = None: Receives each reading as (device_id, session_id, state, data, timestamp), with the data in the binary mode of the device, instead of storing it (as a gateway does).
         '''
 
-        self.__database = list()
-        self.__database_lock = Lock()
+        self.__database = Database()
+        self.__storage = storage
+        self.__hot = hot
+        self.__broker = Broker()
+        self.__ingest = IngestLanes(self.__add_entry_db, on_error=lambda error: self.__metrics['ingest_failures'].labels(self.__failure_reason(error)).add(), deliver=self.__broker.publish)
         self.__devices = devices
         self.__devices_lock = Lock()
         self.__host = socket(AF_INET, SOCK_STREAM)
+        self.__host.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
         self.__host.bind((sv_addr, sv_port))
-        self.__clients = list()
+        self.__clients = dict()
         self.__clients_lock = Lock()
+        self.__connections = 0
+        self.__capture = None
+        self.__rng = get_default() if rng is None else rng
         self.__running = False
+        self.__sink = sink
+
+        # Register the metrics of the server
+
+        self.__registry = metrics.registry if registry is None else registry
+
+        self.__metrics = {
+            'connections': self.__registry.counter('iot_connections_total', 'Connections accepted.'),
+            'connections_closed': self.__registry.counter('iot_connections_closed_total', 'Connections closed, by reason.', ('reason',)),
+            'accept_errors': self.__registry.counter('iot_accept_errors_total', 'Connections that failed to be accepted.'),
+            'handshakes_started': self.__registry.counter('iot_handshakes_started_total', 'Handshakes started.'),
+            'handshakes_completed': self.__registry.counter('iot_handshakes_completed_total', 'Handshakes completed.'),
+            'handshakes_failed': self.__registry.counter('iot_handshakes_failed_total', 'Handshakes failed, by reason.', ('reason',)),
+            'decrypt_failures': self.__registry.counter('iot_decrypt_failures_total', 'Readings that failed to be authenticated, by reason.', ('reason',)),
+            'batches': self.__registry.counter('iot_batches_total', 'Batches of readings received from gateways.'),
+            'batches_rejected': self.__registry.counter('iot_batches_rejected_total', 'Batches of readings rejected, with a device the gateway may not forward or malformed.'),
+            'vault_writes': self.__registry.counter('iot_vault_writes_total', 'Vault and rotation history files written.'),
+            'readings': self.__registry.counter('iot_readings_ingested_total', 'Readings stored, by device.', ('device',)),
+            'ingest_failures': self.__registry.counter('iot_ingest_failures_total', 'Readings that failed to be stored, by reason.', ('reason',)),
+            'handshake_seconds': self.__registry.histogram('iot_handshake_duration_seconds', 'Time to complete a handshake on the server.'),
+            'reading_seconds': self.__registry.histogram('iot_reading_duration_seconds', 'Time from the receipt of a reading to its submission for storage.')
+        }
+
+        self.__registry.gauge('iot_connections_open', 'Connections open.', lambda: len(self.__clients))
+        self.__registry.gauge('iot_sessions_active', 'Devices with a session.', lambda: sum(device['auth'] is not None for device in list(self.__devices.values())))
+        self.__registry.gauge('iot_ingest_queue_depth', 'Readings waiting to be stored, by lane.', lambda: {(lane,): depth for lane, depth in self.__ingest.get_depths().items()}, ('lane',))
+
+        # Create the database columns of the known devices
+
+        for device_id, device in self.__devices.items():
+
+            # The gateways have no readings of their own
+
+            if device['controller'] is None:
+                continue
 
-    def __add_entry_db(self, device_id: int, session_id: int, state: int, sensors: list) -> None:
+            self.__database.register_device(device_id, device['controller'])
+
+            if self.__storage is not None:
+
+                self.__storage.register_device(device_id, device['controller'])
+
+            if self.__hot is not None:
+
+                self.__hot.register_device(device_id, device['controller'])
+
+    def __add_entry_db(self, device_id: int, session_id: int, state: int, sensors: list, timestamp: float, lane: str) -> None:
         '''
-        Adds an entry to the device information database.
+        Adds an entry to the device information database, from the writer of the ingest lanes.
 
         Args:
             device_id (int): The identifier of the device.
             session_id (int): The identifier of the session.
             state (int): The state of the device.
             sensors (list): The list of information from the sensors.
+            timestamp (float): The time of the reading.
+            lane (str): The ingest lane of the reading ('alarm' or 'bulk').
         
         Returns:
             None: The entry is added to the database.
         '''
-        
-        # Calculate the current timestamp
 
-        timestamp = time()
+        # Keep the entry in the hot tier for the last readings, and add it to the storage or to the database
+
+        if self.__hot is not None:
+
+            self.__hot.append(device_id, session_id, state, sensors, timestamp)
+
+        if self.__storage is None:
+
+            self.__database.add(device_id, session_id, state, sensors, timestamp)
+
+        else:
+
+            self.__storage.append(device_id, session_id, state, sensors, timestamp)
+
+        self.__metrics['readings'].labels(device_id).add()
+
+        # Deliver the entry to the subscribers (alarms and the readings they promoted were delivered when received)
+
+        if lane != 'alarm':
+
+            self.__broker.publish(device_id, session_id, state, sensors, timestamp)
+
+    def load_readings(self, device_id: int, session_id: int, data: bytes, timestamp: float = None) -> int:
+        '''
+        Loads a batch of concatenated readings of a device into the database, decoding them at once.
+
+        Args:
+            device_id (int): The identifier of the device.
+            session_id (int): The identifier of the session.
+            data (bytes): The readings in binary mode.
+            timestamp (float) = None: The time of the readings (now if not given).
+
+        Returns:
+            int: The number of readings loaded.
+
+        Raises:
+            ValueError: If the data is not a whole number of readings.
+        '''
+
+        records = self.__devices[device_id]['controller'].bytes_to_records(data)
+
+        if timestamp is None:
+            timestamp = time()
+
+        # Keep the readings in the hot tier for the last readings, and add them to the storage or to the database one column at a time
+
+        if self.__hot is not None:
+
+            for state, sensors in self.__devices[device_id]['controller'].records_to_information(records):
+
+                self.__hot.append(device_id, session_id, state, sensors, timestamp)
+
+        if self.__storage is None:
+
+            self.__database.add_records(device_id, records, session_id, timestamp)
+
+        else:
+
+            self.__storage.append_records(device_id, records, session_id, timestamp)
+
+        self.__metrics['readings'].labels(device_id).add(len(records))
+
+        if self.__broker.has_subscribers():
+
+            for state, sensors in self.__devices[device_id]['controller'].records_to_information(records):
+
+                self.__broker.publish(device_id, session_id, state, sensors, timestamp)
+
+        return len(records)
+
+    def subscribe(self, device_id: int = None, session_id: int = None, state: int = None, capacity: int = 1024) -> Subscription:
+        '''
+        Subscribes to the readings as they are ingested.
+
+        Args:
+            device_id (int) = None: The identifier of device to filter.
+            session_id (int) = None: The identifier of session to filter.
+            state (int) = None: The device state to filter.
+            capacity (int) = 1024: The number of readings buffered for the subscriber, the oldest being dropped when full.
+
+        Returns:
+            Subscription: The subscription, from which the readings are taken.
+        '''
+
+        return self.__broker.subscribe(device_id, session_id, state, capacity)
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        '''
+        Cancels a subscription to the readings.
+
+        Args:
+            subscription (Subscription): The subscription.
+
+        Returns:
+            None: The subscription is closed.
+        '''
+
+        self.__broker.unsubscribe(subscription)
+
+    def get_registry(self) -> MetricsRegistry:
+        '''
+        Returns the registry of the metrics of the server, to be served with a MetricsServer.
+
+        Returns:
+            MetricsRegistry: The registry.
+        '''
+
+        return self.__registry
+
+    def get_port(self) -> int:
+        '''
+        Returns the port the server is bound to (the one picked by the system if it was given 0).
+
+        Returns:
+            int: The port.
+        '''
+
+        return self.__host.getsockname()[1]
+
+    def export_sessions(self, seal_key: bytes, device_ids: set = None, with_vault: bool = True) -> bytes:
+        '''
+        Exports the running sessions so another worker can continue them, detaching them from this one.
+
+        The connections of the exported sessions are closed after a hand-off message, the devices resume them on a
+        connection to the worker that imports them, without a new handshake.
+
+        Args:
+            seal_key (bytes): The local key that seals the session keys and vaults (KEY_LENGTH bytes).
+            device_ids (set) = None: The devices whose sessions are exported (all of them if not given).
+            with_vault (bool) = True: If the vaults are included (otherwise the importer reads them from its files).
+
+        Returns:
+            bytes: The sessions.
+        '''
+
+        entries = []
+        clients = []
+
+        if device_ids is not None:
+
+            device_ids = set(device_ids)
+
+        with self.__devices_lock:
+
+            for device_id, device in self.__devices.items():
+
+                if device['auth'] is None or (device_ids is not None and device_id not in device_ids):
+                    continue
+
+                state = device['auth'].export_state(seal_key, with_vault)
+
+                previous = device['delta'].get_previous() if device.get('delta') is not None else None
+
+                entries.append(SESSION_ENTRY.pack(len(state), NO_PREVIOUS if previous is None else len(previous)) + state + (previous or b''))
+
+                # The session is no longer this worker's, its connection won't abandon it when closed
+
+                _, _, _, _, session_id, _ = STATE_HEADER.unpack_from(state)
 
-        # Add the entry to the database
+                clients.append((device.get('client'), device_id, session_id))
+
+                device['auth'] = None
+                device['client'] = None
+
+        for client, device_id, session_id in clients:
+
+            if client is not None:
+
+                # The device is told the session was handed off before the connection ends, so it resumes it
+                # instead of authenticating again
+
+                try:
+
+                    self.__send(Message(device_id, session_id, b'4', b''), client)
+
+                    client.shutdown(SHUT_RDWR)
+
+                except OSError:
+
+                    pass
+
+        return SESSIONS_HEADER.pack(SESSIONS_MAGIC, SESSIONS_VERSION, len(entries)) + b''.join(entries)
+
+    def import_sessions(self, data: bytes, seal_key: bytes) -> int:
+        '''
+        Imports the sessions exported by another worker, replacing any running session of their devices.
+
+        Args:
+            data (bytes): The sessions.
+            seal_key (bytes): The local key the sessions were sealed under.
 
-        entry = {
+        Returns:
+            int: The number of sessions imported.
+
+        Raises:
+            ValueError: If the sessions have an unknown format or version, are truncated or a session was altered.
+            InvalidTag: If a session wasn't sealed under the key or was altered.
+            KeyError: If a session belongs to an unknown device.
+
+        No session is imported unless all of them are valid.
+        '''
+
+        if len(data) < SESSIONS_HEADER.size:
+            raise ValueError('the sessions are truncated')
+
+        magic, version, count = SESSIONS_HEADER.unpack_from(data)
+
+        if magic != SESSIONS_MAGIC or version != SESSIONS_VERSION:
+            raise ValueError(f'unsupported sessions {magic!r} version {version}')
+
+        offset = SESSIONS_HEADER.size
+        sessions = []
+
+        for _ in range(count):
+
+            if offset + SESSION_ENTRY.size > len(data):
+                raise ValueError('the sessions are truncated')
+
+            state_length, previous_length = SESSION_ENTRY.unpack_from(data, offset)
+            offset += SESSION_ENTRY.size
+
+            if state_length < STATE_HEADER.size or offset + state_length + (0 if previous_length == NO_PREVIOUS else previous_length) > len(data):
+                raise ValueError('the sessions are truncated')
+
+            state = data[offset:offset + state_length]
+            offset += state_length
+
+            previous = None
+
+            if previous_length != NO_PREVIOUS:
+
+                previous = data[offset:offset + previous_length]
+                offset += previous_length
+
+            sessions.append((state, previous))
+
+        if offset != len(data):
+            raise ValueError('the sessions have trailing data')
+
+        # Rebuild every session before replacing any, so a bad one leaves the running sessions as they were
+
+        imported = dict()
+
+        for state, previous in sessions:
+
+            _, _, _, device_id, session_id, _ = STATE_HEADER.unpack_from(state)
+
+            if device_id not in self.__devices:
+                raise KeyError(device_id)
+
+            if device_id in imported:
+                raise ValueError(f'the sessions hold device {device_id} twice')
+
+            # The rest of the session draws from the stream of its handshake
+
+            imported[device_id] = (Authenticator.import_state(state, seal_key, self.__rng.derive(device_id, session_id), writes = self.__metrics['vault_writes']), previous)
+
+        with self.__devices_lock:
+
+            for device_id, (auth, previous) in imported.items():
+
+                device = self.__devices[device_id]
+
+                device['auth'] = auth
+                device['client'] = None
+                device['delta'] = self.__new_delta(device)
+
+                if device['delta'] is not None:
+
+                    device['delta'].set_previous(previous)
+
+        return len(sessions)
+
+    def flush(self, timeout: float = None) -> bool:
+        '''
+        Waits for the received readings to be stored.
+
+        Args:
+            timeout (float) = None: The number of seconds to wait (forever if not given).
+
+        Returns:
+            bool: If every received reading was stored.
+        '''
+
+        return self.__ingest.join(timeout)
+
+    def get_ingest_stats(self) -> dict:
+        '''
+        Returns the latency from receipt to storage of the alarm and the bulk readings.
+
+        Returns:
+            dict: Per lane ('alarm' and 'bulk'), the 'count', 'queued', 'mean', 'max', 'p50' and 'p99' in seconds.
+        '''
+
+        return self.__ingest.get_stats()
+
+    def __stored_entries(self, device_id: int, records) -> list:
+        '''
+        Converts records read from the persistent storage into entries.
+
+        Args:
+            device_id (int): The identifier of the device.
+            records (numpy.ndarray): The records, with a 'time' and 'session' field followed by the fields of the readings.
+
+        Returns:
+            list: The entries, with the device, session, state, sensors and time.
+        '''
+
+        controller = self.__devices[device_id]['controller']
+
+        headers = records[['time', 'session']].tolist()
+        information = controller.records_to_information(records[list(controller.get_dtype().names)])
+
+        return [{
             'device_id': device_id,
             'session_id': session_id,
             'state': state,
             'sensors': sensors,
             'time': timestamp
-        }
+        } for (timestamp, session_id), (state, sensors) in zip(headers, information)]
+
+    def __stored_rows(self, device_id: int = None, session_id: int = None, start: float = None, end: float = None):
+        '''
+        Yields the entries of the persistent storage that match the filters, reading only the segments of the time range.
+
+        Args:
+            device_id (int) = None: The identifier of device to filter.
+            session_id (int) = None: The identifier of session to filter.
+            start (float) = None: The start of the time range (inclusive).
+            end (float) = None: The end of the time range (exclusive).
+
+        Returns:
+            generator: The entries of each device, in time order.
+        '''
+
+        for dev_id in ([device_id] if device_id is not None else self.__storage.get_device_ids()):
+
+            if self.__devices.get(dev_id, {}).get('controller') is None:
+                continue
 
-        with self.__database_lock:
+            records = self.__storage.read(dev_id, start, end)
 
-            self.__database.append(entry)
+            if session_id is not None:
+
+                records = records[records['session'] == session_id]
+
+            yield from self.__stored_entries(dev_id, records[np.argsort(records['time'], kind='stable')])
 
     def show_db(self, device_id: int = None, session_id: int = None) -> None:
         '''
@@ -79,47 +510,266 @@ class Handler:
         Returns:
             None: Prints the database information.
         '''
-        
-        with self.__database_lock:
 
-            for entry in self.__database:
+        # Print from a snapshot, so the ingest is not blocked while printing
 
-                if (device_id is not None and entry['device_id'] != device_id):
-                    continue
+        for entry in self.rows(device_id, session_id):
 
-                if (session_id is not None and entry['session_id'] != session_id):
-                    continue
+            print(f'dev_id: {entry["device_id"]} | session: {entry["session_id"]} | state: {entry["state"]} | time: {entry["time"]}')
+
+            readings = ''
+
+            for reading in entry['sensors']:
 
-                print(f'dev_id: {entry["device_id"]} | session: {entry["session_id"]} | state: {entry["state"]} | time: {entry["time"]}')
+                readings += str(reading) + ' '
 
-                readings = ''
+            print(readings)
 
-                for reading in entry['sensors']:
+    def rows(self, device_id: int = None, session_id: int = None, start: float = None, end: float = None):
+        '''
+        Yields the database entries that match the filters lazily, from a snapshot taken when the iteration starts.
+
+        With a persistent storage, the entries are read from its segments (with the ones of previous runs), one
+        device at a time, so the readings don't have to be kept in memory.
+
+        Args:
+            device_id (int) = None: The identifier of device to filter.
+            session_id (int) = None: The identifier of session to filter.
+            start (float) = None: The start of the time range (inclusive).
+            end (float) = None: The end of the time range (exclusive).
+
+        Returns:
+            generator: The entries, with the device, session, state, sensors and time.
+        '''
 
-                    readings += str(reading) + ' '
+        if self.__storage is not None:
 
-                print(readings)
+            yield from self.__stored_rows(device_id, session_id, start, end)
+            return
+
+        yield from self.__database.rows(device_id, session_id, start, end)
+
+    def last_readings(self, device_id: int, n: int) -> list:
+        '''
+        Returns the most recent readings of a device, from the hot tier if there is one.
+
+        Args:
+            device_id (int): The identifier of the device.
+            n (int): The number of readings.
+
+        Returns:
+            list: The entries, from the oldest to the newest.
+        '''
+
+        if self.__hot is not None:
+
+            return self.__hot.last(device_id, n)
+
+        if self.__storage is not None:
+
+            return self.__stored_entries(device_id, self.__storage.last(device_id, n))
+
+        return self.__database.last(device_id, n)
+
+    def query(self, device_id: int, start: float = None, end: float = None, session_id: int = None) -> list:
+        '''
+        Returns the database entries of a device inside a time range.
+
+        Args:
+            device_id (int): The identifier of the device.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+            session_id (int) = None: The identifier of session to filter.
+
+        Returns:
+            list: The entries, with the device, session, state, sensors and time.
+        '''
+
+        return list(self.rows(device_id, session_id, start, end))
+
+    def aggregate(self, device_id: int, start: float = None, end: float = None, window: float = None) -> list:
+        '''
+        Computes the min, max, mean and last value of each sensor of a device over the windows of a time range.
+
+        With a persistent storage, the readings of the time range are read from its segments.
+
+        Args:
+            device_id (int): The identifier of the device.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+            window (float) = None: The length of the windows in seconds (a single window if not given).
+
+        Returns:
+            list: A dictionary per window with readings, with its 'start', 'count' and per sensor statistics.
+
+        Raises:
+            ValueError: If the window is not positive.
+        '''
+
+        if self.__storage is not None:
+
+            # Aggregate the stored readings of the range in a database of their own
+
+            database = Database()
+            database.register_device(device_id, self.__devices[device_id]['controller'])
+            database.add_records(device_id, self.__storage.read(device_id, start, end))
+
+            return database.aggregate(device_id, start, end, window)
+
+        return self.__database.aggregate(device_id, start, end, window)
 
     def run_server(self) -> None:
         
-        self.__host.listen(5)
+        # Leave room for reconnect storms of many devices at once
+
+        self.__host.listen(SOMAXCONN)
         self.__running = True
 
-        try:
+        while (self.__running):
 
-            while (self.__running):
+            try:
 
                 client_socket, _ = self.__host.accept()
 
-                with self.__clients_lock:
+            except OSError:
 
-                    self.__clients.append(client_socket)
+                # Closing the server ends the loop, any other error is counted and retried
 
-                Thread(target=self.__handle_conn, args=(client_socket,)).start()
+                if not self.__running:
+                    break
 
-        except Exception:
+                self.__metrics['accept_errors'].inc()
 
-            pass
+                sleep(0.01)
+                continue
+
+            self.__metrics['connections'].inc()
+
+            with self.__clients_lock:
+
+                self.__clients[client_socket] = self.__connections
+                self.__connections += 1
+
+            Thread(target=self.__handle_conn, args=(client_socket,)).start()
+
+    @staticmethod
+    def __failure_reason(error: Exception) -> str:
+        '''
+        Names the reason of a failure, for the metrics.
+
+        Args:
+            error (Exception): The error.
+
+        Returns:
+            str: The reason.
+        '''
+
+        if isinstance(error, InvalidTag):
+            return 'invalid_tag'
+
+        if isinstance(error, VaultOutOfSync):
+            return 'out_of_sync'
+
+        if isinstance(error, InvalidCommParameters):
+            return 'invalid_parameters'
+
+        if isinstance(error, KeyError):
+            return 'unknown_device'
+
+        if isinstance(error, (ConnectionError, OSError)):
+            return 'connection'
+
+        return type(error).__name__
+
+    def __receive(self, client: socket) -> Message:
+        '''
+        Reads a message from a client, capturing it if a capture is running.
+
+        Args:
+            client (socket): The communication socket with the client.
+
+        Returns:
+            Message: The message.
+        '''
+
+        msg = Message.read_bytes(client)
+
+        capture = self.__capture
+
+        if capture is not None:
+
+            capture.record(self.__clients.get(client, 0), INBOUND, msg)
+
+        return msg
+
+    def __send(self, msg: Message, client: socket) -> None:
+        '''
+        Writes a message to a client, capturing it if a capture is running.
+
+        Args:
+            msg (Message): The message.
+            client (socket): The communication socket with the client.
+
+        Returns:
+            None: The message is sent.
+        '''
+
+        capture = self.__capture
+
+        if capture is not None:
+
+            capture.record(self.__clients.get(client, 0), OUTBOUND, msg)
+
+        msg.write_bytes(client)
+
+    def start_capture(self, path: str, key: bytes = None) -> None:
+        '''
+        Starts capturing the frames exchanged with the devices, after a snapshot of their vaults.
+
+        Args:
+            path (str): The path of the capture.
+            key (bytes) = None: The key that seals the vaults in the capture (they are left out if not given).
+
+        Returns:
+            None: The frames are recorded until the capture is stopped.
+        '''
+
+        # No vault rotates while the snapshot is taken
+
+        with self.__devices_lock:
+
+            self.__capture = CaptureWriter(path, {device_id: (read_file_bytes(PATH_SV_VAULTS + str(device_id)), device['controller']) for device_id, device in self.__devices.items()}, self.__rng.get_seed(), key)
+
+    def stop_capture(self) -> int:
+        '''
+        Stops capturing the frames.
+
+        Returns:
+            int: The number of frames captured.
+        '''
+
+        capture, self.__capture = self.__capture, None
+
+        if capture is None:
+            return 0
+
+        capture.close()
+
+        return capture.get_frames()
+
+    @staticmethod
+    def __new_delta(device: dict) -> DeltaCodec:
+        '''
+        Creates the decoder of the readings of a new session.
+
+        Args:
+            device (dict): The device.
+
+        Returns:
+            DeltaCodec: The decoder (None if the device doesn't send deltas or is a gateway).
+        '''
+
+        return DeltaCodec() if device['controller'] is not None and device['controller'].is_delta() else None
 
     def __handle_authentication(self, msg: Message, client: socket) -> None:
         '''
@@ -139,8 +789,12 @@ class Handler:
             BrokenPipeError: In case communication fails.
         '''
 
+        timer = instrument.timer('sv.handshake')
+
         with self.__devices_lock:
 
+            timer.lap('lock_wait')
+
             # Check if device has running session
 
             if (self.__devices[msg.get_deviceId()]['auth'] is not None):
@@ -148,19 +802,28 @@ class Handler:
             
             # Create authenticator for this device
 
-            self.__devices[msg.get_deviceId()]['auth'] = Authenticator(msg.get_deviceId(), False, msg.get_sessionId())
+            self.__devices[msg.get_deviceId()]['auth'] = Authenticator(msg.get_deviceId(), False, msg.get_sessionId(), self.__rng.derive(msg.get_deviceId(), msg.get_sessionId()), writes = self.__metrics['vault_writes'])
+            self.__devices[msg.get_deviceId()]['client'] = client
+
+            timer.lap('vault_load')
 
-            # Create a challenge and send it to the device
+            # Roll the vault of a lagging device forward, then create a challenge and send it to the device
+
+            sync = self.__devices[msg.get_deviceId()]['auth'].sync_response(msg.get_data())
 
             k1, ch1 = self.__devices[msg.get_deviceId()]['auth'].generate_challenge(False)
 
-            m2 = self.__devices[msg.get_deviceId()]['auth'].handshake(False, challenge = ch1)
+            m2 = self.__devices[msg.get_deviceId()]['auth'].handshake(False, challenge = ch1, sync = sync)
+
+            timer.lap('challenge')
 
-            m2.write_bytes(client)
+            self.__send(m2, client)
 
             # Retreive the message challenge from the device and solve it
 
-            m3 = Message.read_bytes(client)
+            m3 = self.__receive(client)
+
+            timer.lap('m2_m3')
 
             if not self.__devices[msg.get_deviceId()]['auth'].check_handshake(m3):
                 raise InvalidCommParameters()
@@ -169,6 +832,8 @@ class Handler:
 
             ch2 = Challenge.from_bytes(data[CHALLENGE_SIZE+KEY_LENGTH:])
 
+            timer.lap('decrypt')
+
             # Check the correctness of the solution to the challenge
 
             if not ch1.verify(data[0:CHALLENGE_SIZE]):
@@ -180,11 +845,22 @@ class Handler:
 
             m4 = self.__devices[msg.get_deviceId()]['auth'].handshake(True, k2, ch2.get_chal())
 
+            timer.lap('solve')
+
             # Associate the gotten session key from device
 
             self.__devices[msg.get_deviceId()]['auth'].feed_key(t1)
 
-            m4.write_bytes(client)
+            # Start the readings of the new session from a keyframe
+
+            self.__devices[msg.get_deviceId()]['delta'] = self.__new_delta(self.__devices[msg.get_deviceId()])
+
+            self.__send(m4, client)
+
+            timer.lap('m4')
+            timer.stop()
+
+            instrument.count('sv.handshakes')
 
     def __handle_information(self, msg: Message) -> None:
         '''
@@ -201,19 +877,36 @@ class Handler:
             InvalidTag: If decryption fails due to authentication failure.
         '''
 
+        received = perf_counter()
+
+        timer = instrument.timer('sv.reading')
+
         with self.__devices_lock:
+
+            timer.lap('lock_wait')
         
             # Fetchs the data from the authenticated message
 
+            if self.__devices[msg.get_deviceId()]['auth'] is None or self.__devices[msg.get_deviceId()]['controller'] is None:
+                raise InvalidCommParameters()
+
             data = self.__devices[msg.get_deviceId()]['auth'].decrypt(msg)
 
+            timer.lap('decrypt')
+
+            # Reconstructs the full reading (if appliable)
+
+            if self.__devices[msg.get_deviceId()]['delta'] is not None:
+
+                data = self.__devices[msg.get_deviceId()]['delta'].decode(data)
+
             # Converts the data to readings
 
             state, sensors = self.__devices[msg.get_deviceId()]['controller'].bytes_to_information(data)
 
-            # Adds entry to the database
+            timestamp = time()
 
-            self.__add_entry_db(msg.get_deviceId(), msg.get_sessionId(), state, sensors)
+            timer.lap('decode')
 
             # Checks if the current device session finished
 
@@ -223,7 +916,133 @@ class Handler:
 
                 self.__devices[msg.get_deviceId()]['auth'] = None
 
+                timer.lap('rotate')
+
+        # A gateway hands the reading on instead of storing it, in the format of the device decoded in bulk upstream
+
+        if self.__sink is not None:
+
+            self.__sink(msg.get_deviceId(), msg.get_sessionId(), state, data, timestamp)
+
+        else:
+
+            # Alarms are delivered to the subscribers at once, and stored ahead of the routine readings
+            # (outside the lock, so a full bulk lane doesn't hold back the other devices)
+
+            self.__ingest.submit(msg.get_deviceId(), msg.get_sessionId(), state, sensors, timestamp, received)
+
+        timer.lap('submit')
+        timer.stop()
+
+        instrument.count('sv.readings')
+
+    def __handle_batch(self, msg: Message, client: socket) -> None:
+        '''
+        Handles messages of a gateway that contain the readings of the devices it serves, acknowledging each batch.
+
+        Args:
+            msg (Message): The message.
+            client (socket): The communication socket with the gateway.
+
+        Returns:
+            None: The readings are queued in the ingest lanes and the batch is acknowledged.
+
+        Raises:
+            InvalidCommParameters: If the sender isn't an authenticated gateway.
+            InvalidTag: If decryption fails due to authentication failure.
+        '''
+
+        received = perf_counter()
+
+        timer = instrument.timer('sv.batch')
+
+        with self.__devices_lock:
+
+            timer.lap('lock_wait')
+
+            # Only the gateways send batches, each one being a message of their session
+
+            if self.__devices[msg.get_deviceId()]['auth'] is None or self.__devices[msg.get_deviceId()]['controller'] is not None:
+                raise InvalidCommParameters()
+
+            data = self.__devices[msg.get_deviceId()]['auth'].decrypt(msg, b'2')
+
+            timer.lap('decrypt')
+
+            # The acknowledgement is tagged with the key of the session the batch came in, before it is rotated,
+            # so the gateway only drops a batch the server itself rejected
+
+            acks = dict()
+
+            for status in (BATCH_ACCEPTED, BATCH_REJECTED):
+
+                ack = status + msg.get_data()[0:NONCE_SIZE]
+
+                acks[status] = ack + self.__devices[msg.get_deviceId()]['auth'].sign(ack)
+
+            if self.__devices[msg.get_deviceId()]['auth'].time_lived() == TIME_TO_LIVE:
+
+                self.__devices[msg.get_deviceId()]['auth'].reset()
+
+                self.__devices[msg.get_deviceId()]['auth'] = None
+
+                timer.lap('rotate')
+
+            allowed = self.__devices[msg.get_deviceId()].get('devices', set())
+
+        # The whole batch is rejected if it is malformed or has a group of a device the gateway may not forward,
+        # the session is still good so the gateway is told and the connection kept
+
+        try:
+
+            readings = []
+
+            for device_id, session_id, timestamps, data in bytes_to_batch(data):
+
+                if device_id not in allowed or self.__devices.get(device_id, {}).get('controller') is None:
+                    raise InvalidCommParameters()
+
+                controller = self.__devices[device_id]['controller']
+
+                information = controller.records_to_information(controller.bytes_to_records(data))
+
+                if len(information) != len(timestamps):
+                    raise ValueError(f'{len(information)} readings with {len(timestamps)} times')
+
+                readings.extend((device_id, session_id, state, sensors, timestamp) for (state, sensors), timestamp in zip(information, timestamps))
+
+        except (InvalidCommParameters, ValueError):
+
+            self.__metrics['batches_rejected'].inc()
+
+            self.__send(Message(msg.get_deviceId(), msg.get_sessionId(), b'3', acks[BATCH_REJECTED]), client)
+
+            timer.stop()
+
+            return
+
+        timer.lap('decode')
+
+        # Each reading goes through the ingest lanes, so the alarms are delivered and stored first
+
+        for device_id, session_id, state, sensors, timestamp in readings:
+
+            self.__ingest.submit(device_id, session_id, state, sensors, timestamp, received)
+
+        self.__metrics['batches'].inc()
+
+        self.__send(Message(msg.get_deviceId(), msg.get_sessionId(), b'3', acks[BATCH_ACCEPTED]), client)
+
+        timer.lap('submit')
+        timer.stop()
+
+        instrument.count('sv.batches')
+
     def __handle_conn(self, client: socket) -> None:
+
+        # The devices that tried to authenticate through this connection
+
+        device_ids = set()
         
         try:
 
@@ -231,42 +1050,133 @@ class Handler:
 
                 # Reads the message sent from client
 
-                msg = Message.read_bytes(client)
+                msg = self.__receive(client)
 
                 # Interprets the message received
 
                 if msg.get_type() == b'0':
 
-                    self.__handle_authentication(msg, client)
+                    device_ids.add(msg.get_deviceId())
+
+                    self.__metrics['handshakes_started'].inc()
+
+                    start = perf_counter()
+
+                    try:
+
+                        self.__handle_authentication(msg, client)
+
+                    except Exception as error:
+
+                        self.__metrics['handshakes_failed'].labels(self.__failure_reason(error)).add()
+                        raise
+
+                    self.__metrics['handshakes_completed'].inc()
+                    self.__metrics['handshake_seconds'].record(perf_counter() - start)
 
                 elif msg.get_type() == b'1':
+
+                    start = perf_counter()
+
+                    try:
                     
-                    self.__handle_information(msg)
+                        self.__handle_information(msg)
+
+                    except (InvalidTag, InvalidCommParameters) as error:
+
+                        self.__metrics['decrypt_failures'].labels(self.__failure_reason(error)).add()
+                        raise
+
+                    self.__metrics['reading_seconds'].record(perf_counter() - start)
+
+                    # A session resumed from another worker belongs to the connection it continues on
+
+                    if msg.get_deviceId() not in device_ids:
+
+                        device_ids.add(msg.get_deviceId())
+
+                        with self.__devices_lock:
+
+                            if self.__devices[msg.get_deviceId()]['auth'] is not None and self.__devices[msg.get_deviceId()]['client'] is None:
+
+                                self.__devices[msg.get_deviceId()]['client'] = client
+
+                elif msg.get_type() == b'2':
+
+                    try:
+
+                        self.__handle_batch(msg, client)
+
+                    except (InvalidTag, InvalidCommParameters) as error:
+
+                        self.__metrics['decrypt_failures'].labels(self.__failure_reason(error)).add()
+                        raise
 
                 else:
 
                     raise InvalidCommParameters()
 
-        except Exception:
+        except Exception as error:
 
-            pass
+            # The connection ends on any error, the reason is kept in the metrics
+
+            self.__metrics['connections_closed'].labels(self.__failure_reason(error)).add()
 
         finally:
 
+            # Abandons the sessions of the connection, without rotating the vaults, so the devices can reconnect
+
+            with self.__devices_lock:
+
+                for device_id in device_ids:
+
+                    if self.__devices.get(device_id, {}).get('client') is client:
+
+                        self.__devices[device_id]['auth'] = None
+                        self.__devices[device_id]['client'] = None
+
             # Removes the finished connection
 
             client.close()
 
             with self.__clients_lock:
 
-                self.__clients.remove(client)
+                self.__clients.pop(client, None)
 
     def close(self) -> None:
 
+        # Shutting the sockets down wakes the threads blocked on them, so the port and the connections are freed
+
         self.__running = False
+
+        try:
+
+            self.__host.shutdown(SHUT_RDWR)
+
+        except OSError:
+
+            pass
+
         self.__host.close()
 
+        self.__ingest.stop()
+
+        self.__broker.close()
+
+        if self.__storage is not None:
+
+            self.__storage.close()
+
         with self.__clients_lock:
 
             for client in self.__clients:
+
+                try:
+
+                    client.shutdown(SHUT_RDWR)
+
+                except OSError:
+
+                    pass
+
                 client.close()
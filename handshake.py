@@ -0,0 +1,142 @@
+from authenticator import InvalidCommParameters, Authenticator, KEY_LENGTH
+from challenge import Challenge, CHALLENGE_SIZE
+from message import Message
+from crypto import decrypt
+
+class DeviceHandshake:
+    '''
+    A class that runs the device side of the handshake (m1 to m4), independent of the transport.
+
+    The caller sends the messages the steps return and feeds the steps the messages it receives, so the same
+    exchange serves blocking sockets, asyncio streams and in memory tests.
+
+    Attributes:
+        __authenticator (Authenticator): The authenticator of the device, reset or new for the session.
+        __key (bytes): The key that encrypts the answer of the server (None until m3).
+        __challenge (Challenge): The challenge of the device to the server (None until m3).
+    '''
+
+    def __init__(self, authenticator: Authenticator):
+        '''
+        Initializes a DeviceHandshake object.
+
+        Args:
+            authenticator (Authenticator): The authenticator of the device, reset or new for the session.
+        '''
+
+        self.__authenticator = authenticator
+        self.__key = None
+        self.__challenge = None
+
+    def start(self) -> Message:
+        '''
+        Creates the first message, with the generation of the vault.
+
+        Returns:
+            Message: The m1 to send.
+        '''
+
+        return self.__authenticator.handshake(False, sync = self.__authenticator.sync_request())
+
+    def respond(self, m2: Message) -> Message:
+        '''
+        Solves the challenge of the server and challenges it back.
+
+        Args:
+            m2 (Message): The challenge of the server, with its generation of the vault.
+
+        Returns:
+            Message: The m3 to send.
+
+        Raises:
+            InvalidCommParameters: If the message has invalid parameters.
+        '''
+
+        ch1 = Challenge.from_bytes(m2.get_data())
+
+        # Catch up with the vault of the server first
+
+        self.__authenticator.apply_sync(m2.get_data()[ch1.get_length():])
+
+        k1 = self.__authenticator.solve_challenge(ch1)
+
+        self.__key, self.__challenge = self.__authenticator.generate_challenge(True, ch1.get_set())
+
+        return self.__authenticator.handshake(True, k1, ch1.get_chal(), self.__challenge)
+
+    def finish(self, m4: Message) -> None:
+        '''
+        Verifies the answer of the server and takes the session key.
+
+        Args:
+            m4 (Message): The answer of the server.
+
+        Returns:
+            None: The session key is agreed.
+
+        Raises:
+            InvalidTag: If decryption fails due to authentication failure.
+            InvalidCommParameters: If the message has invalid parameters or the challenge isn't solved.
+        '''
+
+        if self.__challenge is None:
+            raise InvalidCommParameters()
+
+        self.__authenticator.check_handshake(m4)
+
+        data = decrypt(m4.get_data(), self.__key)
+
+        if not self.__challenge.verify(data[0:CHALLENGE_SIZE]):
+            raise InvalidCommParameters()
+
+        self.__authenticator.feed_key(data[CHALLENGE_SIZE:CHALLENGE_SIZE + KEY_LENGTH])
+
+def run_handshake(authenticator: Authenticator, write, read) -> None:
+    '''
+    Runs the device side of the handshake over a blocking transport.
+
+    Args:
+        authenticator (Authenticator): The authenticator of the device, reset or new for the session.
+        write (callable): Sends a message.
+        read (callable): Returns the next message received.
+
+    Returns:
+        None: The session key is agreed.
+
+    Raises:
+        InvalidTag: If decryption fails due to authentication failure.
+        InvalidCommParameters: If communication of the handshake has invalid parameters.
+    '''
+
+    handshake = DeviceHandshake(authenticator)
+
+    write(handshake.start())
+
+    write(handshake.respond(read()))
+
+    handshake.finish(read())
+
+async def run_handshake_async(authenticator: Authenticator, write, read) -> None:
+    '''
+    Runs the device side of the handshake over an asyncio transport.
+
+    Args:
+        authenticator (Authenticator): The authenticator of the device, reset or new for the session.
+        write (callable): Sends a message (without waiting).
+        read (coroutine function): Returns the next message received.
+
+    Returns:
+        None: The session key is agreed.
+
+    Raises:
+        InvalidTag: If decryption fails due to authentication failure.
+        InvalidCommParameters: If communication of the handshake has invalid parameters.
+    '''
+
+    handshake = DeviceHandshake(authenticator)
+
+    write(handshake.start())
+
+    write(handshake.respond(await read()))
+
+    handshake.finish(await read())
@@ -0,0 +1,306 @@
+from controller import ALARM_STATES
+from collections import deque
+from threading import Thread, Condition, Lock
+from time import perf_counter
+
+class IngestLanes:
+    '''
+    A class that queues the readings to be stored in two lanes, drained by a single writer thread.
+
+    Readings in an alarm state go through the priority lane, which the writer always drains before the bulk
+    lane, so an alarm never waits behind routine telemetry. The readings of the same device still queued in
+    the bulk lane are promoted along with the alarm, so the readings of each device are stored in order. Each
+    device keeps its own queue of the bulk readings, so an alarm finds them without scanning the lane. The
+    bulk lane is bounded, blocking the receivers when the writer falls behind, while the priority lane is never
+    blocked.
+
+    An alarm is delivered as soon as it is queued (if a deliver is given), right after the readings it promotes
+    (and after the reading of the device being written, if any), so the readings of each device are also
+    delivered in order.
+
+    Attributes:
+        __write (callable): Called with the device, session, state, sensors, time and lane of each reading.
+        __on_error (callable): Called with the error of each reading that failed to be written (None to ignore them).
+        __deliver (callable): Called at once with the device, session, state, sensors and time of each alarm and of the readings it promotes (None if they are delivered when written).
+        __lanes (dict): The queue of readings (with their own lane) of each lane ('alarm' and 'bulk').
+        __queued (dict): The readings of each device queued in the bulk lane, from the oldest.
+        __bulk (int): The number of readings queued in the bulk lane (the promoted ones are left behind, marked without a lane).
+        __bulk_capacity (int): The number of readings the bulk lane holds.
+        __condition (Condition): The condition that signals changes to the lanes.
+        __pending (int): The number of readings queued or being written.
+        __writing (int): The device of the reading being written (None if there is none).
+        __latencies (dict): The recent seconds from receipt to write of each lane.
+        __totals (dict): The number of readings, seconds and maximum seconds written of each lane.
+        __stopped (bool): If the writer was stopped.
+        __thread (Thread): The writer thread.
+    '''
+
+    def __init__(self, write, bulk_capacity: int = 65536, samples: int = 4096, on_error = None, deliver = None):
+        '''
+        Initializes an IngestLanes object.
+
+        Args:
+            write (callable): Called with the device, session, state, sensors, time and lane of each reading (promoted readings are written from the 'alarm' lane).
+            bulk_capacity (int) = 65536: The number of readings the bulk lane holds.
+            samples (int) = 4096: The number of recent latencies kept per lane for the percentiles.
+            on_error (callable) = None: Called with the error of each reading that failed to be written.
+            deliver (callable) = None: Called at once with the device, session, state, sensors and time of each alarm, after the readings it promotes.
+        '''
+
+        self.__write = write
+        self.__on_error = on_error
+        self.__deliver = deliver
+        self.__lanes = {'alarm': deque(), 'bulk': deque()}
+        self.__queued = dict()
+        self.__bulk = 0
+        self.__bulk_capacity = bulk_capacity
+        self.__condition = Condition(Lock())
+        self.__pending = 0
+        self.__writing = None
+        self.__latencies = {'alarm': deque(maxlen=samples), 'bulk': deque(maxlen=samples)}
+        self.__totals = {lane: {'count': 0, 'seconds': 0.0, 'max': 0.0} for lane in self.__lanes}
+        self.__stopped = False
+
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    @staticmethod
+    def classify(state: int) -> str:
+        '''
+        Returns the lane of a reading.
+
+        Args:
+            state (int): The state of the device.
+
+        Returns:
+            str: 'alarm' if the state is an alarm, 'bulk' otherwise.
+        '''
+
+        return 'alarm' if state in ALARM_STATES else 'bulk'
+
+    def submit(self, device_id: int, session_id: int, state: int, sensors: list, timestamp: float, received: float = None) -> str:
+        '''
+        Queues a reading in its lane.
+
+        Args:
+            device_id (int): The identifier of the device.
+            session_id (int): The identifier of the session.
+            state (int): The state of the device.
+            sensors (list): The list of information from the sensors.
+            timestamp (float): The time of the reading.
+            received (float) = None: The performance counter when the reading was received (now if not given).
+
+        Returns:
+            str: The lane of the reading.
+
+        Raises:
+            RuntimeError: If the writer was stopped.
+        '''
+
+        lane = self.classify(state)
+        received = perf_counter() if received is None else received
+
+        with self.__condition:
+
+            # Only the bulk lane pushes back on the receivers
+
+            if lane == 'bulk':
+
+                self.__condition.wait_for(lambda: self.__bulk < self.__bulk_capacity or self.__stopped)
+
+            # An alarm waits for the reading of its device being written (and delivered), if any
+
+            else:
+
+                self.__condition.wait_for(lambda: self.__writing != device_id or self.__stopped)
+
+            if self.__stopped:
+                raise RuntimeError('the ingest lanes were stopped')
+
+            # Promote the earlier readings of the device to the alarm lane, taken from its own queue (without
+            # scanning the bulk lane), and mark them in the bulk lane so the writer skips them
+
+            promoted = []
+
+            if lane == 'alarm':
+
+                for reading in self.__queued.pop(device_id, ()):
+
+                    promoted.append(tuple(reading[0:6]) + ('alarm',))
+
+                    reading[6] = None
+
+                self.__lanes['alarm'].extend(promoted)
+                self.__bulk -= len(promoted)
+
+                self.__lanes['alarm'].append((device_id, session_id, state, sensors, timestamp, received, lane))
+
+            else:
+
+                reading = [device_id, session_id, state, sensors, timestamp, received, lane]
+
+                self.__lanes['bulk'].append(reading)
+                self.__queued.setdefault(device_id, deque()).append(reading)
+                self.__bulk += 1
+
+            self.__pending += 1
+
+            # Deliver the promoted readings before the alarm (under the lock, so the alarms of a device keep their order)
+
+            if lane == 'alarm' and self.__deliver is not None:
+
+                for reading in promoted:
+
+                    self.__deliver(*reading[0:5])
+
+                self.__deliver(device_id, session_id, state, sensors, timestamp)
+
+            self.__condition.notify_all()
+
+        return lane
+
+    def __run(self) -> None:
+        '''
+        Writes the queued readings, alarms first, until stopped and drained.
+
+        Returns:
+            None: Runs until stopped.
+        '''
+
+        while True:
+
+            with self.__condition:
+
+                self.__condition.wait_for(lambda: self.__lanes['alarm'] or self.__bulk or self.__stopped)
+
+                if not self.__lanes['alarm'] and not self.__bulk:
+                    return
+
+                if self.__lanes['alarm']:
+
+                    device_id, session_id, state, sensors, timestamp, received, lane = self.__lanes['alarm'].popleft()
+
+                    # Only promoted readings are left in an empty bulk lane
+
+                    if not self.__bulk:
+
+                        self.__lanes['bulk'].clear()
+
+                else:
+
+                    # Skip the readings promoted out of the bulk lane
+
+                    while self.__lanes['bulk'][0][6] is None:
+
+                        self.__lanes['bulk'].popleft()
+
+                    device_id, session_id, state, sensors, timestamp, received, lane = self.__lanes['bulk'].popleft()
+
+                    # The reading is the oldest one of its device
+
+                    self.__queued[device_id].popleft()
+
+                    if not self.__queued[device_id]:
+
+                        del self.__queued[device_id]
+
+                    self.__bulk -= 1
+
+                self.__writing = device_id
+
+                self.__condition.notify_all()
+
+            # A reading that fails to be written must not stop the writer
+
+            try:
+
+                self.__write(device_id, session_id, state, sensors, timestamp, lane)
+
+            except Exception as error:
+
+                if self.__on_error is not None:
+
+                    self.__on_error(error)
+
+            latency = perf_counter() - received
+
+            with self.__condition:
+
+                self.__latencies[lane].append(latency)
+
+                self.__totals[lane]['count'] += 1
+                self.__totals[lane]['seconds'] += latency
+                self.__totals[lane]['max'] = max(self.__totals[lane]['max'], latency)
+
+                self.__pending -= 1
+                self.__writing = None
+
+                self.__condition.notify_all()
+
+    def join(self, timeout: float = None) -> bool:
+        '''
+        Waits for every queued reading to be written.
+
+        Args:
+            timeout (float) = None: The number of seconds to wait (forever if not given).
+
+        Returns:
+            bool: If the lanes were drained.
+        '''
+
+        with self.__condition:
+
+            return self.__condition.wait_for(lambda: self.__pending == 0, timeout)
+
+    def get_depths(self) -> dict:
+        '''
+        Returns the number of readings queued in each lane.
+
+        Returns:
+            dict: The number of readings of the 'alarm' and 'bulk' lanes.
+        '''
+
+        return {'alarm': len(self.__lanes['alarm']), 'bulk': self.__bulk}
+
+    def get_stats(self) -> dict:
+        '''
+        Returns the latency from receipt to write of each lane.
+
+        Returns:
+            dict: Per lane, the 'count', 'queued', 'mean' and 'max' seconds and the 'p50' and 'p99' of the recent ones.
+        '''
+
+        with self.__condition:
+
+            stats = dict()
+
+            for lane, totals in self.__totals.items():
+
+                recent = sorted(self.__latencies[lane])
+
+                stats[lane] = {
+                    'count': totals['count'],
+                    'queued': len(self.__lanes['alarm']) if lane == 'alarm' else self.__bulk,
+                    'mean': totals['seconds'] / totals['count'] if totals['count'] else 0.0,
+                    'max': totals['max'],
+                    'p50': recent[len(recent) // 2] if recent else 0.0,
+                    'p99': recent[min(len(recent) - 1, len(recent) * 99 // 100)] if recent else 0.0
+                }
+
+            return stats
+
+    def stop(self) -> None:
+        '''
+        Stops taking readings and waits for the writer to write the queued ones.
+
+        Returns:
+            None: The writer thread is stopped.
+        '''
+
+        with self.__condition:
+
+            self.__stopped = True
+
+            self.__condition.notify_all()
+
+        self.__thread.join()
@@ -0,0 +1,420 @@
+from threading import Lock, local, current_thread
+from time import perf_counter
+import os
+
+# The number of histogram buckets, bucket i holding the durations under 2^i microseconds
+
+BUCKETS = 32
+
+class Sharded:
+    '''
+    A class representing a metric whose values are sharded per thread, so recording takes no lock.
+
+    Each shard is a list of numbers, summed element by element when the metric is read. The shards of the
+    threads that ended are folded into a retired shard, so short lived threads don't pile up.
+
+    Attributes:
+        __name (str): The name of the metric.
+        __size (int): The number of values in each shard.
+        __local (local): The shard of the current thread.
+        __shards (list): The thread and shard of every thread that recorded.
+        __retired (list): The sum of the shards of the threads that ended.
+        __lock (Lock): The lock that protects the list of shards.
+    '''
+
+    def __init__(self, name: str, size: int):
+        '''
+        Initializes a Sharded object.
+
+        Args:
+            name (str): The name of the metric.
+            size (int): The number of values in each shard.
+        '''
+
+        self.__name = name
+        self.__size = size
+        self.__local = local()
+        self.__shards = list()
+        self.__retired = [0] * size
+        self.__lock = Lock()
+
+    def get_name(self) -> str:
+        '''
+        Returns the name of the metric.
+
+        Returns:
+            str: The name.
+        '''
+
+        return self.__name
+
+    def _shard(self) -> list:
+        '''
+        Returns the shard of the current thread, creating it on its first record.
+
+        Returns:
+            list: The values of the thread.
+        '''
+
+        try:
+
+            return self.__local.shard
+
+        except AttributeError:
+
+            shard = self.__local.shard = [0] * self.__size
+
+            with self.__lock:
+
+                self.__shards.append((current_thread(), shard))
+
+            return shard
+
+    def _collect(self) -> list:
+        '''
+        Sums the shards of every thread, folding the ones of the threads that ended.
+
+        Returns:
+            list: The values of the metric.
+        '''
+
+        with self.__lock:
+
+            live = list()
+
+            for thread, shard in self.__shards:
+
+                if thread.is_alive():
+
+                    live.append((thread, shard))
+
+                else:
+
+                    self.__retired = [a + b for a, b in zip(self.__retired, shard)]
+
+            self.__shards = live
+
+            total = list(self.__retired)
+
+            for _, shard in live:
+
+                total = [a + b for a, b in zip(total, shard)]
+
+        return total
+
+class Histogram(Sharded):
+    '''
+    A class representing a histogram of durations with power of two buckets.
+
+    Each shard holds the count, the total seconds and the count of each bucket.
+    '''
+
+    def __init__(self, name: str):
+        '''
+        Initializes a Histogram object.
+
+        Args:
+            name (str): The name of the histogram.
+        '''
+
+        super().__init__(name, 2 + BUCKETS)
+
+    def record(self, seconds: float) -> None:
+        '''
+        Records a duration.
+
+        Args:
+            seconds (float): The duration.
+
+        Returns:
+            None: The duration is counted in its bucket.
+        '''
+
+        shard = self._shard()
+
+        bucket = int(seconds * 1e6).bit_length()
+
+        if bucket >= BUCKETS:
+            bucket = BUCKETS - 1
+
+        shard[0] += 1
+        shard[1] += seconds
+        shard[2 + bucket] += 1
+
+    def snapshot(self) -> dict:
+        '''
+        Merges the shards of every thread.
+
+        Returns:
+            dict: The 'count', 'sum' in seconds and 'buckets', with the 'p50', 'p90' and 'p99' as bucket upper bounds in seconds.
+        '''
+
+        values = self._collect()
+
+        count, total, buckets = values[0], values[1], values[2:]
+
+        summary = {'count': count, 'sum': total, 'buckets': buckets}
+
+        for label, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+
+            # The first bucket that reaches the quantile
+
+            seen = 0
+            summary[label] = 0.0
+
+            for i, n in enumerate(buckets):
+
+                seen += n
+
+                if count and seen >= q * count:
+
+                    summary[label] = (1 << i) / 1e6
+                    break
+
+        return summary
+
+class Counter(Sharded):
+    '''
+    A class representing a counter of events.
+    '''
+
+    def __init__(self, name: str):
+        '''
+        Initializes a Counter object.
+
+        Args:
+            name (str): The name of the counter.
+        '''
+
+        super().__init__(name, 1)
+
+    def add(self, n: int = 1) -> None:
+        '''
+        Counts events.
+
+        Args:
+            n (int) = 1: The number of events.
+
+        Returns:
+            None: The events are counted.
+        '''
+
+        self._shard()[0] += n
+
+    def value(self) -> int:
+        '''
+        Sums the shards of every thread.
+
+        Returns:
+            int: The number of events.
+        '''
+
+        return self._collect()[0]
+
+class PhaseTimer:
+    '''
+    A class that times the consecutive phases of an operation into histograms named after it.
+
+    Attributes:
+        __name (str): The name of the operation.
+        __start (float): The performance counter when the operation started.
+        __last (float): The performance counter when the last phase ended.
+    '''
+
+    def __init__(self, name: str):
+        '''
+        Initializes a PhaseTimer object, starting the first phase.
+
+        Args:
+            name (str): The name of the operation.
+        '''
+
+        self.__name = name
+        self.__start = self.__last = perf_counter()
+
+    def lap(self, phase: str) -> None:
+        '''
+        Ends the current phase, recording it as '<operation>.<phase>'.
+
+        Args:
+            phase (str): The name of the phase.
+
+        Returns:
+            None: The phase is recorded and the next one starts.
+        '''
+
+        now = perf_counter()
+
+        histogram(f'{self.__name}.{phase}').record(now - self.__last)
+
+        self.__last = now
+
+    def stop(self) -> None:
+        '''
+        Ends the operation, recording its whole duration under its name.
+
+        Returns:
+            None: The operation is recorded.
+        '''
+
+        histogram(self.__name).record(perf_counter() - self.__start)
+
+class NullTimer:
+    '''
+    A class that stands for the PhaseTimer while the instrumentation is disabled, doing nothing.
+    '''
+
+    def lap(self, phase: str) -> None:
+        '''
+        Does nothing.
+
+        Args:
+            phase (str): The name of the phase.
+
+        Returns:
+            None: Nothing is recorded.
+        '''
+
+    def stop(self) -> None:
+        '''
+        Does nothing.
+
+        Returns:
+            None: Nothing is recorded.
+        '''
+
+# The shared state of the instrumentation (disabled unless IOT_INSTRUMENT=1)
+
+enabled = os.environ.get('IOT_INSTRUMENT') == '1'
+
+NULL_TIMER = NullTimer()
+
+_histograms = dict()
+_counters = dict()
+_lock = Lock()
+
+def enable() -> None:
+    '''
+    Enables the instrumentation.
+
+    Returns:
+        None: The hooks start recording.
+    '''
+
+    global enabled
+
+    enabled = True
+
+def disable() -> None:
+    '''
+    Disables the instrumentation, the hooks doing nothing but checking it.
+
+    Returns:
+        None: The hooks stop recording.
+    '''
+
+    global enabled
+
+    enabled = False
+
+def histogram(name: str) -> Histogram:
+    '''
+    Returns the histogram of a name, creating it if needed.
+
+    Args:
+        name (str): The name of the histogram.
+
+    Returns:
+        Histogram: The histogram.
+    '''
+
+    found = _histograms.get(name)
+
+    if found is None:
+
+        with _lock:
+
+            found = _histograms.setdefault(name, Histogram(name))
+
+    return found
+
+def counter(name: str) -> Counter:
+    '''
+    Returns the counter of a name, creating it if needed.
+
+    Args:
+        name (str): The name of the counter.
+
+    Returns:
+        Counter: The counter.
+    '''
+
+    found = _counters.get(name)
+
+    if found is None:
+
+        with _lock:
+
+            found = _counters.setdefault(name, Counter(name))
+
+    return found
+
+def timer(name: str):
+    '''
+    Starts timing the phases of an operation.
+
+    Args:
+        name (str): The name of the operation.
+
+    Returns:
+        PhaseTimer: The timer (a shared one that does nothing if the instrumentation is disabled).
+    '''
+
+    return PhaseTimer(name) if enabled else NULL_TIMER
+
+def count(name: str, n: int = 1) -> None:
+    '''
+    Counts events, if the instrumentation is enabled.
+
+    Args:
+        name (str): The name of the counter.
+        n (int) = 1: The number of events.
+
+    Returns:
+        None: The events are counted.
+    '''
+
+    if enabled:
+
+        counter(name).add(n)
+
+def snapshot() -> dict:
+    '''
+    Returns what was recorded so far.
+
+    Returns:
+        dict: The 'histograms' and the 'counters', by name.
+    '''
+
+    with _lock:
+
+        histograms = dict(_histograms)
+        counters = dict(_counters)
+
+    return {
+        'histograms': {name: found.snapshot() for name, found in sorted(histograms.items())},
+        'counters': {name: found.value() for name, found in sorted(counters.items())}
+    }
+
+def reset() -> None:
+    '''
+    Forgets what was recorded so far.
+
+    Returns:
+        None: The histograms and counters are dropped.
+    '''
+
+    with _lock:
+
+        _histograms.clear()
+        _counters.clear()
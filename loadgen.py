@@ -0,0 +1,454 @@
+from setup import provision, PATH_DV_VAULTS, PATH_SV_VAULTS, PATH_DV_KEYS
+from authenticator import Authenticator, TIME_TO_LIVE
+from handshake import run_handshake_async
+from config_dv import thermo, assist
+from controller import Controller
+from delta import DeltaCodec
+from handler import Handler
+from capture import load_capture_key
+from message import Message, HEADER
+from rng import Randomness
+from copy import deepcopy
+from collections import deque
+from multiprocessing import Process, Pipe, Event
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter, time
+import argparse, asyncio, json, os, resource
+
+# Load generator: provisions a fleet of virtual devices in a scratch directory and drives them, from a single
+# event loop, against a Handler running in its own process
+
+def percentiles(samples) -> dict:
+    '''
+    Summarizes a list of latencies.
+
+    Args:
+        samples (list): The latencies in seconds.
+
+    Returns:
+        dict: The 'count', 'p50', 'p90', 'p99' and 'max' in seconds (zero if there are no samples).
+    '''
+
+    samples = sorted(samples)
+
+    if not samples:
+        return {'count': 0, 'p50': 0.0, 'p90': 0.0, 'p99': 0.0, 'max': 0.0}
+
+    def at(q: float) -> float:
+
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    return {'count': len(samples), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': samples[-1]}
+
+def controller_of(device_id: int) -> Controller:
+    '''
+    Returns the controller of a virtual device, alternating the thermometers and the assistants.
+
+    Args:
+        device_id (int): The identifier of the device.
+
+    Returns:
+        Controller: The controller.
+    '''
+
+    return thermo if device_id % 2 else assist
+
+class Fleet:
+    '''
+    A class representing the settings and the counters shared by the virtual devices.
+
+    Attributes:
+        host (str): The address of the server.
+        port (int): The port of the server.
+        rate (float): The readings per second of each device.
+        churn (float): The probability of a device reconnecting after each reading.
+        deadline (float): The performance counter at which the devices stop.
+        storm (int): The number of reconnect storms so far (the devices reconnect when it changes).
+        stats (dict): The counters of the fleet.
+        handshakes (list): The latency of each handshake.
+        errors (dict): The number of errors of each kind.
+        rng (Randomness): The source the devices split their own streams from.
+    '''
+
+    def __init__(self, host: str, port: int, rate: float, churn: float, duration: float, rng: Randomness = None):
+        '''
+        Initializes a Fleet object.
+
+        Args:
+            host (str): The address of the server.
+            port (int): The port of the server.
+            rate (float): The readings per second of each device.
+            churn (float): The probability of a device reconnecting after each reading.
+            duration (float): The number of seconds the devices run.
+            rng (Randomness) = None: The source the devices split their own streams from (the CSPRNG if not given).
+        '''
+
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.churn = churn
+        self.deadline = perf_counter() + duration
+        self.storm = 0
+        self.stats = {'connections': 0, 'handshakes': 0, 'readings': 0, 'errors': 0}
+        self.handshakes = list()
+        self.errors = dict()
+        self.rng = Randomness() if rng is None else rng
+
+class VirtualDevice:
+    '''
+    A class that emulates an IoT device over asyncio streams, following the same protocol as the Device.
+
+    Attributes:
+        __deviceId (int): The identifier of the device.
+        __controller (Controller): The controller of the sensors.
+        __authenticator (Authenticator): The authenticator of the current session (None if there is none).
+        __delta (DeltaCodec): The encoder of successive readings (None if the delta mode is disabled).
+        __fleet (Fleet): The fleet the device belongs to.
+        __rng (Randomness): The source of the pacing and the churn of the device.
+        __authRng (Randomness): The source of the keys, challenges and nonces of the device.
+    '''
+
+    def __init__(self, device_id: int, controller: Controller, fleet: Fleet):
+        '''
+        Initializes a VirtualDevice object.
+
+        Args:
+            device_id (int): The identifier of the device.
+            controller (Controller): The controller of the sensors.
+            fleet (Fleet): The fleet the device belongs to.
+        '''
+
+        self.__deviceId = device_id
+        self.__controller = deepcopy(controller)
+        self.__authenticator = None
+        self.__delta = DeltaCodec() if controller.is_delta() else None
+        self.__fleet = fleet
+        self.__rng = fleet.rng.derive(device_id, 'pacing')
+        self.__authRng = fleet.rng.derive(device_id, 'auth')
+
+        self.__controller.set_rng(fleet.rng.derive(device_id, 'sensors'))
+
+    @staticmethod
+    async def __read(reader: asyncio.StreamReader) -> Message:
+        '''
+        Reads a message from the server.
+
+        Args:
+            reader (asyncio.StreamReader): The stream from the server.
+
+        Returns:
+            Message: The message.
+        '''
+
+        device_id, session_id, type, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+
+        return Message(device_id, session_id, type, await reader.readexactly(length))
+
+    async def __authenticate(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Authenticates the server and itself, agreeing on a shared key.
+
+        Args:
+            reader (asyncio.StreamReader): The stream from the server.
+            writer (asyncio.StreamWriter): The stream to the server.
+
+        Returns:
+            None: The authentication is sucessful and the key is agreed.
+
+        Raises:
+            InvalidTag: If decryption fails due to authentication failure.
+            InvalidCommParameters: If communication of the handshake has invalid parameters.
+        '''
+
+        start = perf_counter()
+
+        # Reset or initialize the authenticator
+
+        if self.__authenticator is None:
+
+            self.__authenticator = Authenticator(self.__deviceId, True, rng = self.__authRng)
+
+        else:
+
+            self.__authenticator.reset()
+
+        if self.__delta is not None:
+
+            self.__delta.reset()
+
+        await run_handshake_async(self.__authenticator, lambda msg: writer.write(msg.to_bytes()), lambda: self.__read(reader))
+
+        self.__fleet.stats['handshakes'] += 1
+        self.__fleet.handshakes.append(perf_counter() - start)
+
+    async def __session(self) -> None:
+        '''
+        Connects to the server and sends readings, until the deadline, a reconnect storm or churn.
+
+        Returns:
+            None: The connection is closed.
+        '''
+
+        storm = self.__fleet.storm
+
+        reader, writer = await asyncio.open_connection(self.__fleet.host, self.__fleet.port)
+
+        self.__fleet.stats['connections'] += 1
+
+        try:
+
+            while perf_counter() < self.__fleet.deadline and storm == self.__fleet.storm:
+
+                if self.__authenticator is None or self.__authenticator.time_lived() == TIME_TO_LIVE:
+
+                    await self.__authenticate(reader, writer)
+
+                # Spread the readings of the fleet around the rate
+
+                await asyncio.sleep(self.__rng.expovariate(self.__fleet.rate))
+
+                self.__controller.change_state()
+
+                data = self.__controller.read_device_bytes(None)
+
+                if self.__delta is not None:
+
+                    data = self.__delta.encode(data)
+
+                writer.write(self.__authenticator.encrypt(data).to_bytes())
+
+                await writer.drain()
+
+                self.__fleet.stats['readings'] += 1
+
+                if self.__rng.random() < self.__fleet.churn:
+                    break
+
+        finally:
+
+            # A finished session rotates the vault, as the server will, an unfinished one is abandoned by both
+
+            if self.__authenticator is not None and self.__authenticator.time_lived() == TIME_TO_LIVE:
+
+                self.__authenticator.reset()
+
+            self.__authenticator = None
+
+            writer.close()
+
+            try:
+
+                await writer.wait_closed()
+
+            except ConnectionError:
+
+                pass
+
+    async def run(self) -> None:
+        '''
+        Runs sessions until the deadline, reconnecting after errors.
+
+        Returns:
+            None: The deadline was reached.
+        '''
+
+        # Start the devices at different times
+
+        await asyncio.sleep(self.__rng.uniform(0, 1 / self.__fleet.rate))
+
+        while perf_counter() < self.__fleet.deadline:
+
+            try:
+
+                await self.__session()
+
+            except Exception as e:
+
+                # A handshake is rejected while the server still holds the abandoned session of the device
+
+                self.__fleet.stats['errors'] += 1
+                self.__fleet.errors[type(e).__name__] = self.__fleet.errors.get(type(e).__name__, 0) + 1
+
+                await asyncio.sleep(self.__rng.uniform(0.05, 0.2))
+
+def serve(path: str, device_ids: list, port: int, ready, stop, conn, capture: str = None, seed: int = None, capture_key: bytes = None) -> None:
+    '''
+    Runs the Handler of the fleet, sending its statistics back when stopped.
+
+    Args:
+        path (str): The directory with the vaults of the fleet.
+        device_ids (list): The identifiers of the devices.
+        port (int): The port of the server.
+        ready (Event): Set once the server accepts connections.
+        stop (Event): Set to stop the server.
+        conn (Connection): Where the statistics are sent.
+        capture (str) = None: The path where the traffic is captured (not captured if not given).
+        seed (int) = None: The seed of the server randomness (the CSPRNG if not given).
+        capture_key (bytes) = None: The key that seals the vaults in the capture (they are left out if not given).
+
+    Returns:
+        None: The statistics are sent.
+    '''
+
+    os.chdir(path)
+
+    sv = Handler({device_id: {'auth': None, 'controller': controller_of(device_id)} for device_id in device_ids}, 'localhost', port, rng = Randomness(seed))
+
+    # Count the readings delivered to a subscriber, and how long after their receipt
+
+    subscription = sv.subscribe(capacity=1 << 20)
+    delivered = deque(maxlen=1 << 20)
+
+    def consume() -> None:
+
+        for entry in subscription:
+
+            delivered.append(time() - entry['time'])
+
+    Thread(target=consume, daemon=True).start()
+    Thread(target=sv.run_server, daemon=True).start()
+
+    if capture is not None:
+
+        sv.start_capture(capture, capture_key)
+
+    ready.set()
+    stop.wait()
+
+    sv.flush(10)
+
+    sv.stop_capture()
+
+    conn.send({'readings': len(delivered), 'dropped': subscription.get_dropped(), 'delivery': percentiles(delivered), 'ingest': sv.get_ingest_stats()})
+
+    sv.close()
+
+async def drive(fleet: Fleet, device_ids: list, storm_every: float) -> None:
+    '''
+    Runs the virtual devices, with reconnect storms at a fixed period.
+
+    Args:
+        fleet (Fleet): The fleet.
+        device_ids (list): The identifiers of the devices.
+        storm_every (float): The seconds between reconnect storms (none if zero).
+
+    Returns:
+        None: Every device reached the deadline.
+    '''
+
+    async def storms() -> None:
+
+        while storm_every > 0 and perf_counter() + storm_every < fleet.deadline:
+
+            await asyncio.sleep(storm_every)
+
+            fleet.storm += 1
+
+    await asyncio.gather(storms(), *(VirtualDevice(device_id, controller_of(device_id), fleet).run() for device_id in device_ids))
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Drives a fleet of virtual devices against a local server.')
+    parser.add_argument('--devices', type=int, default=1000, help='the number of virtual devices')
+    parser.add_argument('--rate', type=float, default=1.0, help='the readings per second of each device')
+    parser.add_argument('--duration', type=float, default=30.0, help='the seconds the fleet runs')
+    parser.add_argument('--churn', type=float, default=0.0, help='the probability of reconnecting after each reading')
+    parser.add_argument('--storm-every', type=float, default=0.0, help='the seconds between reconnect storms of the whole fleet')
+    parser.add_argument('--port', type=int, default=9270, help='the port of the server')
+    parser.add_argument('--capture', help='capture the traffic of the server to this file, for replay.py')
+    parser.add_argument('--capture-key', help='the key that seals the vaults in the capture, created if missing (<capture>.key if not given, the vaults of the fleet are gone after the run)')
+    parser.add_argument('--seed', type=int, help='make the vaults, handshakes and readings reproducible (insecure, for tests only)')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    capture = None if args.capture is None else os.path.abspath(args.capture)
+    capture_key = None if capture is None else load_capture_key(capture + '.key' if args.capture_key is None else args.capture_key)
+
+    rng = Randomness(args.seed)
+
+    # Each device takes a socket on both ends
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with TemporaryDirectory() as path:
+
+        # Provision the fleet
+
+        os.chdir(path)
+
+        for directory in (PATH_DV_VAULTS, PATH_SV_VAULTS, PATH_DV_KEYS):
+
+            os.makedirs(directory)
+
+        start = perf_counter()
+
+        device_ids = [provision(device_id, rng.derive(device_id, 'provision')) for device_id in range(1, args.devices + 1)]
+
+        provisioning = perf_counter() - start
+
+        # Start the server in its own process, so it doesn't share the interpreter with the fleet
+
+        ready, stop = Event(), Event()
+        receiver, sender = Pipe(False)
+
+        server = Process(target=serve, args=(path, device_ids, args.port, ready, stop, sender, capture, args.seed, capture_key))
+        server.start()
+
+        while not ready.wait(0.1):
+
+            if not server.is_alive():
+                raise SystemExit('the server failed to start')
+
+        fleet = Fleet('localhost', args.port, args.rate, args.churn, args.duration, rng)
+
+        start = perf_counter()
+
+        asyncio.run(drive(fleet, device_ids, args.storm_every))
+
+        elapsed = perf_counter() - start
+
+        stop.set()
+        server_stats = receiver.recv()
+        server.join(10)
+
+        if server.is_alive():
+
+            server.terminate()
+
+        os.chdir('/')
+
+    report = {
+        'devices': args.devices,
+        'seconds': elapsed,
+        'provisioning_seconds': provisioning,
+        'storms': fleet.storm,
+        **fleet.stats,
+        'error_kinds': fleet.errors,
+        'handshakes_per_second': fleet.stats['handshakes'] / elapsed,
+        'readings_per_second': fleet.stats['readings'] / elapsed,
+        'handshake_latency': percentiles(fleet.handshakes),
+        'server': {**server_stats, 'readings_per_second': server_stats['readings'] / elapsed}
+    }
+
+    if args.json:
+
+        print(json.dumps(report, indent=2))
+        return
+
+    ms = lambda summary: ' '.join(f'{key} {summary[key] * 1000:.2f}ms' for key in ('p50', 'p90', 'p99', 'max'))
+
+    print(f'{args.devices} devices for {elapsed:.1f}s (provisioned in {provisioning:.1f}s), {fleet.storm} reconnect storms')
+    print(f'connections {fleet.stats["connections"]}, errors {fleet.stats["errors"]} {fleet.errors}')
+    print(f'handshakes {fleet.stats["handshakes"]} ({report["handshakes_per_second"]:.1f}/s), latency {ms(report["handshake_latency"])}')
+    print(f'readings sent {fleet.stats["readings"]} ({report["readings_per_second"]:.1f}/s), delivered {server_stats["readings"]} ({report["server"]["readings_per_second"]:.1f}/s, {server_stats["dropped"]} dropped)')
+    print(f'delivery latency {ms(server_stats["delivery"])}')
+
+    for lane, stats in server_stats['ingest'].items():
+
+        print(f'{lane} ingest {stats["count"]} readings, latency p50 {stats["p50"] * 1000:.2f}ms p99 {stats["p99"] * 1000:.2f}ms max {stats["max"] * 1000:.2f}ms')
+
+if __name__ == '__main__':
+
+    main()
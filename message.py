@@ -1,4 +1,24 @@
 from socket import socket
+from struct import Struct
+
+# The header of a message frame (device identifier, session identifier, type and data length)
+
+HEADER = Struct('<II1sI')
+
+# The header of each group of readings in a batch (device identifier, session identifier, number of readings and data length),
+# followed by the time of each reading and the readings
+
+BATCH_GROUP = Struct('<IIII')
+
+# The time of a reading in a batch
+
+BATCH_TIMESTAMP = Struct('<d')
+
+# The status of the acknowledgement of a batch, followed by the nonce of the batch and the tag of both under the
+# session key of the gateway
+
+BATCH_ACCEPTED = b'\x01'
+BATCH_REJECTED = b'\x00'
 
 class Message:
     '''
@@ -83,16 +103,48 @@ class Message:
             BrokenPipeError: In case communication fails.
         '''
 
-        # Write the header
+        # Write the whole frame at once
+
+        conn.sendall(self.to_bytes())
+
+    def to_bytes(self) -> bytes:
+        '''
+        Converts the message into its frame.
+
+        Returns:
+            bytes: The header followed by the data.
+        '''
+
+        return HEADER.pack(self.__deviceId, self.__sessionId, self.__type, self.get_dataLength()) + self.__data
+
+    @staticmethod
+    def __recv_exact(conn: socket, size: int) -> bytes:
+        '''
+        Reads an exact number of bytes from a connection socket, as a frame may arrive in several pieces.
+
+        Args:
+            conn (socket): The connection socket.
+            size (int): The number of bytes.
+
+        Returns:
+            bytes: The bytes read.
+
+        Raises:
+            ConnectionResetError: If the connection is closed before all the bytes arrive.
+        '''
 
-        conn.sendall(self.__deviceId.to_bytes(4, 'little'))
-        conn.sendall(self.__sessionId.to_bytes(4, 'little'))
-        conn.sendall(self.__type)
+        data = bytearray()
 
-        # Write the data
+        while len(data) < size:
 
-        conn.sendall(self.get_dataLength().to_bytes(4, 'little'))
-        conn.sendall(self.__data)
+            chunk = conn.recv(size - len(data))
+
+            if not chunk:
+                raise ConnectionResetError('the connection was closed')
+
+            data += chunk
+
+        return bytes(data)
 
     @classmethod
     def read_bytes(cls, conn: socket):
@@ -106,15 +158,61 @@ class Message:
     
         # Read the header
 
-        device_id = int.from_bytes(conn.recv(4), 'little')
-        session_id = int.from_bytes(conn.recv(4), 'little')
-        type = conn.recv(1)
+        device_id, session_id, type, length = HEADER.unpack(cls.__recv_exact(conn, HEADER.size))
 
         # Read the data
 
-        length = int.from_bytes(conn.recv(4), 'little')
-        data = conn.recv(length)
+        data = cls.__recv_exact(conn, length)
 
         # Create the message object
 
-        return Message(device_id, session_id, type, data)
\ No newline at end of file
+        return Message(device_id, session_id, type, data)
+
+def batch_to_bytes(groups: list) -> bytes:
+    '''
+    Converts the readings of several device sessions into the data of a batch message.
+
+    Args:
+        groups (list): The readings of each device session, as (device_id, session_id, timestamps, data), with the time of each reading and the readings concatenated in binary mode.
+
+    Returns:
+        bytes: The header, the times and the readings of each group.
+    '''
+
+    return b''.join(BATCH_GROUP.pack(device_id, session_id, len(timestamps), len(data)) + Struct(f'<{len(timestamps)}d').pack(*timestamps) + data for device_id, session_id, timestamps, data in groups)
+
+def bytes_to_batch(data: bytes) -> list:
+    '''
+    Converts the data of a batch message into the readings of each device session.
+
+    Args:
+        data (bytes): The data of the batch.
+
+    Returns:
+        list: The readings of each device session, as (device_id, session_id, timestamps, data).
+
+    Raises:
+        ValueError: If a group is truncated.
+    '''
+
+    groups = []
+    offset = 0
+
+    while offset < len(data):
+
+        if offset + BATCH_GROUP.size > len(data):
+            raise ValueError('truncated batch group header')
+
+        device_id, session_id, count, length = BATCH_GROUP.unpack_from(data, offset)
+        offset += BATCH_GROUP.size
+
+        if offset + count * BATCH_TIMESTAMP.size + length > len(data):
+            raise ValueError('truncated batch group data')
+
+        timestamps = list(Struct(f'<{count}d').unpack_from(data, offset))
+        offset += count * BATCH_TIMESTAMP.size
+
+        groups.append((device_id, session_id, timestamps, data[offset:offset + length]))
+        offset += length
+
+    return groups
@@ -0,0 +1,339 @@
+from instrument import Counter, Histogram, BUCKETS
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+
+class CounterFamily:
+    '''
+    A class representing a counter split by the values of its labels.
+
+    Attributes:
+        __name (str): The name of the counter.
+        __labels (tuple): The names of the labels.
+        __children (dict): The counter of each tuple of label values.
+        __lock (Lock): The lock that serializes the creation of children.
+    '''
+
+    def __init__(self, name: str, labels: tuple = ()):
+        '''
+        Initializes a CounterFamily object.
+
+        Args:
+            name (str): The name of the counter.
+            labels (tuple) = (): The names of the labels.
+        '''
+
+        self.__name = name
+        self.__labels = tuple(labels)
+        self.__children = dict()
+        self.__lock = Lock()
+
+    def get_labels(self) -> tuple:
+        '''
+        Returns the names of the labels.
+
+        Returns:
+            tuple: The names of the labels.
+        '''
+
+        return self.__labels
+
+    def labels(self, *values) -> Counter:
+        '''
+        Returns the counter of some label values, creating it if needed.
+
+        Args:
+            *values: The value of each label.
+
+        Returns:
+            Counter: The counter.
+        '''
+
+        child = self.__children.get(values)
+
+        if child is None:
+
+            with self.__lock:
+
+                child = self.__children.setdefault(values, Counter(self.__name))
+
+        return child
+
+    def inc(self, n: int = 1) -> None:
+        '''
+        Counts events on the counter without labels.
+
+        Args:
+            n (int) = 1: The number of events.
+
+        Returns:
+            None: The events are counted.
+        '''
+
+        self.labels().add(n)
+
+    def collect(self) -> dict:
+        '''
+        Returns the value of every child.
+
+        Returns:
+            dict: The value of each tuple of label values.
+        '''
+
+        with self.__lock:
+
+            children = dict(self.__children)
+
+        return {values: child.value() for values, child in children.items()}
+
+class MetricsRegistry:
+    '''
+    A class that keeps the metrics of the server and renders them in the Prometheus text format.
+
+    Counters and histograms are sharded per thread, so the ingest path never waits on them. Gauges are
+    callables evaluated when the metrics are rendered.
+
+    Attributes:
+        __metrics (dict): The type, help text and metric of each name, in registration order.
+        __lock (Lock): The lock that protects the metrics.
+    '''
+
+    def __init__(self):
+        '''
+        Initializes a MetricsRegistry object.
+        '''
+
+        self.__metrics = dict()
+        self.__lock = Lock()
+
+    def __register(self, name: str, kind: str, help: str, metric):
+        '''
+        Registers a metric, or returns the one already registered with the name (gauges are replaced).
+
+        Args:
+            name (str): The name of the metric.
+            kind (str): The Prometheus type of the metric.
+            help (str): The description of the metric.
+            metric: The metric.
+
+        Returns:
+            The metric registered with the name.
+
+        Raises:
+            ValueError: If the name is registered with another type.
+        '''
+
+        with self.__lock:
+
+            if name in self.__metrics:
+
+                if self.__metrics[name][0] != kind:
+                    raise ValueError(f'{name} is already registered as a {self.__metrics[name][0]}')
+
+                if kind != 'gauge':
+                    return self.__metrics[name][2]
+
+            self.__metrics[name] = (kind, help, metric)
+
+            return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> CounterFamily:
+        '''
+        Registers a counter.
+
+        Args:
+            name (str): The name of the counter.
+            help (str): The description of the counter.
+            labels (tuple) = (): The names of the labels.
+
+        Returns:
+            CounterFamily: The counter.
+        '''
+
+        return self.__register(name, 'counter', help, CounterFamily(name, labels))
+
+    def histogram(self, name: str, help: str) -> Histogram:
+        '''
+        Registers a histogram of durations in seconds.
+
+        Args:
+            name (str): The name of the histogram.
+            help (str): The description of the histogram.
+
+        Returns:
+            Histogram: The histogram.
+        '''
+
+        return self.__register(name, 'histogram', help, Histogram(name))
+
+    def gauge(self, name: str, help: str, callback, labels: tuple = ()) -> None:
+        '''
+        Registers a gauge, whose value is taken when the metrics are rendered, replacing any with the name.
+
+        Args:
+            name (str): The name of the gauge.
+            help (str): The description of the gauge.
+            callback (callable): Returns the value, or a dictionary with the value of each tuple of label values.
+            labels (tuple) = (): The names of the labels.
+
+        Returns:
+            None: The gauge is registered.
+        '''
+
+        self.__register(name, 'gauge', help, (callback, tuple(labels)))
+
+    @staticmethod
+    def __format_labels(names: tuple, values: tuple) -> str:
+        '''
+        Formats the labels of a sample.
+
+        Args:
+            names (tuple): The names of the labels.
+            values (tuple): The values of the labels.
+
+        Returns:
+            str: The labels between braces (empty if there are none).
+        '''
+
+        pairs = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in zip(names, values)]
+
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> str:
+        '''
+        Renders every metric in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        '''
+
+        with self.__lock:
+
+            metrics = list(self.__metrics.items())
+
+        lines = []
+
+        for name, (kind, help, metric) in metrics:
+
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            if kind == 'counter':
+
+                for values, value in sorted(metric.collect().items()):
+
+                    lines.append(f'{name}{self.__format_labels(metric.get_labels(), values)} {value}')
+
+            elif kind == 'gauge':
+
+                callback, labels = metric
+                value = callback()
+
+                samples = value.items() if isinstance(value, dict) else [((), value)]
+
+                for values, sample in samples:
+
+                    lines.append(f'{name}{self.__format_labels(labels, values)} {sample}')
+
+            else:
+
+                # The buckets are cumulative, with their upper bounds in seconds
+
+                snapshot = metric.snapshot()
+                cumulative = 0
+
+                for i, n in enumerate(snapshot['buckets'][:BUCKETS - 1]):
+
+                    cumulative += n
+
+                    lines.append(f'{name}_bucket{{le="{(1 << i) / 1e6}"}} {cumulative}')
+
+                lines.append(f'{name}_bucket{{le="+Inf"}} {snapshot["count"]}')
+                lines.append(f'{name}_sum {snapshot["sum"]}')
+                lines.append(f'{name}_count {snapshot["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer:
+    '''
+    A class that serves the metrics of a registry over HTTP, on /metrics.
+
+    Attributes:
+        __server (ThreadingHTTPServer): The HTTP server.
+        __thread (Thread): The thread that runs the server.
+    '''
+
+    def __init__(self, registry: MetricsRegistry, addr: str = '127.0.0.1', port: int = 9100):
+        '''
+        Initializes a MetricsServer object, binding the port.
+
+        Args:
+            registry (MetricsRegistry): The registry to serve.
+            addr (str) = '127.0.0.1': The address of the endpoint (local only by default).
+            port (int) = 9100: The port of the endpoint.
+        '''
+
+        class Endpoint(BaseHTTPRequestHandler):
+
+            def do_GET(self) -> None:
+
+                if self.path.split('?')[0] != '/metrics':
+
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+
+                pass
+
+        self.__server = ThreadingHTTPServer((addr, port), Endpoint)
+        self.__server.daemon_threads = True
+        self.__thread = None
+
+    def get_port(self) -> int:
+        '''
+        Returns the port the endpoint is bound to.
+
+        Returns:
+            int: The port.
+        '''
+
+        return self.__server.server_address[1]
+
+    def start(self) -> None:
+        '''
+        Starts serving in the background.
+
+        Returns:
+            None: The background thread is started.
+        '''
+
+        self.__thread = Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        '''
+        Stops serving, closing the port.
+
+        Returns:
+            None: The background thread is stopped.
+        '''
+
+        self.__server.shutdown()
+        self.__server.server_close()
+
+        if self.__thread is not None:
+
+            self.__thread.join()
+            self.__thread = None
+
+# The registry shared by the modules of the server
+
+registry = MetricsRegistry()
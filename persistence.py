@@ -0,0 +1,273 @@
+from crypto import encrypt, decrypt, NONCE_SIZE
+from utils import write_file_atomic
+from rng import Randomness
+from cryptography.exceptions import InvalidTag
+from struct import Struct
+from time import monotonic
+import os
+
+# The generation of a vault (the rotations since it was provisioned), appended to the persisted vault
+
+GENERATION = Struct('<Q')
+
+# The size of the rotation hash (HMAC-SHA256), of a journal entry (generation reached, generation rotated from
+# and hash) and of an encrypted one (nonce, entry and tag)
+
+HASH_SIZE = 32
+JOURNAL_ENTRY = Struct('<QQ32s')
+JOURNAL_ENTRY_SIZE = NONCE_SIZE + JOURNAL_ENTRY.size + 16
+
+# The rotations a device keeps in its journal once they are persisted, to roll back to a server that missed them
+
+ROLLBACK_SIZE = 4
+
+class PersistencePolicy:
+    '''
+    A class representing how often a device persists its rotated vault.
+
+    Between two persists each rotation is only appended to the journal, which is enough to rebuild the vault
+    after a crash.
+
+    Attributes:
+        __every (int): The rotations between persists (None if only the interval counts).
+        __interval (float): The seconds between persists (None if only the rotations count).
+        __sync (bool): If the writes are flushed to the storage.
+    '''
+
+    def __init__(self, every: int = 32, interval: float = 300.0, sync: bool = True):
+        '''
+        Initializes a PersistencePolicy object.
+
+        Args:
+            every (int) = 32: The rotations between persists (None if only the interval counts).
+            interval (float) = 300.0: The seconds between persists (None if only the rotations count).
+            sync (bool) = True: If the writes are flushed to the storage.
+        '''
+
+        self.__every = every
+        self.__interval = interval
+        self.__sync = sync
+
+    def is_sync(self) -> bool:
+        '''
+        Checks if the writes are flushed to the storage.
+
+        Returns:
+            bool: If the writes are synced.
+        '''
+
+        return self.__sync
+
+    def due(self, rotations: int, since: float) -> bool:
+        '''
+        Checks if the vault has to be persisted.
+
+        Args:
+            rotations (int): The rotations since the last persist.
+            since (float): The monotonic time of the last persist.
+
+        Returns:
+            bool: If the vault is due.
+        '''
+
+        if rotations == 0:
+            return False
+
+        if self.__every is not None and rotations >= self.__every:
+            return True
+
+        return self.__interval is not None and monotonic() - since >= self.__interval
+
+# The policy that persists every rotation, as the server does
+
+EVERY_ROTATION = PersistencePolicy(1, None)
+
+class VaultJournal:
+    '''
+    A class representing the journal of the rotations of a device vault since it was last persisted.
+
+    Each entry holds the generation reached, the one rotated from and the hash the keys were XORed with,
+    encrypted with the device key. A rotation XORs every key with its hash, so the persisted vault plus the
+    entries rebuild the current vault, and the last entries undo the rotations the server missed. A torn entry
+    at the end (a crash while appending) is ignored.
+
+    Attributes:
+        __path (str): The path of the journal.
+        __key (bytes): The key of the entries.
+        __rng (Randomness): The source of the nonces.
+        __sync (bool): If the appends are flushed to the storage.
+    '''
+
+    def __init__(self, path: str, key: bytes, rng: Randomness = None, sync: bool = True):
+        '''
+        Initializes a VaultJournal object.
+
+        Args:
+            path (str): The path of the journal.
+            key (bytes): The key of the entries.
+            rng (Randomness) = None: The source of the nonces (the default one if not given).
+            sync (bool) = True: If the appends are flushed to the storage.
+        '''
+
+        self.__path = path
+        self.__key = key
+        self.__rng = rng
+        self.__sync = sync
+
+    def entries(self) -> list:
+        '''
+        Reads the entries of the journal.
+
+        Returns:
+            list: The generations and hash of each rotation, as (generation, previous, hash), up to the first unreadable entry.
+        '''
+
+        if not os.path.exists(self.__path):
+            return []
+
+        with open(self.__path, 'rb') as file:
+
+            data = file.read()
+
+        entries = []
+
+        for offset in range(0, len(data) - JOURNAL_ENTRY_SIZE + 1, JOURNAL_ENTRY_SIZE):
+
+            try:
+
+                plain = decrypt(data[offset:offset + JOURNAL_ENTRY_SIZE], self.__key)
+
+            except InvalidTag:
+
+                break
+
+            entries.append(JOURNAL_ENTRY.unpack(plain))
+
+        return entries
+
+    def append(self, generation: int, previous: int, digest: bytes) -> None:
+        '''
+        Appends a rotation.
+
+        Args:
+            generation (int): The generation the rotation reached.
+            previous (int): The generation the rotation started from.
+            digest (bytes): The hash the keys were XORed with.
+
+        Returns:
+            None: The entry is written.
+        '''
+
+        with open(self.__path, 'ab') as file:
+
+            file.write(encrypt(JOURNAL_ENTRY.pack(generation, previous, digest), self.__key, self.__rng))
+
+            if self.__sync:
+
+                file.flush()
+                os.fsync(file.fileno())
+
+    def trim(self, generation: int, keep: int = ROLLBACK_SIZE) -> None:
+        '''
+        Drops the rotations that aren't needed, once the vault they lead to is persisted.
+
+        Args:
+            generation (int): The generation of the persisted vault (the rotations past it are dropped).
+            keep (int) = ROLLBACK_SIZE: The last rotations up to the generation that are kept, to roll back.
+
+        Returns:
+            None: The journal holds the kept rotations.
+        '''
+
+        entries = [entry for entry in self.entries() if entry[0] <= generation][-keep:] if keep > 0 else []
+
+        write_file_atomic(b''.join(encrypt(JOURNAL_ENTRY.pack(*entry), self.__key, self.__rng) for entry in entries), self.__path, self.__sync)
+
+# The rotations a server remembers to roll a lagging device forward, and the layout of each one
+
+HISTORY_SIZE = 16
+HISTORY_ENTRY = Struct('<Q32s')
+
+class MaskHistory:
+    '''
+    A class representing the recent rotation hashes of a server vault.
+
+    A rotation XORs every key with its hash, so the hashes between two generations XOR into a single mask
+    that takes a vault from one generation to the other.
+
+    Attributes:
+        __path (str): The path of the history.
+        __size (int): The number of rotations kept.
+    '''
+
+    def __init__(self, path: str, size: int = HISTORY_SIZE):
+        '''
+        Initializes a MaskHistory object.
+
+        Args:
+            path (str): The path of the history.
+            size (int) = HISTORY_SIZE: The number of rotations kept.
+        '''
+
+        self.__path = path
+        self.__size = size
+
+    def entries(self) -> list:
+        '''
+        Reads the rotations kept.
+
+        Returns:
+            list: The generation and hash of each rotation, as (generation, hash), oldest first.
+        '''
+
+        if not os.path.exists(self.__path):
+            return []
+
+        with open(self.__path, 'rb') as file:
+
+            data = file.read()
+
+        return [HISTORY_ENTRY.unpack_from(data, offset) for offset in range(0, len(data) - HISTORY_ENTRY.size + 1, HISTORY_ENTRY.size)]
+
+    def append(self, generation: int, digest: bytes) -> None:
+        '''
+        Adds a rotation, forgetting the oldest one past the size.
+
+        Args:
+            generation (int): The generation the rotation reached.
+            digest (bytes): The hash the keys were XORed with.
+
+        Returns:
+            None: The history is written.
+        '''
+
+        entries = self.entries()[-(self.__size - 1):] if self.__size > 1 else []
+
+        entries.append((generation, digest))
+
+        write_file_atomic(b''.join(HISTORY_ENTRY.pack(*entry) for entry in entries), self.__path, False)
+
+    def mask(self, start: int, end: int) -> bytes:
+        '''
+        Returns the mask that takes a vault from a generation to a later one.
+
+        Args:
+            start (int): The generation of the vault.
+            end (int): The generation to reach.
+
+        Returns:
+            bytes: The XOR of the hashes of the rotations in between (None if any of them was forgotten).
+        '''
+
+        digests = {generation: digest for generation, digest in self.entries()}
+
+        mask = bytes(HASH_SIZE)
+
+        for generation in range(start + 1, end + 1):
+
+            if generation not in digests:
+                return None
+
+            mask = bytes(a ^ b for a, b in zip(mask, digests[generation]))
+
+        return mask
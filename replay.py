@@ -0,0 +1,257 @@
+from capture import read_capture, load_capture_key, conversations, frame_bytes, INBOUND
+from authenticator import PATH_SV_VAULTS
+from loadgen import percentiles
+from handler import Handler
+from message import Message, HEADER
+from utils import read_file_bytes, write_file_bytes
+from rng import Randomness
+from multiprocessing import Process, Pipe, Event
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+import argparse, asyncio, json, os, resource
+
+# Replayer: starts a Handler from the vault snapshot of a capture and feeds it the captured connections, as
+# fast as possible or at their original pacing. A capture of a seeded server replays to the same responses,
+# as long as the replayed server has the same seed
+
+def serve(path: str, devices: dict, port: int, seed: int, ready, stop, conn) -> None:
+    '''
+    Runs the Handler of the replay, sending its counters back when stopped.
+
+    Args:
+        path (str): The directory with the vaults of the snapshot.
+        devices (dict): The controller of each device identifier.
+        port (int): The port of the server.
+        seed (int): The seed of the server randomness (None for the CSPRNG).
+        ready (Event): Set once the server accepts connections.
+        stop (Event): Set to stop the server.
+        conn (Connection): Where the counters are sent.
+
+    Returns:
+        None: The counters are sent.
+    '''
+
+    os.chdir(path)
+
+    sv = Handler({device_id: {'auth': None, 'controller': controller} for device_id, controller in devices.items()}, 'localhost', port, rng = Randomness(seed))
+
+    Thread(target=sv.run_server, daemon=True).start()
+
+    ready.set()
+    stop.wait()
+
+    sv.flush(10)
+
+    # Read the counters of the server back from its registry
+
+    registry = sv.get_registry()
+    counters = dict()
+
+    for name in ('iot_handshakes_completed_total', 'iot_handshakes_failed_total', 'iot_decrypt_failures_total', 'iot_readings_ingested_total'):
+
+        counters[name] = sum(registry.counter(name, '').collect().values())
+
+    conn.send({**counters, 'ingest': sv.get_ingest_stats()})
+
+    sv.close()
+
+async def replay(frames: list, port: int, speed: float, start: float, stats: dict, latencies: list) -> None:
+    '''
+    Replays the frames of a connection, sending the inbound ones and waiting for the outbound ones.
+
+    Args:
+        frames (list): The frames of the connection, as (offset, direction, message).
+        port (int): The port of the server.
+        speed (float): The pacing relative to the capture (as fast as possible if zero).
+        start (float): The performance counter when the replay started.
+        stats (dict): The counters of the replay.
+        latencies (list): The latency of each response.
+
+    Returns:
+        None: The connection is replayed.
+    '''
+
+    if speed > 0:
+
+        await asyncio.sleep(max(0.0, start + frames[0][0] / speed - perf_counter()))
+
+    reader, writer = await asyncio.open_connection('localhost', port)
+
+    sent = perf_counter()
+
+    try:
+
+        for at, direction, msg in frames:
+
+            if direction == INBOUND:
+
+                if speed > 0:
+
+                    await asyncio.sleep(max(0.0, start + at / speed - perf_counter()))
+
+                writer.write(msg.to_bytes())
+
+                await writer.drain()
+
+                sent = perf_counter()
+
+                stats['frames'] += 1
+                stats['bytes'] += frame_bytes(msg)
+
+            else:
+
+                # The server answers a handshake, the same answer means the server replayed deterministically
+
+                device_id, session_id, type, length = HEADER.unpack(await asyncio.wait_for(reader.readexactly(HEADER.size), 10))
+
+                response = Message(device_id, session_id, type, await reader.readexactly(length))
+
+                latencies.append(perf_counter() - sent)
+
+                stats['responses'] += 1
+                stats['identical'] += response.to_bytes() == msg.to_bytes()
+
+    except Exception:
+
+        stats['errors'] += 1
+
+    finally:
+
+        # Wait for the server to close its end, once it abandoned the sessions of the connection
+
+        try:
+
+            writer.write_eof()
+
+            await asyncio.wait_for(reader.read(), 10)
+
+        except Exception:
+
+            pass
+
+        writer.close()
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Replays a capture against a local server.')
+    parser.add_argument('capture', help='the capture to replay')
+    parser.add_argument('--speed', type=float, default=0.0, help='the pacing relative to the capture (as fast as possible if zero)')
+    parser.add_argument('--port', type=int, default=9370, help='the port of the server')
+    parser.add_argument('--seed', type=int, help='the seed of the server randomness (the one of the capture if not given)')
+    parser.add_argument('--key', help='the key that sealed the vaults of the capture')
+    parser.add_argument('--vaults', default=PATH_SV_VAULTS, help='the server vaults, for a capture that left them out (they must be the ones of when the capture started)')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    try:
+
+        devices, frames, seed = read_capture(args.capture, None if args.key is None else load_capture_key(args.key, False))
+
+    except ValueError as error:
+
+        raise SystemExit(str(error))
+
+    if args.seed is not None:
+
+        seed = args.seed
+
+    split = conversations(frames)
+
+    # The connections of a device rotate its vault in turn, so they are replayed one after the other
+
+    chains = dict()
+
+    for conversation in split.values():
+
+        chains.setdefault(conversation[0][2].get_deviceId(), []).append(conversation)
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with TemporaryDirectory() as path:
+
+        # Start the server from the vaults of the snapshot
+
+        os.makedirs(os.path.join(path, PATH_SV_VAULTS))
+
+        for device_id, (vault, _) in devices.items():
+
+            # A capture without the vaults replays from the server vaults
+
+            if vault is None:
+
+                try:
+
+                    vault = read_file_bytes(os.path.join(args.vaults, str(device_id)))
+
+                except FileNotFoundError:
+
+                    raise SystemExit(f'the capture left out the vault of device {device_id}, and it isn\'t in {args.vaults}')
+
+            write_file_bytes(vault, os.path.join(path, PATH_SV_VAULTS, str(device_id)))
+
+        ready, stop = Event(), Event()
+        receiver, sender = Pipe(False)
+
+        server = Process(target=serve, args=(path, {device_id: controller for device_id, (_, controller) in devices.items()}, args.port, seed, ready, stop, sender))
+        server.start()
+
+        while not ready.wait(0.1):
+
+            if not server.is_alive():
+                raise SystemExit('the server failed to start')
+
+        stats = {'connections': len(split), 'frames': 0, 'bytes': 0, 'responses': 0, 'identical': 0, 'errors': 0}
+        latencies = []
+
+        async def chain(conversations: list, start: float) -> None:
+
+            for conversation in conversations:
+
+                await replay(conversation, args.port, args.speed, start, stats, latencies)
+
+        async def run() -> None:
+
+            start = perf_counter()
+
+            await asyncio.gather(*(chain(conversations, start) for conversations in chains.values()))
+
+        start = perf_counter()
+
+        asyncio.run(run())
+
+        elapsed = perf_counter() - start
+
+        stop.set()
+        server_stats = receiver.recv()
+        server.join(10)
+
+        if server.is_alive():
+
+            server.terminate()
+
+    report = {
+        'capture_seconds': frames[-1][0] if frames else 0.0,
+        'seconds': elapsed,
+        'seed': seed,
+        **stats,
+        'frames_per_second': stats['frames'] / elapsed,
+        'bytes_per_second': stats['bytes'] / elapsed,
+        'response_latency': percentiles(latencies),
+        'server': server_stats
+    }
+
+    if args.json:
+
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f'{len(frames)} frames over {len(split)} connections, captured in {report["capture_seconds"]:.1f}s, replayed in {elapsed:.2f}s' + ('' if seed is None else f' (seed {seed})'))
+    print(f'sent {stats["frames"]} frames ({report["frames_per_second"]:.1f}/s, {report["bytes_per_second"] / 1024:.1f} KiB/s), {stats["errors"]} connections failed')
+    print(f'responses {stats["responses"]} ({stats["identical"]} identical to the capture), latency ' + ' '.join(f'{key} {report["response_latency"][key] * 1000:.2f}ms' for key in ('p50', 'p90', 'p99', 'max')))
+    print(f'server: {server_stats["iot_handshakes_completed_total"]} handshakes, {server_stats["iot_handshakes_failed_total"]} failed, {server_stats["iot_readings_ingested_total"]} readings, {server_stats["iot_decrypt_failures_total"]} decrypt failures')
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,511 @@
+from storage import SegmentStore, Segment, SEGMENT_EXTENSION
+from controller import failed_mask
+from threading import Thread, Event, Lock
+from time import time, perf_counter
+import os, struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The header of the rollups of a device (magic, version and size of each rollup)
+
+ROLLUPS_MAGIC = b'RUP'
+ROLLUPS_VERSION = 1
+ROLLUPS_HEADER = struct.Struct('<3sBI')
+
+class RetentionPolicy:
+    '''
+    A class representing how long the readings are kept, per device and per sensor type.
+
+    Raw readings older than the raw retention are downsampled into rollups (min, max, mean and count per
+    interval) of the sensors of the rolled up types, and the rollups are kept for the rollup retention.
+
+    Attributes:
+        __default (dict): The retention of the devices without a specific one.
+        __devices (dict): The retention of specific device identifiers (only the keys that differ).
+    '''
+
+    def __init__(self, raw_seconds: float = 86400, rollup_interval: float = 3600, rollup_seconds: float = None, rollup_types: tuple = ('INT', 'FLOAT', 'BOOLEAN'), devices: dict = None):
+        '''
+        Initializes a RetentionPolicy object.
+
+        Args:
+            raw_seconds (float) = 86400: The number of seconds raw readings are kept.
+            rollup_interval (float) = 3600: The number of seconds summarized by each rollup.
+            rollup_seconds (float) = None: The number of seconds rollups are kept (forever if not given).
+            rollup_types (tuple) = ('INT', 'FLOAT', 'BOOLEAN'): The sensor types kept in the rollups.
+            devices (dict) = None: The retention of specific device identifiers, with any of the above keys.
+        '''
+
+        self.__default = {
+            'raw_seconds': raw_seconds,
+            'rollup_interval': rollup_interval,
+            'rollup_seconds': rollup_seconds,
+            'rollup_types': tuple(rollup_types)
+        }
+
+        self.__devices = dict() if devices is None else devices
+
+    def for_device(self, device_id: int) -> dict:
+        '''
+        Returns the retention of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            dict: The 'raw_seconds', 'rollup_interval', 'rollup_seconds' and 'rollup_types' of the device.
+        '''
+
+        return {**self.__default, **self.__devices.get(device_id, {})}
+
+class Compactor:
+    '''
+    A class that enforces a retention policy over a segment store, in the background.
+
+    Each step handles a bounded amount of work: expired segments are downsampled into rollups and deleted,
+    runs of small segments are merged into one and expired rollups are dropped. The segments are read and
+    written without the store lock, so ingest is only blocked while files are swapped.
+
+    Each rollup records the segment it comes from, so a segment left behind by a crash after its rollups
+    were written is deleted without being rolled up twice.
+
+    Attributes:
+        __store (SegmentStore): The store being compacted.
+        __policy (RetentionPolicy): The retention policy.
+        __interval (float): The number of seconds between steps.
+        __max_segments (int): The number of segments handled per device in each step.
+        __merge_records (int): The number of records under which sealed segments are merged.
+        __stats (dict): The totals of the work done so far.
+        __last_error (Exception): The last error of a step (None if there was none).
+    '''
+
+    def __init__(self, store: SegmentStore, policy: RetentionPolicy, interval: float = 60, max_segments: int = 4, merge_records: int = 16384):
+        '''
+        Initializes a Compactor object.
+
+        Args:
+            store (SegmentStore): The store being compacted.
+            policy (RetentionPolicy): The retention policy.
+            interval (float) = 60: The number of seconds between steps.
+            max_segments (int) = 4: The number of segments handled per device in each step.
+            merge_records (int) = 16384: The number of records under which sealed segments are merged.
+        '''
+
+        self.__store = store
+        self.__policy = policy
+        self.__interval = interval
+        self.__max_segments = max_segments
+        self.__merge_records = merge_records
+        self.__stats = {'steps': 0, 'segments_expired': 0, 'segments_merged': 0, 'rollups': 0, 'reclaimed_bytes': 0, 'seconds': 0.0, 'errors': 0}
+        self.__last_error = None
+        self.__stats_lock = Lock()
+        self.__stop = Event()
+        self.__thread = None
+
+    def __rollup_dtype(self, device_id: int, retention: dict):
+        '''
+        Returns the structured type of the rollups of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+            retention (dict): The retention of the device.
+
+        Returns:
+            numpy.dtype: The type with a 'start' and 'count' field, the 'segment' and 'segment_time' of the segment rolled up, followed by the min, max, mean and count of the valid readings of each sensor kept.
+        '''
+
+        fields = [('start', '<f8'), ('count', '<u4'), ('segment', '<u4'), ('segment_time', '<f8')]
+
+        for i, sensor in enumerate(self.__store.get_controller(device_id).get_sensors()):
+
+            if sensor['type'] in retention['rollup_types']:
+
+                fields += [(f'sensor_{i}_min', '<f8'), (f'sensor_{i}_max', '<f8'), (f'sensor_{i}_mean', '<f8'), (f'sensor_{i}_count', '<u4')]
+
+        return np.dtype(fields)
+
+    @staticmethod
+    def __sensor_names(dtype) -> list:
+        '''
+        Returns the names of the sensors kept in the rollups.
+
+        Args:
+            dtype (numpy.dtype): The structured type of the rollups.
+
+        Returns:
+            list: The 'sensor_<i>' prefix of the fields of each sensor.
+        '''
+
+        return [name[:-len('_min')] for name in dtype.names if name.endswith('_min')]
+
+    @staticmethod
+    def __source(segment: Segment) -> tuple[int, float]:
+        '''
+        Identifies a segment in the rollups, by its sequence and the time of its oldest record.
+
+        Args:
+            segment (Segment): The segment.
+
+        Returns:
+            tuple[int, float]: The sequence and time of the segment.
+        '''
+
+        return int(os.path.basename(segment.path)[:-len(SEGMENT_EXTENSION)]), segment.min_time
+
+    def __read_rollups(self, device_id: int, dtype):
+        '''
+        Reads the rollups of a device, checking their header.
+
+        Args:
+            device_id (int): The identifier of the device.
+            dtype (numpy.dtype): The structured type of the rollups.
+
+        Returns:
+            numpy.ndarray: The rollups (empty if there are none).
+
+        Raises:
+            ValueError: If the rollups have an unknown format, version or size.
+        '''
+
+        data = self.__store.read_rollups(device_id)
+
+        if not data:
+            return np.zeros(0, dtype=dtype)
+
+        magic, version, size = ROLLUPS_HEADER.unpack_from(data)
+
+        if magic != ROLLUPS_MAGIC or version != ROLLUPS_VERSION or size != dtype.itemsize or (len(data) - ROLLUPS_HEADER.size) % size != 0:
+            raise ValueError(f'unsupported rollups {magic!r} version {version} of {size} bytes')
+
+        return np.frombuffer(data, dtype=dtype, offset=ROLLUPS_HEADER.size)
+
+    def __downsample(self, records, interval: float, dtype):
+        '''
+        Downsamples records into one rollup per interval.
+
+        Args:
+            records (numpy.ndarray): The records, as read from the store.
+            interval (float): The number of seconds summarized by each rollup.
+            dtype (numpy.dtype): The structured type of the rollups.
+
+        Returns:
+            numpy.ndarray: The rollups.
+        '''
+
+        # Sort the records by interval, and find where each interval starts
+
+        records = records[np.argsort(records['time'], kind='stable')]
+
+        bins = (records['time'] // interval).astype('i8')
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+        counts = np.diff(np.append(starts, len(records)))
+
+        rollups = np.zeros(len(starts), dtype=dtype)
+
+        rollups['start'] = bins[starts] * interval
+        rollups['count'] = counts
+
+        # The failed readings are left out (the statistics are NaN in an interval where the sensor always failed)
+
+        for sensor in self.__sensor_names(dtype):
+
+            values = records[sensor].astype('f8')
+            valid = ~failed_mask(records['failed'], int(sensor[len('sensor_'):]))
+
+            valid_counts = np.add.reduceat(valid.astype('u4'), starts)
+
+            rollups[sensor + '_min'] = np.fmin.reduceat(np.where(valid, values, np.nan), starts)
+            rollups[sensor + '_max'] = np.fmax.reduceat(np.where(valid, values, np.nan), starts)
+            rollups[sensor + '_mean'] = np.add.reduceat(np.where(valid, values, 0.0), starts) / np.maximum(valid_counts, 1)
+            rollups[sensor + '_count'] = valid_counts
+
+            rollups[sensor + '_mean'][valid_counts == 0] = np.nan
+
+        return rollups
+
+    def __compact_device(self, device_id: int, now: float) -> dict:
+        '''
+        Runs one bounded step of compaction over the segments and rollups of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+            now (float): The current time.
+
+        Returns:
+            dict: The work done in the step.
+        '''
+
+        report = {'segments_expired': 0, 'segments_merged': 0, 'rollups': 0, 'reclaimed_bytes': 0}
+
+        retention = self.__policy.for_device(device_id)
+        dtype = self.__rollup_dtype(device_id, retention)
+
+        sealed = self.__store.sealed_segments(device_id)
+
+        # Downsample and delete the segments that expired
+
+        expired = [segment for segment in sealed if segment.count > 0 and segment.max_time < now - retention['raw_seconds']][0:self.__max_segments]
+
+        for segment in expired:
+
+            existing = self.__read_rollups(device_id, dtype)
+            sequence, segment_time = self.__source(segment)
+
+            # A segment already rolled up (before a crash) is only deleted
+
+            if not np.any((existing['segment'] == sequence) & (existing['segment_time'] == segment_time)):
+
+                rollups = self.__downsample(self.__store.read_segment(device_id, segment), retention['rollup_interval'], dtype)
+
+                rollups['segment'] = sequence
+                rollups['segment_time'] = segment_time
+
+                if len(existing) > 0:
+
+                    self.__store.write_rollups(device_id, rollups.tobytes())
+
+                else:
+
+                    self.__store.write_rollups(device_id, ROLLUPS_HEADER.pack(ROLLUPS_MAGIC, ROLLUPS_VERSION, dtype.itemsize) + rollups.tobytes(), False)
+
+                report['rollups'] += len(rollups)
+
+            report['reclaimed_bytes'] += self.__store.replace_segments(device_id, [segment])
+            report['segments_expired'] += 1
+
+        # Merge a run of small segments (or drop empty ones)
+
+        run = []
+
+        for segment in sealed:
+
+            if segment in expired:
+                continue
+
+            if segment.count < self.__merge_records and sum(other.count for other in run) + segment.count <= self.__merge_records and len(run) < self.__max_segments:
+
+                run.append(segment)
+
+            elif len(run) > 1:
+
+                break
+
+            else:
+
+                run = [segment] if segment.count < self.__merge_records else []
+
+        if len(run) > 1 or (len(run) == 1 and run[0].count == 0):
+
+            records = np.concatenate([self.__store.read_segment(device_id, segment) for segment in run])
+
+            report['reclaimed_bytes'] += self.__store.replace_segments(device_id, run, records)
+            report['segments_merged'] += len(run)
+
+        # Drop the rollups that expired
+
+        if retention['rollup_seconds'] is not None:
+
+            rollups = self.__read_rollups(device_id, dtype)
+
+            kept = rollups[rollups['start'] >= now - retention['rollup_seconds']]
+
+            if len(kept) < len(rollups):
+
+                self.__store.write_rollups(device_id, ROLLUPS_HEADER.pack(ROLLUPS_MAGIC, ROLLUPS_VERSION, dtype.itemsize) + kept.tobytes(), False)
+
+                report['reclaimed_bytes'] += rollups.nbytes - kept.nbytes
+
+        return report
+
+    def step(self, now: float = None) -> dict:
+        '''
+        Runs one bounded step of compaction over every device.
+
+        Args:
+            now (float) = None: The current time (the clock if not given).
+
+        A device that fails is skipped until the next step, the error is counted and kept.
+
+        Returns:
+            dict: The work done in the step, with the 'reclaimed_bytes', the 'errors' and the 'seconds' it took.
+
+        Raises:
+            ImportError: If numpy is not available.
+        '''
+
+        if np is None:
+            raise ImportError('numpy is required for compaction')
+
+        now = time() if now is None else now
+
+        start = perf_counter()
+
+        report = {'segments_expired': 0, 'segments_merged': 0, 'rollups': 0, 'reclaimed_bytes': 0, 'errors': 0}
+
+        for device_id in self.__store.get_device_ids():
+
+            try:
+
+                for key, value in self.__compact_device(device_id, now).items():
+
+                    report[key] += value
+
+            except Exception as error:
+
+                report['errors'] += 1
+
+                self.__last_error = error
+
+        report['seconds'] = perf_counter() - start
+
+        with self.__stats_lock:
+
+            self.__stats['steps'] += 1
+
+            for key, value in report.items():
+
+                self.__stats[key] += value
+
+        return report
+
+    def rollups(self, device_id: int, start: float = None, end: float = None) -> list:
+        '''
+        Returns the rollups of a device inside a time range, merging the ones of the same interval.
+
+        Args:
+            device_id (int): The identifier of the device.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+
+        Returns:
+            list: A dictionary per interval, with its 'start', 'count' and the 'min', 'max', 'mean' and 'count' of each sensor kept.
+
+        Raises:
+            ValueError: If the rollups have an unknown format, version or size.
+        '''
+
+        dtype = self.__rollup_dtype(device_id, self.__policy.for_device(device_id))
+        rollups = self.__read_rollups(device_id, dtype)
+
+        merged = dict()
+
+        for rollup in rollups.tolist():
+
+            row = dict(zip(dtype.names, rollup))
+
+            # The segment of each rollup is only kept for the compaction
+
+            del row['segment'], row['segment_time']
+
+            if (start is not None and row['start'] < start) or (end is not None and row['start'] >= end):
+                continue
+
+            if row['start'] not in merged:
+
+                merged[row['start']] = row
+                continue
+
+            # Combine the intervals split across segments
+
+            other = merged[row['start']]
+            count = other['count'] + row['count']
+
+            for sensor in self.__sensor_names(dtype):
+
+                valid = other[sensor + '_count'] + row[sensor + '_count']
+
+                # An interval where the sensor always failed doesn't weigh in
+
+                if row[sensor + '_count'] == 0:
+                    continue
+
+                if other[sensor + '_count'] == 0:
+
+                    for suffix in ('_min', '_max', '_mean', '_count'):
+
+                        other[sensor + suffix] = row[sensor + suffix]
+
+                    continue
+
+                other[sensor + '_min'] = min(other[sensor + '_min'], row[sensor + '_min'])
+                other[sensor + '_max'] = max(other[sensor + '_max'], row[sensor + '_max'])
+                other[sensor + '_mean'] = (other[sensor + '_mean'] * other[sensor + '_count'] + row[sensor + '_mean'] * row[sensor + '_count']) / valid
+                other[sensor + '_count'] = valid
+
+            other['count'] = count
+
+        return [merged[key] for key in sorted(merged)]
+
+    def get_stats(self) -> dict:
+        '''
+        Returns the totals of the work done so far.
+
+        Returns:
+            dict: The number of steps, segments expired and merged, rollups written, bytes reclaimed, errors and seconds spent.
+        '''
+
+        with self.__stats_lock:
+
+            return dict(self.__stats)
+
+    def get_last_error(self) -> Exception:
+        '''
+        Returns the last error of a step.
+
+        Returns:
+            Exception: The error (None if there was none).
+        '''
+
+        return self.__last_error
+
+    def __run(self) -> None:
+        '''
+        Runs steps periodically, until stopped, surviving the errors of any step.
+
+        Returns:
+            None: Runs until stopped.
+        '''
+
+        while not self.__stop.wait(self.__interval):
+
+            try:
+
+                self.step()
+
+            except Exception as error:
+
+                with self.__stats_lock:
+
+                    self.__stats['errors'] += 1
+
+                self.__last_error = error
+
+    def start(self) -> None:
+        '''
+        Starts compacting in the background.
+
+        Returns:
+            None: The background thread is started.
+        '''
+
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        '''
+        Stops compacting in the background, waiting for the current step.
+
+        Returns:
+            None: The background thread is stopped.
+        '''
+
+        self.__stop.set()
+
+        if self.__thread is not None:
+
+            self.__thread.join()
+            self.__thread = None
@@ -0,0 +1,444 @@
+from controller import Controller
+from storage import RECORD_HEADER
+from threading import Lock
+
+# The number of readings of a new ring, doubled as the device sends more
+
+INITIAL_CAPACITY = 16
+
+class RingBuffer:
+    '''
+    A class representing a fixed capacity ring of the most recent readings of a device.
+
+    The ring is preallocated from the width of the readings of the controller, each slot holding a record
+    with the same layout as the ones of the segments (time, session and the encoded reading).
+
+    Attributes:
+        __controller (Controller): The controller that defines the sensors of the device.
+        __width (int): The size of each record in bytes.
+        __capacity (int): The number of records the ring holds.
+        __data (bytearray): The preallocated records.
+        __next (int): The slot of the next record.
+        __count (int): The number of records held.
+    '''
+
+    def __init__(self, controller: Controller, capacity: int):
+        '''
+        Initializes a RingBuffer object.
+
+        Args:
+            controller (Controller): The controller that defines the sensors of the device.
+            capacity (int): The number of records the ring holds.
+        '''
+
+        self.__controller = controller
+        self.__width = RECORD_HEADER.size + controller.get_reading_size()
+        self.__capacity = capacity
+        self.__data = bytearray(capacity * self.__width)
+        self.__next = 0
+        self.__count = 0
+
+    def get_width(self) -> int:
+        '''
+        Returns the size of each record in bytes.
+
+        Returns:
+            int: The size of the records.
+        '''
+
+        return self.__width
+
+    def get_capacity(self) -> int:
+        '''
+        Returns the number of records the ring holds.
+
+        Returns:
+            int: The capacity of the ring.
+        '''
+
+        return self.__capacity
+
+    def __len__(self) -> int:
+        '''
+        Returns the number of records held.
+
+        Returns:
+            int: The number of records.
+        '''
+
+        return self.__count
+
+    def memory_usage(self) -> int:
+        '''
+        Returns the number of bytes preallocated for the ring.
+
+        Returns:
+            int: The size of the ring.
+        '''
+
+        return len(self.__data)
+
+    def append(self, record: bytes) -> bytes:
+        '''
+        Writes a record in the next slot, overwriting the oldest one if the ring is full.
+
+        Args:
+            record (bytes): The record.
+
+        Returns:
+            bytes: The record overwritten (None if the ring wasn't full).
+        '''
+
+        offset = self.__next * self.__width
+
+        evicted = bytes(self.__data[offset:offset + self.__width]) if self.__count == self.__capacity else None
+
+        self.__data[offset:offset + self.__width] = record
+
+        self.__next = (self.__next + 1) % self.__capacity
+        self.__count = min(self.__count + 1, self.__capacity)
+
+        return evicted
+
+    def resize(self, capacity: int) -> list:
+        '''
+        Reallocates the ring with another capacity, keeping its most recent records.
+
+        Args:
+            capacity (int): The new number of records the ring holds (at least one).
+
+        Returns:
+            list: The records that didn't fit, from the oldest to the newest.
+        '''
+
+        records = self.last(self.__count)
+        dropped, kept = records[0:max(0, len(records) - capacity)], records[max(0, len(records) - capacity):]
+
+        data = bytearray(capacity * self.__width)
+
+        data[0:len(kept) * self.__width] = b''.join(kept)
+
+        self.__data = data
+        self.__capacity = capacity
+        self.__count = len(kept)
+        self.__next = self.__count % capacity
+
+        return dropped
+
+    def last(self, n: int) -> list:
+        '''
+        Returns the most recent records, without scanning the others.
+
+        Args:
+            n (int): The number of records.
+
+        Returns:
+            list: The records, from the oldest to the newest.
+        '''
+
+        n = min(n, self.__count)
+
+        slots = [(self.__next - n + i) % self.__capacity for i in range(n)]
+
+        return [bytes(self.__data[slot * self.__width:(slot + 1) * self.__width]) for slot in slots]
+
+    def encode(self, session_id: int, state: int, sensors: list, timestamp: float) -> bytes:
+        '''
+        Converts a reading into a record.
+
+        Args:
+            session_id (int): The identifier of the session.
+            state (int): The state of the device.
+            sensors (list): The list of information from the sensors.
+            timestamp (float): The time of the reading.
+
+        Returns:
+            bytes: The record.
+        '''
+
+        return RECORD_HEADER.pack(timestamp, session_id) + self.__controller.information_to_bytes(state, sensors)
+
+    def decode(self, device_id: int, record: bytes) -> dict:
+        '''
+        Converts a record into an entry.
+
+        Args:
+            device_id (int): The identifier of the device.
+            record (bytes): The record.
+
+        Returns:
+            dict: The entry, with the device, session, state, sensors and time.
+        '''
+
+        timestamp, session_id = RECORD_HEADER.unpack_from(record)
+        state, sensors = self.__controller.bytes_to_information(record[RECORD_HEADER.size:])
+
+        return {
+            'device_id': device_id,
+            'session_id': session_id,
+            'state': state,
+            'sensors': sensors,
+            'time': timestamp
+        }
+
+class HotTier:
+    '''
+    A class representing the hot tier of the readings: a ring buffer per device, under a global memory cap.
+
+    The rings are allocated on the first reading of their device and grow as it sends more, up to its share
+    of the memory cap (the cap divided among the registered devices), so registering many devices costs
+    nothing up front. When more devices register the rings over their new share are shrunk, so the cap holds.
+    Readings overwritten in the rings or dropped when they shrink are spilled (if a spill is given).
+
+    Attributes:
+        __memory_cap (int): The number of bytes all the rings may take.
+        __capacity (int): The default number of readings kept per device.
+        __spill (callable): The function that receives the spilled readings (None to discard them).
+        __devices (dict): The controller and number of readings kept of each registered device identifier.
+        __rings (dict): The ring of each device identifier with readings.
+        __lock (Lock): The lock that protects the rings.
+    '''
+
+    def __init__(self, memory_cap: int, capacity: int = 1024, spill = None):
+        '''
+        Initializes a HotTier object.
+
+        Args:
+            memory_cap (int): The number of bytes all the rings may take.
+            capacity (int) = 1024: The default number of readings kept per device.
+            spill (callable) = None: Called with the device, session, state, sensors and time of each spilled reading.
+        '''
+
+        self.__memory_cap = memory_cap
+        self.__capacity = capacity
+        self.__spill = spill
+        self.__devices = dict()
+        self.__rings = dict()
+        self.__lock = Lock()
+
+    def register_device(self, device_id: int, controller: Controller, capacity: int = None) -> None:
+        '''
+        Registers a device, whose ring is allocated when its first reading comes in.
+
+        Args:
+            device_id (int): The identifier of the device.
+            controller (Controller): The controller that defines the sensors of the device.
+            capacity (int) = None: The number of readings kept (the default if not given).
+
+        Returns:
+            None: The device is registered, the rings over their new share are shrunk.
+        '''
+
+        spilled = []
+
+        with self.__lock:
+
+            if device_id in self.__devices:
+                return
+
+            self.__devices[device_id] = (controller, self.__capacity if capacity is None else capacity)
+
+            # The share of every device got smaller
+
+            for other, ring in list(self.__rings.items()):
+
+                limit = self.__get_limit(other)
+
+                if ring.get_capacity() <= limit:
+                    continue
+
+                if limit > 0:
+
+                    dropped = ring.resize(limit)
+
+                else:
+
+                    dropped = ring.last(len(ring))
+
+                    del self.__rings[other]
+
+                spilled.extend((other, ring, record) for record in dropped)
+
+        if self.__spill is None:
+            return
+
+        for other, ring, record in spilled:
+
+            entry = ring.decode(other, record)
+
+            self.__spill(other, entry['session_id'], entry['state'], entry['sensors'], entry['time'])
+
+    def get_capacity(self, device_id: int) -> int:
+        '''
+        Returns the number of readings a device may keep, its share of the memory cap.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            int: The capacity of the ring of the device (0 if the readings of the device are not kept).
+        '''
+
+        with self.__lock:
+
+            return self.__get_limit(device_id)
+
+    def __get_limit(self, device_id: int) -> int:
+        '''
+        Returns the number of readings a device may keep, with the lock held.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            int: The capacity of the ring of the device.
+        '''
+
+        controller, capacity = self.__devices[device_id]
+
+        share = self.__memory_cap // len(self.__devices) // (RECORD_HEADER.size + controller.get_reading_size())
+
+        return min(capacity, share)
+
+    def append(self, device_id: int, session_id: int, state: int, sensors: list, timestamp: float) -> None:
+        '''
+        Adds a reading to the ring of its device, spilling the oldest one if the ring is full.
+
+        Args:
+            device_id (int): The identifier of the device.
+            session_id (int): The identifier of the session.
+            state (int): The state of the device.
+            sensors (list): The list of information from the sensors.
+            timestamp (float): The time of the reading.
+
+        Returns:
+            None: The reading is added.
+        '''
+
+        with self.__lock:
+
+            ring = self.__rings.get(device_id)
+            limit = self.__get_limit(device_id)
+
+            # Allocate the ring on the first reading, and double it while it is under its share
+
+            if ring is None and limit > 0:
+
+                ring = self.__rings[device_id] = RingBuffer(self.__devices[device_id][0], min(limit, INITIAL_CAPACITY))
+
+            elif ring is not None and len(ring) == ring.get_capacity() and ring.get_capacity() < limit:
+
+                ring.resize(min(limit, 2 * ring.get_capacity()))
+
+            if ring is None:
+
+                evicted = None
+
+            else:
+
+                evicted = ring.append(ring.encode(session_id, state, sensors, timestamp))
+
+        if self.__spill is None:
+            return
+
+        # A device without a share of the memory spills every reading
+
+        if ring is None:
+
+            self.__spill(device_id, session_id, state, sensors, timestamp)
+
+        elif evicted is not None:
+
+            entry = ring.decode(device_id, evicted)
+
+            self.__spill(device_id, entry['session_id'], entry['state'], entry['sensors'], entry['time'])
+
+    def last(self, device_id: int, n: int) -> list:
+        '''
+        Returns the most recent readings of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+            n (int): The number of readings.
+
+        Returns:
+            list: The entries, from the oldest to the newest.
+        '''
+
+        with self.__lock:
+
+            ring = self.__rings.get(device_id)
+
+            if ring is None:
+                return []
+
+            records = ring.last(n)
+
+        return [ring.decode(device_id, record) for record in records]
+
+    def set_spill(self, spill) -> None:
+        '''
+        Sets where the spilled readings go.
+
+        Args:
+            spill (callable): Called with the device, session, state, sensors and time of each spilled reading (None to discard them).
+
+        Returns:
+            None: The spill is set.
+        '''
+
+        self.__spill = spill
+
+    def entries(self, device_id: int) -> list:
+        '''
+        Returns every reading held for a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            list: The entries, from the oldest to the newest.
+        '''
+
+        return self.last(device_id, self.__memory_cap)
+
+    def get_device_ids(self) -> list:
+        '''
+        Returns the identifiers of the devices with readings in a ring.
+
+        Returns:
+            list: The device identifiers.
+        '''
+
+        with self.__lock:
+
+            return list(self.__rings)
+
+    def memory_usage(self) -> int:
+        '''
+        Returns the number of bytes allocated for all the rings.
+
+        Returns:
+            int: The memory used by the hot tier.
+        '''
+
+        with self.__lock:
+
+            return sum(ring.memory_usage() for ring in self.__rings.values())
+
+    def get_stats(self) -> dict:
+        '''
+        Returns the usage of the hot tier.
+
+        Returns:
+            dict: The 'memory_cap', 'memory_usage', 'readings' held and 'capacity' in readings of the rings allocated.
+        '''
+
+        with self.__lock:
+
+            return {
+                'memory_cap': self.__memory_cap,
+                'memory_usage': sum(ring.memory_usage() for ring in self.__rings.values()),
+                'readings': sum(len(ring) for ring in self.__rings.values()),
+                'capacity': sum(ring.get_capacity() for ring in self.__rings.values())
+            }
@@ -0,0 +1,215 @@
+from hashlib import sha256
+import os, random
+
+class Randomness:
+    '''
+    A class representing a source of randomness, shared by the challenges, the keys, the nonces and the sensors.
+
+    Without a seed every draw comes from the operating system CSPRNG. With a seed the draws come from a
+    Mersenne Twister and are reproducible bit for bit, which is only meant for tests, benchmarks and replays:
+    seeded keys and nonces are NOT secret.
+
+    Attributes:
+        __seed (int): The seed of the draws (None for the CSPRNG).
+        __random (random.Random): The generator of the draws.
+    '''
+
+    def __init__(self, seed: int = None):
+        '''
+        Initializes a Randomness object.
+
+        Args:
+            seed (int) = None: The seed of the draws (the CSPRNG of the system if not given).
+        '''
+
+        self.__seed = seed
+        self.__random = random.SystemRandom() if seed is None else random.Random(seed)
+
+    def get_seed(self) -> int:
+        '''
+        Returns the seed of the draws.
+
+        Returns:
+            int: The seed (None for the CSPRNG).
+        '''
+
+        return self.__seed
+
+    def is_seeded(self) -> bool:
+        '''
+        Checks if the draws are reproducible.
+
+        Returns:
+            bool: If a seed was given.
+        '''
+
+        return self.__seed is not None
+
+    def derive(self, *labels) -> 'Randomness':
+        '''
+        Returns an independent source for a part of the system, so the draws of each part don't depend on
+        how the parts interleave.
+
+        Args:
+            *labels: What the source is for (a device identifier, a session identifier...).
+
+        Returns:
+            Randomness: A source seeded from this seed and the labels (this same source for the CSPRNG).
+        '''
+
+        if self.__seed is None:
+            return self
+
+        digest = sha256('/'.join(str(label) for label in (self.__seed,) + labels).encode()).digest()
+
+        return Randomness(int.from_bytes(digest[0:8], 'little'))
+
+    def bytes(self, n: int) -> bytes:
+        '''
+        Draws random bytes.
+
+        Args:
+            n (int): The number of bytes.
+
+        Returns:
+            bytes: The bytes.
+        '''
+
+        if self.__seed is None:
+            return os.urandom(n)
+
+        return self.__random.randbytes(n)
+
+    def randint(self, a: int, b: int) -> int:
+        '''
+        Draws an integer between a and b, both included.
+
+        Args:
+            a (int): The lower bound.
+            b (int): The upper bound.
+
+        Returns:
+            int: The integer.
+        '''
+
+        return self.__random.randint(a, b)
+
+    def uniform(self, a: float, b: float) -> float:
+        '''
+        Draws a float between a and b.
+
+        Args:
+            a (float): The lower bound.
+            b (float): The upper bound.
+
+        Returns:
+            float: The float.
+        '''
+
+        return self.__random.uniform(a, b)
+
+    def random(self) -> float:
+        '''
+        Draws a float between 0 and 1.
+
+        Returns:
+            float: The float.
+        '''
+
+        return self.__random.random()
+
+    def expovariate(self, rate: float) -> float:
+        '''
+        Draws the time until the next event of a Poisson process.
+
+        Args:
+            rate (float): The events per unit of time.
+
+        Returns:
+            float: The time.
+        '''
+
+        return self.__random.expovariate(rate)
+
+    def choice(self, sequence):
+        '''
+        Draws an element of a sequence.
+
+        Args:
+            sequence (list): The sequence.
+
+        Returns:
+            The element.
+        '''
+
+        return self.__random.choice(sequence)
+
+    def choices(self, sequence, k: int) -> list:
+        '''
+        Draws elements of a sequence, with replacement.
+
+        Args:
+            sequence (list): The sequence.
+            k (int): The number of elements.
+
+        Returns:
+            list: The elements.
+        '''
+
+        return self.__random.choices(sequence, k = k)
+
+    def sample(self, population, k: int) -> list:
+        '''
+        Draws distinct elements of a population.
+
+        Args:
+            population (list): The population.
+            k (int): The number of elements.
+
+        Returns:
+            list: The elements.
+        '''
+
+        return self.__random.sample(population, k)
+
+# The source used when none is given (the CSPRNG unless a test seeds it)
+
+_default = Randomness()
+
+def get_default() -> Randomness:
+    '''
+    Returns the source used when none is given.
+
+    Returns:
+        Randomness: The source.
+    '''
+
+    return _default
+
+def set_default(randomness: Randomness = None) -> None:
+    '''
+    Replaces the source used when none is given.
+
+    Args:
+        randomness (Randomness) = None: The source (the CSPRNG if not given).
+
+    Returns:
+        None: The default source is replaced.
+    '''
+
+    global _default
+
+    _default = Randomness() if randomness is None else randomness
+
+def seed(value: int) -> None:
+    '''
+    Makes the draws of every part without its own source reproducible, for tests only.
+
+    Args:
+        value (int): The seed.
+
+    Returns:
+        None: The default source is seeded.
+    '''
+
+    set_default(Randomness(value))
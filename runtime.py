@@ -0,0 +1,566 @@
+from authenticator import Authenticator, TIME_TO_LIVE
+from handshake import run_handshake_async
+from controller import Controller
+from delta import DeltaCodec
+from message import Message, HEADER
+from scheduler import TimerWheel
+from setup import load_registry, PATH_REGISTRY
+from rng import Randomness, get_default
+from copy import deepcopy
+import argparse, asyncio, json, resource
+
+# The bytes a device may have waiting to be sent before its readings are dropped
+
+HIGH_WATER = 64 * 1024
+
+# The seconds a device waits to reconnect after an error
+
+RECONNECT_DELAY = 5.0
+
+class AsyncDevice:
+    '''
+    A class representing a Device driven by a DeviceRuntime, over asyncio streams.
+
+    The readings are sent without waiting for the socket, the handshakes run as tasks of the event loop and
+    a reading that comes up while the device is still connecting or authenticating is skipped.
+
+    Attributes:
+        __deviceId (int): The identifier of the device.
+        __controller (Controller): The controller of the sensors.
+        __authenticator (Authenticator): The authenticator of the current session (None if there is none).
+        __delta (DeltaCodec): The encoder of successive readings (None if the delta mode is disabled).
+        __rng (Randomness): The source of the keys, challenges and nonces.
+        __reader (asyncio.StreamReader): The stream from the server (None if not connected).
+        __writer (asyncio.StreamWriter): The stream to the server (None if not connected).
+        __busy (bool): If the device is connecting or authenticating.
+        __resumed (bool): If the session was resumed on a new connection without a handshake.
+    '''
+
+    def __init__(self, device_id: int, controller: Controller, rng: Randomness = None):
+        '''
+        Initializes an AsyncDevice object.
+
+        Args:
+            device_id (int): The identifier of the device.
+            controller (Controller): The controller of the sensors.
+            rng (Randomness) = None: The source of the keys and the readings (the default one if not given).
+        '''
+
+        if rng is None:
+            rng = get_default()
+
+        self.__deviceId = device_id
+        self.__controller = deepcopy(controller)
+        self.__authenticator = None
+        self.__delta = DeltaCodec() if controller.is_delta() else None
+        self.__rng = rng.derive(device_id, 'auth')
+        self.__reader = None
+        self.__writer = None
+        self.__busy = False
+        self.__resumed = False
+
+        self.__controller.set_rng(rng.derive(device_id, 'sensors'))
+
+    def get_deviceId(self) -> int:
+        '''
+        Returns the identifier of the device.
+
+        Returns:
+            int: The identifier.
+        '''
+
+        return self.__deviceId
+
+    def is_busy(self) -> bool:
+        '''
+        Checks if the device is connecting or authenticating.
+
+        Returns:
+            bool: If a reading would have to wait.
+        '''
+
+        return self.__busy
+
+    def is_ready(self) -> bool:
+        '''
+        Checks if a reading can be sent right away.
+
+        Returns:
+            bool: If the device is connected and its session has messages left.
+        '''
+
+        return not self.__busy and self.__is_connected() and self.__authenticator is not None and self.__authenticator.time_lived() < TIME_TO_LIVE
+
+    def __is_connected(self) -> bool:
+        '''
+        Checks if the connection is open, the server closing it (as a worker that hands the session off does)
+        shows as the end of the stream.
+
+        Returns:
+            bool: If the connection is open.
+        '''
+
+        return self.__writer is not None and not self.__reader.at_eof() and not self.__writer.transport.is_closing()
+
+    def get_backlog(self) -> int:
+        '''
+        Returns the bytes waiting to be sent.
+
+        Returns:
+            int: The size of the write buffer (zero if not connected).
+        '''
+
+        return 0 if self.__writer is None else self.__writer.transport.get_write_buffer_size()
+
+    async def __read(self) -> Message:
+        '''
+        Reads a message from the server.
+
+        Returns:
+            Message: The message.
+        '''
+
+        device_id, session_id, type, length = HEADER.unpack(await self.__reader.readexactly(HEADER.size))
+
+        return Message(device_id, session_id, type, await self.__reader.readexactly(length))
+
+    async def prepare(self, host: str, port: int, gate: asyncio.Semaphore) -> None:
+        '''
+        Connects to the server if needed and authenticates a new session, as the Device does.
+
+        When the server closed the connection of a live session, the session is resumed once on a new connection
+        without a handshake, since another worker may have taken it over. If the resumed connection is closed
+        again the session is ended and a new one is authenticated.
+
+        Args:
+            host (str): The address of the server.
+            port (int): The port of the server.
+            gate (asyncio.Semaphore): Bounds the handshakes in flight (the device is busy while it waits).
+
+        Returns:
+            None: The device is ready to send.
+
+        Raises:
+            InvalidTag: If decryption fails due to authentication failure.
+            InvalidCommParameters: If communication of the handshake has invalid parameters.
+            ConnectionError: In case communication fails.
+        '''
+
+        self.__busy = True
+
+        try:
+
+            async with gate:
+
+                if self.__writer is not None and not self.__is_connected():
+
+                    self.__disconnect()
+
+                if self.__writer is None:
+
+                    self.__reader, self.__writer = await asyncio.open_connection(host, port)
+
+                    if not self.__resumed and self.__authenticator is not None and self.__authenticator.time_lived() < TIME_TO_LIVE:
+
+                        self.__resumed = True
+                        return
+
+                await self.__handshake()
+
+                self.__resumed = False
+
+        finally:
+
+            self.__busy = False
+
+    async def __handshake(self) -> None:
+        '''
+        Runs the handshake on the connection.
+
+        Returns:
+            None: The session key is agreed.
+        '''
+        # Reset or initialize the authenticator
+
+        if self.__authenticator is None:
+
+            self.__authenticator = Authenticator(self.__deviceId, True, rng = self.__rng)
+
+        else:
+
+            self.__authenticator.reset()
+
+        if self.__delta is not None:
+
+            self.__delta.reset()
+
+        await run_handshake_async(self.__authenticator, lambda msg: self.__writer.write(msg.to_bytes()), self.__read)
+
+    def send(self) -> None:
+        '''
+        Sends a reading without waiting for the socket, the device must be ready.
+
+        Returns:
+            None: The reading is in the write buffer.
+        '''
+
+        self.__controller.change_state()
+
+        data = self.__controller.read_device_bytes(None)
+
+        if self.__delta is not None:
+
+            data = self.__delta.encode(data)
+
+        self.__writer.write(self.__authenticator.encrypt(data).to_bytes())
+
+    def close(self) -> None:
+        '''
+        Closes the connection, a finished session rotates the vault and an unfinished one is abandoned, as the
+        server does.
+
+        Returns:
+            None: The device is disconnected.
+        '''
+
+        self.__end_session()
+
+        if self.__writer is not None:
+
+            self.__writer.close()
+
+        self.__reader = self.__writer = None
+
+    def __end_session(self) -> None:
+        '''
+        Ends the session, a finished one rotates the vault and an unfinished one is abandoned, as the server does.
+
+        Returns:
+            None: The device has no session.
+        '''
+
+        if self.__authenticator is not None and self.__authenticator.time_lived() == TIME_TO_LIVE:
+
+            self.__authenticator.reset()
+
+        # Persist the rotations that are only journaled
+
+        if self.__authenticator is not None:
+
+            self.__authenticator.persist()
+
+        self.__authenticator = None
+        self.__resumed = False
+
+    def __disconnect(self) -> None:
+        '''
+        Drops a connection closed by the server, keeping a live session to resume unless it was already resumed.
+
+        Returns:
+            None: The device is disconnected.
+        '''
+
+        # The server may have missed the last readings, so a finished session is abandoned rather than rotated: a
+        # vault behind the server is rolled forward by the next handshake (one ahead of it would be rolled back
+        # from the journal, at the cost of persisting the vault)
+
+        if self.__resumed or (self.__authenticator is not None and self.__authenticator.time_lived() == TIME_TO_LIVE):
+
+            self.__authenticator = None
+            self.__resumed = False
+
+        self.__writer.close()
+
+        self.__reader = self.__writer = None
+
+class DeviceRuntime:
+    '''
+    A class that drives many devices from one event loop, sampling each one on a timer wheel.
+
+    Each device samples at the interval, moved by a random jitter so the devices don't synchronize. The
+    event loop wakes up once per tick whatever the number of devices, and a sample costs an encryption and a
+    buffered write, so the CPU use grows with the readings per second and not with the devices.
+
+    Attributes:
+        __host (str): The address of the server.
+        __port (int): The port of the server.
+        __interval (float): The seconds between the readings of a device.
+        __jitter (float): The relative spread of the interval.
+        __tick (float): The resolution of the timers.
+        __rng (Randomness): The source the devices split their own streams from.
+        __pacing (Randomness): The source of the phases and the jitter.
+        __devices (list): The devices.
+        __handshakes (asyncio.Semaphore): Bounds the handshakes in flight (None until running).
+        __wheel (TimerWheel): The timers of the devices (None until running).
+        __tasks (set): The connections and handshakes in flight (the event loop only keeps weak references to them).
+        __running (bool): If the runtime is running.
+        __stats (dict): The counters of the runtime.
+        __errors (dict): The number of errors of each kind.
+    '''
+
+    def __init__(self, host: str, port: int, interval: float = 3.0, jitter: float = 0.1, tick: float = 0.01, rng: Randomness = None):
+        '''
+        Initializes a DeviceRuntime object.
+
+        Args:
+            host (str): The address of the server.
+            port (int): The port of the server.
+            interval (float) = 3.0: The seconds between the readings of a device, as Device.run.
+            jitter (float) = 0.1: The relative spread of the interval.
+            tick (float) = 0.01: The resolution of the timers.
+            rng (Randomness) = None: The source of the devices and the pacing (the default one if not given).
+        '''
+
+        self.__host = host
+        self.__port = port
+        self.__interval = interval
+        self.__jitter = jitter
+        self.__tick = tick
+        self.__rng = get_default() if rng is None else rng
+        self.__pacing = self.__rng.derive('pacing')
+        self.__devices = list()
+        self.__handshakes = None
+        self.__wheel = None
+        self.__tasks = set()
+        self.__running = False
+        self.__stats = {'samples': 0, 'sent': 0, 'skipped': 0, 'backpressure': 0, 'handshakes': 0, 'errors': 0, 'lag_max': 0.0, 'lag_sum': 0.0}
+        self.__errors = dict()
+
+    def add(self, device_id: int, controller: Controller) -> AsyncDevice:
+        '''
+        Adds a device, before the runtime runs.
+
+        Args:
+            device_id (int): The identifier of the device.
+            controller (Controller): The controller of the sensors.
+
+        Returns:
+            AsyncDevice: The device.
+        '''
+
+        device = AsyncDevice(device_id, controller, self.__rng)
+
+        self.__devices.append(device)
+
+        return device
+
+    def __next(self, device: AsyncDevice, delay: float) -> None:
+        '''
+        Schedules the next sample of a device.
+
+        Args:
+            device (AsyncDevice): The device.
+            delay (float): The seconds until the sample.
+
+        Returns:
+            None: The sample is scheduled.
+        '''
+
+        self.__wheel.schedule(delay, self.__sample, device)
+
+    def __sample(self, device: AsyncDevice) -> None:
+        '''
+        Takes a sample of a device, sending it right away if the device is ready.
+
+        Args:
+            device (AsyncDevice): The device.
+
+        Returns:
+            None: The reading is sent, or skipped, and the next sample is scheduled.
+        '''
+
+        # How late the timer fires after its tick
+
+        lag = asyncio.get_running_loop().time() - self.__wheel.get_time(self.__wheel.get_current())
+
+        self.__stats['samples'] += 1
+        self.__stats['lag_sum'] += lag
+        self.__stats['lag_max'] = max(self.__stats['lag_max'], lag)
+
+        if not self.__running:
+            return
+
+        self.__next(device, self.__interval * (1 + self.__pacing.uniform(-self.__jitter, self.__jitter)))
+
+        if device.is_ready():
+
+            # A device whose socket doesn't keep up drops the readings instead of piling them up
+
+            if device.get_backlog() > HIGH_WATER:
+
+                self.__stats['backpressure'] += 1
+                return
+
+            device.send()
+
+            self.__stats['sent'] += 1
+
+        elif device.is_busy():
+
+            self.__stats['skipped'] += 1
+
+        else:
+
+            task = asyncio.get_running_loop().create_task(self.__prepare_and_send(device))
+
+            self.__tasks.add(task)
+            task.add_done_callback(self.__tasks.discard)
+
+    async def __prepare_and_send(self, device: AsyncDevice) -> None:
+        '''
+        Connects or renews the session of a device, then sends the sample.
+
+        Args:
+            device (AsyncDevice): The device.
+
+        Returns:
+            None: The reading is sent, or the device is closed after an error.
+        '''
+
+        try:
+
+            await device.prepare(self.__host, self.__port, self.__handshakes)
+
+            self.__stats['handshakes'] += 1
+
+            if self.__running:
+
+                device.send()
+
+                self.__stats['sent'] += 1
+
+        except Exception as e:
+
+            # A connection that failed is dropped, the device reconnects on a later sample
+
+            self.__stats['errors'] += 1
+            self.__errors[type(e).__name__] = self.__errors.get(type(e).__name__, 0) + 1
+
+            device.close()
+
+    async def run(self, duration: float = None, max_handshakes: int = 64) -> None:
+        '''
+        Runs the devices.
+
+        Args:
+            duration (float) = None: The seconds to run (until stopped if not given).
+            max_handshakes (int) = 64: The handshakes in flight at once, so the fleet doesn't storm the server.
+
+        Returns:
+            None: The runtime stopped and the devices are disconnected.
+        '''
+
+        loop = asyncio.get_running_loop()
+
+        self.__wheel = TimerWheel(self.__tick, loop.time())
+        self.__handshakes = asyncio.Semaphore(max_handshakes)
+        self.__running = True
+
+        # Spread the first samples over an interval
+
+        for device in self.__devices:
+
+            self.__next(device, self.__pacing.uniform(0, self.__interval))
+
+        deadline = None if duration is None else loop.time() + duration
+
+        try:
+
+            while self.__running and (deadline is None or loop.time() < deadline):
+
+                await asyncio.sleep(self.__tick)
+
+                self.__wheel.advance(loop.time())
+
+        finally:
+
+            self.__running = False
+
+            # Cancel the connections and handshakes in flight before closing their devices
+
+            for task in list(self.__tasks):
+
+                task.cancel()
+
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+
+            for device in self.__devices:
+
+                device.close()
+
+    def stop(self) -> None:
+        '''
+        Stops the runtime at its next tick.
+
+        Returns:
+            None: The runtime is stopping.
+        '''
+
+        self.__running = False
+
+    def get_stats(self) -> dict:
+        '''
+        Returns the counters of the runtime.
+
+        Returns:
+            dict: The 'samples' taken, readings 'sent', 'skipped' while busy and dropped for 'backpressure', the 'handshakes', the 'errors' (with their 'kinds'), the 'lag_mean' and 'lag_max' seconds of the timers and the 'pending' timers.
+        '''
+
+        stats = {key: value for key, value in self.__stats.items() if key != 'lag_sum'}
+
+        stats['lag_mean'] = self.__stats['lag_sum'] / self.__stats['samples'] if self.__stats['samples'] else 0.0
+        stats['kinds'] = dict(self.__errors)
+        stats['pending'] = 0 if self.__wheel is None else self.__wheel.get_pending()
+
+        return stats
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Runs the devices of the registry (python setup.py --count <n>) from one process.')
+    parser.add_argument('--registry', default=PATH_REGISTRY, help='the registry of the devices')
+    parser.add_argument('--host', default='localhost', help='the address of the server')
+    parser.add_argument('--port', type=int, default=9070, help='the port of the server')
+    parser.add_argument('--interval', type=float, default=3.0, help='the seconds between the readings of a device')
+    parser.add_argument('--jitter', type=float, default=0.1, help='the relative spread of the interval')
+    parser.add_argument('--tick', type=float, default=0.01, help='the resolution of the timers')
+    parser.add_argument('--duration', type=float, help='the seconds to run (until interrupted by default)')
+    parser.add_argument('--seed', type=int, help='make the keys, readings and pacing reproducible (insecure, for tests only)')
+    parser.add_argument('--json', action='store_true', help='print the counters as JSON')
+    args = parser.parse_args()
+
+    # Each device takes a socket
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    runtime = DeviceRuntime(args.host, args.port, args.interval, args.jitter, args.tick, Randomness(args.seed))
+
+    for device_id, device in load_registry(args.registry).items():
+
+        runtime.add(device_id, device['controller'])
+
+    try:
+
+        asyncio.run(runtime.run(args.duration))
+
+    except KeyboardInterrupt:
+
+        pass
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    stats = runtime.get_stats()
+    stats['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+
+    if args.json:
+
+        print(json.dumps(stats, indent=2))
+        return
+
+    print(f'{stats["samples"]} samples, {stats["sent"]} sent, {stats["skipped"]} skipped while busy, {stats["backpressure"]} dropped for backpressure')
+    print(f'{stats["handshakes"]} handshakes, {stats["errors"]} errors {stats["kinds"]}')
+    print(f'timer lag mean {stats["lag_mean"] * 1000:.2f}ms max {stats["lag_max"] * 1000:.2f}ms, {stats["cpu_seconds"]:.2f}s of CPU')
+
+if __name__ == '__main__':
+
+    main()
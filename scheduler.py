@@ -0,0 +1,239 @@
+from math import ceil
+
+class Timer:
+    '''
+    A class representing a callback scheduled on a TimerWheel.
+
+    Attributes:
+        __expiry (int): The tick the timer fires at.
+        __callback (callable): The function called when the timer fires.
+        __args (tuple): The arguments of the callback.
+        __cancelled (bool): If the timer was cancelled.
+    '''
+
+    def __init__(self, expiry: int, callback, args: tuple):
+        '''
+        Initializes a Timer object.
+
+        Args:
+            expiry (int): The tick the timer fires at.
+            callback (callable): The function called when the timer fires.
+            args (tuple): The arguments of the callback.
+        '''
+
+        self.__expiry = expiry
+        self.__callback = callback
+        self.__args = args
+        self.__cancelled = False
+
+    def get_expiry(self) -> int:
+        '''
+        Returns the tick the timer fires at.
+
+        Returns:
+            int: The tick.
+        '''
+
+        return self.__expiry
+
+    def cancel(self) -> None:
+        '''
+        Cancels the timer, it is dropped when its slot comes up.
+
+        Returns:
+            None: The timer won't fire.
+        '''
+
+        self.__cancelled = True
+
+    def is_cancelled(self) -> bool:
+        '''
+        Checks if the timer was cancelled.
+
+        Returns:
+            bool: If the timer was cancelled.
+        '''
+
+        return self.__cancelled
+
+    def fire(self) -> None:
+        '''
+        Calls the callback of the timer.
+
+        Returns:
+            None: The callback is called.
+        '''
+
+        self.__callback(*self.__args)
+
+class TimerWheel:
+    '''
+    A class representing a hierarchical timer wheel, where scheduling and cancelling cost the same no matter
+    how many timers are pending.
+
+    Each level has 2^bits slots, a slot of level L spanning 2^(bits * L) ticks. A timer goes in the lowest
+    level whose span covers its delay, and moves down a level each time the level below wraps around, until
+    it fires from level 0.
+
+    Attributes:
+        __tick (float): The seconds of each tick.
+        __origin (float): The time of tick 0.
+        __bits (int): The bits of the slot index of each level.
+        __mask (int): The mask of the slot index of each level.
+        __wheels (list): The slots of each level, each one a list of timers.
+        __current (int): The last tick processed.
+        __pending (int): The number of timers waiting in the wheel (cancelled ones included).
+    '''
+
+    def __init__(self, tick: float = 0.01, start: float = 0.0, bits: int = 8, levels: int = 4):
+        '''
+        Initializes a TimerWheel object.
+
+        Args:
+            tick (float) = 0.01: The seconds of each tick (the resolution of the timers).
+            start (float) = 0.0: The time of tick 0, in the clock given to advance.
+            bits (int) = 8: The bits of the slot index of each level.
+            levels (int) = 4: The number of levels (the longest delay is 2^(bits * levels) ticks).
+        '''
+
+        self.__tick = tick
+        self.__origin = start
+        self.__bits = bits
+        self.__mask = (1 << bits) - 1
+        self.__wheels = [[list() for _ in range(1 << bits)] for _ in range(levels)]
+        self.__current = 0
+        self.__pending = 0
+
+    def get_pending(self) -> int:
+        '''
+        Returns the number of timers waiting in the wheel.
+
+        Returns:
+            int: The number of timers (cancelled ones are counted until their slot comes up).
+        '''
+
+        return self.__pending
+
+    def get_current(self) -> int:
+        '''
+        Returns the last tick processed (the one firing, from a callback).
+
+        Returns:
+            int: The tick.
+        '''
+
+        return self.__current
+
+    def get_time(self, tick: int) -> float:
+        '''
+        Returns the time of a tick.
+
+        Args:
+            tick (int): The tick.
+
+        Returns:
+            float: The time, in the clock given to advance.
+        '''
+
+        return self.__origin + tick * self.__tick
+
+    def __place(self, timer: Timer) -> None:
+        '''
+        Puts a timer in the slot of the lowest level that covers its delay.
+
+        Args:
+            timer (Timer): The timer.
+
+        Returns:
+            None: The timer is in its slot.
+
+        Raises:
+            ValueError: If the delay is longer than the wheel.
+        '''
+
+        delta = timer.get_expiry() - self.__current
+
+        for level, wheel in enumerate(self.__wheels):
+
+            if delta < 1 << (self.__bits * (level + 1)):
+
+                wheel[(timer.get_expiry() >> (self.__bits * level)) & self.__mask].append(timer)
+                return
+
+        raise ValueError(f'the delay of {delta} ticks is longer than the wheel')
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        '''
+        Schedules a callback.
+
+        Args:
+            delay (float): The seconds until the callback (rounded up to the next tick).
+            callback (callable): The function to call.
+            *args: The arguments of the callback.
+
+        Returns:
+            Timer: The timer, which can be cancelled.
+
+        Raises:
+            ValueError: If the delay is longer than the wheel.
+        '''
+
+        timer = Timer(self.__current + max(1, ceil(delay / self.__tick)), callback, args)
+
+        self.__place(timer)
+
+        self.__pending += 1
+
+        return timer
+
+    def advance(self, now: float) -> int:
+        '''
+        Processes the ticks up to a time, firing the timers that expired.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            int: The number of timers fired.
+        '''
+
+        target = int((now - self.__origin) / self.__tick)
+        fired = 0
+
+        while self.__current < target:
+
+            self.__current += 1
+
+            # Move the timers of the upper levels down when the level below wraps around
+
+            for level in range(1, len(self.__wheels)):
+
+                if self.__current & ((1 << (self.__bits * level)) - 1):
+                    break
+
+                index = (self.__current >> (self.__bits * level)) & self.__mask
+
+                timers = self.__wheels[level][index]
+                self.__wheels[level][index] = list()
+
+                for timer in timers:
+
+                    self.__place(timer)
+
+            # Fire the timers of the tick, the callbacks can schedule new ones
+
+            index = self.__current & self.__mask
+
+            timers = self.__wheels[0][index]
+            self.__wheels[0][index] = list()
+
+            for timer in timers:
+
+                self.__pending -= 1
+
+                if not timer.is_cancelled():
+
+                    timer.fire()
+                    fired += 1
+
+        return fired
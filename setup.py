@@ -1,6 +1,11 @@
-from utils import write_file_bytes, read_file_bytes, bytes_list_to_bytes
-from crypto import generate_keys, generate_key, encrypt
-import random
+from utils import write_file_bytes, read_file_bytes
+from crypto import generate_key, encrypt
+from rng import Randomness, get_default
+from config_dv import PROFILES
+from authenticator import JOURNAL_SUFFIX, HISTORY_SUFFIX
+from multiprocessing import Pool
+from time import perf_counter
+import argparse, os
 
 VAULT_SIZE = 128
 KEY_SIZE = 32
@@ -8,22 +13,290 @@ KEY_SIZE = 32
 PATH_DV_VAULTS = 'dvVaults/'
 PATH_SV_VAULTS = 'svVaults/'
 PATH_DV_KEYS = 'dvKeys/'
+PATH_REGISTRY = 'registry.txt'
 
-# The running script to generate an IoT device configuration (server and device wise)
+# The identifiers fit the 32 bits of the message header, 0 is the one the server signs with
 
-# Generate a device id
+MAX_DEVICE_ID = 2 ** 32 - 1
 
-dev_id = random.randint(1, 10000)
+# The devices given to each provisioning worker at a time
 
-# Generate the vault and the device key
+CHUNK_SIZE = 512
 
-vault = generate_keys(VAULT_SIZE, KEY_SIZE)
-key = generate_key(KEY_SIZE)
+def _generate(rng: Randomness) -> tuple[bytes, bytes, bytes]:
+    '''
+    Generates the vault and the key of a device.
 
-data = bytes_list_to_bytes(vault)
+    Args:
+        rng (Randomness): The source of the keys.
 
-# Write the information to be used
+    Returns:
+        tuple[bytes, bytes, bytes]: The server vault, the device key and the encrypted device vault.
+    '''
 
-write_file_bytes(data, PATH_SV_VAULTS + str(dev_id))
-write_file_bytes(key, PATH_DV_KEYS + str(dev_id))
-write_file_bytes(encrypt(data, key), PATH_DV_VAULTS + str(dev_id))
\ No newline at end of file
+    # The whole vault is drawn at once
+
+    data = rng.bytes(VAULT_SIZE * KEY_SIZE)
+    key = generate_key(KEY_SIZE, rng)
+
+    return data, key, encrypt(data, key, rng)
+
+def _write(dev_id: int, data: bytes, key: bytes, vault: bytes) -> None:
+    '''
+    Writes the files of a device, dropping the rotation journal and history of any previous device with the identifier.
+
+    Args:
+        dev_id (int): The identifier of the device.
+        data (bytes): The server vault.
+        key (bytes): The device key.
+        vault (bytes): The encrypted device vault.
+
+    Returns:
+        None: The files are written.
+    '''
+
+    write_file_bytes(data, PATH_SV_VAULTS + str(dev_id))
+    write_file_bytes(key, PATH_DV_KEYS + str(dev_id))
+    write_file_bytes(vault, PATH_DV_VAULTS + str(dev_id))
+
+    for path in (PATH_DV_VAULTS + str(dev_id) + JOURNAL_SUFFIX, PATH_SV_VAULTS + str(dev_id) + HISTORY_SUFFIX):
+
+        if os.path.exists(path):
+
+            os.remove(path)
+
+def provisioned() -> set:
+    '''
+    Returns the identifiers of the devices already provisioned, relative to the working directory.
+
+    Returns:
+        set: The identifiers with a server vault.
+    '''
+
+    if not os.path.isdir(PATH_SV_VAULTS):
+        return set()
+
+    return {int(name) for name in os.listdir(PATH_SV_VAULTS) if name.isdigit()}
+
+def provision(dev_id: int = None, rng: Randomness = None) -> int:
+    '''
+    Generates an IoT device configuration (server and device wise), relative to the working directory.
+
+    Args:
+        dev_id (int) = None: The identifier of the device (a random unused one if not given).
+        rng (Randomness) = None: The source of the identifier and the keys (the default one if not given).
+
+    Returns:
+        int: The identifier of the device.
+
+    Raises:
+        ValueError: If the identifier is out of the range of identifiers.
+    '''
+
+    if rng is None:
+        rng = get_default()
+
+    # Generate a device id that isn't taken
+
+    if dev_id is None:
+
+        dev_id = allocate(1, provisioned(), rng)[0]
+
+    elif not 1 <= dev_id <= MAX_DEVICE_ID:
+
+        raise ValueError(f'the device identifiers go from 1 to {MAX_DEVICE_ID}, not {dev_id}')
+
+    # Generate the vault and the device key
+
+    data, key, vault = _generate(rng)
+
+    # Write the information to be used
+
+    _write(dev_id, data, key, vault)
+
+    return dev_id
+
+def allocate(n: int, taken: set, rng: Randomness = None, start: int = None) -> list:
+    '''
+    Allocates identifiers for new devices.
+
+    Args:
+        n (int): The number of identifiers.
+        taken (set): The identifiers already in use.
+        rng (Randomness) = None: The source of the identifiers (the default one if not given).
+        start (int) = None: The first of consecutive identifiers, skipping the taken ones (random ones if not given).
+
+    Returns:
+        list: The identifiers, none of them taken nor repeated.
+
+    Raises:
+        ValueError: If the start is out of the range of identifiers or there aren't enough free identifiers.
+    '''
+
+    # Identifier 0 is the one of the server
+
+    if start is not None and not 1 <= start <= MAX_DEVICE_ID:
+        raise ValueError(f'the device identifiers go from 1 to {MAX_DEVICE_ID}, not from {start}')
+
+    if n > MAX_DEVICE_ID - len(taken):
+        raise ValueError(f'there are not {n} free device identifiers')
+
+    if rng is None:
+        rng = get_default()
+
+    ids = list()
+    used = set(taken)
+
+    candidate = start
+
+    while len(ids) < n:
+
+        if start is None:
+
+            candidate = rng.randint(1, MAX_DEVICE_ID)
+
+        elif candidate > MAX_DEVICE_ID:
+
+            raise ValueError(f'there are not {n} free device identifiers from {start}')
+
+        if candidate not in used:
+
+            used.add(candidate)
+            ids.append(candidate)
+
+        if start is not None:
+
+            candidate += 1
+
+    return ids
+
+def provision_chunk(ids: list, seed: int = None) -> int:
+    '''
+    Provisions a chunk of devices, in a worker process.
+
+    Args:
+        ids (list): The identifiers of the devices.
+        seed (int) = None: The seed of the keys, split per device (the CSPRNG if not given).
+
+    Returns:
+        int: The number of devices provisioned.
+    '''
+
+    root = Randomness(seed)
+
+    for dev_id in ids:
+
+        _write(dev_id, *_generate(root.derive(dev_id, 'provision')))
+
+    return len(ids)
+
+def provision_bulk(n: int, profile: str, workers: int = None, seed: int = None, start: int = None, registry: str = PATH_REGISTRY) -> list:
+    '''
+    Provisions many devices in parallel, relative to the working directory, and appends them to the registry.
+
+    Args:
+        n (int): The number of devices.
+        profile (str): The name of the controller of the devices (a key of config_dv.PROFILES).
+        workers (int) = None: The number of worker processes (one per CPU if not given).
+        seed (int) = None: The seed of the identifiers and keys (the CSPRNG if not given, insecure otherwise).
+        start (int) = None: The first of consecutive identifiers (random ones if not given).
+        registry (str) = PATH_REGISTRY: The registry the devices are appended to.
+
+    Returns:
+        list: The identifiers of the devices.
+
+    Raises:
+        KeyError: If the profile is unknown.
+        ValueError: If the start is out of the range of identifiers or there aren't enough free identifiers.
+    '''
+
+    if profile not in PROFILES:
+        raise KeyError(f'unknown profile {profile}')
+
+    for directory in (PATH_DV_VAULTS, PATH_SV_VAULTS, PATH_DV_KEYS):
+
+        os.makedirs(directory, exist_ok = True)
+
+    # The identifiers are allocated up front, so the workers never collide
+
+    taken = provisioned()
+
+    if os.path.exists(registry):
+
+        taken |= set(load_registry(registry))
+
+    ids = allocate(n, taken, Randomness(seed).derive('ids'), start)
+
+    chunks = [ids[i:i + CHUNK_SIZE] for i in range(0, len(ids), CHUNK_SIZE)]
+
+    with Pool(workers) as pool:
+
+        pool.starmap(provision_chunk, [(chunk, seed) for chunk in chunks])
+
+    # Register the devices once all of them have their files
+
+    with open(registry, 'a') as file:
+
+        file.write(''.join(f'{dev_id} {profile}\n' for dev_id in ids))
+
+    return ids
+
+def load_registry(path: str = PATH_REGISTRY) -> dict:
+    '''
+    Loads the devices of a registry, in the format the Handler takes them.
+
+    Args:
+        path (str) = PATH_REGISTRY: The path of the registry.
+
+    Returns:
+        dict: The authenticator (None) and the controller of each device identifier.
+
+    Raises:
+        KeyError: If a device has an unknown profile.
+    '''
+
+    devices = dict()
+
+    with open(path) as file:
+
+        for line in file:
+
+            if not line.strip():
+                continue
+
+            dev_id, profile = line.split()
+
+            devices[int(dev_id)] = {'auth': None, 'controller': PROFILES[profile]}
+
+    return devices
+
+# The running script to generate IoT device configurations (one device if no count is given)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Provisions IoT devices in the working directory.')
+    parser.add_argument('--count', type=int, help='provision this many devices in parallel and register them')
+    parser.add_argument('--profile', default='thermo', choices=sorted(PROFILES), help='the controller of the devices')
+    parser.add_argument('--workers', type=int, help='the number of worker processes (one per CPU by default)')
+    parser.add_argument('--start', type=int, help='give consecutive identifiers from this one (random ones by default)')
+    parser.add_argument('--registry', default=PATH_REGISTRY, help='the registry the devices are appended to')
+    parser.add_argument('--seed', type=int, help='make the identifiers and keys reproducible (insecure, for tests only)')
+    args = parser.parse_args()
+
+    if args.start is not None and not 1 <= args.start <= MAX_DEVICE_ID:
+
+        parser.error(f'--start must be from 1 to {MAX_DEVICE_ID} (0 is the server)')
+
+    if args.count is None:
+
+        print(provision())
+
+    else:
+
+        start = perf_counter()
+
+        ids = provision_bulk(args.count, args.profile, args.workers, args.seed, args.start, args.registry)
+
+        elapsed = perf_counter() - start
+
+        print(f'{len(ids)} devices provisioned in {elapsed:.2f}s ({len(ids) / elapsed:.0f}/s), registered in {args.registry}')
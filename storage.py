@@ -0,0 +1,1026 @@
+from controller import Controller
+from utils import write_file_atomic
+from threading import Lock, Thread, Event
+import os, mmap, struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The header of each record (time and session) and the footer of each sealed segment
+
+RECORD_HEADER = struct.Struct('<dI')
+SEGMENT_FOOTER = struct.Struct('<ddQ4s')
+SEGMENT_MAGIC = b'SEG1'
+SEGMENT_EXTENSION = '.seg'
+ROLLUPS_FILE = 'rollups.roll'
+
+# The swap of compacted segments in progress (the segment replaced by the new one, and the segments removed),
+# finished when the segments are opened again after a crash
+
+MERGE_INTENT = 'merge.intent'
+TMP_EXTENSION = '.tmp'
+
+class Segment:
+    '''
+    A class representing a segment file of fixed width records of a single device.
+
+    Attributes:
+        path (str): The path of the segment file.
+        min_time (float): The time of the oldest record (None if empty).
+        max_time (float): The time of the newest record (None if empty).
+        count (int): The number of records written to the file.
+        sealed (bool): If the segment has its footer and won't grow anymore.
+    '''
+
+    def __init__(self, path: str, min_time: float = None, max_time: float = None, count: int = 0, sealed: bool = False):
+        '''
+        Initializes a Segment object.
+
+        Args:
+            path (str): The path of the segment file.
+            min_time (float) = None: The time of the oldest record.
+            max_time (float) = None: The time of the newest record.
+            count (int) = 0: The number of records.
+            sealed (bool) = False: If the segment has its footer.
+        '''
+
+        self.path = path
+        self.min_time = min_time
+        self.max_time = max_time
+        self.count = count
+        self.sealed = sealed
+
+    def overlaps(self, start: float = None, end: float = None) -> bool:
+        '''
+        Checks if the segment may have records inside a time range.
+
+        Args:
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+
+        Returns:
+            bool: If the records of the segment can't be skipped.
+        '''
+
+        if self.count == 0:
+            return False
+
+        return (start is None or self.max_time >= start) and (end is None or self.min_time < end)
+
+class DeviceSegments:
+    '''
+    A class representing the segments of a single device, with the buffer of the records not yet written.
+
+    Attributes:
+        __path (str): The directory of the segments of the device.
+        __dtype (numpy.dtype): The structured type of the records (None if numpy is not available).
+        __record_size (int): The size of each record in bytes.
+        __segments (list): The segments of the device, the last one being the active one.
+        __file (file): The file of the active segment (None until the first write).
+        __buffer (bytearray): The records not yet written to the active segment.
+    '''
+
+    def __init__(self, path: str, controller: Controller):
+        '''
+        Initializes a DeviceSegments object, finishing a swap of segments and sealing any segment left unsealed
+        by a previous run.
+
+        Args:
+            path (str): The directory of the segments of the device.
+            controller (Controller): The controller that defines the sensors of the device.
+        '''
+
+        self.__path = path
+        self.__dtype = None if np is None else np.dtype([('time', '<f8'), ('session', '<u4')] + controller.get_dtype().descr)
+        self.__record_size = RECORD_HEADER.size + controller.get_reading_size()
+        self.__segments = list()
+        self.__file = None
+        self.__buffer = bytearray()
+
+        os.makedirs(path, exist_ok=True)
+
+        self.__recover()
+
+        for name in sorted(os.listdir(path)):
+
+            if name.endswith(SEGMENT_EXTENSION):
+
+                self.__segments.append(self.__open_segment(os.path.join(path, name)))
+
+        self.__new_segment()
+
+    def __recover(self) -> None:
+        '''
+        Finishes the swap of segments a crash interrupted, and deletes the segments written for a swap that
+        didn't start.
+
+        Returns:
+            None: The directory has either the old or the new segments, never both.
+        '''
+
+        intent = os.path.join(self.__path, MERGE_INTENT)
+
+        if os.path.exists(intent):
+
+            with open(intent) as file:
+
+                target, *removed = file.read().split()
+
+            # The new segment was synced before the swap was recorded, so the swap is rolled forward
+
+            if target != '-' and os.path.exists(os.path.join(self.__path, target + TMP_EXTENSION)):
+
+                os.replace(os.path.join(self.__path, target + TMP_EXTENSION), os.path.join(self.__path, target))
+
+            for name in removed:
+
+                if os.path.exists(os.path.join(self.__path, name)):
+
+                    os.remove(os.path.join(self.__path, name))
+
+            os.remove(intent)
+
+        for name in os.listdir(self.__path):
+
+            if name.endswith(SEGMENT_EXTENSION + TMP_EXTENSION):
+
+                os.remove(os.path.join(self.__path, name))
+
+    def __sync_directory(self) -> None:
+        '''
+        Syncs the directory of the segments, so the files created, renamed and removed are persisted.
+
+        Returns:
+            None: The directory is synced.
+        '''
+
+        descriptor = os.open(self.__path, os.O_RDONLY)
+
+        try:
+
+            os.fsync(descriptor)
+
+        finally:
+
+            os.close(descriptor)
+
+    def __open_segment(self, path: str) -> Segment:
+        '''
+        Reads the footer of an existing segment, sealing it if it has none.
+
+        Args:
+            path (str): The path of the segment file.
+
+        Returns:
+            Segment: The sealed segment.
+        '''
+
+        size = os.path.getsize(path)
+
+        with open(path, 'r+b') as file:
+
+            if size >= SEGMENT_FOOTER.size and (size - SEGMENT_FOOTER.size) % self.__record_size == 0:
+
+                file.seek(size - SEGMENT_FOOTER.size)
+
+                min_time, max_time, count, magic = SEGMENT_FOOTER.unpack(file.read(SEGMENT_FOOTER.size))
+
+                if magic == SEGMENT_MAGIC and count * self.__record_size == size - SEGMENT_FOOTER.size:
+
+                    return Segment(path, min_time, max_time, count, True)
+
+            # Drop any partially written record and scan the time range
+
+            count = size // self.__record_size
+
+            file.truncate(count * self.__record_size)
+
+            times = []
+
+            for i in range(count):
+
+                file.seek(i * self.__record_size)
+
+                times.append(RECORD_HEADER.unpack(file.read(RECORD_HEADER.size))[0])
+
+            segment = Segment(path, min(times, default=None), max(times, default=None), count)
+
+            self.__write_footer(file, segment)
+
+        return segment
+
+    def __write_footer(self, file, segment: Segment) -> None:
+        '''
+        Appends the footer to a segment file, sealing it.
+
+        Args:
+            file (file): The segment file, opened for writing.
+            segment (Segment): The segment.
+
+        Returns:
+            None: The footer is written.
+        '''
+
+        file.seek(segment.count * self.__record_size)
+
+        file.write(SEGMENT_FOOTER.pack(segment.min_time or 0.0, segment.max_time or 0.0, segment.count, SEGMENT_MAGIC))
+        file.flush()
+
+        os.fsync(file.fileno())
+
+        segment.sealed = True
+
+    def __new_segment(self) -> None:
+        '''
+        Starts a new active segment.
+
+        Returns:
+            None: The segment is added to the list.
+        '''
+
+        sequence = int(os.path.basename(self.__segments[-1].path)[:-len(SEGMENT_EXTENSION)]) + 1 if self.__segments else 0
+
+        self.__segments.append(Segment(os.path.join(self.__path, f'{sequence:08d}{SEGMENT_EXTENSION}')))
+
+    def append(self, record: bytes, timestamp: float) -> None:
+        '''
+        Appends a record to the buffer of the active segment.
+
+        Args:
+            record (bytes): The record, with its header.
+            timestamp (float): The time of the record.
+
+        Returns:
+            None: The record is buffered.
+        '''
+
+        segment = self.__segments[-1]
+
+        segment.min_time = timestamp if segment.min_time is None else min(segment.min_time, timestamp)
+        segment.max_time = timestamp if segment.max_time is None else max(segment.max_time, timestamp)
+        segment.count += 1
+
+        self.__buffer += record
+
+    def buffered(self) -> int:
+        '''
+        Returns the number of records not yet written.
+
+        Returns:
+            int: The number of buffered records.
+        '''
+
+        return len(self.__buffer) // self.__record_size
+
+    def flush(self) -> int:
+        '''
+        Writes the buffered records to the active segment, without syncing them.
+
+        Returns:
+            int: The file descriptor of the active segment (None if it was never written).
+        '''
+
+        if self.__buffer:
+
+            if self.__file is None:
+
+                self.__file = open(self.__segments[-1].path, 'ab')
+
+            self.__file.write(self.__buffer)
+            self.__file.flush()
+
+            self.__buffer = bytearray()
+
+        return None if self.__file is None else self.__file.fileno()
+
+    def roll(self, max_records: int, max_age: float, now: float) -> bool:
+        '''
+        Seals the active segment and starts a new one, if it is too big or too old.
+
+        Args:
+            max_records (int): The number of records of a full segment.
+            max_age (float): The number of seconds a segment stays active.
+            now (float): The current time.
+
+        Returns:
+            bool: If the segment was rolled.
+        '''
+
+        segment = self.__segments[-1]
+
+        if segment.count == 0 or (segment.count < max_records and now - segment.min_time < max_age):
+            return False
+
+        self.close()
+        self.__new_segment()
+
+        return True
+
+    def close(self) -> None:
+        '''
+        Writes the buffered records and seals the active segment.
+
+        Returns:
+            None: The active segment is sealed.
+        '''
+
+        if self.__segments[-1].count == 0:
+            return
+
+        self.flush()
+
+        self.__write_footer(self.__file, self.__segments[-1])
+
+        self.__file.close()
+        self.__file = None
+
+    def segments(self) -> list:
+        '''
+        Returns the segments of the device.
+
+        Returns:
+            list: The segments, the last one being the active one.
+        '''
+
+        return list(self.__segments)
+
+    def get_dtype(self):
+        '''
+        Returns the structured type of the records.
+
+        Returns:
+            numpy.dtype: The type with a 'time' and 'session' field followed by the fields of the readings.
+        '''
+
+        return self.__dtype
+
+    def get_path(self) -> str:
+        '''
+        Returns the directory of the segments of the device.
+
+        Returns:
+            str: The directory.
+        '''
+
+        return self.__path
+
+    def read_segment(self, segment: Segment):
+        '''
+        Reads every record of a sealed segment.
+
+        Args:
+            segment (Segment): The sealed segment.
+
+        Returns:
+            numpy.ndarray: The records of the segment.
+        '''
+
+        return np.fromfile(segment.path, dtype=self.__dtype, count=segment.count)
+
+    def write_segment(self, path: str, records) -> Segment:
+        '''
+        Writes records to a new sealed segment file.
+
+        Args:
+            path (str): The path of the segment file.
+            records (numpy.ndarray): The records.
+
+        Returns:
+            Segment: The sealed segment.
+        '''
+
+        segment = Segment(path, float(records['time'].min()), float(records['time'].max()), len(records))
+
+        with open(path, 'wb') as file:
+
+            file.write(records.tobytes())
+
+            self.__write_footer(file, segment)
+
+        return segment
+
+    def replace(self, old: list, new: Segment = None) -> int:
+        '''
+        Replaces sealed segments by a single one (or by nothing), deleting their files.
+
+        The swap is recorded before any file is touched, so a crash in the middle of it is finished when the
+        segments are opened again, instead of leaving the new segment next to the ones it replaces.
+
+        Args:
+            old (list): The sealed segments to replace.
+            new (Segment) = None: The segment that takes the place of the first one, written and synced at the path of the first one with TMP_EXTENSION.
+
+        Returns:
+            int: The number of bytes reclaimed from the disk.
+        '''
+
+        intent = os.path.join(self.__path, MERGE_INTENT)
+        removed = old if new is None else old[1:]
+
+        write_file_atomic(' '.join(['-' if new is None else os.path.basename(old[0].path)] + [os.path.basename(segment.path) for segment in removed]).encode(), intent)
+
+        self.__sync_directory()
+
+        # Swap the files
+
+        if new is not None:
+
+            os.replace(new.path, old[0].path)
+
+            new.path = old[0].path
+
+        for segment in removed:
+
+            os.remove(segment.path)
+
+        os.remove(intent)
+
+        self.__sync_directory()
+
+        # Swap the segments
+
+        reclaimed = 0
+        position = self.__segments.index(old[0])
+
+        for segment in old:
+
+            self.__segments.remove(segment)
+
+            reclaimed += segment.count * self.__record_size + SEGMENT_FOOTER.size
+
+        if new is not None:
+
+            self.__segments.insert(position, new)
+
+            reclaimed -= new.count * self.__record_size + SEGMENT_FOOTER.size
+
+        return reclaimed
+
+    def snapshot(self) -> list:
+        '''
+        Writes the buffered records and copies the segments, so they can be read while records are appended.
+
+        Returns:
+            list: The copies of the segments, with the records written so far.
+        '''
+
+        self.flush()
+
+        return [Segment(segment.path, segment.min_time, segment.max_time, segment.count, segment.sealed) for segment in self.__segments]
+
+    def read(self, segments: list, start: float = None, end: float = None) -> list:
+        '''
+        Reads the records inside a time range, memory mapping only the segments that overlap it.
+
+        Args:
+            segments (list): The segments to read, as given by snapshot.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+
+        Returns:
+            list: One record array per segment read.
+
+        Raises:
+            ImportError: If numpy is not available.
+            FileNotFoundError: If a segment was replaced since the snapshot.
+        '''
+
+        if np is None:
+            raise ImportError('numpy is required to read segments')
+
+        arrays = []
+
+        for segment in segments:
+
+            if not segment.overlaps(start, end):
+                continue
+
+            with open(segment.path, 'rb') as file:
+
+                with mmap.mmap(file.fileno(), segment.count * self.__record_size, access=mmap.ACCESS_READ) as view:
+
+                    records = np.frombuffer(view, dtype=self.__dtype, count=segment.count)
+
+                    mask = np.ones(segment.count, dtype=bool)
+
+                    if start is not None:
+
+                        mask &= records['time'] >= start
+
+                    if end is not None:
+
+                        mask &= records['time'] < end
+
+                    # Copy the selected records out, so the mapping can be closed
+
+                    arrays.append(records[mask].copy())
+
+                    del records
+
+        return arrays
+
+    def last(self, segments: list, n: int) -> list:
+        '''
+        Reads the most recently appended records, from the newest segments only.
+
+        Args:
+            segments (list): The segments to read, as given by snapshot.
+            n (int): The number of records.
+
+        Returns:
+            list: One record array per segment read, from the oldest.
+
+        Raises:
+            ImportError: If numpy is not available.
+            FileNotFoundError: If a segment was replaced since the snapshot.
+        '''
+
+        if np is None:
+            raise ImportError('numpy is required to read segments')
+
+        arrays = []
+
+        for segment in reversed(segments):
+
+            if n <= 0:
+                break
+
+            count = min(n, segment.count)
+
+            if count == 0:
+                continue
+
+            with open(segment.path, 'rb') as file:
+
+                file.seek((segment.count - count) * self.__record_size)
+
+                arrays.insert(0, np.frombuffer(file.read(count * self.__record_size), dtype=self.__dtype))
+
+            n -= count
+
+        return arrays
+
+class SegmentStore:
+    '''
+    A class representing the persistent storage of the readings, in append-only segment files per device.
+
+    Records are buffered and written in batches, while a background thread periodically writes and syncs
+    what is buffered, so ingest never waits for the disk to sync.
+
+    Attributes:
+        __path (str): The directory of the storage.
+        __devices (dict): The segments and controller of each device identifier.
+        __segment_records (int): The number of records of a full segment.
+        __segment_seconds (float): The number of seconds a segment stays active.
+        __batch_records (int): The number of buffered records that triggers a write.
+        __sync_interval (float): The number of seconds between syncs to the disk.
+        __lock (Lock): The lock that protects the segments and buffers.
+        __swaps (int): The number of segment swaps, so a read can tell if its segments were replaced.
+    '''
+
+    def __init__(self, path: str, segment_records: int = 65536, segment_seconds: float = 3600, batch_records: int = 256, sync_interval: float = 1.0):
+        '''
+        Initializes a SegmentStore object.
+
+        Args:
+            path (str): The directory of the storage.
+            segment_records (int) = 65536: The number of records of a full segment.
+            segment_seconds (float) = 3600: The number of seconds a segment stays active.
+            batch_records (int) = 256: The number of buffered records of a device that triggers a write.
+            sync_interval (float) = 1.0: The number of seconds between syncs to the disk.
+        '''
+
+        self.__path = path
+        self.__devices = dict()
+        self.__segment_records = segment_records
+        self.__segment_seconds = segment_seconds
+        self.__batch_records = batch_records
+        self.__sync_interval = sync_interval
+        self.__lock = Lock()
+        self.__swaps = 0
+        self.__stop = Event()
+        self.__syncer = Thread(target=self.__run_syncer, daemon=True)
+
+        os.makedirs(path, exist_ok=True)
+
+        self.__syncer.start()
+
+    def register_device(self, device_id: int, controller: Controller) -> None:
+        '''
+        Opens the segments of a device, based on its sensors.
+
+        Args:
+            device_id (int): The identifier of the device.
+            controller (Controller): The controller that defines the sensors of the device.
+
+        Returns:
+            None: The device is registered.
+        '''
+
+        with self.__lock:
+
+            if device_id not in self.__devices:
+
+                self.__devices[device_id] = {
+                    'segments': DeviceSegments(os.path.join(self.__path, str(device_id)), controller),
+                    'controller': controller
+                }
+
+    def append(self, device_id: int, session_id: int, state: int, sensors: list, timestamp: float) -> None:
+        '''
+        Appends a reading to the storage.
+
+        Args:
+            device_id (int): The identifier of the device.
+            session_id (int): The identifier of the session.
+            state (int): The state of the device.
+            sensors (list): The list of information from the sensors.
+            timestamp (float): The time of the reading.
+
+        Returns:
+            None: The reading is buffered, and written if the batch is full.
+        '''
+
+        record = RECORD_HEADER.pack(timestamp, session_id) + self.__devices[device_id]['controller'].information_to_bytes(state, sensors)
+
+        with self.__lock:
+
+            segments = self.__devices[device_id]['segments']
+
+            segments.roll(self.__segment_records, self.__segment_seconds, timestamp)
+            segments.append(record, timestamp)
+
+            if segments.buffered() >= self.__batch_records:
+
+                segments.flush()
+
+    def append_records(self, device_id: int, records, session_id: int, timestamp: float) -> None:
+        '''
+        Appends a record array of readings of the same session to the storage.
+
+        Args:
+            device_id (int): The identifier of the device.
+            records (numpy.recarray): The readings, as given by Controller.bytes_to_records.
+            session_id (int): The identifier of the session.
+            timestamp (float): The time of the readings.
+
+        Returns:
+            None: The readings are buffered, and written if the batch is full.
+        '''
+
+        # Build the stored records with the header fields
+
+        stored = np.zeros(len(records), dtype=[('time', '<f8'), ('session', '<u4')] + records.dtype.descr)
+
+        for field in records.dtype.names:
+
+            stored[field] = records[field]
+
+        stored['time'] = timestamp
+        stored['session'] = session_id
+
+        data = stored.tobytes()
+        size = stored.itemsize
+
+        with self.__lock:
+
+            segments = self.__devices[device_id]['segments']
+
+            for i in range(len(stored)):
+
+                segments.roll(self.__segment_records, self.__segment_seconds, timestamp)
+                segments.append(data[i * size:(i + 1) * size], timestamp)
+
+            if segments.buffered() >= self.__batch_records:
+
+                segments.flush()
+
+    def __read_snapshot(self, device_id: int, read) -> list:
+        '''
+        Reads the segments of a device without holding the lock, so a long read doesn't block the writers.
+
+        The lock is only held to take the snapshot of the segments. The records written are never changed, so
+        only a swap of the compactor can change the files read, in which case the read is done again.
+
+        Args:
+            device_id (int): The identifier of the device.
+            read (callable): Reads the records, given the segments of the device and their snapshot.
+
+        Returns:
+            list: The record arrays read.
+        '''
+
+        segments = self.__devices[device_id]['segments']
+
+        while True:
+
+            with self.__lock:
+
+                swaps = self.__swaps
+                snapshot = segments.snapshot()
+
+            try:
+
+                arrays = read(segments, snapshot)
+
+            except FileNotFoundError:
+
+                arrays = None
+
+            with self.__lock:
+
+                if self.__swaps == swaps:
+
+                    if arrays is None:
+                        raise FileNotFoundError('a segment is missing')
+
+                    return arrays
+
+    def read(self, device_id: int, start: float = None, end: float = None):
+        '''
+        Reads the records of a device inside a time range, skipping the segments outside of it.
+
+        Args:
+            device_id (int): The identifier of the device.
+            start (float) = None: The start of the range (inclusive).
+            end (float) = None: The end of the range (exclusive).
+
+        Returns:
+            numpy.ndarray: The records, with a 'time' and 'session' field followed by the fields of the readings.
+
+        Raises:
+            ImportError: If numpy is not available.
+        '''
+
+        arrays = self.__read_snapshot(device_id, lambda segments, snapshot: segments.read(snapshot, start, end))
+
+        if not arrays:
+
+            return np.zeros(0, dtype=np.dtype([('time', '<f8'), ('session', '<u4')] + self.__devices[device_id]['controller'].get_dtype().descr))
+
+        return np.concatenate(arrays)
+
+    def last(self, device_id: int, n: int):
+        '''
+        Reads the most recently appended records of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+            n (int): The number of records.
+
+        Returns:
+            numpy.ndarray: The records, with a 'time' and 'session' field followed by the fields of the readings.
+
+        Raises:
+            ImportError: If numpy is not available.
+        '''
+
+        arrays = self.__read_snapshot(device_id, lambda segments, snapshot: segments.last(snapshot, n))
+
+        if not arrays:
+
+            return np.zeros(0, dtype=self.__devices[device_id]['segments'].get_dtype())
+
+        return np.concatenate(arrays)
+
+    def segments(self, device_id: int) -> list:
+        '''
+        Returns the segments of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            list: The segments, the last one being the active one.
+        '''
+
+        with self.__lock:
+
+            return self.__devices[device_id]['segments'].segments()
+
+    def get_device_ids(self) -> list:
+        '''
+        Returns the identifiers of the registered devices.
+
+        Returns:
+            list: The device identifiers.
+        '''
+
+        with self.__lock:
+
+            return list(self.__devices)
+
+    def get_controller(self, device_id: int) -> Controller:
+        '''
+        Returns the controller of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            Controller: The controller that defines the sensors of the device.
+        '''
+
+        return self.__devices[device_id]['controller']
+
+    def sealed_segments(self, device_id: int) -> list:
+        '''
+        Returns the sealed segments of a device, which won't change until they are replaced.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            list: The sealed segments, from the oldest.
+        '''
+
+        with self.__lock:
+
+            return [segment for segment in self.__devices[device_id]['segments'].segments() if segment.sealed]
+
+    def read_segment(self, device_id: int, segment: Segment):
+        '''
+        Reads every record of a sealed segment, without blocking the writers.
+
+        Args:
+            device_id (int): The identifier of the device.
+            segment (Segment): The sealed segment.
+
+        Returns:
+            numpy.ndarray: The records of the segment.
+        '''
+
+        return self.__devices[device_id]['segments'].read_segment(segment)
+
+    def replace_segments(self, device_id: int, old: list, records = None) -> int:
+        '''
+        Replaces sealed segments of a device by a single segment with the given records (or by nothing).
+
+        The new segment is written before taking the lock, so the writers are only blocked while the files
+        are swapped.
+
+        Args:
+            device_id (int): The identifier of the device.
+            old (list): The sealed segments to replace.
+            records (numpy.ndarray) = None: The records of the new segment.
+
+        Returns:
+            int: The number of bytes reclaimed from the disk.
+        '''
+
+        segments = self.__devices[device_id]['segments']
+
+        new = None
+
+        if records is not None and len(records) > 0:
+
+            new = segments.write_segment(old[0].path + TMP_EXTENSION, records)
+
+        with self.__lock:
+
+            self.__swaps += 1
+
+            return segments.replace(old, new)
+
+    def read_rollups(self, device_id: int) -> bytes:
+        '''
+        Reads the rollups of a device.
+
+        Args:
+            device_id (int): The identifier of the device.
+
+        Returns:
+            bytes: The rollups, in the format chosen by who wrote them (empty if there are none).
+        '''
+
+        path = os.path.join(self.__devices[device_id]['segments'].get_path(), ROLLUPS_FILE)
+
+        with self.__lock:
+
+            if not os.path.exists(path):
+                return bytes()
+
+            with open(path, 'rb') as file:
+
+                return file.read()
+
+    def write_rollups(self, device_id: int, data: bytes, append: bool = True) -> None:
+        '''
+        Writes the rollups of a device, appending them or replacing the existing ones, atomically.
+
+        The new rollups file is written and synced before taking the lock (only the compactor writes the
+        rollups), so the writers are only blocked while the files are swapped.
+
+        Args:
+            device_id (int): The identifier of the device.
+            data (bytes): The rollups.
+            append (bool) = True: If the rollups are appended to the existing ones.
+
+        Returns:
+            None: The rollups are persisted.
+        '''
+
+        path = os.path.join(self.__devices[device_id]['segments'].get_path(), ROLLUPS_FILE)
+
+        with open(path + '.tmp', 'wb') as file:
+
+            if append and os.path.exists(path):
+
+                with open(path, 'rb') as existing:
+
+                    file.write(existing.read())
+
+            file.write(data)
+            file.flush()
+
+            os.fsync(file.fileno())
+
+        with self.__lock:
+
+            os.replace(path + '.tmp', path)
+
+    def sync(self) -> None:
+        '''
+        Writes every buffered record and syncs the active segments to the disk.
+
+        Returns:
+            None: The records are persisted.
+
+        Raises:
+            OSError: If a segment failed to be synced (after syncing the others).
+        '''
+
+        # Write under the lock, but sync without holding it, on duplicates of the descriptors so a segment
+        # sealed in the meantime can't have its descriptor closed (and reused by another file) under the sync
+
+        descriptors = []
+
+        with self.__lock:
+
+            for device in self.__devices.values():
+
+                descriptor = device['segments'].flush()
+
+                if descriptor is not None:
+
+                    descriptors.append(os.dup(descriptor))
+
+        error = None
+
+        for descriptor in descriptors:
+
+            try:
+
+                os.fsync(descriptor)
+
+            except OSError as e:
+
+                # Sync the other segments before reporting it
+
+                error = error or e
+
+            finally:
+
+                os.close(descriptor)
+
+        if error is not None:
+            raise error
+
+    def __run_syncer(self) -> None:
+        '''
+        Periodically syncs the storage, until it is closed.
+
+        Returns:
+            None: Runs until the storage is closed.
+        '''
+
+        while not self.__stop.wait(self.__sync_interval):
+
+            # A failed sync is tried again on the next interval
+
+            try:
+
+                self.sync()
+
+            except OSError:
+
+                pass
+
+    def close(self) -> None:
+        '''
+        Stops the background syncing and seals the active segments.
+
+        Returns:
+            None: The storage is closed.
+        '''
+
+        self.__stop.set()
+        self.__syncer.join()
+
+        with self.__lock:
+
+            for device in self.__devices.values():
+
+                device['segments'].close()
@@ -1,14 +1,68 @@
 from handler import Handler
+from storage import SegmentStore
+from retention import RetentionPolicy, Compactor
+from ringbuffer import HotTier
+from metrics import MetricsServer
+from capture import load_capture_key
 from config_dv import thermo, assist
+from setup import load_registry, PATH_REGISTRY
 from threading import Thread
+import os, sys
 
 # Start server
 
-sv = Handler({1058: {'auth': None, 'controller': thermo}, 5953: {'auth': None, 'controller': assist}}, 'localhost', 9070)
+store = SegmentStore('svReadings/')
+
+devices = {1058: {'auth': None, 'controller': thermo}, 5953: {'auth': None, 'controller': assist}}
+
+# Add the devices of the bulk provisioning (python setup.py --count <n>)
+
+if os.path.exists(PATH_REGISTRY):
+
+    devices.update(load_registry())
+
+# Accept the batches of an edge gateway if asked (python terminal_sv.py --gateway <id>), it has no sensors of its own
+# and may only forward the devices it serves, the ones of its registry (--gateway-registry <path>, as given to
+# gateway.py --registry)
+
+if '--gateway' in sys.argv:
+
+    path = sys.argv[sys.argv.index('--gateway-registry') + 1] if '--gateway-registry' in sys.argv else PATH_REGISTRY
+
+    served = {1058, 5953}
+
+    if os.path.exists(path):
+
+        served.update(load_registry(path))
+
+    devices[int(sys.argv[sys.argv.index('--gateway') + 1])] = {'auth': None, 'controller': None, 'devices': served}
+
+# The readings (with the ones stored by previous runs) are read from the segments when queried
+
+sv = Handler(devices, 'localhost', 9070, store, HotTier(16 * 1024 * 1024))
+
+# Keep a day of raw readings and hourly rollups of the older ones
+
+compactor = Compactor(store, RetentionPolicy())
+compactor.start()
 
 sv_th = Thread(target=sv.run_server)
 sv_th.start()
 
+# Expose the metrics of the server locally, in the Prometheus text format
+
+metrics_sv = MetricsServer(sv.get_registry(), '127.0.0.1', 9071)
+metrics_sv.start()
+
+# Capture the traffic of the server for replay.py if asked (python terminal_sv.py --capture <path>), sealing
+# the vaults with a key kept apart from the capture if given (--capture-key <path>, created if missing)
+
+if '--capture' in sys.argv:
+
+    key = load_capture_key(sys.argv[sys.argv.index('--capture-key') + 1]) if '--capture-key' in sys.argv else None
+
+    sv.start_capture(sys.argv[sys.argv.index('--capture') + 1], key)
+
 # Control terminal
 
 while True:
@@ -48,4 +102,14 @@ while True:
 
 # Close server
 
+sv.stop_capture()
+
+metrics_sv.stop()
+
+compactor.stop()
+
+print(compactor.get_stats())
+
+print(sv.get_ingest_stats())
+
 sv.close()
\ No newline at end of file
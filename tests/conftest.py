@@ -0,0 +1,22 @@
+import os, sys
+import pytest
+
+# The modules live at the root of the repository
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from setup import PATH_DV_VAULTS, PATH_SV_VAULTS, PATH_DV_KEYS
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''
+    Runs a test from an empty directory with the vault and key directories, as the scripts expect.
+    '''
+
+    monkeypatch.chdir(tmp_path)
+
+    for path in (PATH_DV_VAULTS, PATH_SV_VAULTS, PATH_DV_KEYS):
+
+        os.makedirs(path)
+
+    return tmp_path
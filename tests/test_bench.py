@@ -0,0 +1,19 @@
+from bench import cases, DEVICE_ID, RESET_DEVICE_ID
+from setup import provision
+from rng import Randomness
+from config_dv import thermo, assist
+
+def test_cases_leave_the_shared_controllers_unseeded(workdir):
+
+    provision(DEVICE_ID, Randomness(0))
+    provision(RESET_DEVICE_ID, Randomness(1))
+
+    benchmarks = cases()
+
+    assert 'Controller.decode[thermo]' in benchmarks
+
+    # The shared controllers still draw from the default source
+
+    for controller in (thermo, assist):
+
+        assert getattr(controller, '_Controller__rng') is None
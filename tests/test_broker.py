@@ -0,0 +1,151 @@
+from broker import Broker
+from ingest import IngestLanes
+from gateway import Uplink
+from handler import Handler
+from controller import Controller
+from metrics import MetricsRegistry
+from setup import provision
+from rng import Randomness
+from threading import Event, Thread
+import time
+
+def test_subscribers_get_the_readings_that_match_their_filters():
+
+    broker = Broker()
+
+    everything = broker.subscribe()
+    device = broker.subscribe(device_id = 1)
+    alarms = broker.subscribe(device_id = 1, state = 2)
+
+    assert broker.publish(1, 7, 0, [1, 0.5], 10.0) == 2
+    assert broker.publish(2, 7, 2, [2, 0.5], 11.0) == 1
+    assert broker.publish(1, 7, 2, [3, 0.5], 12.0) == 3
+
+    assert [everything.get(0)['time'] for _ in range(3)] == [10.0, 11.0, 12.0]
+    assert [device.get(0)['time'] for _ in range(2)] == [10.0, 12.0]
+    assert alarms.get(0)['sensors'] == (3, 0.5)
+
+    # Nothing else was delivered
+
+    assert everything.get(0) is None and device.get(0) is None and alarms.get(0) is None
+
+    broker.close()
+
+def test_unsubscribed_readers_stop_receiving_and_wake_up():
+
+    broker = Broker()
+
+    first = broker.subscribe(device_id = 1)
+    second = broker.subscribe(device_id = 1)
+
+    readings = []
+    reader = Thread(target=lambda: readings.extend(first))
+    reader.start()
+
+    broker.publish(1, 7, 0, [1, 0.5], 10.0)
+
+    broker.unsubscribe(first)
+    reader.join(5)
+
+    assert not reader.is_alive() and [entry['time'] for entry in readings] == [10.0]
+
+    # The other subscriber of the same filters keeps its readings
+
+    assert broker.publish(1, 7, 0, [2, 0.5], 11.0) == 1
+    assert [second.get(0)['time'] for _ in range(2)] == [10.0, 11.0]
+
+    broker.unsubscribe(second)
+
+    assert not broker.has_subscribers()
+    assert broker.publish(1, 7, 0, [3, 0.5], 12.0) == 0
+
+def test_a_full_subscription_drops_its_oldest_readings():
+
+    broker = Broker()
+
+    subscription = broker.subscribe(capacity = 3)
+
+    for i in range(5):
+
+        broker.publish(1, 7, 0, [i, 0.5], float(i))
+
+    # The publisher never waits, the slow subscriber loses the oldest readings
+
+    assert subscription.get_dropped() == 2
+    assert [subscription.get(0)['time'] for _ in range(3)] == [2.0, 3.0, 4.0]
+
+    broker.close()
+
+def test_alarms_are_delivered_before_they_are_written():
+
+    broker = Broker()
+    subscription = broker.subscribe(device_id = 1)
+
+    written, writing, release = [], Event(), Event()
+
+    def write(device_id, session_id, state, sensors, timestamp, lane):
+
+        writing.set()
+        release.wait(5)
+
+        written.append(timestamp)
+
+    lanes = IngestLanes(write, deliver = broker.publish)
+
+    # The writer holds the reading of another device, so the readings of the device stay queued
+
+    lanes.submit(2, 7, 0, [0, 0.5], 1.0)
+
+    assert writing.wait(5)
+
+    lanes.submit(1, 7, 0, [1, 0.5], 10.0)
+    lanes.submit(1, 7, 2, [2, 0.5], 11.0)
+
+    # The alarm is delivered at once, after the reading it promoted
+
+    assert [subscription.get(1)['time'] for _ in range(2)] == [10.0, 11.0]
+    assert written == []
+
+    release.set()
+
+    assert lanes.join(5)
+    assert written == [1.0, 10.0, 11.0]
+
+    # The promoted and alarm readings aren't delivered twice when written
+
+    assert subscription.get(0) is None
+
+    lanes.stop()
+
+def test_handler_delivers_alarms_to_the_subscribers(workdir):
+
+    provision(9, Randomness(0))
+
+    controller = Controller()
+    controller.create_int_sensor(-120, 120)
+    controller.create_float_sensor(0, 100, 0.01)
+
+    handler = Handler({1: {'auth': None, 'controller': controller}, 9: {'auth': None, 'controller': None, 'devices': {1}}}, 'localhost', 0, registry = MetricsRegistry())
+    Thread(target=handler.run_server, daemon=True).start()
+
+    time.sleep(0.05)
+
+    alarms = handler.subscribe(state = 2)
+    everything = handler.subscribe(device_id = 1)
+
+    uplink = Uplink(9, 'localhost', handler.get_port(), rng = Randomness(1))
+
+    uplink.add(1, 7, 0, controller.information_to_bytes(0, [1, 0.5]), 10.0)
+    uplink.add(1, 7, 2, controller.information_to_bytes(2, [2, 0.5]), 11.0)
+
+    assert uplink.flush() == 2
+    assert handler.flush(5)
+
+    assert alarms.get(1)['time'] == 11.0 and alarms.get(0) is None
+    assert [everything.get(1)['time'] for _ in range(2)] == [10.0, 11.0]
+
+    handler.unsubscribe(alarms)
+    handler.unsubscribe(everything)
+
+    uplink.close()
+    handler.close()
@@ -0,0 +1,84 @@
+from capture import CaptureWriter, read_capture, controller_to_bytes, controller_from_bytes, load_capture_key
+from config_dv import thermo, assist
+from controller import Controller
+from message import Message
+import os, pytest
+
+VAULT = bytes(range(64))
+
+def write(path, key = None):
+
+    capture = CaptureWriter(path, {1: (VAULT, thermo), 2: (VAULT[::-1], None)}, 5, key)
+    capture.record(0, 0, Message(1, 9, b'0', b'hello'))
+    capture.close()
+
+def test_vaults_are_left_out_without_a_key(tmp_path):
+
+    path = str(tmp_path / 'capture')
+
+    write(path)
+
+    devices, frames, seed = read_capture(path)
+
+    assert seed == 5 and devices[1][0] is None and devices[2][0] is None
+    assert VAULT not in open(path, 'rb').read()
+    assert frames[0][3].get_data() == b'hello'
+
+def test_vaults_are_sealed_with_the_key(tmp_path):
+
+    path = str(tmp_path / 'capture')
+    key = load_capture_key(str(tmp_path / 'key'))
+
+    write(path, key)
+
+    assert VAULT not in open(path, 'rb').read()
+
+    devices, _, _ = read_capture(path, key)
+
+    assert devices[1][0] == VAULT and devices[2][0] == VAULT[::-1]
+
+    # The key is needed, and only the right one unseals the vaults
+
+    with pytest.raises(ValueError):
+        read_capture(path)
+
+    with pytest.raises(ValueError):
+        read_capture(path, bytes(len(key)))
+
+def test_key_is_kept_and_private(tmp_path):
+
+    path = str(tmp_path / 'key')
+
+    key = load_capture_key(path)
+
+    assert load_capture_key(path) == key
+    assert os.stat(path).st_mode & 0o077 == 0
+
+    with pytest.raises(ValueError):
+        load_capture_key(str(tmp_path / 'missing'), False)
+
+def test_controllers_round_trip_as_specs():
+
+    compact = Controller(compact=True, delta=True)
+    compact.create_int_sensor(-120, 120)
+    compact.create_float_sensor(0, 100, 0.01)
+
+    for controller in (thermo, assist, compact):
+
+        copy = controller_from_bytes(controller_to_bytes(controller))
+
+        assert copy.get_sensors() == controller.get_sensors()
+        assert (copy.is_compact(), copy.is_delta()) == (controller.is_compact(), controller.is_delta())
+
+        data = controller.read_device_bytes(None)
+
+        assert copy.bytes_to_information(data) == controller.bytes_to_information(data)
+
+    assert controller_from_bytes(controller_to_bytes(None)) is None
+
+def test_malformed_specs_are_rejected():
+
+    for data in (b'\x80\x04', b'{"sensors": [{"type": "EXEC"}], "compact": false, "delta": false}', b'{}'):
+
+        with pytest.raises(ValueError):
+            controller_from_bytes(data)
@@ -0,0 +1,64 @@
+from cluster import Router
+from message import Message
+from metrics import MetricsRegistry
+from socket import socket, create_connection
+from threading import Thread
+import time
+
+def connect(router: Router) -> socket:
+    '''
+    Connects to the router, once its thread listens.
+    '''
+
+    for _ in range(100):
+
+        try:
+
+            return create_connection(('localhost', router.get_port()))
+
+        except ConnectionRefusedError:
+
+            time.sleep(0.02)
+
+    return create_connection(('localhost', router.get_port()))
+
+def test_router_holds_devices_until_released():
+
+    node = socket()
+    node.bind(('localhost', 0))
+    node.listen()
+    node.settimeout(0.3)
+
+    router = Router('localhost', 0, registry = MetricsRegistry())
+    router.set_node('node-1', 'localhost', node.getsockname()[1])
+    Thread(target=router.run, daemon=True).start()
+
+    router.hold({1})
+
+    client = connect(router)
+    Message(1, 0, b'0', b'hello').write_bytes(client)
+
+    # The held device isn't forwarded before the release
+
+    try:
+
+        node.accept()
+        forwarded = True
+
+    except TimeoutError:
+
+        forwarded = False
+
+    assert not forwarded
+
+    router.release()
+
+    upstream, _ = node.accept()
+    upstream.settimeout(2)
+
+    assert Message.read_bytes(upstream).get_data() == b'hello'
+
+    upstream.close()
+    client.close()
+    router.close()
+    node.close()
@@ -0,0 +1,99 @@
+from controller import Controller
+from rng import Randomness
+import pytest
+
+def make_controller(compact: bool = False) -> Controller:
+
+    controller = Controller(compact = compact)
+    controller.create_int_sensor(-120, 120)
+    controller.create_float_sensor(0, 100, 0.01)
+    controller.create_str_sensor(10)
+    controller.create_bool_sensor()
+
+    return controller
+
+def test_failed_sensors_round_trip():
+
+    controller = make_controller()
+
+    readings = [None, 12.5, None, True]
+
+    assert controller.bytes_to_information(controller.information_to_bytes(3, readings)) == (3, readings)
+
+def test_failure_differs_from_default_value():
+
+    controller = make_controller()
+
+    assert controller.bytes_to_information(controller.information_to_bytes(0, [0, 0.0, '', False])) == (0, [0, 0.0, '', False])
+    assert controller.bytes_to_information(controller.information_to_bytes(0, [None] * 4)) == (0, [None] * 4)
+
+def test_failure_bitmap_spans_bytes():
+
+    controller = Controller()
+
+    for _ in range(11):
+
+        controller.create_int_sensor(0, 10)
+
+    readings = [None if i in (0, 8, 10) else i for i in range(11)]
+
+    assert controller.get_failed_size() == 2
+    assert controller.bytes_to_information(controller.information_to_bytes(1, readings)) == (1, readings)
+
+def test_records_keep_failures():
+
+    controller = make_controller()
+
+    data = controller.information_to_bytes(0, [5, None, 'abc', False]) + controller.information_to_bytes(2, [None, 1.5, None, True])
+
+    assert controller.records_to_information(controller.bytes_to_records(data)) == [(0, [5, None, 'abc', False]), (2, [None, 1.5, None, True])]
+
+def test_compact_failed_sensors_round_trip():
+
+    controller = make_controller(compact = True)
+
+    for readings in ([None, 12.5, None, True], [-120, None, 'abc', None], [None] * 4, [-120, 0.0, '', False]):
+
+        assert controller.compact_to_information(controller.information_to_compact(2, readings)) == (2, readings)
+
+def test_compact_failure_is_distinct_from_lower_bound():
+
+    controller = make_controller(compact = True)
+
+    # The lower bound was the value a failed sensor used to be sent as
+
+    assert controller.information_to_compact(0, [None, 0.0, '', False]) != controller.information_to_compact(0, [-120, 0.0, '', False])
+
+def test_bulk_decode_matches_single_decode():
+
+    for compact in (False, True):
+
+        controller = make_controller(compact)
+        controller.set_rng(Randomness(7))
+
+        readings = []
+
+        for _ in range(64):
+
+            controller.change_state()
+
+            readings.append(controller.read_device_bytes(controller.gen_fail_list()))
+
+        expected = [controller.bytes_to_information(data) for data in readings]
+
+        assert any(None in sensors for _, sensors in expected)
+
+        # The records hold the floats in single precision, as the fixed width readings do
+
+        for (state, sensors), (expected_state, expected_sensors) in zip(controller.records_to_information(controller.bytes_to_records(b''.join(readings))), expected):
+
+            assert state == expected_state
+            assert sensors == [pytest.approx(sensor, rel = 1e-6) if isinstance(sensor, float) else sensor for sensor in expected_sensors]
+
+def test_bulk_decode_rejects_partial_compact_readings():
+
+    controller = make_controller(compact = True)
+
+    with pytest.raises(ValueError):
+
+        controller.bytes_to_records(controller.information_to_compact(0, [1, 2.0, 'a', True]) + b'\x00')
@@ -0,0 +1,98 @@
+import pytest
+from database import Database
+from controller import Controller
+
+def make_database() -> Database:
+
+    controller = Controller()
+    controller.create_int_sensor(0, 100)
+    controller.create_str_sensor(4)
+
+    database = Database()
+    database.register_device(1, controller)
+
+    return database, controller
+
+def test_failed_readings_are_kept_as_none():
+
+    database, controller = make_database()
+
+    database.add(1, 7, 0, [None, 'ab'], 1.0)
+    database.add_records(1, controller.bytes_to_records(controller.information_to_bytes(0, [3, None])), 7, 2.0)
+
+    assert [entry['sensors'] for entry in database.rows(1)] == [[None, 'ab'], [3, None]]
+
+def test_aggregate_leaves_failed_readings_out():
+
+    database, _ = make_database()
+
+    database.add(1, 7, 0, [10, 'a'], 1.0)
+    database.add(1, 7, 0, [None, None], 2.0)
+    database.add(1, 7, 0, [20, 'b'], 3.0)
+    database.add(1, 7, 0, [None, None], 11.0)
+
+    first, second = database.aggregate(1, 0.0, 20.0, 10.0)
+
+    assert first['count'] == 3
+    assert first['sensors'][0] == {'min': 10, 'max': 20, 'mean': 15.0, 'last': 20, 'count': 2}
+    assert first['sensors'][1] == {'last': 'b'}
+
+    assert second['sensors'][0] == {'min': None, 'max': None, 'mean': None, 'last': None, 'count': 0}
+    assert second['sensors'][1] == {'last': None}
+
+def test_time_range_with_readings_out_of_order():
+
+    database, controller = make_database()
+
+    times = [5.0, 1.0, 3.0, 9.0, 2.0, 7.0]
+
+    for i, timestamp in enumerate(times):
+
+        database.add(1, 7 + i % 2, 0, [i, 'x'], timestamp)
+
+    # A batch whose clock is behind the others
+
+    data = controller.information_to_bytes(0, [10, 'y']) * 2
+
+    database.add_records(1, controller.bytes_to_records(data), 9, 4.0)
+
+    assert [entry['time'] for entry in database.query(1, 2.0, 7.0)] == [2.0, 3.0, 4.0, 4.0, 5.0]
+    assert [entry['time'] for entry in database.query(1, 2.0, 7.0, 7)] == [2.0, 3.0, 5.0]
+    assert [entry['time'] for entry in database.query(1)] == sorted(times + [4.0, 4.0])
+
+def test_time_range_with_many_runs():
+
+    database, _ = make_database()
+
+    for i in range(200):
+
+        database.add(1, 7, 0, [i % 100, 'x'], float((i * 37) % 101))
+
+    expected = sorted(float((i * 37) % 101) for i in range(200) if 10 <= (i * 37) % 101 < 50)
+
+    assert [entry['time'] for entry in database.query(1, 10.0, 50.0)] == expected
+
+def test_aggregate_with_readings_out_of_order():
+
+    database, _ = make_database()
+
+    for value, timestamp in [(1, 12.0), (2, 1.0), (3, 11.0), (4, 2.0)]:
+
+        database.add(1, 7, 0, [value, str(value)], timestamp)
+
+    first, second = database.aggregate(1, 0.0, 20.0, 10.0)
+
+    assert (first['start'], first['count'], first['sensors'][0]['mean'], first['sensors'][0]['last'], first['sensors'][1]['last']) == (0.0, 2, 3.0, 4, '4')
+    assert (second['start'], second['count'], second['sensors'][0]['mean'], second['sensors'][0]['last'], second['sensors'][1]['last']) == (10.0, 2, 2.0, 1, '1')
+
+def test_aggregate_rejects_non_positive_windows():
+
+    database, _ = make_database()
+
+    database.add(1, 7, 0, [1, 'a'], 1.0)
+
+    for window in (0, -1.0):
+
+        with pytest.raises(ValueError):
+
+            database.aggregate(1, window = window)
@@ -0,0 +1,122 @@
+from delta import DeltaCodec, KEYFRAME, DELTA
+from device import Device
+from handler import Handler
+from controller import Controller
+from metrics import MetricsRegistry
+from setup import provision
+from rng import Randomness
+from threading import Thread
+from copy import deepcopy
+import time
+import pytest
+
+def test_delta_frames_round_trip():
+
+    encoder, decoder = DeltaCodec(), DeltaCodec()
+
+    readings = [bytes(16), bytes(15) + b'\x01', b'\x02' + bytes(14) + b'\x01', bytes(range(16))]
+
+    frames = [encoder.encode(reading) for reading in readings]
+
+    # The first reading is a keyframe, the small changes are deltas and the whole change is a keyframe again
+
+    assert [frame[0] for frame in frames] == [KEYFRAME, DELTA, DELTA, KEYFRAME]
+    assert len(frames[1]) == 1 + 2 + 1
+
+    assert [decoder.decode(frame) for frame in frames] == readings
+
+def test_delta_reset_starts_with_a_keyframe():
+
+    encoder, decoder = DeltaCodec(), DeltaCodec()
+
+    decoder.decode(encoder.encode(bytes(16)))
+
+    # A new session resets both sides, so the stream starts again from a keyframe
+
+    encoder.reset()
+    decoder.reset()
+
+    frame = encoder.encode(bytes(15) + b'\x01')
+
+    assert frame[0] == KEYFRAME
+    assert decoder.decode(frame) == bytes(15) + b'\x01'
+
+    # A delta without its keyframe can't be decoded
+
+    encoder.encode(bytes(16))
+
+    decoder.reset()
+
+    with pytest.raises(ValueError):
+        decoder.decode(encoder.encode(bytes(15) + b'\x02'))
+
+def test_delta_frames_that_dont_match_are_rejected():
+
+    encoder, decoder = DeltaCodec(), DeltaCodec()
+
+    decoder.decode(encoder.encode(bytes(16)))
+
+    frame = encoder.encode(bytes(15) + b'\x01')
+
+    for bad in (b'', frame[:2], frame[:-1], frame + b'\x00'):
+
+        with pytest.raises(ValueError):
+            decoder.decode(bad)
+
+def test_delta_readings_are_stored_whole_across_sessions(workdir):
+
+    provision(1, Randomness(0))
+
+    controller = Controller(delta = True)
+    controller.create_int_sensor(-120, 120)
+    controller.create_float_sensor(0, 100, 0.01)
+    controller.create_bool_sensor()
+
+    handler = Handler({1: {'auth': None, 'controller': controller}}, 'localhost', 0, registry = MetricsRegistry())
+    Thread(target=handler.run_server, daemon=True).start()
+
+    for _ in range(100):
+
+        try:
+
+            device = Device('localhost', handler.get_port(), 1, controller, Randomness(1), interval = 0.01)
+            break
+
+        except ConnectionRefusedError:
+
+            time.sleep(0.02)
+
+    thread = Thread(target=device.run, daemon=True)
+    thread.start()
+
+    # Two sessions (of TIME_TO_LIVE messages) have passed, so the codecs were reset in between
+
+    for _ in range(250):
+
+        handler.flush(1)
+
+        if len(list(handler.rows(1))) >= 12:
+            break
+
+        time.sleep(0.02)
+
+    device.close()
+    thread.join(5)
+    handler.flush(5)
+
+    rows = list(handler.rows(1))
+
+    assert len(rows) >= 12
+
+    # The readings are drawn from the stream the device derives, so they can be generated again
+
+    expected = deepcopy(controller)
+    expected.set_rng(Randomness(1).derive(1, 'sensors'))
+
+    for row in rows:
+
+        expected.change_state()
+
+        assert (row['state'], row['sensors']) == controller.bytes_to_information(expected.read_device_bytes(None))
+
+    handler.close()
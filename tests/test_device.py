@@ -0,0 +1,151 @@
+from device import Device
+from handler import Handler
+from metrics import MetricsRegistry
+from config_dv import thermo
+from setup import provision
+from rng import Randomness
+from threading import Thread
+from copy import deepcopy
+import time
+
+SEAL_KEY = bytes(range(32))
+
+def serve(port: int = 0) -> Handler:
+
+    handler = Handler({1: {'auth': None, 'controller': thermo}}, 'localhost', port, registry = MetricsRegistry())
+    Thread(target=handler.run_server, daemon=True).start()
+
+    return handler
+
+def start(handler: Handler, reconnect_delay: float, interval: float = 0.05) -> tuple:
+    '''
+    Starts a device once the server thread listens.
+    '''
+
+    for _ in range(100):
+
+        try:
+
+            device = Device('localhost', handler.get_port(), 1, thermo, Randomness(1), interval = interval, reconnect_delay = reconnect_delay)
+            break
+
+        except ConnectionRefusedError:
+
+            time.sleep(0.02)
+
+    thread = Thread(target=device.run, daemon=True)
+    thread.start()
+
+    return device, thread
+
+def wait_rows(handler: Handler, count: int) -> int:
+
+    for _ in range(250):
+
+        handler.flush(1)
+
+        rows = len(list(handler.rows(1)))
+
+        if rows >= count:
+            return rows
+
+        time.sleep(0.02)
+
+    return len(list(handler.rows(1)))
+
+def handshakes(handler: Handler) -> int:
+
+    return sum(handler.get_registry().counter('iot_handshakes_completed_total', '').collect().values())
+
+def test_device_resumes_its_session_after_a_hand_off(workdir):
+
+    provision(1, Randomness(0))
+
+    handler = serve()
+
+    device, thread = start(handler, 0.01)
+
+    assert wait_rows(handler, 2) >= 2
+
+    # The session is handed off, closing the connection, and handed back as another node would take it
+
+    handler.import_sessions(handler.export_sessions(SEAL_KEY, {1}), SEAL_KEY)
+
+    rows = wait_rows(handler, 4)
+
+    device.close()
+    thread.join(5)
+
+    assert rows >= 4 and not thread.is_alive()
+    assert handshakes(handler) == 1
+
+    handler.close()
+
+def test_device_reconnects_to_a_restarted_server(workdir):
+
+    provision(1, Randomness(0))
+
+    handler = serve()
+    port = handler.get_port()
+
+    device, thread = start(handler, 0.05)
+
+    assert wait_rows(handler, 2) >= 2
+
+    handler.close()
+
+    # The new server doesn't know the session, so the device authenticates again
+
+    restarted = serve(port)
+
+    assert wait_rows(restarted, 2) >= 2
+    assert handshakes(restarted) == 1
+
+    device.close()
+    thread.join(5)
+
+    assert not thread.is_alive()
+
+    restarted.close()
+
+def test_no_reading_is_lost_when_a_server_restarts(workdir):
+
+    provision(1, Randomness(0))
+
+    handler = serve()
+    port = handler.get_port()
+
+    # The server is restarted while the device waits between the readings
+
+    device, thread = start(handler, 0.05, 0.3)
+
+    assert wait_rows(handler, 2) >= 2
+
+    handler.close()
+
+    rows = list(handler.rows(1))
+
+    restarted = serve(port)
+
+    assert wait_rows(restarted, 3) >= 3
+
+    device.close()
+    thread.join(5)
+    restarted.flush(5)
+
+    rows += list(restarted.rows(1))
+
+    # The readings are drawn from the stream the device derives, none of them is missing
+
+    expected = deepcopy(thermo)
+    expected.set_rng(Randomness(1).derive(1, 'sensors'))
+
+    for row in rows:
+
+        expected.change_state()
+
+        assert (row['state'], row['sensors']) == thermo.bytes_to_information(expected.read_device_bytes(None))
+
+    assert handshakes(restarted) == 1
+
+    restarted.close()
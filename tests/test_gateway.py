@@ -0,0 +1,247 @@
+from gateway import Uplink
+from handler import Handler
+from controller import Controller
+from message import Message, batch_to_bytes, bytes_to_batch, BATCH_REJECTED
+from metrics import MetricsRegistry
+from setup import provision
+from rng import Randomness
+from socket import socket, create_connection, SHUT_RDWR
+from threading import Event, Thread
+import time
+
+GATEWAY_ID = 9
+
+def make_thermo() -> Controller:
+
+    controller = Controller()
+    controller.create_int_sensor(-120, 120)
+    controller.create_float_sensor(0, 100, 0.01)
+
+    return controller
+
+def make_compact() -> Controller:
+
+    controller = Controller(compact = True)
+    controller.create_int_sensor(-120, 120)
+    controller.create_bool_sensor()
+
+    return controller
+
+def serve(devices: dict) -> Handler:
+
+    devices[GATEWAY_ID] = {'auth': None, 'controller': None, 'devices': {1, 2}}
+
+    return Handler(devices, 'localhost', 0, registry = MetricsRegistry())
+
+def start(handler: Handler) -> None:
+
+    Thread(target=handler.run_server, daemon=True).start()
+
+    # Wait for the server thread to listen
+
+    time.sleep(0.05)
+
+def test_batches_carry_the_time_of_each_reading():
+
+    groups = [(1, 7, [1.0, 2.5], b'abcdef'), (2, 8, [], b'')]
+
+    assert bytes_to_batch(batch_to_bytes(groups)) == groups
+
+def test_uplink_stores_each_reading_with_its_time(workdir):
+
+    provision(GATEWAY_ID, Randomness(0))
+
+    thermo, compact = make_thermo(), make_compact()
+    handler = serve({1: {'auth': None, 'controller': thermo}, 2: {'auth': None, 'controller': compact}})
+    start(handler)
+
+    uplink = Uplink(GATEWAY_ID, 'localhost', handler.get_port(), rng = Randomness(1))
+
+    uplink.add(1, 7, 0, thermo.information_to_bytes(0, [1, 0.5]), 10.0)
+    uplink.add(1, 7, 2, thermo.information_to_bytes(2, [2, 1.5]), 11.0)
+    uplink.add(2, 3, 0, compact.information_to_compact(0, [-120, True]), 12.0)
+
+    assert uplink.flush() == 3
+    assert handler.flush(5)
+
+    assert [(entry['state'], entry['time']) for entry in handler.rows(1)] == [(0, 10.0), (2, 11.0)]
+    assert [(entry['sensors'], entry['time']) for entry in handler.rows(2)] == [([-120, True], 12.0)]
+
+    # The alarm went through the alarm lane (with the reading it promoted, if still queued)
+
+    assert handler.get_ingest_stats()['alarm']['count'] >= 1
+
+    uplink.close()
+    handler.close()
+
+def test_uplink_readings_of_devices_not_registered_to_the_gateway_are_rejected(workdir):
+
+    provision(GATEWAY_ID, Randomness(0))
+
+    thermo = make_thermo()
+    handler = serve({1: {'auth': None, 'controller': thermo}, 3: {'auth': None, 'controller': thermo}})
+    start(handler)
+
+    uplink = Uplink(GATEWAY_ID, 'localhost', handler.get_port(), rng = Randomness(1))
+
+    uplink.add(1, 7, 0, thermo.information_to_bytes(0, [1, 0.5]), 10.0)
+    uplink.add(3, 7, 0, thermo.information_to_bytes(0, [1, 0.5]), 10.0)
+
+    assert uplink.flush() == 0
+
+    # The rejection is acknowledged, so the session goes on
+
+    uplink.add(1, 7, 0, thermo.information_to_bytes(0, [2, 0.5]), 11.0)
+
+    assert uplink.flush() == 1
+    assert handler.flush(5)
+
+    stats = uplink.get_stats()
+
+    assert stats['rejected'] == 2 and stats['handshakes'] == 1 and stats['errors'] == 0
+    assert [entry['time'] for entry in handler.rows(1)] == [11.0]
+    assert list(handler.rows(3)) == []
+
+    uplink.close()
+    handler.close()
+
+def test_uplink_queues_a_batch_again_until_the_server_is_up(workdir):
+
+    provision(GATEWAY_ID, Randomness(0))
+
+    thermo = make_thermo()
+    handler = serve({1: {'auth': None, 'controller': thermo}})
+
+    uplink = Uplink(GATEWAY_ID, 'localhost', handler.get_port(), rng = Randomness(1))
+
+    uplink.add(1, 7, 0, thermo.information_to_bytes(0, [1, 0.5]), 10.0)
+
+    # The server doesn't listen yet
+
+    assert uplink.flush() == 0
+    assert uplink.get_stats()['pending'] == 1
+
+    uplink.add(1, 7, 0, thermo.information_to_bytes(0, [2, 0.5]), 11.0)
+
+    start(handler)
+
+    assert uplink.flush() == 2
+    assert handler.flush(5)
+
+    assert [entry['time'] for entry in handler.rows(1)] == [10.0, 11.0]
+    assert uplink.get_stats()['pending'] == 0
+
+    uplink.close()
+    handler.close()
+
+def forge_rejections(port: int, forging: Event) -> int:
+    '''
+    Relays the connections to a server, turning its batch acknowledgements into rejections while forging is set.
+    '''
+
+    proxy = socket()
+    proxy.bind(('localhost', 0))
+    proxy.listen()
+
+    def copy(source: socket, destination: socket) -> None:
+
+        try:
+
+            while data := source.recv(4096):
+
+                destination.sendall(data)
+
+        except OSError:
+
+            pass
+
+        try:
+
+            destination.shutdown(SHUT_RDWR)
+
+        except OSError:
+
+            pass
+
+    def relay(client: socket) -> None:
+
+        upstream = create_connection(('localhost', port))
+
+        Thread(target=copy, args=(client, upstream), daemon=True).start()
+
+        try:
+
+            while True:
+
+                msg = Message.read_bytes(upstream)
+
+                if msg.get_type() == b'3' and forging.is_set():
+
+                    msg = Message(msg.get_deviceId(), msg.get_sessionId(), b'3', BATCH_REJECTED + msg.get_data()[1:])
+
+                msg.write_bytes(client)
+
+        except Exception:
+
+            for connection in (client, upstream):
+
+                try:
+
+                    connection.shutdown(SHUT_RDWR)
+
+                except OSError:
+
+                    pass
+
+    def accept() -> None:
+
+        while True:
+
+            Thread(target=relay, args=(proxy.accept()[0],), daemon=True).start()
+
+    Thread(target=accept, daemon=True).start()
+
+    return proxy.getsockname()[1]
+
+def test_uplink_keeps_a_batch_whose_rejection_is_forged(workdir):
+
+    provision(GATEWAY_ID, Randomness(0))
+
+    thermo = make_thermo()
+    handler = serve({1: {'auth': None, 'controller': thermo}})
+    start(handler)
+
+    forging = Event()
+    forging.set()
+
+    uplink = Uplink(GATEWAY_ID, 'localhost', forge_rejections(handler.get_port(), forging), rng = Randomness(1))
+
+    uplink.add(1, 7, 0, thermo.information_to_bytes(0, [1, 0.5]), 10.0)
+
+    # The forged rejection isn't tagged with the session key, so the batch is queued again instead of dropped
+
+    assert uplink.flush() == 0
+
+    stats = uplink.get_stats()
+
+    assert stats['rejected'] == 0 and stats['errors'] == 1 and stats['pending'] == 1
+
+    forging.clear()
+
+    # The server abandons the session of the dropped connection before the gateway authenticates again
+
+    for _ in range(250):
+
+        if 'iot_sessions_active 0' in handler.get_registry().render().splitlines():
+            break
+
+        time.sleep(0.02)
+
+    assert uplink.flush() == 1
+    assert handler.flush(5)
+
+    assert 10.0 in [entry['time'] for entry in handler.rows(1)]
+    assert uplink.get_stats()['pending'] == 0
+
+    uplink.close()
+    handler.close()
@@ -0,0 +1,126 @@
+from handler import Handler
+from controller import Controller
+from metrics import MetricsRegistry
+from storage import SegmentStore, DeviceSegments
+from ringbuffer import HotTier
+from threading import Event, Thread
+
+def make_handler(devices: dict, **kwargs) -> Handler:
+
+    return Handler(devices, 'localhost', 0, registry = MetricsRegistry(), **kwargs)
+
+def test_load_readings_decodes_compact_readings():
+
+    controller = Controller(compact = True)
+    controller.create_int_sensor(-120, 120)
+    controller.create_bool_sensor()
+
+    handler = make_handler({1: {'auth': None, 'controller': controller}})
+
+    data = controller.information_to_compact(2, [-120, None]) + controller.information_to_compact(0, [None, True])
+
+    assert handler.load_readings(1, 7, data, 5.0) == 2
+    assert [(entry['state'], entry['sensors']) for entry in handler.rows(1)] == [(2, [-120, None]), (0, [None, True])]
+
+    handler.close()
+
+def make_thermo() -> Controller:
+
+    controller = Controller()
+    controller.create_int_sensor(-120, 120)
+    controller.create_float_sensor(0, 100, 0.01)
+
+    return controller
+
+def test_stored_readings_are_read_from_the_segments(tmp_path):
+
+    controller = make_thermo()
+
+    store = SegmentStore(str(tmp_path), sync_interval = 60)
+    handler = make_handler({1: {'auth': None, 'controller': controller}}, storage = store)
+
+    handler.load_readings(1, 7, controller.information_to_bytes(0, [1, 0.5]) * 3, 10.0)
+    handler.load_readings(1, 8, controller.information_to_bytes(2, [None, 1.5]), 20.0)
+    handler.close()
+
+    # A new run serves the readings of the previous one without loading them
+
+    store = SegmentStore(str(tmp_path), sync_interval = 60)
+    handler = make_handler({1: {'auth': None, 'controller': controller}}, storage = store)
+
+    handler.load_readings(1, 9, controller.information_to_bytes(1, [3, 2.5]), 5.0)
+
+    assert [(entry['session_id'], entry['time']) for entry in handler.query(1)] == [(9, 5.0), (7, 10.0), (7, 10.0), (7, 10.0), (8, 20.0)]
+    assert [entry['sensors'] for entry in handler.query(1, 15.0, 30.0)] == [[None, 1.5]]
+    assert [entry['session_id'] for entry in handler.query(1, session_id = 7)] == [7, 7, 7]
+    assert [entry['session_id'] for entry in handler.last_readings(1, 2)] == [8, 9]
+
+    window, = handler.aggregate(1, 0.0, 30.0)
+
+    assert window['count'] == 5 and window['sensors'][0]['mean'] == 1.5
+
+    handler.close()
+
+def test_readings_evicted_from_the_hot_tier_are_still_served(tmp_path):
+
+    controller = make_thermo()
+
+    for store in (None, SegmentStore(str(tmp_path), sync_interval = 60)):
+
+        hot = HotTier(1 << 20, capacity = 4)
+        handler = make_handler({1: {'auth': None, 'controller': controller}}, storage = store, hot = hot)
+
+        for i in range(10):
+
+            handler.load_readings(1, 7, controller.information_to_bytes(0, [i, 0.5]), float(i))
+
+        assert [entry['time'] for entry in handler.query(1)] == [float(i) for i in range(10)]
+        assert [entry['time'] for entry in handler.last_readings(1, 10)] == [float(i) for i in range(6, 10)]
+        assert handler.aggregate(1)[0]['count'] == 10
+
+        handler.close()
+
+def test_a_long_stored_query_doesnt_block_the_writers(tmp_path, monkeypatch):
+
+    controller = make_thermo()
+
+    store = SegmentStore(str(tmp_path), segment_records = 4, sync_interval = 60)
+    handler = make_handler({1: {'auth': None, 'controller': controller}}, storage = store)
+
+    for i in range(6):
+
+        handler.load_readings(1, 7, controller.information_to_bytes(0, [i, 0.5]), float(i))
+
+    # Hold the query in the middle of reading the segments
+
+    reading, release = Event(), Event()
+    read = DeviceSegments.read
+
+    def slow_read(self, *args, **kwargs):
+
+        reading.set()
+        release.wait(5)
+
+        return read(self, *args, **kwargs)
+
+    monkeypatch.setattr(DeviceSegments, 'read', slow_read)
+
+    query = Thread(target=lambda: rows.extend(handler.rows(1)))
+    rows = []
+    query.start()
+
+    assert reading.wait(5)
+
+    writer = Thread(target=handler.load_readings, args=(1, 7, controller.information_to_bytes(0, [6, 0.5]), 6.0))
+    writer.start()
+    writer.join(1)
+
+    writing = writer.is_alive()
+
+    release.set()
+    query.join(5)
+
+    assert not writing
+    assert [row['time'] for row in rows] == [float(i) for i in range(6)]
+
+    handler.close()
@@ -0,0 +1,112 @@
+from handshake import DeviceHandshake, run_handshake, run_handshake_async
+from authenticator import Authenticator, InvalidCommParameters, KEY_LENGTH
+from challenge import Challenge, CHALLENGE_SIZE
+from crypto import decrypt
+from handler import Handler
+from metrics import MetricsRegistry
+from runtime import DeviceRuntime
+from config_dv import thermo
+from setup import provision
+from rng import Randomness
+from threading import Thread
+import asyncio, copy, pytest
+
+class MemoryServer:
+    '''
+    The server side of the handshake, in memory, as the Handler runs it.
+    '''
+
+    def __init__(self):
+
+        self.auth = None
+        self.replies = []
+
+    def write(self, msg):
+
+        if self.auth is None:
+
+            self.auth = Authenticator(msg.get_deviceId(), False, msg.get_sessionId(), Randomness(1))
+
+            sync = self.auth.sync_response(msg.get_data())
+
+            self.key, self.challenge = self.auth.generate_challenge(False)
+
+            self.replies.append(self.auth.handshake(False, challenge = self.challenge, sync = sync))
+
+        else:
+
+            data = decrypt(msg.get_data(), self.key)
+
+            assert self.challenge.verify(data[0:CHALLENGE_SIZE])
+
+            t1 = data[CHALLENGE_SIZE:CHALLENGE_SIZE + KEY_LENGTH]
+            solving = Challenge.from_bytes(data[CHALLENGE_SIZE + KEY_LENGTH:])
+
+            self.replies.append(self.auth.handshake(True, self.auth.solve_challenge(solving, t1), solving.get_chal()))
+
+            self.auth.feed_key(t1)
+
+    def read(self):
+
+        return self.replies.pop(0)
+
+def test_handshake_agrees_on_the_session_key(workdir):
+
+    provision(1, Randomness(0))
+
+    device = Authenticator(1, True, rng = Randomness(2))
+    server = MemoryServer()
+
+    run_handshake(device, server.write, server.read)
+
+    assert server.auth.decrypt(device.encrypt(b'reading')) == b'reading'
+
+def test_async_handshake_agrees_on_the_session_key(workdir):
+
+    provision(1, Randomness(0))
+
+    device = Authenticator(1, True, rng = Randomness(2))
+    server = MemoryServer()
+
+    async def read():
+
+        return server.read()
+
+    asyncio.run(run_handshake_async(device, server.write, read))
+
+    assert server.auth.decrypt(device.encrypt(b'reading')) == b'reading'
+
+def test_handshake_rejects_an_answer_out_of_order(workdir):
+
+    provision(1, Randomness(0))
+
+    handshake = DeviceHandshake(Authenticator(1, True, rng = Randomness(2)))
+
+    with pytest.raises(InvalidCommParameters):
+        handshake.finish(handshake.start())
+
+def test_runtime_devices_authenticate_with_the_server(workdir):
+
+    for device_id in (1, 2, 3):
+
+        provision(device_id, Randomness(device_id))
+
+    handler = Handler({device_id: {'auth': None, 'controller': thermo} for device_id in (1, 2, 3)}, 'localhost', 0, registry = MetricsRegistry())
+    Thread(target=handler.run_server, daemon=True).start()
+
+    runtime = DeviceRuntime('localhost', handler.get_port(), 0.05, 0.1, 0.005, Randomness(4))
+
+    for device_id in (1, 2, 3):
+
+        runtime.add(device_id, copy.deepcopy(thermo))
+
+    asyncio.run(runtime.run(0.5))
+
+    stats = runtime.get_stats()
+
+    assert stats['errors'] == 0 and stats['sent'] > 0 and stats['handshakes'] >= 3
+
+    assert handler.flush(5)
+    assert len(list(handler.rows())) == stats['sent']
+
+    handler.close()
@@ -0,0 +1,163 @@
+from ingest import IngestLanes
+from threading import Event, Thread
+
+def test_promoted_readings_are_delivered_before_the_alarm():
+
+    release = Event()
+    taken = Event()
+    written = []
+    delivered = []
+
+    def write(device_id, session_id, state, sensors, timestamp, lane):
+
+        taken.set()
+        release.wait()
+
+        written.append((timestamp, lane))
+
+        # The writer delivers the routine readings, as the handler does
+
+        if lane != 'alarm':
+
+            delivered.append(timestamp)
+
+    lanes = IngestLanes(write, deliver = lambda device_id, session_id, state, sensors, timestamp: delivered.append(timestamp))
+
+    # The writer holds the first reading while the others queue
+
+    lanes.submit(1, 7, 0, [], 1.0)
+
+    assert taken.wait(5)
+
+    for timestamp in (2.0, 3.0):
+
+        lanes.submit(1, 7, 0, [], timestamp)
+
+    lanes.submit(2, 7, 0, [], 4.0)
+
+    # The alarm waits for the reading of its device being written
+
+    alarm = Thread(target=lanes.submit, args=(1, 7, 2, [], 5.0))
+    alarm.start()
+    alarm.join(0.1)
+
+    assert alarm.is_alive() and delivered == []
+
+    release.set()
+    alarm.join(5)
+
+    assert lanes.join(5)
+
+    # The readings of the device are delivered and written in order, whichever lane they took
+
+    assert [timestamp for timestamp in delivered if timestamp != 4.0] == [1.0, 2.0, 3.0, 5.0]
+    assert [timestamp for timestamp, lane in written if timestamp != 4.0] == [1.0, 2.0, 3.0, 5.0]
+    assert sorted(delivered) == [1.0, 2.0, 3.0, 4.0, 5.0]
+
+    lanes.stop()
+
+def test_queued_readings_are_promoted_with_the_alarm():
+
+    release = Event()
+    taken = Event()
+    written = []
+    delivered = []
+
+    def write(device_id, session_id, state, sensors, timestamp, lane):
+
+        taken.set()
+        release.wait()
+
+        written.append((timestamp, lane))
+
+    lanes = IngestLanes(write, deliver = lambda device_id, session_id, state, sensors, timestamp: delivered.append(timestamp))
+
+    # The writer holds a reading of another device while the readings queue
+
+    lanes.submit(2, 7, 0, [], 1.0)
+
+    assert taken.wait(5)
+
+    lanes.submit(1, 7, 0, [], 2.0)
+    lanes.submit(2, 7, 0, [], 3.0)
+    lanes.submit(1, 7, 0, [], 4.0)
+    lanes.submit(1, 7, 2, [], 5.0)
+
+    assert delivered == [2.0, 4.0, 5.0]
+
+    release.set()
+
+    assert lanes.join(5)
+
+    assert written == [(1.0, 'bulk'), (2.0, 'alarm'), (4.0, 'alarm'), (5.0, 'alarm'), (3.0, 'bulk')]
+
+    lanes.stop()
+
+def test_alarms_of_other_devices_dont_wait():
+
+    release = Event()
+    taken = Event()
+
+    def write(*reading):
+
+        taken.set()
+        release.wait()
+
+    delivered = []
+
+    lanes = IngestLanes(write, deliver = lambda *reading: delivered.append(reading[0]))
+
+    lanes.submit(1, 7, 0, [], 1.0)
+
+    assert taken.wait(5)
+
+    lanes.submit(2, 7, 3, [], 2.0)
+
+    assert delivered == [2]
+
+    release.set()
+    lanes.stop()
+
+def test_promoted_readings_leave_the_bulk_lane():
+
+    release = Event()
+    taken = Event()
+    written = []
+
+    def write(device_id, session_id, state, sensors, timestamp, lane):
+
+        taken.set()
+        release.wait()
+
+        written.append((device_id, timestamp, lane))
+
+    lanes = IngestLanes(write, bulk_capacity = 4)
+
+    lanes.submit(9, 7, 0, [], 0.0)
+
+    assert taken.wait(5)
+
+    # Fill the bulk lane with the readings of two devices
+
+    for timestamp in (1.0, 2.0):
+
+        lanes.submit(1, 7, 0, [], timestamp)
+        lanes.submit(2, 7, 0, [], timestamp)
+
+    # The alarm takes only the readings of its device, which frees their room in the bulk lane
+
+    lanes.submit(1, 7, 3, [], 3.0)
+
+    assert lanes.get_depths() == {'alarm': 3, 'bulk': 2}
+
+    lanes.submit(2, 7, 0, [], 4.0)
+    lanes.submit(2, 7, 0, [], 5.0)
+
+    release.set()
+
+    assert lanes.join(5)
+
+    assert written == [(9, 0.0, 'bulk'), (1, 1.0, 'alarm'), (1, 2.0, 'alarm'), (1, 3.0, 'alarm'), (2, 1.0, 'bulk'), (2, 2.0, 'bulk'), (2, 4.0, 'bulk'), (2, 5.0, 'bulk')]
+    assert lanes.get_depths() == {'alarm': 0, 'bulk': 0}
+
+    lanes.stop()
@@ -0,0 +1,108 @@
+from instrument import Histogram, Counter, PhaseTimer, NULL_TIMER, BUCKETS
+from threading import Thread
+import instrument
+import pytest
+
+@pytest.fixture
+def instrumentation():
+    '''
+    Runs a test with the instrumentation enabled and empty, restoring it afterwards.
+    '''
+
+    enabled = instrument.enabled
+
+    instrument.reset()
+    instrument.enable()
+
+    yield
+
+    instrument.reset()
+
+    if not enabled:
+        instrument.disable()
+
+def test_durations_fall_in_power_of_two_buckets():
+
+    histogram = Histogram('h')
+
+    # Bucket i holds the durations under 2^i microseconds
+
+    for seconds in (0.0, 1e-6, 3e-6, 4e-6, 1e6):
+
+        histogram.record(seconds)
+
+    buckets = histogram.snapshot()['buckets']
+
+    assert len(buckets) == BUCKETS
+    assert (buckets[0], buckets[1], buckets[2], buckets[3], buckets[BUCKETS - 1]) == (1, 1, 1, 1, 1)
+    assert sum(buckets) == 5
+
+def test_quantiles_are_bucket_upper_bounds():
+
+    histogram = Histogram('h')
+
+    for _ in range(90):
+
+        histogram.record(10e-6)
+
+    for _ in range(10):
+
+        histogram.record(1000e-6)
+
+    summary = histogram.snapshot()
+
+    assert summary['count'] == 100 and summary['sum'] == pytest.approx(90 * 10e-6 + 10 * 1000e-6)
+    assert (summary['p50'], summary['p90'], summary['p99']) == (16e-6, 16e-6, 1024e-6)
+
+    assert Histogram('empty').snapshot()['p99'] == 0.0
+
+def test_shards_of_ended_threads_are_folded():
+
+    counter = Counter('c')
+
+    counter.add(2)
+
+    threads = [Thread(target=counter.add, args=(3,)) for _ in range(4)]
+
+    for thread in threads:
+
+        thread.start()
+        thread.join()
+
+    # The ended threads are folded into the retired shard, without losing their counts
+
+    assert counter.value() == 14
+    assert counter.value() == 14
+
+    counter.add()
+
+    assert counter.value() == 15
+
+def test_disabled_hooks_record_nothing(instrumentation):
+
+    instrument.disable()
+
+    assert instrument.timer('op') is NULL_TIMER
+
+    instrument.timer('op').lap('phase')
+    instrument.count('events')
+
+    assert instrument.snapshot() == {'histograms': {}, 'counters': {}}
+
+    # Enabled, the same hooks record
+
+    instrument.enable()
+
+    timer = instrument.timer('op')
+
+    assert isinstance(timer, PhaseTimer)
+
+    timer.lap('phase')
+    timer.stop()
+    instrument.count('events', 2)
+
+    recorded = instrument.snapshot()
+
+    assert sorted(recorded['histograms']) == ['op', 'op.phase']
+    assert recorded['histograms']['op']['count'] == 1
+    assert recorded['counters'] == {'events': 2}
@@ -0,0 +1,137 @@
+from metrics import MetricsRegistry, MetricsServer
+from gateway import Uplink
+from handler import Handler
+from controller import Controller
+from setup import provision
+from rng import Randomness
+from threading import Thread
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import time
+import pytest
+
+def test_labels_are_escaped():
+
+    registry = MetricsRegistry()
+
+    counter = registry.counter('requests_total', 'Requests.', ('path',))
+    counter.labels('a"b\\c\nd').add(2)
+    counter.labels('plain').add()
+
+    lines = registry.render().splitlines()
+
+    assert lines[0:2] == ['# HELP requests_total Requests.', '# TYPE requests_total counter']
+    assert 'requests_total{path="a\\"b\\\\c\\nd"} 2' in lines
+    assert 'requests_total{path="plain"} 1' in lines
+
+def test_histogram_buckets_are_cumulative():
+
+    registry = MetricsRegistry()
+
+    histogram = registry.histogram('op_seconds', 'Operations.')
+
+    # Bucket i holds the durations under 2^i microseconds
+
+    for seconds in (0.5e-6, 1.5e-6, 1.5e-6, 3e-6, 1e6):
+
+        histogram.record(seconds)
+
+    lines = registry.render().splitlines()
+
+    assert 'op_seconds_bucket{le="1e-06"} 1' in lines
+    assert 'op_seconds_bucket{le="2e-06"} 3' in lines
+    assert 'op_seconds_bucket{le="4e-06"} 4' in lines
+    assert 'op_seconds_bucket{le="+Inf"} 5' in lines
+    assert 'op_seconds_count 5' in lines
+
+    # Every bucket holds the ones before it
+
+    counts = [int(line.split()[-1]) for line in lines if line.startswith('op_seconds_bucket')]
+
+    assert counts == sorted(counts) and counts[-1] == 5
+
+def test_gauges_are_replaced_and_counters_kept():
+
+    registry = MetricsRegistry()
+
+    registry.gauge('depth', 'Depth.', lambda: 1)
+    registry.gauge('depth', 'Depth.', lambda: {('bulk',): 3, ('alarm',): 0}, ('lane',))
+
+    first = registry.counter('events_total', 'Events.')
+    first.inc()
+
+    # A counter registered again is the same one, another type is an error
+
+    assert registry.counter('events_total', 'Events.') is first
+
+    with pytest.raises(ValueError):
+        registry.gauge('events_total', 'Events.', lambda: 0)
+
+    lines = registry.render().splitlines()
+
+    assert 'depth 1' not in lines
+    assert 'depth{lane="bulk"} 3' in lines and 'depth{lane="alarm"} 0' in lines
+    assert lines.count('# TYPE depth gauge') == 1
+    assert 'events_total 1' in lines
+
+def test_metrics_are_served_over_http():
+
+    registry = MetricsRegistry()
+    registry.counter('events_total', 'Events.').inc(4)
+
+    server = MetricsServer(registry, port = 0)
+    server.start()
+
+    url = f'http://127.0.0.1:{server.get_port()}'
+
+    try:
+
+        with urlopen(url + '/metrics', timeout = 5) as response:
+
+            assert response.status == 200
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert 'events_total 4' in response.read().decode().splitlines()
+
+        with pytest.raises(HTTPError) as error:
+            urlopen(url + '/other', timeout = 5)
+
+        assert error.value.code == 404
+
+    finally:
+
+        server.stop()
+
+def test_handler_counts_the_vault_writes(workdir):
+
+    provision(9, Randomness(0))
+
+    controller = Controller()
+    controller.create_int_sensor(-120, 120)
+    controller.create_float_sensor(0, 100, 0.01)
+
+    registry = MetricsRegistry()
+
+    handler = Handler({1: {'auth': None, 'controller': controller}, 9: {'auth': None, 'controller': None, 'devices': {1}}}, 'localhost', 0, registry = registry)
+    Thread(target=handler.run_server, daemon=True).start()
+
+    time.sleep(0.05)
+
+    uplink = Uplink(9, 'localhost', handler.get_port(), rng = Randomness(1))
+
+    # Enough batches for the session of the gateway to end, rotating the server vault
+
+    for i in range(10):
+
+        uplink.add(1, 7, 0, controller.information_to_bytes(0, [i, 0.5]), float(i))
+
+        assert uplink.flush() == 1
+
+    # The vault and its rotation history were written once per session that ended
+
+    sessions = uplink.get_stats()['handshakes'] - 1
+
+    assert sessions >= 1
+    assert 'iot_vault_writes_total ' + str(2 * sessions) in registry.render().splitlines()
+
+    uplink.close()
+    handler.close()
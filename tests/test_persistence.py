@@ -0,0 +1,135 @@
+from authenticator import Authenticator, PATH_DV_VAULTS, JOURNAL_SUFFIX
+from persistence import PersistencePolicy, VaultJournal, JOURNAL_ENTRY_SIZE, ROLLBACK_SIZE
+from crypto import generate_key
+from setup import provision
+from rng import Randomness
+import os, shutil
+
+# Never persisted by the cadence, so the rotations stay in the journal
+
+JOURNALED = PersistencePolicy(1000, None, False)
+
+def vault_of(authenticator: Authenticator) -> list:
+
+    return list(getattr(authenticator, '_Authenticator__vault'))
+
+def rotated(rotations: int) -> Authenticator:
+
+    provision(1, Randomness(0))
+
+    authenticator = Authenticator(1, True, rng = Randomness(1), persistence = JOURNALED)
+
+    for _ in range(rotations):
+
+        authenticator.reset()
+
+    return authenticator
+
+def test_journal_replays_the_rotations(workdir):
+
+    device = rotated(5)
+
+    # The entries only read with the device key
+
+    assert len(VaultJournal(PATH_DV_VAULTS + '1' + JOURNAL_SUFFIX, generate_key(32)).entries()) == 0
+    assert os.path.getsize(PATH_DV_VAULTS + '1' + JOURNAL_SUFFIX) == 5 * JOURNAL_ENTRY_SIZE
+
+    reloaded = Authenticator(1, True, persistence = JOURNALED)
+
+    assert reloaded.get_generation() == 5
+    assert vault_of(reloaded) == vault_of(device)
+
+def test_torn_entry_is_ignored(workdir):
+
+    device = rotated(3)
+    expected = vault_of(device)
+
+    # A crash while appending the fourth rotation leaves part of its entry
+
+    with open(PATH_DV_VAULTS + '1' + JOURNAL_SUFFIX, 'ab') as file:
+
+        file.write(os.urandom(JOURNAL_ENTRY_SIZE // 2))
+
+    reloaded = Authenticator(1, True, persistence = JOURNALED)
+
+    assert reloaded.get_generation() == 3
+    assert vault_of(reloaded) == expected
+
+    # The next rotation goes on from the replayed vault, as the original would have
+
+    device.reset()
+    reloaded.reset()
+
+    assert vault_of(reloaded) == vault_of(device)
+
+def test_unreadable_entry_ends_the_replay(workdir):
+
+    rotated(3)
+
+    path = PATH_DV_VAULTS + '1' + JOURNAL_SUFFIX
+
+    with open(path, 'r+b') as file:
+
+        file.seek(JOURNAL_ENTRY_SIZE + 20)
+        file.write(b'\x00')
+
+    assert Authenticator(1, True, persistence = JOURNALED).get_generation() == 1
+
+def test_crash_between_the_rename_and_the_trim(workdir):
+
+    device = rotated(4)
+    expected = vault_of(device)
+
+    journal = PATH_DV_VAULTS + '1' + JOURNAL_SUFFIX
+
+    shutil.copy(journal, 'journal')
+
+    device.persist()
+
+    assert os.path.getsize(journal) == min(4, ROLLBACK_SIZE) * JOURNAL_ENTRY_SIZE
+
+    # The vault was renamed into place with its generation, but the journal wasn't trimmed
+
+    shutil.copy('journal', journal)
+
+    reloaded = Authenticator(1, True, persistence = JOURNALED)
+
+    assert reloaded.get_generation() == 4
+    assert vault_of(reloaded) == expected
+
+def test_crash_before_the_rename(workdir):
+
+    device = rotated(2)
+    expected = vault_of(device)
+
+    # A temporary vault that was never renamed is ignored, the old vault and the journal rebuild the rotations
+
+    with open(PATH_DV_VAULTS + '1.tmp', 'wb') as file:
+
+        file.write(os.urandom(100))
+
+    reloaded = Authenticator(1, True, persistence = JOURNALED)
+
+    assert reloaded.get_generation() == 2
+    assert vault_of(reloaded) == expected
+
+def test_journal_is_trimmed_after_the_vault_is_persisted(workdir):
+
+    provision(1, Randomness(0))
+
+    device = Authenticator(1, True, rng = Randomness(1), persistence = PersistencePolicy(2, None, False))
+
+    journal = VaultJournal(PATH_DV_VAULTS + '1' + JOURNAL_SUFFIX, getattr(device, '_Authenticator__vaultKey'))
+
+    for _ in range(2 * ROLLBACK_SIZE):
+
+        device.reset()
+
+    # The vault holds every rotation, the journal only the last ones (to roll back), which aren't replayed
+
+    assert [entry[0:2] for entry in journal.entries()] == [(generation, generation - 1) for generation in range(ROLLBACK_SIZE + 1, 2 * ROLLBACK_SIZE + 1)]
+
+    reloaded = Authenticator(1, True, persistence = JOURNALED)
+
+    assert reloaded.get_generation() == 2 * ROLLBACK_SIZE
+    assert vault_of(reloaded) == vault_of(device)
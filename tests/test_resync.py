@@ -0,0 +1,172 @@
+from authenticator import Authenticator, VaultOutOfSync, TIME_TO_LIVE
+from persistence import PersistencePolicy, ROLLBACK_SIZE, EVERY_ROTATION
+from handshake import run_handshake
+from handler import Handler
+from message import Message
+from metrics import MetricsRegistry
+from config_dv import thermo
+from setup import provision
+from rng import Randomness
+from threading import Thread
+from test_handshake import MemoryServer
+from test_sessions import connect
+import pytest, time
+
+def vault_of(authenticator: Authenticator) -> list:
+
+    return list(getattr(authenticator, '_Authenticator__vault'))
+
+def session(device: Authenticator, messages: int, received: int) -> Authenticator:
+    '''
+    Runs a session of the device with a fresh server, which receives only the first messages.
+    '''
+
+    server = MemoryServer()
+
+    run_handshake(device, server.write, server.read)
+
+    for i in range(messages):
+
+        msg = device.encrypt(bytes([i]))
+
+        if i < received:
+
+            server.auth.decrypt(msg)
+
+    # The server rotates once it received the whole session, as the Handler does
+
+    if server.auth.time_lived() == TIME_TO_LIVE:
+
+        server.auth.reset()
+
+    return server.auth
+
+@pytest.mark.parametrize('policy', [PersistencePolicy(1000, None, False), EVERY_ROTATION])
+def test_device_ahead_rolls_back(workdir, policy):
+
+    provision(1, Randomness(0))
+
+    device = Authenticator(1, True, rng = Randomness(2), persistence = policy)
+
+    # The last reading of the session is lost in flight, so only the device rotates
+
+    session(device, TIME_TO_LIVE, TIME_TO_LIVE - 1)
+
+    device.reset()
+
+    assert device.get_generation() == 1
+
+    server = session(device, 1, 1)
+
+    assert device.get_generation() == server.get_generation() == 0
+    assert vault_of(device) == vault_of(server)
+
+    # The rollback is persisted, the undone rotation isn't replayed
+
+    assert Authenticator(1, True, persistence = policy).get_generation() == 0
+
+def test_device_behind_rolls_forward(workdir):
+
+    provision(1, Randomness(0))
+
+    device = Authenticator(1, True, rng = Randomness(2))
+
+    # The server rotates, the device drops the session before it rotates
+
+    server = session(device, TIME_TO_LIVE, TIME_TO_LIVE)
+
+    assert server.get_generation() == 1
+
+    device = Authenticator(1, True, rng = Randomness(3))
+
+    server = session(device, 1, 1)
+
+    assert device.get_generation() == server.get_generation() == 1
+    assert vault_of(device) == vault_of(server)
+
+def test_device_ahead_past_the_journal_is_out_of_sync(workdir):
+
+    provision(1, Randomness(0))
+
+    device = Authenticator(1, True, rng = Randomness(2), persistence = EVERY_ROTATION)
+
+    for _ in range(ROLLBACK_SIZE + 1):
+
+        device.reset()
+
+    with pytest.raises(VaultOutOfSync):
+        session(device, 1, 1)
+
+    # The vault is left as it was
+
+    assert device.get_generation() == ROLLBACK_SIZE + 1
+
+def test_lost_reading_resyncs_with_the_handler(workdir):
+
+    provision(1, Randomness(0))
+
+    handler = Handler({1: {'auth': None, 'controller': thermo}}, 'localhost', 0, registry = MetricsRegistry())
+    Thread(target=handler.run_server, daemon=True).start()
+
+    device = Authenticator(1, True, rng = Randomness(2))
+
+    # The ninth reading of the first session never reaches the server
+
+    connection = connect(handler)
+
+    run_handshake(device, lambda msg: msg.write_bytes(connection), lambda: Message.read_bytes(connection))
+
+    for i in range(TIME_TO_LIVE):
+
+        msg = device.encrypt(thermo.read_device_bytes(None))
+
+        if i < TIME_TO_LIVE - 1:
+
+            msg.write_bytes(connection)
+
+    connection.close()
+
+    device.reset()
+
+    # The next session rolls the device back to the server instead of failing
+
+    deadline = time.monotonic() + 5
+
+    while True:
+
+        connection = connect(handler)
+
+        try:
+
+            run_handshake(device, lambda msg: msg.write_bytes(connection), lambda: Message.read_bytes(connection))
+
+            break
+
+        except (ConnectionError, OSError):
+
+            # The server may not have dropped the first session yet
+
+            connection.close()
+
+            assert time.monotonic() < deadline
+
+            device = Authenticator(1, True, rng = Randomness(3))
+
+            time.sleep(0.05)
+
+    device.encrypt(thermo.read_device_bytes(None)).write_bytes(connection)
+
+    assert device.get_generation() == 0
+
+    for _ in range(100):
+
+        if len(list(handler.rows(1))) == TIME_TO_LIVE:
+            break
+
+        handler.flush(1)
+        time.sleep(0.02)
+
+    assert len(list(handler.rows(1))) == TIME_TO_LIVE
+
+    connection.close()
+    handler.close()
@@ -0,0 +1,166 @@
+from storage import SegmentStore
+from retention import RetentionPolicy, Compactor, ROLLUPS_HEADER, ROLLUPS_MAGIC, ROLLUPS_VERSION
+from controller import Controller
+import math, time
+import storage
+import pytest
+
+def make_store(path) -> SegmentStore:
+
+    controller = Controller()
+    controller.create_int_sensor(0, 100)
+
+    store = SegmentStore(str(path), segment_records = 4, sync_interval = 60)
+    store.register_device(1, controller)
+
+    return store
+
+def test_rollups_leave_failed_readings_out(tmp_path):
+
+    store = make_store(tmp_path)
+
+    for i, reading in enumerate([10, None, 30, None, None]):
+
+        store.append(1, 7, 0, [reading], 100.0 * i)
+
+    store.close()
+
+    store = make_store(tmp_path)
+
+    compactor = Compactor(store, RetentionPolicy(raw_seconds = 10, rollup_interval = 1000))
+    compactor.step(now = 10000.0)
+
+    rollup, = compactor.rollups(1)
+
+    assert rollup['count'] == 5
+    assert (rollup['sensor_0_min'], rollup['sensor_0_max'], rollup['sensor_0_mean'], rollup['sensor_0_count']) == (10.0, 30.0, 20.0, 2)
+
+    store.close()
+
+def test_rollups_of_a_sensor_that_always_failed(tmp_path):
+
+    store = make_store(tmp_path)
+
+    store.append(1, 7, 0, [None], 0.0)
+
+    store.close()
+
+    store = make_store(tmp_path)
+
+    compactor = Compactor(store, RetentionPolicy(raw_seconds = 10, rollup_interval = 1000))
+    compactor.step(now = 10000.0)
+
+    rollup, = compactor.rollups(1)
+
+    assert rollup['sensor_0_count'] == 0 and math.isnan(rollup['sensor_0_mean'])
+
+    store.close()
+
+def fill_store(path, readings: int = 6) -> SegmentStore:
+
+    store = make_store(path)
+
+    for i in range(readings):
+
+        store.append(1, 7, 0, [i], 100.0 * i)
+
+    store.close()
+
+    return make_store(path)
+
+def test_rollups_have_a_versioned_header(tmp_path):
+
+    store = fill_store(tmp_path)
+
+    Compactor(store, RetentionPolicy(raw_seconds = 10, rollup_interval = 1000)).step(now = 10000.0)
+
+    data = store.read_rollups(1)
+    magic, version, size = ROLLUPS_HEADER.unpack_from(data)
+
+    assert (magic, version) == (ROLLUPS_MAGIC, ROLLUPS_VERSION)
+    assert (len(data) - ROLLUPS_HEADER.size) == 2 * size
+
+    # Rollups of another version are refused
+
+    store.write_rollups(1, ROLLUPS_HEADER.pack(ROLLUPS_MAGIC, ROLLUPS_VERSION + 1, 0), False)
+
+    with pytest.raises(ValueError):
+
+        Compactor(store, RetentionPolicy()).rollups(1)
+
+    store.close()
+
+def test_crash_between_rollups_and_swap_doesnt_double_count(tmp_path, monkeypatch):
+
+    store = fill_store(tmp_path)
+
+    compactor = Compactor(store, RetentionPolicy(raw_seconds = 10, rollup_interval = 1000))
+
+    # Crash right after the rollups of the first segment are written
+
+    def crash(*args, **kwargs):
+        raise OSError('crash')
+
+    monkeypatch.setattr(store, 'replace_segments', crash)
+
+    assert compactor.step(now = 10000.0)['errors'] == 1
+
+    store.close()
+
+    store = make_store(tmp_path)
+
+    compactor = Compactor(store, RetentionPolicy(raw_seconds = 10, rollup_interval = 1000))
+    compactor.step(now = 10000.0)
+
+    rollup, = compactor.rollups(1)
+
+    assert rollup['count'] == 6 and rollup['sensor_0_count'] == 6
+    assert store.sealed_segments(1) == []
+
+    store.close()
+
+def test_crash_after_the_merged_segment_is_renamed_doesnt_duplicate_readings(tmp_path, monkeypatch):
+
+    store = fill_store(tmp_path)
+
+    assert [segment.count for segment in store.sealed_segments(1)] == [4, 2]
+
+    # Crash right after the merged segment took the place of the first one, before the second one is removed
+
+    def crash(*args, **kwargs):
+        raise OSError('crash')
+
+    monkeypatch.setattr(storage.os, 'remove', crash)
+
+    assert Compactor(store, RetentionPolicy(raw_seconds = math.inf)).step(now = 1000.0)['errors'] == 1
+
+    monkeypatch.undo()
+
+    # The next start finishes the swap
+
+    store = make_store(tmp_path)
+
+    assert [segment.count for segment in store.sealed_segments(1)] == [6]
+    assert list(store.read(1)['time']) == [100.0 * i for i in range(6)]
+
+    store.close()
+
+def test_background_compaction_survives_errors(tmp_path, monkeypatch):
+
+    store = fill_store(tmp_path)
+
+    compactor = Compactor(store, RetentionPolicy(raw_seconds = 0), interval = 0.01)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('disk')
+
+    monkeypatch.setattr(store, 'get_device_ids', fail)
+
+    compactor.start()
+
+    time.sleep(0.1)
+
+    assert compactor.get_stats()['errors'] > 1 and isinstance(compactor.get_last_error(), RuntimeError)
+
+    compactor.stop()
+    store.close()
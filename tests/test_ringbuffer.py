@@ -0,0 +1,97 @@
+from ringbuffer import HotTier, INITIAL_CAPACITY
+from storage import RECORD_HEADER
+from controller import Controller
+
+def make_thermo() -> Controller:
+
+    controller = Controller()
+    controller.create_int_sensor(-120, 120)
+    controller.create_float_sensor(0, 100, 0.01)
+
+    return controller
+
+def test_many_devices_fit_under_the_cap():
+
+    controller = make_thermo()
+    hot = HotTier(16 * 1024 * 1024)
+
+    for device_id in range(2000):
+
+        hot.register_device(device_id, controller)
+
+    # Nothing is allocated before the readings come in, and each device gets its share
+
+    assert hot.memory_usage() == 0
+    assert hot.get_capacity(0) == 16 * 1024 * 1024 // 2000 // (RECORD_HEADER.size + controller.get_reading_size())
+
+    for device_id in range(2000):
+
+        hot.append(device_id, 1, 0, [1, 2.0], 1.0)
+
+    assert hot.memory_usage() <= 16 * 1024 * 1024
+
+def test_rings_grow_up_to_their_share_keeping_the_order():
+
+    controller = make_thermo()
+    spilled = []
+
+    hot = HotTier(1 << 20, capacity = 40, spill = lambda *reading: spilled.append(reading[4]))
+    hot.register_device(1, controller)
+
+    for i in range(50):
+
+        hot.append(1, 1, 0, [i, 0.5], float(i))
+
+    assert hot.get_stats()['capacity'] == 40 > INITIAL_CAPACITY
+    assert [entry['time'] for entry in hot.entries(1)] == [float(i) for i in range(10, 50)]
+    assert spilled == [float(i) for i in range(10)]
+
+def test_device_without_a_share_spills_everything():
+
+    controller = make_thermo()
+    spilled = []
+
+    hot = HotTier(1, spill = lambda *reading: spilled.append(reading[0]))
+    hot.register_device(1, controller)
+
+    hot.append(1, 1, 0, [1, 2.0], 1.0)
+
+    assert hot.last(1, 1) == [] and spilled == [1]
+
+def test_rings_shrink_when_more_devices_register():
+
+    controller = make_thermo()
+    width = RECORD_HEADER.size + controller.get_reading_size()
+    spilled = []
+
+    hot = HotTier(200 * width, capacity = 1000, spill = lambda *reading: spilled.append((reading[0], reading[4])))
+
+    for device_id in range(2):
+
+        hot.register_device(device_id, controller)
+
+    # Both devices fill their share of the cap
+
+    for i in range(100):
+
+        for device_id in range(2):
+
+            hot.append(device_id, 1, 0, [i, 0.5], float(i))
+
+    assert hot.get_stats()['readings'] == 200 and spilled == []
+
+    # Doubling the devices halves the shares, the oldest readings are spilled
+
+    for device_id in range(2, 4):
+
+        hot.register_device(device_id, controller)
+
+    for i in range(100):
+
+        for device_id in range(2, 4):
+
+            hot.append(device_id, 1, 0, [i, 0.5], float(i))
+
+    assert hot.memory_usage() <= 200 * width
+    assert [entry['time'] for entry in hot.entries(0)] == [float(i) for i in range(50, 100)]
+    assert sorted(spilled)[0:50] == [(0, float(i)) for i in range(50)]
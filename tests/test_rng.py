@@ -0,0 +1,60 @@
+from rng import Randomness, get_default
+from crypto import generate_key, generate_keys
+from challenge import Challenge
+from controller import Controller
+
+def draws(rng: Randomness) -> tuple:
+    '''
+    Draws a vault, a key, a challenge and some readings from a source.
+    '''
+
+    controller = Controller()
+    controller.create_int_sensor(-120, 120)
+    controller.create_float_sensor(0, 100, 0.01)
+    controller.set_rng(rng)
+
+    readings = []
+
+    for _ in range(5):
+
+        controller.change_state()
+        readings.append(controller.read_device_bytes(None))
+
+    return generate_keys(8, 32, rng), generate_key(32, rng), Challenge(8, rng = rng).to_bytes(), readings
+
+def test_the_same_seed_draws_the_same_values():
+
+    assert draws(Randomness(7)) == draws(Randomness(7))
+    assert draws(Randomness(7)) != draws(Randomness(8))
+
+def test_derived_sources_are_independent_and_reproducible():
+
+    rng = Randomness(7)
+
+    first, second = rng.derive(1, 'sensors'), rng.derive(2, 'sensors')
+
+    # The draws of one source don't move the other, whatever the order they are taken in
+
+    expected = Randomness(7).derive(2, 'sensors').bytes(32)
+
+    first.bytes(1000)
+
+    assert second.bytes(32) == expected
+    assert first.get_seed() != second.get_seed()
+
+    # Deriving doesn't draw from the parent, and gives the same source every time
+
+    assert rng.bytes(32) == Randomness(7).bytes(32)
+    assert rng.derive(1, 'sensors').bytes(32) == Randomness(7).derive(1, 'sensors').bytes(32)
+    assert Randomness(7).derive(1, 'sensors').bytes(32) != Randomness(8).derive(1, 'sensors').bytes(32)
+
+def test_the_default_source_is_not_seeded():
+
+    rng = get_default()
+
+    assert not rng.is_seeded() and rng.get_seed() is None
+
+    # The CSPRNG derives itself, its draws don't repeat
+
+    assert rng.derive(1, 'sensors') is rng
+    assert Randomness().bytes(32) != Randomness().bytes(32)
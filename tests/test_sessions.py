@@ -0,0 +1,177 @@
+from handler import Handler, SESSIONS_HEADER, SESSIONS_MAGIC, SESSIONS_VERSION, SESSION_ENTRY, NO_PREVIOUS
+from authenticator import Authenticator
+from handshake import run_handshake
+from metrics import MetricsRegistry
+from config_dv import thermo
+from crypto import generate_key
+from setup import provision
+from rng import Randomness
+from socket import create_connection
+from threading import Thread
+from cryptography.exceptions import InvalidTag
+from test_handshake import MemoryServer
+import pytest, time
+
+SEAL_KEY = bytes(range(32))
+
+def make_handler(device_ids) -> Handler:
+
+    return Handler({device_id: {'auth': None, 'controller': thermo} for device_id in device_ids}, 'localhost', 0, registry = MetricsRegistry())
+
+def sessions_of(handler: Handler) -> dict:
+
+    return {device_id: device['auth'] for device_id, device in getattr(handler, '_Handler__devices').items() if device['auth'] is not None}
+
+def authenticated(device_id: int) -> tuple[Authenticator, bytes]:
+    '''
+    Runs a handshake in memory, returning the device and the exported session of the server.
+    '''
+
+    provision(device_id, Randomness(device_id))
+
+    device = Authenticator(device_id, True, rng = Randomness(100 + device_id))
+    server = MemoryServer()
+
+    run_handshake(device, server.write, server.read)
+
+    return device, server.auth.export_state(SEAL_KEY)
+
+def connect(handler: Handler):
+    '''
+    Connects to a worker, once its server thread listens.
+    '''
+
+    for _ in range(100):
+
+        try:
+
+            return create_connection(('localhost', handler.get_port()))
+
+        except ConnectionRefusedError:
+
+            time.sleep(0.02)
+
+    return create_connection(('localhost', handler.get_port()))
+
+def pack(states: list) -> bytes:
+
+    return SESSIONS_HEADER.pack(SESSIONS_MAGIC, SESSIONS_VERSION, len(states)) + b''.join(SESSION_ENTRY.pack(len(state), NO_PREVIOUS) + state for state in states)
+
+def test_sessions_round_trip_between_workers(workdir):
+
+    devices = dict()
+    states = []
+
+    for device_id in (1, 2):
+
+        devices[device_id], state = authenticated(device_id)
+        states.append(state)
+
+    first, second = make_handler([1, 2]), make_handler([1, 2])
+
+    assert first.import_sessions(pack(states), SEAL_KEY) == 2
+
+    data = first.export_sessions(SEAL_KEY)
+
+    assert sessions_of(first) == {}
+    assert second.import_sessions(data, SEAL_KEY) == 2
+    assert set(sessions_of(second)) == {1, 2}
+
+    # The devices go on with their sessions on the second worker, without a handshake
+
+    Thread(target=second.run_server, daemon=True).start()
+
+    for device_id, device in devices.items():
+
+        connection = connect(second)
+
+        device.encrypt(thermo.read_device_bytes(None)).write_bytes(connection)
+
+        for _ in range(100):
+
+            second.flush(1)
+
+            if list(second.rows(device_id)):
+                break
+
+            time.sleep(0.02)
+
+        assert len(list(second.rows(device_id))) == 1
+
+        connection.close()
+
+    first.close()
+    second.close()
+
+def test_export_only_the_given_devices(workdir):
+
+    states = [authenticated(device_id)[1] for device_id in (1, 2, 3)]
+
+    handler, other = make_handler([1, 2, 3]), make_handler([1, 2, 3])
+
+    handler.import_sessions(pack(states), SEAL_KEY)
+
+    assert other.import_sessions(handler.export_sessions(SEAL_KEY, {1, 3}), SEAL_KEY) == 2
+
+    assert set(sessions_of(handler)) == {2}
+    assert set(sessions_of(other)) == {1, 3}
+
+    handler.close()
+    other.close()
+
+def rejected(handler: Handler, data: bytes, error, key: bytes = SEAL_KEY) -> None:
+    '''
+    Checks an import fails without changing the running sessions.
+    '''
+
+    before = sessions_of(handler)
+
+    with pytest.raises(error):
+        handler.import_sessions(data, key)
+
+    assert sessions_of(handler) == before
+
+def test_invalid_sessions_change_nothing(workdir):
+
+    states = [authenticated(device_id)[1] for device_id in (1, 2, 3)]
+
+    handler = make_handler([1, 2, 3])
+
+    handler.import_sessions(pack(states[0:1]), SEAL_KEY)
+
+    # A session of a device the worker doesn't serve, after a valid one
+
+    other = make_handler([1, 2, 3, 9])
+    other.import_sessions(pack([authenticated(9)[1]]), SEAL_KEY)
+    unknown = other.export_sessions(SEAL_KEY)[SESSIONS_HEADER.size + SESSION_ENTRY.size:]
+
+    rejected(handler, pack([states[1], unknown]), KeyError)
+
+    # The device identifier in the clear header moved to another device
+
+    tampered = bytearray(states[2])
+    tampered[5:9] = (1).to_bytes(4, 'little')
+
+    rejected(handler, pack([states[1], bytes(tampered)]), ValueError)
+
+    # The sealed part altered
+
+    tampered = bytearray(states[2])
+    tampered[-1] ^= 1
+
+    rejected(handler, pack([states[1], bytes(tampered)]), InvalidTag)
+
+    # Another key, a truncated export, trailing data, a duplicated device and an unknown version
+
+    rejected(handler, pack(states[1:3]), InvalidTag, generate_key(32))
+    rejected(handler, pack(states[1:3])[:-10], ValueError)
+    rejected(handler, pack(states[1:3]) + b'\x00', ValueError)
+    rejected(handler, pack([states[1], states[1]]), ValueError)
+    rejected(handler, SESSIONS_HEADER.pack(SESSIONS_MAGIC, SESSIONS_VERSION + 1, 0), ValueError)
+    rejected(handler, pack(states[1:3])[0:5], ValueError)
+
+    assert handler.import_sessions(pack(states[1:3]), SEAL_KEY) == 2
+    assert set(sessions_of(handler)) == {1, 2, 3}
+
+    handler.close()
+    other.close()
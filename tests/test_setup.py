@@ -0,0 +1,28 @@
+from setup import allocate, provision, provision_bulk, provisioned, MAX_DEVICE_ID
+import pytest
+
+def test_allocate_never_hands_out_the_server_identifier():
+
+    assert allocate(3, set(), start=1) == [1, 2, 3]
+
+    for start in (0, -5, MAX_DEVICE_ID + 1):
+
+        with pytest.raises(ValueError):
+            allocate(1, set(), start=start)
+
+def test_allocate_skips_taken_identifiers():
+
+    assert allocate(3, {2, 3}, start=1) == [1, 4, 5]
+
+    with pytest.raises(ValueError):
+        allocate(2, set(), start=MAX_DEVICE_ID)
+
+def test_bulk_provisioning_rejects_the_server_identifier(workdir):
+
+    with pytest.raises(ValueError):
+        provision_bulk(2, 'thermo', workers=1, start=0, registry='registry.txt')
+
+    with pytest.raises(ValueError):
+        provision(0)
+
+    assert provisioned() == set()
@@ -1,3 +1,5 @@
+import os
+
 def read_file_bytes(path: str) -> bytes:
     '''
     Reads the bynary information of a file given its path.
@@ -73,4 +75,33 @@ def bytes_list_to_bytes(data: list) -> bytes:
 
         final += info
 
-    return final
\ No newline at end of file
+    return final
+
+def write_file_atomic(data: bytes, path: str, sync: bool = True) -> None:
+    '''
+    Writes bynary information to a file given its path, replacing it at once so a crash leaves either the old
+    or the new content.
+
+    Args:
+        data (bytes): The binary information for writing.
+        path (str): The path of the file desired for writing.
+        sync (bool) = True: If the data is flushed to the storage before the file is replaced.
+
+    Return:
+        None: The data is written on the file.
+    '''
+
+    # Write a temporary file next to the target and move it over the target
+
+    tmp = path + '.tmp'
+
+    with open(tmp, 'wb') as file:
+
+        file.write(data)
+
+        if sync:
+
+            file.flush()
+            os.fsync(file.fileno())
+
+    os.replace(tmp, path)